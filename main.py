@@ -5,22 +5,71 @@
 # Требует: pip install pyTelegramBotAPI Flask gunicorn psycopg2-binary
 
 import os
+import sys
 import time
+import calendar
+import io
+import csv
+import json
+import zlib
+import tempfile
+import shutil
+import re
+import hashlib
+import random
+import bisect
 import logging
+import threading
+import weakref
+import queue
+import atexit
+import functools
+import heapq
+import itertools
+import glob
+import cProfile
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import timedelta
-from flask import Flask, request, abort
+from flask import Flask, Response, request, abort, stream_with_context
+try:
+    import fcntl
+except ImportError:
+    # без flock (Windows) файлы spool / журнала защищены только от потоков своего процесса
+    fcntl = None
+
+# воспроизведение журнала апдейтов (python main.py --replay <каталог|файлы> [--speed N]): всегда чистая
+# временная база (Postgres — только явно заданный REPLAY_DATABASE_URL) и фейковый Bot API
+REPLAY_MODE = "--replay" in sys.argv
+if REPLAY_MODE:
+    REPLAY_DIR = tempfile.mkdtemp(prefix="teleform-replay-")
+    atexit.register(shutil.rmtree, REPLAY_DIR, True)
 
 # DB drivers (Postgres optional)
-DATABASE_URL = os.environ.get("DATABASE_URL")
+DATABASE_URL = os.environ.get("REPLAY_DATABASE_URL") if REPLAY_MODE else os.environ.get("DATABASE_URL")
 USE_PG = bool(DATABASE_URL)
 
 if USE_PG:
     import psycopg2
+    import psycopg2.pool
+    # таймауты: недоступная БД не должна подвешивать обработчики (0 — без ограничения)
+    PG_CONNECT_TIMEOUT = int(os.environ.get("PG_CONNECT_TIMEOUT", 5))
+    PG_STATEMENT_TIMEOUT_MS = int(os.environ.get("PG_STATEMENT_TIMEOUT_MS", 15000))
+    # TCP keepalive: оборванное без FIN соединение (NAT, failover) обнаруживается за idle + interval * count сек,
+    # а не висит до таймаута ядра — важно для долгоживущих соединений вроде слушателя инвалидации
+    PG_KEEPALIVES_IDLE = int(os.environ.get("PG_KEEPALIVES_IDLE", 30))
+    PG_KEEPALIVES_INTERVAL = int(os.environ.get("PG_KEEPALIVES_INTERVAL", 10))
+    PG_KEEPALIVES_COUNT = int(os.environ.get("PG_KEEPALIVES_COUNT", 3))
+
+    def pg_connect():
+        return psycopg2.connect(DATABASE_URL, connect_timeout=PG_CONNECT_TIMEOUT,
+                                keepalives=1, keepalives_idle=PG_KEEPALIVES_IDLE,
+                                keepalives_interval=PG_KEEPALIVES_INTERVAL, keepalives_count=PG_KEEPALIVES_COUNT,
+                                options=f"-c statement_timeout={PG_STATEMENT_TIMEOUT_MS}")
+
     # connect to Postgres
     try:
-        pg_conn = psycopg2.connect(DATABASE_URL)
-        db = pg_conn
-        cur = db.cursor()
+        pg_conn = pg_connect()
         logger = logging.getLogger(__name__)
         logger.info("Using PostgreSQL database")
     except Exception as e:
@@ -28,6 +77,23 @@ if USE_PG:
 else:
     import sqlite3
 
+# быстрый JSON-декодер (опционально): pip install orjson
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    import sre_parse, sre_constants
+
+# автомат Aho-Corasick на C для правил автомодерации (опционально): pip install pyahocorasick
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 import telebot
 from telebot import types
 
@@ -35,30 +101,1093 @@ from telebot import types
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# ========== МЕТРИКИ ==========
+# простые счётчики в памяти процесса (отдаются через GET /metrics)
+METRICS = {}
+_metrics_lock = threading.Lock()
+
+def metric_inc(name, value=1):
+    with _metrics_lock:
+        METRICS[name] = METRICS.get(name, 0) + value
+
+def metric_observe(name, seconds):
+    # длительности: число, сумма и максимум в миллисекундах
+    ms = seconds * 1000.0
+    with _metrics_lock:
+        METRICS[name + "_count"] = METRICS.get(name + "_count", 0) + 1
+        METRICS[name + "_sum_ms"] = METRICS.get(name + "_sum_ms", 0.0) + ms
+        if ms > METRICS.get(name + "_max_ms", 0.0):
+            METRICS[name + "_max_ms"] = ms
+
+def metrics_snapshot():
+    with _metrics_lock:
+        return dict(METRICS)
+
+# счётчики выполняющегося обработчика (только в режиме профилирования): запросы к БД и вызовы Bot API
+_profile_local = threading.local()
+
 # ========== НАСТРОЙКИ (токен из env или значение по умолчанию) ==========
 # Если хочешь хранить токен в env — задай BOT_TOKEN в Render. Если нет, будет использован токен ниже.
 TOKEN = os.environ.get("BOT_TOKEN", "8419255009:AAES3WkfbLW9Gd1JrZiN8x5hQHFGA0EaRD0")
+# несколько ботов в одном процессе: BOT_TOKENS через запятую (первый — основной, ему принадлежат каналы
+# и состояния, созданные до появления мультиарендности); без BOT_TOKENS — один бот с BOT_TOKEN
+BOT_TOKENS = [t.strip() for t in os.environ.get("BOT_TOKENS", "").split(",") if t.strip()] or [TOKEN]
+TOKEN = BOT_TOKENS[0]
+DEFAULT_BOT_ID = int(TOKEN.split(":", 1)[0])
 # Укажи публичный URL вашего сервиса (Render) в WEBHOOK_URL env, например https://your-service.onrender.com
 # Если WEBHOOK_URL не задан, используем переменную RENDER_EXTERNAL_URL (Render автоматически её выставляет).
 WEBHOOK_BASE = os.environ.get("WEBHOOK_URL") or os.environ.get("RENDER_EXTERNAL_URL", "https://your-service.onrender.com")
 PORT = int(os.environ.get("PORT", 5000))
+# режим работы: webhook (Flask, по умолчанию) или polling (getUpdates, для self-hosted: python main.py --polling)
+RUN_MODE = "replay" if REPLAY_MODE else "polling" if "--polling" in sys.argv else os.environ.get("BOT_MODE", "webhook")
+# адрес Bot API (для локального сервера/фейка), формат telebot: http://host:port/bot{0}/{1}
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+# long polling: таймаут getUpdates (сек) и число потоков-обработчиков
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", 25))
+POLL_WORKERS = int(os.environ.get("POLL_WORKERS", 8))
+# как часто сохранять позицию long polling внутри долгого пакета (сек); после пакета — всегда
+POLL_OFFSET_SAVE_SECONDS = float(os.environ.get("POLL_OFFSET_SAVE_SECONDS", 2))
+# HTTP-транспорт Bot API: размер пула keep-alive соединений, повторы при сетевых сбоях, HTTP/2 (нужен httpx[http2])
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", max(POLL_WORKERS, 16)))
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", 3))
+HTTP_RETRY_BASE = float(os.environ.get("HTTP_RETRY_BASE", 0.5))
+# 429 с retry_after дольше этого (сек) не пережидаем в потоке обработчика — ошибка сразу уходит вызывающему
+HTTP_RETRY_AFTER_MAX = float(os.environ.get("HTTP_RETRY_AFTER_MAX", 3))
+HTTP2 = os.environ.get("HTTP2", "0") == "1"
+
+# навигация по меню редактированием текущего сообщения вместо отправки нового (0 — старое поведение)
+NAV_EDIT_IN_PLACE = os.environ.get("NAV_EDIT_IN_PLACE", "1") != "0"
+
+# распределение заявок: через сколько секунд без решения заявка передаётся другому модератору
+ASSIGN_TIMEOUT_SECONDS = int(os.environ.get("ASSIGN_TIMEOUT_SECONDS", 6 * 3600))
+ASSIGN_CHECK_INTERVAL = int(os.environ.get("ASSIGN_CHECK_INTERVAL", 60))
+# дайджесты для модераторов: как часто проверять подписки и окно по умолчанию (сек)
+DIGEST_CHECK_INTERVAL = int(os.environ.get("DIGEST_CHECK_INTERVAL", 60))
+DIGEST_DEFAULT_WINDOW = int(os.environ.get("DIGEST_DEFAULT_WINDOW", 3600))
+# заявки моложе этого (сек) могут быть ещё не закоммичены при меньшем id (SERIAL выдаётся до commit):
+# позиция дайджеста за них не двигается, уже показанные из этой полосы запоминаются поштучно
+DIGEST_SETTLE_SECONDS = int(os.environ.get("DIGEST_SETTLE_SECONDS", 600))
+REVIEW_PAGE_SIZE = 5
+# /search: размер страницы и конфигурация полнотекстового поиска Postgres (russian — со стеммингом)
+SEARCH_PAGE_SIZE = 10
+PG_SEARCH_CONFIG = os.environ.get("PG_SEARCH_CONFIG", "russian")
+# фоновые задачи (переназначение и т.п.); 0 — не запускать в этом процессе
+BACKGROUND_JOBS = os.environ.get("BACKGROUND_JOBS", "1") != "0"
 
 COOLDOWN_SECONDS = 3600  # 1 час per-channel
 MAX_TEXT_LENGTH = 4000  # допустимая длина текста
 MAX_FILE_SIZE = 20 * 1024 * 1024  # 20 MB
 DB_PATH = "teleform_full_v2.db"
+# таблицы, записи в которые рассылают инвалидацию кэшей по воркерам
+INVALIDATION_TOPICS = ("channels", "channel_admins", "bans", "cooldowns", "channel_rules")
+# SQLite: интервал опроса cache_versions (сек)
+CACHE_POLL_INTERVAL = float(os.environ.get("CACHE_POLL_INTERVAL", 1.0))
+# размер LRU-кэша прав доступа к каналам (владелец + модераторы)
+ACL_CACHE_SIZE = int(os.environ.get("ACL_CACHE_SIZE", 10000))
+# срок жизни записи кэша прав (сек) — страховка на случай потерянной инвалидации
+ACL_CACHE_TTL = int(os.environ.get("ACL_CACHE_TTL", 300))
+
+# пакетная обработка апдейтов: окно накопления (мс, 0 — каждый апдейт сразу) и размер пакета
+UPDATE_BATCH_WINDOW_MS = int(os.environ.get("UPDATE_BATCH_WINDOW_MS", 0))
+UPDATE_BATCH_MAX = int(os.environ.get("UPDATE_BATCH_MAX", 100))
+
+# защита от флуда на входе webhook: token bucket на пользователя и на чат (токенов/сек, ёмкость)
+FLOOD_CONTROL = os.environ.get("FLOOD_CONTROL", "1") != "0"
+FLOOD_USER_RATE = float(os.environ.get("FLOOD_USER_RATE", 1.0))
+FLOOD_USER_BURST = float(os.environ.get("FLOOD_USER_BURST", 10))
+FLOOD_CHAT_RATE = float(os.environ.get("FLOOD_CHAT_RATE", 3.0))
+FLOOD_CHAT_BURST = float(os.environ.get("FLOOD_CHAT_BURST", 30))
+# 1 — общие для всех воркеров бакеты в БД (таблица rate_buckets)
+FLOOD_SHARED = os.environ.get("FLOOD_SHARED", "0") == "1"
+
+# circuit breaker для БД и Bot API: сколько сбоев подряд его открывают и через сколько секунд пробовать снова
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 5))
+BREAKER_RESET_SECONDS = float(os.environ.get("BREAKER_RESET_SECONDS", 30))
+# реплики Postgres для чтения (URL через запятую): пул соединений на реплику, реплика с отставанием больше
+# REPLICA_MAX_LAG_SECONDS выводится из ротации; после записи пользователь REPLICA_PIN_SECONDS читает с primary
+DATABASE_REPLICA_URLS = [u.strip() for u in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if u.strip()] if USE_PG and not REPLAY_MODE else []
+REPLICA_POOL_SIZE = int(os.environ.get("REPLICA_POOL_SIZE", 8))
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get("REPLICA_MAX_LAG_SECONDS", 2))
+REPLICA_CHECK_INTERVAL = float(os.environ.get("REPLICA_CHECK_INTERVAL", 5))
+REPLICA_PIN_SECONDS = float(os.environ.get("REPLICA_PIN_SECONDS", 10))
+# деградированный режим: файл для апдейтов, принятых во время сбоя, интервал его проигрывания (сек)
+# и размер очереди отложенных некритичных отправок (справка, промо)
+SPOOL_PATH = os.environ.get("SPOOL_PATH", "teleform_spool.jsonl")
+SPOOL_REPLAY_INTERVAL = float(os.environ.get("SPOOL_REPLAY_INTERVAL", 5))
+DEFERRED_CALLS_MAX = int(os.environ.get("DEFERRED_CALLS_MAX", 1000))
+# журнал действий модераторов: сброс в БД каждые AUDIT_FLUSH_MS мс или по набору AUDIT_FLUSH_ROWS строк;
+# сверх AUDIT_BUFFER_SIZE строк в памяти (или без БД) — запись в AUDIT_FALLBACK_PATH
+AUDIT_FLUSH_MS = int(os.environ.get("AUDIT_FLUSH_MS", 200))
+AUDIT_FLUSH_ROWS = int(os.environ.get("AUDIT_FLUSH_ROWS", 200))
+AUDIT_BUFFER_SIZE = int(os.environ.get("AUDIT_BUFFER_SIZE", 10000))
+AUDIT_FALLBACK_PATH = os.environ.get("AUDIT_FALLBACK_PATH", "teleform_audit.jsonl")
+
+# хранение: решённые заявки старше RETENTION_DAYS (по умолчанию; на канал — /retention) переносятся
+# в архив порциями по RETENTION_BATCH строк, не больше RETENTION_MAX_ROWS за проход раз в RETENTION_INTERVAL сек
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", 180))
+RETENTION_BATCH = int(os.environ.get("RETENTION_BATCH", 500))
+RETENTION_MAX_ROWS = int(os.environ.get("RETENTION_MAX_ROWS", 50000))
+RETENTION_INTERVAL = int(os.environ.get("RETENTION_INTERVAL", 3600))
+# SQLite: архив — отдельный файл, подключаемый через ATTACH; Postgres: помесячные партиции submissions
+ARCHIVE_DB_PATH = os.environ.get("ARCHIVE_DB_PATH", "teleform_archive.db")
+PG_PARTITIONING = os.environ.get("PG_PARTITIONING", "1") != "0"
+
+# выгрузка: токен для /admin/export (без него эндпоинт выключен), размер части документа (лимит Bot API — 50 MB)
+# и сколько строк забирать из курсора за раз
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+EXPORT_PART_BYTES = int(os.environ.get("EXPORT_PART_BYTES", 45 * 1024 * 1024))
+EXPORT_FETCH_SIZE = int(os.environ.get("EXPORT_FETCH_SIZE", 2000))
+
+# статистика каналов: свёртки по дням; сверка с исходными таблицами за последние STATS_CHECK_DAYS дней
+# раз в STATS_CHECK_INTERVAL сек (расхождения пересчитываются). Сверяются только дни, закончившиеся больше
+# STATS_SETTLE_SECONDS назад: строки журнала действий других воркеров могут ещё лежать в их буферах
+STATS_CHECK_DAYS = int(os.environ.get("STATS_CHECK_DAYS", 7))
+STATS_CHECK_INTERVAL = int(os.environ.get("STATS_CHECK_INTERVAL", 6 * 3600))
+STATS_SETTLE_SECONDS = int(os.environ.get("STATS_SETTLE_SECONDS", max(600, AUDIT_FLUSH_MS * 50 // 1000)))
+
+# рассылки авторам: общий лимит отправки (сообщений/сек; Telegram — около 30 на бота, часть оставляем
+# обработчикам), сколько получателей читать за раз, как часто сохранять прогресс и обновлять сообщение о нём
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 20))
+BROADCAST_BATCH = int(os.environ.get("BROADCAST_BATCH", 200))
+BROADCAST_CHECKPOINT_EVERY = int(os.environ.get("BROADCAST_CHECKPOINT_EVERY", 25))
+BROADCAST_PROGRESS_INTERVAL = int(os.environ.get("BROADCAST_PROGRESS_INTERVAL", 10))
+BROADCAST_LEASE_SECONDS = int(os.environ.get("BROADCAST_LEASE_SECONDS", 120))
+BROADCAST_POLL_INTERVAL = int(os.environ.get("BROADCAST_POLL_INTERVAL", 5))
+
+# обслуживание БД: pending-заявки без решения дольше PENDING_EXPIRE_DAYS (0 — не истекают) закрываются
+# статусом expired, брошенные состояния диалогов старше STATE_EXPIRE_SECONDS и отжившие cooldowns удаляются;
+# всё порциями по MAINTENANCE_BATCH, не больше MAINTENANCE_MAX_ROWS на задачу за проход.
+# ANALYZE / VACUUM — раз в сутки в часы MAINTENANCE_HOURS (UTC, "начало-конец")
+PENDING_EXPIRE_DAYS = int(os.environ.get("PENDING_EXPIRE_DAYS", 14))
+STATE_EXPIRE_SECONDS = int(os.environ.get("STATE_EXPIRE_SECONDS", 24 * 3600))
+MAINTENANCE_INTERVAL = int(os.environ.get("MAINTENANCE_INTERVAL", 900))
+MAINTENANCE_BATCH = int(os.environ.get("MAINTENANCE_BATCH", 500))
+MAINTENANCE_MAX_ROWS = int(os.environ.get("MAINTENANCE_MAX_ROWS", 20000))
+MAINTENANCE_HOURS = os.environ.get("MAINTENANCE_HOURS", "3-5")
+# истечение заявок шлёт уведомления через общий лимит массовых отправок: за проход закрывается не больше
+# EXPIRE_NOTIFY_MAX заявок (остальные — в следующих проходах), контрольные сообщения модераторов правятся
+# только у заявок, просроченных не больше чем на EXPIRE_EDIT_DAYS (старый хвост очереди не трогаем)
+EXPIRE_NOTIFY_MAX = int(os.environ.get("EXPIRE_NOTIFY_MAX", 300))
+EXPIRE_EDIT_DAYS = int(os.environ.get("EXPIRE_EDIT_DAYS", 2))
+
+# журнал апдейтов для воспроизведения нагрузки: каталог сегментов (не задан — журнал выключен), ротация по
+# объёму несжатых данных или по времени, сколько последних сегментов хранить
+UPDATE_JOURNAL_DIR = os.environ.get("UPDATE_JOURNAL_DIR", "")
+UPDATE_JOURNAL_SEGMENT_BYTES = int(os.environ.get("UPDATE_JOURNAL_SEGMENT_BYTES", 64 * 1024 * 1024))
+UPDATE_JOURNAL_SEGMENT_SECONDS = int(os.environ.get("UPDATE_JOURNAL_SEGMENT_SECONDS", 3600))
+UPDATE_JOURNAL_KEEP = int(os.environ.get("UPDATE_JOURNAL_KEEP", 48))
+# воспроизведение: имитация задержки Bot API (мс) и seed для random — прогоны повторяемы
+REPLAY_API_LATENCY_MS = float(os.environ.get("REPLAY_API_LATENCY_MS", 0))
+REPLAY_SEED = int(os.environ.get("REPLAY_SEED", 0))
+
+# профилирование обработчиков: PROFILE=sample (сэмплирующий профайлер) или cprofile; профилируется
+# случайный 1 из PROFILE_SAMPLE_N апдейтов, в режиме sample — ещё и каждый медленнее PROFILE_SLOW_MS;
+# стеки (folded, для flamegraph.pl / speedscope), .prof и журнал медленных апдейтов — в PROFILE_DIR
+PROFILE_MODE = os.environ.get("PROFILE", "")
+PROFILE_SAMPLE_N = int(os.environ.get("PROFILE_SAMPLE_N", 100))
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", 500))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+if REPLAY_MODE:
+    # все файлы — во временном каталоге, фоновые задачи не нужны, журнал не пишется
+    DB_PATH = os.path.join(REPLAY_DIR, DB_PATH)
+    ARCHIVE_DB_PATH = os.path.join(REPLAY_DIR, os.path.basename(ARCHIVE_DB_PATH))
+    SPOOL_PATH = os.path.join(REPLAY_DIR, os.path.basename(SPOOL_PATH))
+    AUDIT_FALLBACK_PATH = os.path.join(REPLAY_DIR, os.path.basename(AUDIT_FALLBACK_PATH))
+    UPDATE_JOURNAL_DIR = ""
+    BACKGROUND_JOBS = False
+    random.seed(REPLAY_SEED)
+
+# дубликаты заявок: за какой срок искать совпадения (сек) и порог похожести текста (бит SimHash из 64)
+DUPLICATE_WINDOW_SECONDS = int(os.environ.get("DUPLICATE_WINDOW_SECONDS", 30 * 24 * 3600))
+SIMHASH_MAX_DISTANCE = int(os.environ.get("SIMHASH_MAX_DISTANCE", 4))
+
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
+
+# ========== ЗАЩИТА ОТ СБОЕВ (circuit breaker) ==========
+# После BREAKER_FAILURES сбоев подряд зависимость считается недоступной: вызовы сразу падают с
+# CircuitOpenError, не дожидаясь таймаутов. Через BREAKER_RESET_SECONDS пропускается пробный вызов
+# (half-open): успех закрывает breaker, сбой снова открывает.
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    def __init__(self, name, failures=BREAKER_FAILURES, reset_seconds=BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failures = failures
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.errors = 0
+        self.opened_at = 0.0
+        self.probe = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        with self.lock:
+            if self.state == "closed":
+                return True
+            now = time.monotonic()
+            if now - self.opened_at >= self.reset_seconds:
+                # пробный вызов; если он завис — через reset_seconds пускаем следующий
+                self.state = "half_open"
+                self.opened_at = now
+                self.probe = threading.get_ident()
+                return True
+            # запросы самого пробного потока (несколько запросов одной транзакции) не режем
+            return self.state == "half_open" and self.probe == threading.get_ident()
+
+    def check(self):
+        if not self.allow():
+            metric_inc(f"breaker_{self.name}_rejected")
+            raise CircuitOpenError(f"{self.name} недоступен")
+
+    def is_open(self):
+        # True, пока вызовы отклоняются (открыт и время пробы ещё не пришло, или проба уже идёт)
+        if self.state == "closed":
+            return False
+        with self.lock:
+            if self.state == "half_open":
+                return True
+            return self.state == "open" and time.monotonic() - self.opened_at < self.reset_seconds
+
+    def record_success(self):
+        if self.state == "closed" and self.errors == 0:
+            return
+        with self.lock:
+            if self.state != "closed":
+                logger.warning("Circuit breaker %s закрыт — зависимость снова доступна", self.name)
+                metric_inc(f"breaker_{self.name}_closed")
+            self.state = "closed"
+            self.errors = 0
+            self.probe = None
+
+    def record_failure(self):
+        with self.lock:
+            self.errors += 1
+            if self.state == "half_open" or (self.state == "closed" and self.errors >= self.failures):
+                if self.state == "closed":
+                    logger.error("Circuit breaker %s открыт после %s сбоев подряд", self.name, self.errors)
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.probe = None
+                metric_inc(f"breaker_{self.name}_opened")
+
+db_breaker = CircuitBreaker("db")
+api_breaker = CircuitBreaker("api")
+
+def _is_db_outage(e):
+    if USE_PG:
+        return isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+    # в SQLite OperationalError — это и ошибки в SQL; сбоем считаем только недоступность файла
+    if isinstance(e, sqlite3.OperationalError):
+        msg = str(e).lower()
+        return any(s in msg for s in ("locked", "busy", "unable to open", "disk i/o"))
+    return False
+
+class GuardedConnection:
+    # обёртка соединения: все запросы идут через db_breaker; PG-соединение пересоздаётся после обрыва
+    def __init__(self, connect, raw=None):
+        self._connect = connect
+        self.raw = raw if raw is not None else connect()
+        self.generation = 0
+        self._lock = threading.Lock()
+        # SQLite: модуль sqlite3 сам открывает транзакцию (BEGIN) перед записью, и два потока на одном соединении
+        # могут сделать это одновременно («cannot start a transaction within a transaction») — запросы по очереди
+        self._statement_lock = threading.RLock()
+
+    def cursor(self):
+        return GuardedCursor(self)
+
+    def ensure(self):
+        if not USE_PG or not self.raw.closed:
+            return
+        with self._lock:
+            if self.raw.closed:
+                self.raw = self._connect()
+                self.generation += 1
+                logger.warning("Соединение с Postgres восстановлено")
+
+    def on_error(self, e, savepoint=None):
+        if USE_PG:
+            # после любой ошибки транзакция PG в состоянии aborted — без отката упадут все следующие запросы;
+            # внутри savepoint() откатывается только он (чужие незакоммиченные записи на общем соединении целы)
+            try:
+                if not self.raw.closed:
+                    if savepoint is None:
+                        self.raw.rollback()
+                    else:
+                        self.raw.cursor().execute(f"ROLLBACK TO SAVEPOINT {savepoint}")
+            except Exception:
+                try:
+                    self.raw.rollback()
+                except Exception:
+                    pass
+        if _is_db_outage(e):
+            metric_inc("db_errors")
+            db_breaker.record_failure()
+
+    def _run(self, fn, savepoint=None):
+        db_breaker.check()
+        try:
+            self.ensure()
+            if USE_PG:
+                result = fn()
+            else:
+                with self._statement_lock:
+                    result = fn()
+        except Exception as e:
+            self.on_error(e, savepoint)
+            raise
+        db_breaker.record_success()
+        return result
+
+    def commit(self):
+        return self._run(lambda: self.raw.commit())
+
+    def rollback(self):
+        with self._statement_lock:
+            return self.raw.rollback()
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+class GuardedCursor:
+    def __init__(self, conn):
+        self._conn = conn
+        self._cur = None
+        self._gen = None
+        self.savepoint = None   # имя открытого savepoint() этого курсора
+
+    def _raw(self):
+        if self._cur is None or self._gen != self._conn.generation:
+            self._cur = self._conn.raw.cursor()
+            self._gen = self._conn.generation
+        return self._cur
+
+    def _run(self, fn):
+        stats = getattr(_profile_local, "stats", None)
+        if stats is None:
+            return self._conn._run(fn, self.savepoint)
+        t0 = time.perf_counter()
+        try:
+            return self._conn._run(fn, self.savepoint)
+        finally:
+            stats["db_queries"] += 1
+            stats["db_ms"] += (time.perf_counter() - t0) * 1000
+
+    def execute(self, *args):
+        if DATABASE_REPLICA_URLS:
+            note_write(args[0])
+        return self._run(lambda: self._raw().execute(*args))
+
+    def executemany(self, *args):
+        if DATABASE_REPLICA_URLS:
+            note_write(args[0])
+        return self._run(lambda: self._raw().executemany(*args))
+
+    def close(self):
+        if self._cur is not None:
+            try:
+                self._cur.close()
+            except Exception:
+                pass
+
+    def __iter__(self):
+        return iter(self._raw())
+
+    def __getattr__(self, name):
+        return getattr(self._raw(), name)
+
+class ThreadCursor(GuardedCursor):
+    # глобальный cur: обработчики из разных потоков (пул webhook, воркеры long polling) работают через него
+    # одновременно — у каждого потока свой курсор на общем соединении, чтобы execute одного не подменял
+    # результат fetch другого
+    def __init__(self, conn):
+        super().__init__(conn)
+        self._local = threading.local()
+
+    def _raw(self):
+        local = self._local
+        if getattr(local, "cur", None) is None or local.gen != self._conn.generation:
+            local.cur = self._conn.raw.cursor()
+            local.gen = self._conn.generation
+        return local.cur
+
+    def close(self):
+        local_cur = getattr(self._local, "cur", None)
+        if local_cur is not None:
+            try:
+                local_cur.close()
+            except Exception:
+                pass
+            self._local.cur = None
+
+_savepoint_ids = itertools.count(1)
+
+@contextmanager
+def savepoint(c):
+    # изменения одной операции на общем соединении: при ошибке откатываются только они,
+    # незакоммиченные записи параллельных обработчиков остаются
+    name = f"sp_{next(_savepoint_ids)}"
+    c.execute(f"SAVEPOINT {name}")
+    c.savepoint = name
+    try:
+        yield
+    except Exception:
+        c.savepoint = None
+        try:
+            c.execute(f"ROLLBACK TO SAVEPOINT {name}")
+        except Exception:
+            pass
+        raise
+    c.savepoint = None
+
+# ========== РЕПЛИКИ POSTGRES ДЛЯ ЧТЕНИЯ ==========
+# Чтения, которым не страшно небольшое отставание (списки pending, каналы владельца, карточки заявок,
+# выгрузки), идут через read_fetch на случайную здоровую реплику; остальное — на primary, как раньше.
+# Фоновая проверка меряет отставание и выводит из ротации отстающие и недоступные реплики.
+# Апдейт, который что-то записал, дальше читает только с primary, а его автор — ещё REPLICA_PIN_SECONDS:
+# иначе пользователь не увидит собственных изменений (только что подключённый канал и т.п.).
+_route_local = threading.local()
+_pinned_users = {}
+_WRITE_PREFIXES = ("INSERT", "UPDATE", "DELETE")
+# на самой реплике: 0, если всё полученное WAL уже применено, иначе возраст последней применённой транзакции
+REPLICA_LAG_SQL = ("SELECT pg_is_in_recovery(), CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                   "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END")
+
+class Replica:
+    def __init__(self, url):
+        self.url = url
+        # host[:port]/db без логина и пароля — для логов и метрик
+        self.name = url.rsplit("@", 1)[-1].split("?", 1)[0]
+        self.pool = None
+        self.healthy = False
+        self.lag = None
+
+    def connect(self):
+        return psycopg2.connect(self.url, connect_timeout=PG_CONNECT_TIMEOUT,
+                                options=f"-c statement_timeout={PG_STATEMENT_TIMEOUT_MS}")
+
+    def _pool(self):
+        if self.pool is None:
+            self.pool = psycopg2.pool.ThreadedConnectionPool(0, REPLICA_POOL_SIZE, self.url, connect_timeout=PG_CONNECT_TIMEOUT,
+                                                             options=f"-c statement_timeout={PG_STATEMENT_TIMEOUT_MS}")
+        return self.pool
+
+    def fetch(self, sql, params=(), one=False):
+        pool = self._pool()
+        conn = pool.getconn()
+        broken = True
+        try:
+            # autocommit: каждое чтение — своя транзакция, соединение в пуле не висит idle in transaction
+            if not conn.autocommit:
+                conn.autocommit = True
+            c = conn.cursor()
+            try:
+                c.execute(sql, params)
+                result = c.fetchone() if one else c.fetchall()
+            finally:
+                c.close()
+            broken = False
+            return result
+        finally:
+            pool.putconn(conn, close=broken)
+
+    def mark_down(self, reason):
+        if self.healthy:
+            logger.warning("Реплика %s выведена из ротации: %s", self.name, reason)
+            metric_inc("replica_removed")
+        self.healthy = False
+        if isinstance(reason, Exception) and self.pool is not None:
+            # соединения пула могли оборваться вместе с репликой — пересоздаём пул при следующей проверке
+            pool, self.pool = self.pool, None
+            try:
+                pool.closeall()
+            except Exception:
+                pass
+
+    def check(self):
+        try:
+            in_recovery, lag = self.fetch(REPLICA_LAG_SQL, one=True)
+        except Exception as e:
+            self.mark_down(e)
+            return
+        self.lag = 0.0 if not in_recovery else (float(lag) if lag is not None else None)
+        with _metrics_lock:
+            METRICS["replica_lag_ms_" + self.name] = round(self.lag * 1000) if self.lag is not None else -1
+        if self.lag is None or self.lag > REPLICA_MAX_LAG_SECONDS:
+            self.mark_down(f"отставание {self.lag if self.lag is not None else '?'} с")
+        elif not self.healthy:
+            self.healthy = True
+            logger.info("Реплика %s в ротации (отставание %.2f с)", self.name, self.lag)
+
+REPLICAS = [Replica(url) for url in DATABASE_REPLICA_URLS]
+
+def note_write(sql):
+    # запись внутри апдейта закрепляет апдейт и его автора за primary
+    if not getattr(_route_local, "active", False) or not isinstance(sql, str):
+        return
+    if sql.lstrip()[:6].upper() in _WRITE_PREFIXES:
+        _route_local.wrote = True
+        user_id = _route_local.user_id
+        if user_id is not None:
+            _pinned_users[user_id] = time.monotonic() + REPLICA_PIN_SECONDS
+
+def routed_task(task):
+    def run(*args, **kwargs):
+        obj = args[0] if args else None
+        _route_local.active = True
+        _route_local.wrote = False
+        _route_local.user_id = getattr(getattr(obj, "from_user", None), "id", None)
+        try:
+            return task(*args, **kwargs)
+        finally:
+            _route_local.active = False
+            _route_local.user_id = None
+    return run
+
+def replica_for_read():
+    if not REPLICAS:
+        return None
+    if getattr(_route_local, "active", False):
+        if _route_local.wrote:
+            return None
+        user_id = _route_local.user_id
+        if user_id is not None and _pinned_users.get(user_id, 0) > time.monotonic():
+            metric_inc("replica_pinned_reads")
+            return None
+    healthy = [r for r in REPLICAS if r.healthy]
+    return random.choice(healthy) if healthy else None
+
+def read_fetch(sql, params=(), one=False):
+    # чтение, допускающее отставание: со здоровой реплики, при её сбое или без реплик — с primary.
+    # Ненайденная строка перечитывается с primary: скорее всего, она ещё не доехала до реплики
+    replica = replica_for_read()
+    if replica is not None:
+        stats = getattr(_profile_local, "stats", None)
+        t0 = time.perf_counter()
+        try:
+            result = replica.fetch(sql, params, one)
+            metric_inc("replica_reads")
+            if result is not None or not one:
+                return result
+            metric_inc("replica_misses")
+        except psycopg2.pool.PoolError:
+            metric_inc("replica_pool_exhausted")
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            replica.mark_down(e)
+            metric_inc("replica_fallbacks")
+        finally:
+            if stats is not None:
+                stats["db_queries"] += 1
+                stats["db_ms"] += (time.perf_counter() - t0) * 1000
+    c = db.cursor()
+    try:
+        c.execute(sql, params)
+        return c.fetchone() if one else c.fetchall()
+    finally:
+        c.close()
+
+def check_replicas():
+    for replica in REPLICAS:
+        replica.check()
+    now = time.monotonic()
+    for user_id, until in list(_pinned_users.items()):
+        if until <= now:
+            _pinned_users.pop(user_id, None)
+
+def start_replica_health_checks():
+    # в каждом процессе: ротация и пулы у каждого воркера свои; до первой проверки всё читается с primary
+    if not REPLICAS:
+        return
+    def loop():
+        while True:
+            try:
+                check_replicas()
+            except Exception:
+                logger.exception("Проверка реплик не удалась")
+            time.sleep(REPLICA_CHECK_INTERVAL)
+    threading.Thread(target=loop, name="replica-health", daemon=True).start()
+
+# ========== HTTP-ТРАНСПОРТ ДЛЯ BOT API ==========
+# Один пул keep-alive соединений на процесс (размер под число потоков), таймауты по классу метода,
+# повтор с jitter-backoff на сетевых ошибках / 5xx / 429. Подключается через apihelper.CUSTOM_REQUEST_SENDER.
+import requests
+from requests.adapters import HTTPAdapter
+
+# (connect, read) по классам методов; getUpdates задаёт свой read-таймаут сам
+API_TIMEOUTS = {
+    "fast": (3.05, 10),     # ответы на нажатия, редактирование, get_chat*
+    "send": (3.05, 20),
+    "upload": (5, 120),     # отправка файлов
+}
+_FAST_METHODS = {"answerCallbackQuery", "editMessageText", "editMessageReplyMarkup", "getChat", "getChatMember", "getMe", "deleteMessage"}
+_UPLOAD_METHODS = {"sendPhoto", "sendVideo", "sendDocument", "sendMediaGroup"}
+
+def _method_timeout(method_name, files, default):
+    if method_name == "getUpdates":
+        return default
+    if method_name in _FAST_METHODS:
+        return API_TIMEOUTS["fast"]
+    if files or method_name in _UPLOAD_METHODS:
+        return API_TIMEOUTS["upload"]
+    return API_TIMEOUTS["send"]
+
+def _build_http_client():
+    if HTTP2:
+        try:
+            import httpx
+            limits = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+            return httpx.Client(http2=True, limits=limits)
+        except ImportError:
+            logger.warning("HTTP2=1, но httpx[http2] не установлен — используем requests")
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+_http_client = _build_http_client()
+
+# сетевые ошибки транспорта: все и те, при которых запрос точно не дошёл до сервера (их можно повторять)
+if isinstance(_http_client, requests.Session):
+    _NETWORK_ERRORS = (requests.ConnectionError, requests.Timeout, OSError)
+    _NOT_SENT_ERRORS = (requests.ConnectionError,)
+else:
+    import httpx
+    _NETWORK_ERRORS = (httpx.TransportError, OSError)
+    _NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+def _retry_delay(attempt):
+    return HTTP_RETRY_BASE * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+def api_request_sender(method, url, params=None, files=None, timeout=None, proxies=None):
+    method_name = url.rsplit("/", 1)[-1]
+    timeout = _method_timeout(method_name, files, timeout)
+    api_breaker.check()
+    attempt = 0
+    while True:
+        t0 = time.perf_counter()
+        try:
+            if HTTP2 and not isinstance(_http_client, requests.Session):
+                resp = _http_client.request(method.upper(), url, params=params, files=files, timeout=timeout)
+                # telebot при ответе не-JSON читает resp.reason (так у requests), у httpx это reason_phrase
+                resp.reason = resp.reason_phrase
+            else:
+                resp = _http_client.request(method, url, params=params, files=files, timeout=timeout, proxies=proxies)
+        except _NETWORK_ERRORS as e:
+            metric_observe("api_" + method_name, time.perf_counter() - t0)
+            # повторяем только то, что точно не дошло до сервера (ошибка соединения), или быстрые идемпотентные методы
+            retriable = (isinstance(e, _NOT_SENT_ERRORS) and not isinstance(e, requests.ReadTimeout)) or method_name in _FAST_METHODS or method_name == "getUpdates"
+            if attempt >= HTTP_MAX_RETRIES or not retriable or files:
+                metric_inc("api_errors")
+                api_breaker.record_failure()
+                raise
+            metric_inc("api_retries")
+            time.sleep(_retry_delay(attempt))
+            attempt += 1
+            continue
+        metric_observe("api_" + method_name, time.perf_counter() - t0)
+        metric_observe("api_call", time.perf_counter() - t0)
+        if (resp.status_code == 429 or resp.status_code >= 500) and attempt < HTTP_MAX_RETRIES and not files:
+            delay = _retry_delay(attempt)
+            if resp.status_code == 429:
+                try:
+                    delay = (resp.json().get("parameters") or {}).get("retry_after", delay)
+                except Exception:
+                    pass
+            if delay <= HTTP_RETRY_AFTER_MAX:
+                metric_inc("api_retries")
+                time.sleep(delay)
+                attempt += 1
+                continue
+            # долгий retry_after: поток обработчика не держим, 429 получит вызывающий (фоновые рассылки ждут сами)
+            metric_inc("api_retry_after_exceeded")
+        if resp.status_code >= 500:
+            api_breaker.record_failure()
+        else:
+            api_breaker.record_success()
+        return resp
+
+def count_api_calls(sender):
+    # в режиме профилирования — метод и длительность каждого вызова Bot API текущего обработчика
+    @functools.wraps(sender)
+    def wrapper(method, url, *args, **kwargs):
+        stats = getattr(_profile_local, "stats", None)
+        if stats is None:
+            return sender(method, url, *args, **kwargs)
+        t0 = time.perf_counter()
+        try:
+            return sender(method, url, *args, **kwargs)
+        finally:
+            stats["api_calls"].append((url.rsplit("/", 1)[-1], round((time.perf_counter() - t0) * 1000, 1)))
+    return wrapper
+
+telebot.apihelper.CUSTOM_REQUEST_SENDER = count_api_calls(api_request_sender)
+
+# фейковый Bot API для воспроизведения журнала: отвечает правдоподобными объектами, ничего не отправляя
+REPLAY_API_CALLS = {}
+_replay_message_ids = iter(range(1, 1 << 62))
+
+def _replay_int(v):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return 0
+
+def _replay_result(method_name, params):
+    chat_id = _replay_int(params.get("chat_id"))
+    if method_name == "getMe":
+        return {"id": 1, "is_bot": True, "first_name": "replay", "username": "replay_bot"}
+    if method_name == "getChat":
+        return {"id": chat_id, "type": "private" if chat_id > 0 else "channel", "title": "replay", "first_name": "replay"}
+    if method_name == "getChatMember":
+        return {"status": "administrator", "can_post_messages": True, "user": {"id": _replay_int(params.get("user_id")), "is_bot": False, "first_name": "replay"}}
+    if method_name == "copyMessage":
+        return {"message_id": next(_replay_message_ids)}
+    if method_name.startswith("send") or method_name.startswith("edit") or method_name == "forwardMessage":
+        message = {"message_id": _replay_int(params.get("message_id")) or next(_replay_message_ids), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "channel"}, "text": params.get("text") or params.get("caption") or ""}
+        return [message] if method_name == "sendMediaGroup" else message
+    return True
+
+def replay_request_sender(method, url, params=None, files=None, timeout=None, proxies=None):
+    method_name = url.rsplit("/", 1)[-1]
+    REPLAY_API_CALLS[method_name] = REPLAY_API_CALLS.get(method_name, 0) + 1
+    if REPLAY_API_LATENCY_MS:
+        time.sleep(REPLAY_API_LATENCY_MS / 1000)
+    resp = requests.Response()
+    resp.status_code = 200
+    resp._content = json.dumps({"ok": True, "result": _replay_result(method_name, params or {})}).encode()
+    return resp
+
+if REPLAY_MODE:
+    telebot.apihelper.CUSTOM_REQUEST_SENDER = count_api_calls(replay_request_sender)
+
+# ========== ПРОФИЛИРОВАНИЕ ОБРАБОТЧИКОВ ==========
+# Включается PROFILE=sample|cprofile. Обёртка ставится на выполнение обработчика (_exec_task), а не на
+# process_new_updates: в webhook-режиме обработчики идут в пуле потоков, и process_new_updates
+# возвращается раньше, чем они выполнятся. Каждый апдейт помечается типом и именем сработавшего
+# обработчика; для него считаются запросы к БД (число, время) и вызовы Bot API (метод, время).
+# sample: фоновый поток раз в PROFILE_INTERVAL_MS снимает стеки потоков, занятых обработчиками; стеки
+# сохраняются, если апдейт выпал в выборку 1 из PROFILE_SAMPLE_N или оказался медленнее PROFILE_SLOW_MS.
+# cprofile: выбранные апдейты выполняются под cProfile (по одному за раз — профайлер в процессе один).
+class StackSampler:
+    def __init__(self, interval):
+        self.interval = interval
+        self._active = {}
+        self._thread = None
+
+    def begin(self):
+        self._active[threading.get_ident()] = {}
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+            self._thread.start()
+
+    def end(self):
+        return self._active.pop(threading.get_ident(), None) or {}
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for tid, samples in list(self._active.items()):
+                frame = frames.get(tid)
+                if frame is not None:
+                    stack = _folded_stack(frame)
+                    samples[stack] = samples.get(stack, 0) + 1
+
+def _folded_stack(frame):
+    # стек от обёртки профилирования до текущего кадра: "f1 (file:line);f2 (file:line);..."
+    names = []
+    while frame is not None and frame.f_code is not _profiled_call.__code__:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+_sampler = StackSampler(PROFILE_INTERVAL_MS / 1000)
+_cprofile_lock = threading.Lock()
+_profile_files_lock = threading.Lock()
+
+def profiled_task(task, update_type):
+    def run(*args, **kwargs):
+        return _profiled_call(task, update_type, args, kwargs)
+    return run
+
+def _profiled_call(task, update_type, args, kwargs):
+    stats = {"handler": None, "db_queries": 0, "db_ms": 0.0, "api_calls": []}
+    sampled = PROFILE_SAMPLE_N > 0 and random.randrange(PROFILE_SAMPLE_N) == 0
+    profiler = None
+    if PROFILE_MODE == "cprofile" and sampled and _cprofile_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif PROFILE_MODE == "sample":
+        _sampler.begin()
+    _profile_local.stats = stats
+    t0 = time.perf_counter()
+    try:
+        return task(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - t0
+        _profile_local.stats = None
+        if profiler is not None:
+            profiler.disable()
+            _cprofile_lock.release()
+        samples = _sampler.end() if PROFILE_MODE == "sample" else None
+        try:
+            _profile_finish(stats, update_type, args, elapsed, sampled, profiler, samples)
+        except Exception:
+            logger.exception("Не удалось сохранить профиль апдейта")
+
+def _profile_finish(stats, update_type, args, elapsed, sampled, profiler, samples):
+    handler = stats["handler"] or "unhandled"
+    obj = args[0] if args else None
+    content_type = getattr(obj, "content_type", None)
+    kind = f"{update_type}:{content_type}" if content_type else (update_type or type(obj).__name__)
+    ms = elapsed * 1000
+    slow = ms >= PROFILE_SLOW_MS
+    metric_observe("handler_" + handler, elapsed)
+    if not (slow or sampled):
+        return
+    ts = time.time()
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with _profile_files_lock:
+        if samples:
+            with open(os.path.join(PROFILE_DIR, "stacks.folded"), "a", encoding="utf-8") as f:
+                f.writelines(f"{kind};{handler};{stack} {count}\n" for stack, count in samples.items())
+        if profiler is not None:
+            profiler.dump_stats(os.path.join(PROFILE_DIR, f"{int(ts * 1000)}-{handler}.prof"))
+        if slow:
+            record = {"ts": round(ts, 3), "update_type": kind, "handler": handler, "ms": round(ms, 1),
+                      "db_queries": stats["db_queries"], "db_ms": round(stats["db_ms"], 1),
+                      "api_calls": stats["api_calls"], "chat_id": getattr(getattr(obj, "chat", None), "id", None) or getattr(getattr(obj, "from_user", None), "id", None)}
+            with open(os.path.join(PROFILE_DIR, "slow_updates.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    if slow:
+        metric_inc("slow_updates")
+        logger.warning("Медленный апдейт: %s → %s, %.0f мс (БД: %s запросов, %.0f мс; Bot API: %s вызовов)",
+                       kind, handler, ms, stats["db_queries"], stats["db_ms"], len(stats["api_calls"]))
+
+# исключения обработчиков telebot отдаёт exception_handler (с middleware) или пулу потоков. CircuitOpenError
+# запоминаем: апдейт, на котором отказала БД или Bot API, возвращается в spool, а не теряется
+_handler_local = threading.local()
+
+class HandlerErrors(telebot.ExceptionHandler):
+    def handle(self, exception):
+        if isinstance(exception, CircuitOpenError):
+            _handler_local.circuit_error = exception
+        else:
+            logger.exception("Ошибка в обработчике: %s", exception)
+        return True
+
+@contextmanager
+def inline_handlers():
+    # обработчики — прямо в этом потоке, CircuitOpenError из обработчика пробрасывается вызывающему
+    prev = getattr(_handler_local, "inline", False)
+    _handler_local.inline = True
+    try:
+        yield
+    finally:
+        _handler_local.inline = prev
+
+class TeleformBot(telebot.TeleBot):
+    # переносит контекст пакетной предзагрузки и текущего бота в поток, где выполняется обработчик
+    @property
+    def bot_id(self):
+        return int(self.token.split(":", 1)[0])
+
+    def _exec_task(self, task, *args, **kwargs):
+        if PROFILE_MODE:
+            task = profiled_task(task, kwargs.get("update_type"))
+        if REPLICAS:
+            task = routed_task(task)
+        ctx = current_prefetch()
+        inline = getattr(_handler_local, "inline", False)
+        def run(*a, **kw):
+            _handler_local.circuit_error = None
+            result = None
+            with use_tenant(self), use_prefetch(ctx):
+                try:
+                    result = task(*a, **kw)
+                except CircuitOpenError as e:
+                    _handler_local.circuit_error = e
+                error, _handler_local.circuit_error = _handler_local.circuit_error, None
+                if error is not None:
+                    if inline:
+                        raise error
+                    logger.warning("Обработчик прерван (%s), апдейт возвращён в spool", error)
+                    spool_handler_input(a[0] if a else None, kw.get("update_type"))
+            return result
+        if inline:
+            return run(*args, **kwargs)
+        return super()._exec_task(run, *args, **kwargs)
+
+    def _test_message_handler(self, message_handler, message):
+        matched = super()._test_message_handler(message_handler, message)
+        if matched and PROFILE_MODE:
+            stats = getattr(_profile_local, "stats", None)
+            if stats is not None and stats["handler"] is None:
+                stats["handler"] = message_handler["function"].__name__
+        return matched
+
+# ========== НЕСКОЛЬКО БОТОВ В ОДНОМ ПРОЦЕССЕ ==========
+# Каждый токен из BOT_TOKENS — свой TeleformBot: свой webhook /webhook/<token>, свой реестр обработчиков
+# (копия реестра основного бота) и next-step обработчики. БД, HTTP-сессия, кэши и пул потоков — общие.
+# Обработчики обращаются к глобальному bot — это прокси к боту, чей апдейт обрабатывается в потоке
+# (use_tenant в process_update_batch и _exec_task); вне апдейта — к основному. Данные разделены по bot_id:
+# канал принадлежит боту, через которого подключён (заявки, модераторы, баны и прочее идут за каналом),
+# состояния диалогов у каждого бота свои. Фоновые задачи пишут от имени бота канала (channel_tenant).
+_tenant_local = threading.local()
+
+default_bot = TeleformBot(TOKEN, threaded=not REPLAY_MODE, exception_handler=HandlerErrors())
+BOTS = OrderedDict([(default_bot.bot_id, default_bot)])
+for _token in BOT_TOKENS[1:]:
+    _extra = TeleformBot(_token, threaded=False, exception_handler=HandlerErrors())
+    if default_bot.threaded:
+        _extra.threaded, _extra.worker_pool = True, default_bot.worker_pool
+    BOTS[_extra.bot_id] = _extra
+BOTS_BY_TOKEN = {b.token: b for b in BOTS.values()}
+
+def current_bot():
+    return getattr(_tenant_local, "bot", None) or default_bot
+
+def current_bot_id():
+    return current_bot().bot_id
+
+def tenant_active():
+    # поток работает от имени конкретного бота (апдейт или фоновая задача по каналу)
+    return getattr(_tenant_local, "bot", None) is not None
+
+@contextmanager
+def use_tenant(b):
+    prev = getattr(_tenant_local, "bot", None)
+    _tenant_local.bot = b
+    try:
+        yield b
+    finally:
+        _tenant_local.bot = prev
+
+def bind_tenant(fn):
+    # для потоков и отложенных вызовов: fn выполнится от имени текущего бота
+    b = current_bot()
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        with use_tenant(b):
+            return fn(*args, **kwargs)
+    return run
+
+class BotProxy:
+    def __getattr__(self, name):
+        return getattr(current_bot(), name)
+
+    def __setattr__(self, name, value):
+        setattr(current_bot(), name, value)
 
-# Создаём бота (webhook mode)
-bot = telebot.TeleBot(TOKEN)
+# декораторы обработчиков ниже регистрируют их на основном боте; share_handlers раздаёт копии остальным
+bot = BotProxy()
+
+def share_handlers():
+    for b in list(BOTS.values())[1:]:
+        for name, value in vars(default_bot).items():
+            if name.endswith("_handlers") and isinstance(value, list):
+                setattr(b, name, list(value))
 
 # BOT username (для deep links)
-try:
-    BOT_USERNAME = bot.get_me().username
-except Exception:
-    BOT_USERNAME = None
+BOT_USERNAMES = {}
+for _b in BOTS.values():
+    try:
+        BOT_USERNAMES[_b.bot_id] = _b.get_me().username
+    except Exception:
+        BOT_USERNAMES[_b.bot_id] = None
+
+def bot_username():
+    return BOT_USERNAMES.get(current_bot_id())
 
 # ========== БД ==========
+# колонки таблиц, которые архивируются (и на Postgres партиционируются по created_at)
+SUBMISSION_COLUMNS = "id, user_id, content_type, text_content, file_id, status, created_at, anonymous, target_channel_dbid"
+ACTION_COLUMNS = "id, submission_id, moderator_id, action, note, created_at"
+
+def month_bounds(ts):
+    # (начало месяца, начало следующего, "YYYYMM") в UTC для метки времени ts
+    t = time.gmtime(ts)
+    start = calendar.timegm((t.tm_year, t.tm_mon, 1, 0, 0, 0))
+    end = calendar.timegm((t.tm_year + (t.tm_mon == 12), t.tm_mon % 12 + 1, 1, 0, 0, 0))
+    return start, end, f"{t.tm_year}{t.tm_mon:02d}"
+
 if USE_PG:
+    db = GuardedConnection(pg_connect, pg_conn)
+    cur = ThreadCursor(db)
+
+    PARTITIONED_TABLES = {
+        "submissions": '''id SERIAL, user_id BIGINT, content_type TEXT, text_content TEXT, file_id TEXT, status TEXT,
+            created_at BIGINT NOT NULL, anonymous INTEGER DEFAULT 1, target_channel_dbid INTEGER DEFAULT 0,
+            PRIMARY KEY (id, created_at)''',
+        "submission_actions": '''id SERIAL, submission_id INTEGER, moderator_id BIGINT, action TEXT, note TEXT,
+            created_at BIGINT NOT NULL, PRIMARY KEY (id, created_at)''',
+    }
+    PG_MIGRATION_LOCK = 7319001
+
+    def ensure_pg_partitions(table, from_ts, months_ahead=2):
+        # партиции по месяцам от from_ts до now + months_ahead; заранее, чтобы строки не копились в default
+        ts = month_bounds(from_ts)[0]
+        until = int(time.time()) + months_ahead * 31 * 86400
+        while ts <= until:
+            start, end, suffix = month_bounds(ts)
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {table}_p{suffix} PARTITION OF {table} FOR VALUES FROM ({start}) TO ({end})")
+            ts = end
+        db.commit()
+
+    def migrate_pg_tenancy():
+        # разовая миграция баз одного бота: состояния получают bot_id в первичном ключе, каналы — колонку bot_id;
+        # всё существующее принадлежит основному боту
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (PG_MIGRATION_LOCK,))
+        cur.execute("SELECT 1 FROM information_schema.columns WHERE table_name = 'user_states' AND column_name = 'bot_id'")
+        if cur.fetchone() is None:
+            logger.warning("Перевод user_states на ключ (bot_id, user_id)")
+            cur.execute("ALTER TABLE user_states ADD COLUMN bot_id BIGINT")
+            cur.execute("UPDATE user_states SET bot_id = %s", (DEFAULT_BOT_ID,))
+            cur.execute("ALTER TABLE user_states ALTER COLUMN bot_id SET NOT NULL")
+            cur.execute("ALTER TABLE user_states DROP CONSTRAINT user_states_pkey")
+            cur.execute("ALTER TABLE user_states ADD PRIMARY KEY (bot_id, user_id)")
+        cur.execute("ALTER TABLE channels ADD COLUMN IF NOT EXISTS bot_id BIGINT")
+        cur.execute("UPDATE channels SET bot_id = %s WHERE bot_id IS NULL", (DEFAULT_BOT_ID,))
+        db.commit()
+
+    def pg_is_partitioned(table):
+        cur.execute("SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = %s", (table,))
+        return cur.fetchone() is not None
+
+    def partition_pg_table(table):
+        # разовая миграция обычной таблицы в партиционированную по created_at (под advisory lock —
+        # воркеры стартуют одновременно); данные копируются, старая таблица удаляется
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (PG_MIGRATION_LOCK,))
+        if pg_is_partitioned(table):
+            db.commit()
+            return
+        columns = SUBMISSION_COLUMNS if table == "submissions" else ACTION_COLUMNS
+        logger.warning("Перевод таблицы %s на помесячные партиции", table)
+        cur.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+        cur.execute(f"CREATE TABLE {table} ({PARTITIONED_TABLES[table]}) PARTITION BY RANGE (created_at)")
+        cur.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+        cur.execute(f"SELECT coalesce(min(created_at), %s) FROM {table}_legacy", (int(time.time()),))
+        oldest = cur.fetchone()[0]
+        ts = month_bounds(oldest)[0]
+        while ts <= int(time.time()) + 62 * 86400:
+            start, end, suffix = month_bounds(ts)
+            cur.execute(f"CREATE TABLE {table}_p{suffix} PARTITION OF {table} FOR VALUES FROM ({start}) TO ({end})")
+            ts = end
+        select = columns.replace("created_at", "coalesce(created_at, 0)")
+        cur.execute(f"INSERT INTO {table} ({columns}) SELECT {select} FROM {table}_legacy")
+        cur.execute(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), coalesce((SELECT max(id) FROM {table}), 0) + 1, false)")
+        cur.execute(f"DROP TABLE {table}_legacy")
+        db.commit()
+
     # Создадим таблицы в Postgres (с типами, совместимыми с исходной логикой)
     def init_pg_tables():
         # используем BIGINT для id пользователей/каналов и BIGINT created_at (epoch)
@@ -68,7 +1197,8 @@ if USE_PG:
             owner_id BIGINT,
             channel_id TEXT UNIQUE,
             title TEXT,
-            created_at BIGINT
+            created_at BIGINT,
+            bot_id BIGINT
         );
         ''')
         cur.execute('''
@@ -105,11 +1235,14 @@ if USE_PG:
         ''')
         cur.execute('''
         CREATE TABLE IF NOT EXISTS user_states (
-            user_id BIGINT PRIMARY KEY,
+            bot_id BIGINT NOT NULL,
+            user_id BIGINT,
             state TEXT,
-            updated_at BIGINT
+            updated_at BIGINT,
+            PRIMARY KEY (bot_id, user_id)
         );
         ''')
+        migrate_pg_tenancy()
         cur.execute('''
         CREATE TABLE IF NOT EXISTS bans (
             id SERIAL PRIMARY KEY,
@@ -131,74 +1264,299 @@ if USE_PG:
         );
         ''')
         db.commit()
-
-    init_pg_tables()
-else:
-    # SQLite (fallback) — как было раньше
-    db = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
-    cur = db.cursor()
-
-    # channels: owner_id — тот, кто подключил канал
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS channels (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        owner_id INTEGER,
-        channel_id TEXT,
-        title TEXT,
-        created_at INTEGER
-    )
-    ''')
-
-    # гарантируем уникальность channel_id (чтобы не добавлять один и тот же канал несколько раз)
-    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_channels_channel_id ON channels(channel_id)")
-
-    # channel_admins: модераторы канала (owner может добавить нескольких)
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS channel_admins (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        channel_dbid INTEGER,
-        admin_user_id INTEGER,
-        added_by INTEGER,
-        created_at INTEGER,
-        UNIQUE(channel_dbid, admin_user_id)
-    )
-    ''')
-
-    # submissions: заявки от пользователей
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS submissions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        content_type TEXT,
-        text_content TEXT,
-        file_id TEXT,
-        status TEXT,
-        created_at INTEGER,
-        anonymous INTEGER DEFAULT 1,
-        target_channel_dbid INTEGER DEFAULT 0
-    )
-    ''')
-
-    # cooldowns: когда пользователь в последний раз успешно публиковал в канал
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS cooldowns (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        channel_dbid INTEGER,
-        last_ts INTEGER,
-        UNIQUE(user_id, channel_dbid)
-    )
-    ''')
-
-    # persistent user states (замена in-memory user_state)
-    cur.execute('''
-    CREATE TABLE IF NOT EXISTS user_states (
-        user_id INTEGER PRIMARY KEY,
-        state TEXT,
-        updated_at INTEGER
-    )
+        # помесячные партиции: до создания индексов ниже (при миграции индексы уходят вместе со старой таблицей)
+        if PG_PARTITIONING:
+            for table in PARTITIONED_TABLES:
+                partition_pg_table(table)
+                ensure_pg_partitions(table, int(time.time()))
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_submissions_retention ON submissions(target_channel_dbid, status, created_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_submission_actions_sub ON submission_actions(submission_id)")
+        # архив решённых заявок и их действий (переносит retention sweeper)
+        cur.execute(f'''
+        CREATE TABLE IF NOT EXISTS submissions_archive (
+            id INTEGER PRIMARY KEY,
+            user_id BIGINT,
+            content_type TEXT,
+            text_content TEXT,
+            file_id TEXT,
+            status TEXT,
+            created_at BIGINT,
+            anonymous INTEGER,
+            target_channel_dbid INTEGER,
+            archived_at BIGINT
+        );
+        ''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_submissions_archive_channel ON submissions_archive(target_channel_dbid, created_at)")
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS submission_actions_archive (
+            id INTEGER PRIMARY KEY,
+            submission_id INTEGER,
+            moderator_id BIGINT,
+            action TEXT,
+            note TEXT,
+            created_at BIGINT,
+            archived_at BIGINT
+        );
+        ''')
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS submission_messages (
+            id SERIAL PRIMARY KEY,
+            submission_id INTEGER,
+            chat_id BIGINT,
+            message_id BIGINT,
+            created_at BIGINT
+        );
+        ''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_submission_messages_sub ON submission_messages(submission_id)")
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS channel_settings (
+            channel_dbid INTEGER,
+            key TEXT,
+            value TEXT,
+            updated_at BIGINT,
+            PRIMARY KEY (channel_dbid, key)
+        );
+        ''')
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS submission_assignments (
+            submission_id INTEGER PRIMARY KEY,
+            channel_dbid INTEGER,
+            moderator_id BIGINT,
+            assigned_at BIGINT
+        );
+        ''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_submission_assignments_ts ON submission_assignments(assigned_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_submission_assignments_channel ON submission_assignments(channel_dbid, moderator_id)")
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS assign_cursors (
+            channel_dbid INTEGER PRIMARY KEY,
+            next_idx BIGINT DEFAULT 0
+        );
+        ''')
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS submission_fingerprints (
+            submission_id INTEGER PRIMARY KEY,
+            channel_dbid INTEGER,
+            media_id TEXT,
+            text_hash TEXT,
+            simhash BIGINT,
+            created_at BIGINT
+        );
+        ''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_fingerprints_media ON submission_fingerprints(channel_dbid, media_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_fingerprints_text ON submission_fingerprints(channel_dbid, text_hash)")
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS channel_daily_stats (
+            channel_dbid INTEGER,
+            day INTEGER,
+            submitted INTEGER DEFAULT 0,
+            accepted INTEGER DEFAULT 0,
+            rejected INTEGER DEFAULT 0,
+            published INTEGER DEFAULT 0,
+            decision_seconds BIGINT DEFAULT 0,
+            PRIMARY KEY (channel_dbid, day)
+        );
+        ''')
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS channel_decision_hist (
+            channel_dbid INTEGER,
+            day INTEGER,
+            bucket INTEGER,
+            count INTEGER DEFAULT 0,
+            PRIMARY KEY (channel_dbid, day, bucket)
+        );
+        ''')
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS moderator_digests (
+            channel_dbid INTEGER,
+            moderator_id BIGINT,
+            window_seconds INTEGER,
+            last_submission_id INTEGER DEFAULT 0,
+            last_sent_at BIGINT DEFAULT 0,
+            sent_ids TEXT DEFAULT '[]',
+            PRIMARY KEY (channel_dbid, moderator_id)
+        );
+        ''')
+        cur.execute("ALTER TABLE moderator_digests ADD COLUMN IF NOT EXISTS sent_ids TEXT DEFAULT '[]'")
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS bot_offsets (
+            name TEXT PRIMARY KEY,
+            update_offset BIGINT,
+            done_ids TEXT
+        );
+        ''')
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS rate_buckets (
+            bucket_key TEXT PRIMARY KEY,
+            tokens DOUBLE PRECISION,
+            updated_at DOUBLE PRECISION,
+            allowed INTEGER DEFAULT 1
+        );
+        ''')
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS channel_rules (
+            id SERIAL PRIMARY KEY,
+            channel_dbid INTEGER,
+            kind TEXT,
+            pattern TEXT,
+            action TEXT,
+            added_by BIGINT,
+            created_at BIGINT
+        );
+        ''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_channel_rules_channel ON channel_rules(channel_dbid)")
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id SERIAL PRIMARY KEY,
+            channel_dbid INTEGER,
+            owner_id BIGINT,
+            text TEXT,
+            status TEXT,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            last_user_id BIGINT DEFAULT 0,
+            progress_chat_id BIGINT,
+            progress_message_id BIGINT,
+            lease_owner TEXT,
+            lease_until BIGINT DEFAULT 0,
+            created_at BIGINT,
+            updated_at BIGINT
+        );
+        ''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)")
+        # не больше одной незавершённой рассылки на канал; дубликаты, успевшие появиться до индекса, отменяются
+        cur.execute("UPDATE broadcast_jobs SET status = 'cancelled' WHERE status IN ('new', 'running', 'paused') AND id NOT IN "
+                    "(SELECT MAX(id) FROM broadcast_jobs WHERE status IN ('new', 'running', 'paused') GROUP BY channel_dbid)")
+        cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_broadcast_jobs_active ON broadcast_jobs(channel_dbid) WHERE status IN ('new', 'running', 'paused')")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_submissions_channel_user ON submissions(target_channel_dbid, user_id)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_submissions_archive_user ON submissions_archive(target_channel_dbid, user_id)")
+        cur.execute('''
+        CREATE TABLE IF NOT EXISTS maintenance_runs (
+            task TEXT PRIMARY KEY,
+            last_run_at BIGINT DEFAULT 0,
+            rows_processed INTEGER DEFAULT 0,
+            seconds DOUBLE PRECISION DEFAULT 0
+        );
+        ''')
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_submissions_status_created ON submissions(status, created_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_user_states_updated ON user_states(updated_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_cooldowns_last_ts ON cooldowns(last_ts)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_channels_bot_owner ON channels(bot_id, owner_id)")
+        # полнотекстовый поиск: GIN-индекс по выражению, Postgres обновляет его сам при каждой записи
+        cur.execute(f"CREATE INDEX IF NOT EXISTS idx_submissions_fts ON submissions USING GIN (to_tsvector('{PG_SEARCH_CONFIG}', coalesce(text_content, '')))")
+        # инвалидация кэшей в других воркерах: триггеры шлют NOTIFY на каждую запись
+        cur.execute('''
+        CREATE OR REPLACE FUNCTION teleform_notify_invalidate() RETURNS trigger AS $$
+        DECLARE
+            r RECORD;
+            k TEXT;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN r := OLD; ELSE r := NEW; END IF;
+            IF TG_TABLE_NAME = 'channels' THEN
+                k := r.id::text;
+            ELSIF TG_TABLE_NAME IN ('channel_admins', 'channel_rules') THEN
+                k := r.channel_dbid::text;
+            ELSIF TG_TABLE_NAME = 'bans' THEN
+                k := r.channel_dbid::text || ':' || r.user_id::text;
+            ELSE
+                k := r.user_id::text || ':' || r.channel_dbid::text;
+            END IF;
+            PERFORM pg_notify('teleform_invalidate', TG_TABLE_NAME || ':' || k);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        ''')
+        for table in INVALIDATION_TOPICS:
+            cur.execute(f"DROP TRIGGER IF EXISTS teleform_invalidate ON {table}")
+            cur.execute(f"CREATE TRIGGER teleform_invalidate AFTER INSERT OR UPDATE OR DELETE ON {table} FOR EACH ROW EXECUTE PROCEDURE teleform_notify_invalidate()")
+        db.commit()
+
+    init_pg_tables()
+else:
+    # SQLite (fallback) — как было раньше
+    db = GuardedConnection(lambda: sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30))
+    cur = ThreadCursor(db)
+    # incremental vacuum: в новой базе включается сразу, существующая переводится при старте (ниже)
+    cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
+    # channels: owner_id — тот, кто подключил канал
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS channels (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        owner_id INTEGER,
+        channel_id TEXT,
+        title TEXT,
+        created_at INTEGER,
+        bot_id INTEGER
+    )
+    ''')
+    # bot_id: какой из ботов процесса обслуживает канал; в базах одного бота колонки не было
+    cur.execute("PRAGMA table_info(channels)")
+    if "bot_id" not in [r[1] for r in cur.fetchall()]:
+        cur.execute("ALTER TABLE channels ADD COLUMN bot_id INTEGER")
+    cur.execute("UPDATE channels SET bot_id = ? WHERE bot_id IS NULL", (DEFAULT_BOT_ID,))
+
+    # гарантируем уникальность channel_id (чтобы не добавлять один и тот же канал несколько раз)
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_channels_channel_id ON channels(channel_id)")
+
+    # channel_admins: модераторы канала (owner может добавить нескольких)
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS channel_admins (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        channel_dbid INTEGER,
+        admin_user_id INTEGER,
+        added_by INTEGER,
+        created_at INTEGER,
+        UNIQUE(channel_dbid, admin_user_id)
+    )
+    ''')
+
+    # submissions: заявки от пользователей
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS submissions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        content_type TEXT,
+        text_content TEXT,
+        file_id TEXT,
+        status TEXT,
+        created_at INTEGER,
+        anonymous INTEGER DEFAULT 1,
+        target_channel_dbid INTEGER DEFAULT 0
+    )
+    ''')
+
+    # cooldowns: когда пользователь в последний раз успешно публиковал в канал
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS cooldowns (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        channel_dbid INTEGER,
+        last_ts INTEGER,
+        UNIQUE(user_id, channel_dbid)
+    )
     ''')
 
+    # persistent user states (замена in-memory user_state); у каждого бота свои диалоги
+    cur.execute("PRAGMA table_info(user_states)")
+    state_columns = [r[1] for r in cur.fetchall()]
+    if state_columns and "bot_id" not in state_columns:
+        # первичный ключ в SQLite не поменять — пересоздаём таблицу, состояния достаются основному боту
+        cur.execute("ALTER TABLE user_states RENAME TO user_states_legacy")
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS user_states (
+        bot_id INTEGER NOT NULL,
+        user_id INTEGER,
+        state TEXT,
+        updated_at INTEGER,
+        PRIMARY KEY (bot_id, user_id)
+    )
+    ''')
+    if state_columns and "bot_id" not in state_columns:
+        cur.execute("INSERT INTO user_states (bot_id, user_id, state, updated_at) SELECT ?, user_id, state, updated_at FROM user_states_legacy", (DEFAULT_BOT_ID,))
+        cur.execute("DROP TABLE user_states_legacy")
+
     # bans: локальные баны по каналу
     cur.execute('''
     CREATE TABLE IF NOT EXISTS bans (
@@ -222,54 +1580,437 @@ else:
         created_at INTEGER
     )
     ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_submissions_retention ON submissions(target_channel_dbid, status, created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_submission_actions_sub ON submission_actions(submission_id)")
+
+    # архив: решённые заявки старше срока хранения переносятся в отдельный файл (retention sweeper),
+    # основная база остаётся маленькой
+    cur.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_PATH,))
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS archive.submissions_archive (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        content_type TEXT,
+        text_content TEXT,
+        file_id TEXT,
+        status TEXT,
+        created_at INTEGER,
+        anonymous INTEGER,
+        target_channel_dbid INTEGER,
+        archived_at INTEGER
+    )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS archive.idx_submissions_archive_channel ON submissions_archive(target_channel_dbid, created_at)")
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS archive.submission_actions_archive (
+        id INTEGER PRIMARY KEY,
+        submission_id INTEGER,
+        moderator_id INTEGER,
+        action TEXT,
+        note TEXT,
+        created_at INTEGER,
+        archived_at INTEGER
+    )
+    ''')
+
+    # submission_messages: контрольные сообщения (с кнопками), разосланные модераторам
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS submission_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        submission_id INTEGER,
+        chat_id INTEGER,
+        message_id INTEGER,
+        created_at INTEGER
+    )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_submission_messages_sub ON submission_messages(submission_id)")
+
+    # channel_settings: настройки канала в виде ключ/значение (режим распределения и т.п.)
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS channel_settings (
+        channel_dbid INTEGER,
+        key TEXT,
+        value TEXT,
+        updated_at INTEGER,
+        PRIMARY KEY (channel_dbid, key)
+    )
+    ''')
+
+    # submission_assignments: за каким модератором закреплена заявка (режимы round_robin / least_loaded)
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS submission_assignments (
+        submission_id INTEGER PRIMARY KEY,
+        channel_dbid INTEGER,
+        moderator_id INTEGER,
+        assigned_at INTEGER
+    )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_submission_assignments_ts ON submission_assignments(assigned_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_submission_assignments_channel ON submission_assignments(channel_dbid, moderator_id)")
+
+    # assign_cursors: позиция round_robin канала — общая для всех воркеров
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS assign_cursors (
+        channel_dbid INTEGER PRIMARY KEY,
+        next_idx INTEGER DEFAULT 0
+    )
+    ''')
+
+    # submission_fingerprints: отпечатки заявок для поиска дубликатов (file_unique_id медиа, хэш и SimHash текста)
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS submission_fingerprints (
+        submission_id INTEGER PRIMARY KEY,
+        channel_dbid INTEGER,
+        media_id TEXT,
+        text_hash TEXT,
+        simhash INTEGER,
+        created_at INTEGER
+    )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_fingerprints_media ON submission_fingerprints(channel_dbid, media_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_fingerprints_text ON submission_fingerprints(channel_dbid, text_hash)")
+
+    # channel_daily_stats: свёртка заявок канала по дням (day = created_at // 86400, UTC); решения считаются
+    # в день решения, decision_seconds — сумма времени от подачи до решения
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS channel_daily_stats (
+        channel_dbid INTEGER,
+        day INTEGER,
+        submitted INTEGER DEFAULT 0,
+        accepted INTEGER DEFAULT 0,
+        rejected INTEGER DEFAULT 0,
+        published INTEGER DEFAULT 0,
+        decision_seconds INTEGER DEFAULT 0,
+        PRIMARY KEY (channel_dbid, day)
+    )
+    ''')
+    # channel_decision_hist: гистограмма времени до решения по корзинам DECISION_BUCKETS — для медианы
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS channel_decision_hist (
+        channel_dbid INTEGER,
+        day INTEGER,
+        bucket INTEGER,
+        count INTEGER DEFAULT 0,
+        PRIMARY KEY (channel_dbid, day, bucket)
+    )
+    ''')
+
+    # moderator_digests: подписка модератора на дайджест по каналу; last_submission_id — позиция в потоке заявок,
+    # sent_ids — уже показанные заявки выше позиции
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS moderator_digests (
+        channel_dbid INTEGER,
+        moderator_id INTEGER,
+        window_seconds INTEGER,
+        last_submission_id INTEGER DEFAULT 0,
+        last_sent_at INTEGER DEFAULT 0,
+        sent_ids TEXT DEFAULT '[]',
+        PRIMARY KEY (channel_dbid, moderator_id)
+    )
+    ''')
+    cur.execute("PRAGMA table_info(moderator_digests)")
+    if "sent_ids" not in [r[1] for r in cur.fetchall()]:
+        cur.execute("ALTER TABLE moderator_digests ADD COLUMN sent_ids TEXT DEFAULT '[]'")
+
+    # bot_offsets: позиция getUpdates в режиме polling (+ id уже обработанных апдейтов выше позиции)
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS bot_offsets (
+        name TEXT PRIMARY KEY,
+        update_offset INTEGER,
+        done_ids TEXT
+    )
+    ''')
+
+    # rate_buckets: общие token bucket'ы защиты от флуда (режим FLOOD_SHARED)
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS rate_buckets (
+        bucket_key TEXT PRIMARY KEY,
+        tokens REAL,
+        updated_at REAL,
+        allowed INTEGER DEFAULT 1
+    )
+    ''')
+
+    # channel_rules: правила автомодерации канала (ключевые слова, regex, лимиты ссылок/упоминаний, типы)
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS channel_rules (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        channel_dbid INTEGER,
+        kind TEXT,
+        pattern TEXT,
+        action TEXT,
+        added_by INTEGER,
+        created_at INTEGER
+    )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_channel_rules_channel ON channel_rules(channel_dbid)")
+
+    # broadcast_jobs: рассылки владельцев каналов авторам заявок; last_user_id — чекпоинт (получатели идут
+    # по возрастанию user_id), lease_* — аренда задачи воркером, чтобы её не выполняли двое
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        channel_dbid INTEGER,
+        owner_id INTEGER,
+        text TEXT,
+        status TEXT,
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        last_user_id INTEGER DEFAULT 0,
+        progress_chat_id INTEGER,
+        progress_message_id INTEGER,
+        lease_owner TEXT,
+        lease_until INTEGER DEFAULT 0,
+        created_at INTEGER,
+        updated_at INTEGER
+    )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)")
+    # не больше одной незавершённой рассылки на канал; дубликаты, успевшие появиться до индекса, отменяются
+    cur.execute("UPDATE broadcast_jobs SET status = 'cancelled' WHERE status IN ('new', 'running', 'paused') AND id NOT IN "
+                "(SELECT MAX(id) FROM broadcast_jobs WHERE status IN ('new', 'running', 'paused') GROUP BY channel_dbid)")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_broadcast_jobs_active ON broadcast_jobs(channel_dbid) WHERE status IN ('new', 'running', 'paused')")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_submissions_channel_user ON submissions(target_channel_dbid, user_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS archive.idx_submissions_archive_user ON submissions_archive(target_channel_dbid, user_id)")
+
+    # maintenance_runs: последний проход каждой задачи обслуживания (для CAS между воркерами и отчёта)
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS maintenance_runs (
+        task TEXT PRIMARY KEY,
+        last_run_at INTEGER DEFAULT 0,
+        rows_processed INTEGER DEFAULT 0,
+        seconds REAL DEFAULT 0
+    )
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_submissions_status_created ON submissions(status, created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_states_updated ON user_states(updated_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_cooldowns_last_ts ON cooldowns(last_ts)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_channels_bot_owner ON channels(bot_id, owner_id)")
+
+    # submissions_fts: полнотекстовый индекс FTS5 по тексту заявок (external content — текст не дублируется),
+    # поддерживается триггерами; при первом создании заполняется из уже сохранённых заявок
+    try:
+        cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'submissions_fts'")
+        fts_existed = cur.fetchone() is not None
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS submissions_fts USING fts5(text_content, content='submissions', content_rowid='id')")
+        cur.execute("CREATE TRIGGER IF NOT EXISTS submissions_fts_insert AFTER INSERT ON submissions BEGIN INSERT INTO submissions_fts(rowid, text_content) VALUES (new.id, new.text_content); END")
+        cur.execute("CREATE TRIGGER IF NOT EXISTS submissions_fts_delete AFTER DELETE ON submissions BEGIN INSERT INTO submissions_fts(submissions_fts, rowid, text_content) VALUES ('delete', old.id, old.text_content); END")
+        cur.execute("CREATE TRIGGER IF NOT EXISTS submissions_fts_update AFTER UPDATE OF text_content ON submissions BEGIN INSERT INTO submissions_fts(submissions_fts, rowid, text_content) VALUES ('delete', old.id, old.text_content); INSERT INTO submissions_fts(rowid, text_content) VALUES (new.id, new.text_content); END")
+        if not fts_existed:
+            cur.execute("INSERT INTO submissions_fts(submissions_fts) VALUES ('rebuild')")
+        SEARCH_FTS = True
+    except sqlite3.OperationalError:
+        # SQLite собран без FTS5 — поиск через LIKE
+        logger.warning("FTS5 недоступен, /search будет работать через LIKE")
+        SEARCH_FTS = False
+
+    # cache_versions: счётчик версий по таблице; триггеры увеличивают его при записи,
+    # воркеры опрашивают таблицу и сбрасывают свои кэши (аналог LISTEN/NOTIFY)
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS cache_versions (
+        topic TEXT PRIMARY KEY,
+        version INTEGER DEFAULT 0
+    )
+    ''')
+    for table in INVALIDATION_TOPICS:
+        cur.execute("INSERT OR IGNORE INTO cache_versions (topic, version) VALUES (?, 0)", (table,))
+        for op in ("INSERT", "UPDATE", "DELETE"):
+            cur.execute(f"CREATE TRIGGER IF NOT EXISTS teleform_invalidate_{table}_{op.lower()} AFTER {op} ON {table} BEGIN UPDATE cache_versions SET version = version + 1 WHERE topic = '{table}'; END")
 
     db.commit()
 
+    # база, созданная без incremental vacuum, переводится одним полным VACUUM — здесь, до приёма апдейтов:
+    # он переписывает весь файл под эксклюзивной блокировкой, в периодическом обслуживании ему не место
+    cur.execute("PRAGMA auto_vacuum")
+    if cur.fetchone()[0] != 2:
+        logger.info("Перевод базы %s на incremental auto_vacuum (полный VACUUM)", DB_PATH)
+        _vacuum_conn = sqlite3.connect(DB_PATH, timeout=60, isolation_level=None)
+        try:
+            t0 = time.perf_counter()
+            _vacuum_conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            _vacuum_conn.execute("VACUUM")
+            logger.info("Полный VACUUM выполнен за %.1f с", time.perf_counter() - t0)
+        except sqlite3.OperationalError as e:
+            # база занята другим процессом — попробуем при следующем старте
+            logger.warning("Не удалось перевести базу на incremental auto_vacuum: %s", e)
+        finally:
+            _vacuum_conn.close()
+
 # ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
 def now_ts():
     return int(time.time())
 
-# state persistence
-def set_state(user_id, state):
-    ts = now_ts()
-    try:
-        if USE_PG:
-            cur.execute("INSERT INTO user_states (user_id, state, updated_at) VALUES (%s, %s, %s) ON CONFLICT (user_id) DO UPDATE SET state = EXCLUDED.state, updated_at = EXCLUDED.updated_at", (user_id, state, ts))
-            db.commit()
-        else:
-            cur.execute("INSERT OR REPLACE INTO user_states (user_id, state, updated_at) VALUES (?, ?, ?)", (user_id, state, ts))
-            db.commit()
-    except Exception:
-        pass
+# ========== ИНВАЛИДАЦИЯ КЭШЕЙ МЕЖДУ ВОРКЕРАМИ ==========
+# Кэш регистрирует обработчик on_invalidate(topic, fn); fn(key) вызывается при записи в таблицу topic
+# в любом воркере. key — строка ключа строки ("<dbid>", "<dbid>:<user_id>", ...) или None = сбросить всё.
+_invalidation_handlers = {}
 
-def get_state(user_id):
-    if USE_PG:
-        cur.execute("SELECT state FROM user_states WHERE user_id = %s", (user_id,))
-        r = cur.fetchone()
+def on_invalidate(topic, fn):
+    _invalidation_handlers.setdefault(topic, []).append(fn)
+
+def dispatch_invalidation(topic, key=None):
+    for fn in _invalidation_handlers.get(topic, ()):
+        try:
+            fn(key)
+        except Exception:
+            logger.exception("Ошибка обработчика инвалидации %s", topic)
+    metric_inc("cache_invalidations")
+
+def _flush_all_caches():
+    for topic in INVALIDATION_TOPICS:
+        dispatch_invalidation(topic, None)
+
+def _pg_invalidation_listener():
+    import select
+    while True:
+        conn = None
+        try:
+            conn = pg_connect()
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute("LISTEN teleform_invalidate")
+            # пока слушателя не было (старт или переподключение), уведомления могли потеряться
+            _flush_all_caches()
+            metric_inc("invalidation_listener_connects")
+            while True:
+                if select.select([conn], [], [], 30) == ([], [], []):
+                    # тишина: проверяем, что соединение живо (keepalive ловит обрыв TCP, это — зависший сервер)
+                    conn.cursor().execute("SELECT 1")
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    n = conn.notifies.pop(0)
+                    topic, _, key = n.payload.partition(":")
+                    dispatch_invalidation(topic, key or None)
+        except Exception:
+            logger.exception("Слушатель инвалидации Postgres упал, переподключение")
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+
+def _sqlite_invalidation_poller():
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    seen = {}
+    while True:
+        try:
+            for topic, version in conn.execute("SELECT topic, version FROM cache_versions"):
+                if topic in seen and seen[topic] != version:
+                    dispatch_invalidation(topic, None)
+                seen[topic] = version
+        except Exception:
+            logger.exception("Опрос cache_versions не удался")
+        time.sleep(CACHE_POLL_INTERVAL)
+
+def start_invalidation_listener():
+    target = _pg_invalidation_listener if USE_PG else _sqlite_invalidation_poller
+    threading.Thread(target=target, name="cache-invalidation", daemon=True).start()
+
+# ========== ПРЕДЗАГРУЗКА ДАННЫХ ДЛЯ ПАКЕТА АПДЕЙТОВ ==========
+# Перед обработкой пакета все нужные строки грузятся одним IN (...) запросом на таблицу;
+# функции чтения ниже сначала смотрят в контекст пакета. Записи обновляют все живые контексты.
+class PrefetchContext:
+    def __init__(self):
+        self.bot_id = None      # чей пакет: состояния у каждого бота свои
+        self.states = {}        # user_id -> state | None
+        self.channels = {}      # dbid -> (id, owner_id, channel_id, title) | None
+        self.admins = {}        # dbid -> [admin_user_id, ...]
+        self.cooldowns = {}     # (user_id, dbid) -> last_ts | None
+        self.bans = {}          # (dbid, user_id) -> bool
+        self.submissions = {}   # sub_id -> row | None
+
+_prefetch_local = threading.local()
+_live_prefetch = weakref.WeakSet()
+_live_prefetch_lock = threading.Lock()
+_MISSING = object()
+
+def current_prefetch():
+    return getattr(_prefetch_local, "ctx", None)
+
+@contextmanager
+def use_prefetch(ctx):
+    prev = current_prefetch()
+    _prefetch_local.ctx = ctx
+    try:
+        yield ctx
+    finally:
+        _prefetch_local.ctx = prev
+
+def prefetch_lookup(kind, key):
+    ctx = current_prefetch()
+    if ctx is None:
+        return _MISSING
+    value = getattr(ctx, kind).get(key, _MISSING)
+    if value is not _MISSING:
+        metric_inc("prefetch_hit")
+    return value
+
+def prefetch_invalidate(kind, key, value=_MISSING):
+    # запись в БД: обновляем (или выбрасываем) ключ во всех контекстах, которые сейчас в работе
+    with _live_prefetch_lock:
+        contexts = list(_live_prefetch)
+    bot_id = current_bot_id()
+    for ctx in contexts:
+        if kind == "states" and ctx.bot_id != bot_id:
+            continue
+        table = getattr(ctx, kind)
+        if value is _MISSING:
+            table.pop(key, None)
+        else:
+            table[key] = value
+
+# state persistence
+def set_state(user_id, state):
+    ts = now_ts()
+    try:
+        if USE_PG:
+            cur.execute("INSERT INTO user_states (bot_id, user_id, state, updated_at) VALUES (%s, %s, %s, %s) ON CONFLICT (bot_id, user_id) DO UPDATE SET state = EXCLUDED.state, updated_at = EXCLUDED.updated_at", (current_bot_id(), user_id, state, ts))
+            db.commit()
+        else:
+            cur.execute("INSERT OR REPLACE INTO user_states (bot_id, user_id, state, updated_at) VALUES (?, ?, ?, ?)", (current_bot_id(), user_id, state, ts))
+            db.commit()
+        prefetch_invalidate("states", user_id, state)
+    except Exception:
+        pass
+
+def get_state(user_id):
+    cached = prefetch_lookup("states", user_id)
+    if cached is not _MISSING:
+        return cached
+    if USE_PG:
+        cur.execute("SELECT state FROM user_states WHERE bot_id = %s AND user_id = %s", (current_bot_id(), user_id))
+        r = cur.fetchone()
     else:
-        cur.execute("SELECT state FROM user_states WHERE user_id = ?", (user_id,))
+        cur.execute("SELECT state FROM user_states WHERE bot_id = ? AND user_id = ?", (current_bot_id(), user_id))
         r = cur.fetchone()
     return r[0] if r else None
 
 def pop_state(user_id):
+    # состояния нет и в предзагрузке — в БД идти незачем
+    if prefetch_lookup("states", user_id) is None:
+        return None
+    bot_id = current_bot_id()
     if USE_PG:
-        cur.execute("SELECT state FROM user_states WHERE user_id = %s", (user_id,))
+        cur.execute("SELECT state FROM user_states WHERE bot_id = %s AND user_id = %s", (bot_id, user_id))
         r = cur.fetchone()
         if not r:
             return None
         state = r[0]
-        cur.execute("DELETE FROM user_states WHERE user_id = %s", (user_id,))
+        cur.execute("DELETE FROM user_states WHERE bot_id = %s AND user_id = %s", (bot_id, user_id))
         db.commit()
-        return state
     else:
-        cur.execute("SELECT state FROM user_states WHERE user_id = ?", (user_id,))
+        cur.execute("SELECT state FROM user_states WHERE bot_id = ? AND user_id = ?", (bot_id, user_id))
         r = cur.fetchone()
         if not r:
             return None
         state = r[0]
-        cur.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
+        cur.execute("DELETE FROM user_states WHERE bot_id = ? AND user_id = ?", (bot_id, user_id))
         db.commit()
-        return state
+    prefetch_invalidate("states", user_id, None)
+    return state
 
 # channels
 def add_channel(owner_id, channel_id, title):
@@ -282,9 +2023,10 @@ def add_channel(owner_id, channel_id, title):
         if existing:
             return existing[0]
         try:
-            cur.execute("INSERT INTO channels (owner_id, channel_id, title, created_at) VALUES (%s, %s, %s, %s) RETURNING id", (owner_id, key, title, ts))
+            cur.execute("INSERT INTO channels (owner_id, channel_id, title, created_at, bot_id) VALUES (%s, %s, %s, %s, %s) RETURNING id", (owner_id, key, title, ts, current_bot_id()))
             new_id = cur.fetchone()[0]
             db.commit()
+            _acl_forget_user(owner_id)
             return new_id
         except psycopg2.IntegrityError:
             cur.execute("SELECT id FROM channels WHERE channel_id = %s", (key,))
@@ -298,8 +2040,9 @@ def add_channel(owner_id, channel_id, title):
         if existing:
             return existing[0]
         try:
-            cur.execute("INSERT INTO channels (owner_id, channel_id, title, created_at) VALUES (?, ?, ?, ?)", (owner_id, key, title, ts))
+            cur.execute("INSERT INTO channels (owner_id, channel_id, title, created_at, bot_id) VALUES (?, ?, ?, ?, ?)", (owner_id, key, title, ts, current_bot_id()))
             db.commit()
+            _acl_forget_user(owner_id)
             return cur.lastrowid
         except sqlite3.IntegrityError:
             cur.execute("SELECT id FROM channels WHERE channel_id = ?", (key,))
@@ -310,31 +2053,76 @@ def add_channel(owner_id, channel_id, title):
 
 def list_channels_by_owner(owner_id):
     if USE_PG:
-        cur.execute("SELECT id, channel_id, title FROM channels WHERE owner_id = %s ORDER BY created_at DESC", (owner_id,))
-        return cur.fetchall()
+        return read_fetch("SELECT id, channel_id, title FROM channels WHERE owner_id = %s AND bot_id = %s ORDER BY created_at DESC", (owner_id, current_bot_id()))
     else:
-        cur.execute("SELECT id, channel_id, title FROM channels WHERE owner_id = ? ORDER BY created_at DESC", (owner_id,))
-        return cur.fetchall()
+        return read_fetch("SELECT id, channel_id, title FROM channels WHERE owner_id = ? AND bot_id = ? ORDER BY created_at DESC", (owner_id, current_bot_id()))
 
 def get_channel_by_dbid(dbid):
+    cached = prefetch_lookup("channels", dbid)
+    if cached is not _MISSING:
+        return cached
+    # от имени бота (апдейт, фоновая задача по каналу) видны только его каналы
+    if tenant_active():
+        if USE_PG:
+            return read_fetch("SELECT id, owner_id, channel_id, title FROM channels WHERE id = %s AND bot_id = %s", (dbid, current_bot_id()), one=True)
+        else:
+            return read_fetch("SELECT id, owner_id, channel_id, title FROM channels WHERE id = ? AND bot_id = ?", (dbid, current_bot_id()), one=True)
     if USE_PG:
-        cur.execute("SELECT id, owner_id, channel_id, title FROM channels WHERE id = %s", (dbid,))
-        return cur.fetchone()
+        return read_fetch("SELECT id, owner_id, channel_id, title FROM channels WHERE id = %s", (dbid,), one=True)
     else:
-        cur.execute("SELECT id, owner_id, channel_id, title FROM channels WHERE id = ?", (dbid,))
-        return cur.fetchone()
+        return read_fetch("SELECT id, owner_id, channel_id, title FROM channels WHERE id = ?", (dbid,), one=True)
+
+# бот канала не меняется, а dbid не переиспользуются — кэш без инвалидации
+_channel_bots = {}
+
+def channel_bot(dbid):
+    # бот процесса, который обслуживает канал (канал бота, которого в процессе нет, — основной)
+    bot_id = _channel_bots.get(dbid)
+    if bot_id is None:
+        c = db.cursor()
+        try:
+            if USE_PG:
+                c.execute("SELECT bot_id FROM channels WHERE id = %s", (dbid,))
+            else:
+                c.execute("SELECT bot_id FROM channels WHERE id = ?", (dbid,))
+            r = c.fetchone()
+        finally:
+            c.close()
+        if not r:
+            return default_bot
+        bot_id = _channel_bots[dbid] = r[0] or DEFAULT_BOT_ID
+    return BOTS.get(bot_id, default_bot)
+
+def channel_tenant(dbid):
+    # фоновые задачи: сообщения по каналу — от имени его бота
+    return use_tenant(channel_bot(dbid))
 
 def remove_channel(dbid):
     if USE_PG:
         cur.execute("DELETE FROM channels WHERE id = %s", (dbid,))
         cur.execute("DELETE FROM channel_admins WHERE channel_dbid = %s", (dbid,))
         cur.execute("DELETE FROM bans WHERE channel_dbid = %s", (dbid,))
+        cur.execute("DELETE FROM channel_settings WHERE channel_dbid = %s", (dbid,))
+        cur.execute("DELETE FROM moderator_digests WHERE channel_dbid = %s", (dbid,))
+        cur.execute("DELETE FROM channel_rules WHERE channel_dbid = %s", (dbid,))
+        cur.execute("DELETE FROM channel_daily_stats WHERE channel_dbid = %s", (dbid,))
+        cur.execute("DELETE FROM channel_decision_hist WHERE channel_dbid = %s", (dbid,))
+        cur.execute("DELETE FROM assign_cursors WHERE channel_dbid = %s", (dbid,))
         db.commit()
     else:
         cur.execute("DELETE FROM channels WHERE id = ?", (dbid,))
         cur.execute("DELETE FROM channel_admins WHERE channel_dbid = ?", (dbid,))
         cur.execute("DELETE FROM bans WHERE channel_dbid = ?", (dbid,))
+        cur.execute("DELETE FROM channel_settings WHERE channel_dbid = ?", (dbid,))
+        cur.execute("DELETE FROM moderator_digests WHERE channel_dbid = ?", (dbid,))
+        cur.execute("DELETE FROM channel_rules WHERE channel_dbid = ?", (dbid,))
+        cur.execute("DELETE FROM channel_daily_stats WHERE channel_dbid = ?", (dbid,))
+        cur.execute("DELETE FROM channel_decision_hist WHERE channel_dbid = ?", (dbid,))
+        cur.execute("DELETE FROM assign_cursors WHERE channel_dbid = ?", (dbid,))
         db.commit()
+    prefetch_invalidate("channels", dbid, None)
+    prefetch_invalidate("admins", dbid, [])
+    _acl_drop(dbid)
 
 # channel admins
 def add_channel_admin(channel_dbid, admin_user_id, added_by):
@@ -343,6 +2131,8 @@ def add_channel_admin(channel_dbid, admin_user_id, added_by):
         try:
             cur.execute("INSERT INTO channel_admins (channel_dbid, admin_user_id, added_by, created_at) VALUES (%s, %s, %s, %s)", (channel_dbid, admin_user_id, added_by, ts))
             db.commit()
+            prefetch_invalidate("admins", channel_dbid)
+            _acl_update(channel_dbid, add=admin_user_id)
             return True
         except psycopg2.IntegrityError:
             return False
@@ -352,11 +2142,16 @@ def add_channel_admin(channel_dbid, admin_user_id, added_by):
         try:
             cur.execute("INSERT INTO channel_admins (channel_dbid, admin_user_id, added_by, created_at) VALUES (?, ?, ?, ?)", (channel_dbid, admin_user_id, added_by, ts))
             db.commit()
+            prefetch_invalidate("admins", channel_dbid)
+            _acl_update(channel_dbid, add=admin_user_id)
             return True
         except sqlite3.IntegrityError:
             return False
 
 def list_channel_admins(channel_dbid):
+    cached = prefetch_lookup("admins", channel_dbid)
+    if cached is not _MISSING:
+        return list(cached)
     if USE_PG:
         cur.execute("SELECT admin_user_id FROM channel_admins WHERE channel_dbid = %s", (channel_dbid,))
         return [r[0] for r in cur.fetchall()]
@@ -371,6 +2166,8 @@ def remove_channel_admin(channel_dbid, admin_user_id):
     else:
         cur.execute("DELETE FROM channel_admins WHERE channel_dbid = ? AND admin_user_id = ?", (channel_dbid, admin_user_id))
         db.commit()
+    prefetch_invalidate("admins", channel_dbid)
+    _acl_update(channel_dbid, remove=admin_user_id)
 
 # submissions
 def save_submission(user_id, content_type, text_content, file_id, anonymous, target_channel_dbid=0):
@@ -378,39 +2175,303 @@ def save_submission(user_id, content_type, text_content, file_id, anonymous, tar
     if USE_PG:
         cur.execute("INSERT INTO submissions (user_id, content_type, text_content, file_id, status, created_at, anonymous, target_channel_dbid) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id", (user_id, content_type, text_content, file_id, "pending", ts, 1 if anonymous else 0, target_channel_dbid))
         new_id = cur.fetchone()[0]
+        record_channel_stat(cur, target_channel_dbid, ts, "submitted")
         db.commit()
         return new_id
     else:
         cur.execute("INSERT INTO submissions (user_id, content_type, text_content, file_id, status, created_at, anonymous, target_channel_dbid) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (user_id, content_type, text_content, file_id, "pending", ts, 1 if anonymous else 0, target_channel_dbid))
+        new_id = cur.lastrowid
+        record_channel_stat(cur, target_channel_dbid, ts, "submitted")
         db.commit()
-        return cur.lastrowid
+        return new_id
 
 def get_submission(sub_id):
+    cached = prefetch_lookup("submissions", sub_id)
+    if cached is not _MISSING:
+        return cached
     if USE_PG:
-        cur.execute("SELECT id, user_id, content_type, text_content, file_id, status, created_at, anonymous, target_channel_dbid FROM submissions WHERE id = %s", (sub_id,))
-        return cur.fetchone()
+        return read_fetch("SELECT id, user_id, content_type, text_content, file_id, status, created_at, anonymous, target_channel_dbid FROM submissions WHERE id = %s", (sub_id,), one=True)
     else:
-        cur.execute("SELECT id, user_id, content_type, text_content, file_id, status, created_at, anonymous, target_channel_dbid FROM submissions WHERE id = ?", (sub_id,))
-        return cur.fetchone()
+        return read_fetch("SELECT id, user_id, content_type, text_content, file_id, status, created_at, anonymous, target_channel_dbid FROM submissions WHERE id = ?", (sub_id,), one=True)
 
 def set_submission_status(sub_id, status, moderator_id=None, note=None):
     ts = now_ts()
     if USE_PG:
+        cur.execute("SELECT status FROM submissions WHERE id = %s FOR UPDATE", (sub_id,))
+        row = cur.fetchone()
         cur.execute("UPDATE submissions SET status = %s WHERE id = %s", (status, sub_id))
-        if moderator_id:
-            try:
-                cur.execute("INSERT INTO submission_actions (submission_id, moderator_id, action, note, created_at) VALUES (%s, %s, %s, %s, %s)", (sub_id, moderator_id, status, note or "", ts))
-            except Exception:
-                pass
+        if row and row[0] != status:
+            record_status_change(cur, sub_id, row[0], status, ts)
         db.commit()
     else:
+        cur.execute("SELECT status FROM submissions WHERE id = ?", (sub_id,))
+        row = cur.fetchone()
         cur.execute("UPDATE submissions SET status = ? WHERE id = ?", (status, sub_id))
-        if moderator_id:
-            try:
-                cur.execute("INSERT INTO submission_actions (submission_id, moderator_id, action, note, created_at) VALUES (?, ?, ?, ?, ?)", (sub_id, moderator_id, action, note or "", ts))
-            except Exception:
-                pass
+        if row and row[0] != status:
+            record_status_change(cur, sub_id, row[0], status, ts)
+        db.commit()
+    if moderator_id:
+        audit_log.log(sub_id, moderator_id, status, note, ts)
+    prefetch_invalidate("submissions", sub_id)
+
+def transition_submission_status(sub_id, from_status, to_status, moderator_id=None, note=None):
+    # compare-and-set: статус меняется только если он всё ещё from_status.
+    # Возвращает True, если переход выполнил именно этот вызов (второй модератор получит False).
+    # Отдельный курсор — чтобы rowcount не перетёр параллельный обработчик.
+    # Ошибка БД пробрасывается: False значит только «опередил другой модератор».
+    ts = now_ts()
+    c = db.cursor()
+    try:
+        with savepoint(c):
+            if USE_PG:
+                c.execute("UPDATE submissions SET status = %s WHERE id = %s AND status = %s", (to_status, sub_id, from_status))
+                won = c.rowcount == 1
+            else:
+                c.execute("UPDATE submissions SET status = ? WHERE id = ? AND status = ?", (to_status, sub_id, from_status))
+                won = c.rowcount == 1
+            if won:
+                record_status_change(c, sub_id, from_status, to_status, ts)
+        db.commit()
+        if won:
+            if moderator_id:
+                audit_log.log(sub_id, moderator_id, to_status, note, ts)
+            prefetch_invalidate("submissions", sub_id)
+        return won
+    except Exception:
+        logger.exception("Не удалось сменить статус заявки #%s", sub_id)
+        raise
+    finally:
+        c.close()
+
+# контрольные сообщения модераторов
+def save_control_messages(sub_id, sent):
+    # sent: список (chat_id, message_id)
+    if not sent:
+        return
+    ts = now_ts()
+    rows = [(sub_id, chat_id, message_id, ts) for chat_id, message_id in sent]
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.executemany("INSERT INTO submission_messages (submission_id, chat_id, message_id, created_at) VALUES (%s, %s, %s, %s)", rows)
+        else:
+            c.executemany("INSERT INTO submission_messages (submission_id, chat_id, message_id, created_at) VALUES (?, ?, ?, ?)", rows)
+        db.commit()
+    except Exception:
+        logger.exception("Не удалось сохранить контрольные сообщения заявки #%s", sub_id)
+    finally:
+        c.close()
+
+def pop_control_messages(sub_id):
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("DELETE FROM submission_messages WHERE submission_id = %s RETURNING chat_id, message_id", (sub_id,))
+            rows = c.fetchall()
+        else:
+            c.execute("SELECT chat_id, message_id FROM submission_messages WHERE submission_id = ?", (sub_id,))
+            rows = c.fetchall()
+            c.execute("DELETE FROM submission_messages WHERE submission_id = ?", (sub_id,))
         db.commit()
+        return rows
+    finally:
+        c.close()
+
+def list_pending_submissions(channel_dbids, limit=None, offset=0, after_id=None, newest_first=True):
+    # pending заявки по набору каналов (общий запрос для /pending, дайджестов и просмотра)
+    channel_dbids = tuple(channel_dbids)
+    if not channel_dbids:
+        return []
+    ph = '%s' if USE_PG else '?'
+    placeholders = ','.join(ph for _ in channel_dbids)
+    query = f"SELECT id, user_id, content_type, text_content, file_id, created_at, anonymous, target_channel_dbid FROM submissions WHERE status = 'pending' AND target_channel_dbid IN ({placeholders})"
+    params = list(channel_dbids)
+    if after_id is not None:
+        query += f" AND id > {ph}"
+        params.append(after_id)
+    query += " ORDER BY created_at DESC, id DESC" if newest_first else " ORDER BY id"
+    if limit is not None:
+        query += f" LIMIT {ph} OFFSET {ph}"
+        params += [limit, offset]
+    return read_fetch(query, tuple(params))
+
+def search_submissions(channel_dbids, query, limit, offset=0):
+    # полнотекстовый поиск по заявкам каналов: (id, status, created_at, фрагмент, target_channel_dbid),
+    # по релевантности; нужны все слова запроса, слова от 4 букв ищутся по префиксу (падежные окончания),
+    # короче — точно: префикс в 2-3 буквы разворачивается в тысячи термов и ранжирование становится дорогим
+    channel_dbids = tuple(channel_dbids)
+    words = _WORD_RE.findall(query or "")[:16]
+    if not channel_dbids or not words:
+        return []
+    ph = '%s' if USE_PG else '?'
+    placeholders = ','.join(ph for _ in channel_dbids)
+    if USE_PG:
+        tsquery = " & ".join(w + ":*" if len(w) >= 4 else w for w in words)
+        sql = (f"SELECT id, status, created_at, ts_headline('{PG_SEARCH_CONFIG}', text_content, q, 'MaxWords=14, MinWords=6, StartSel=«, StopSel=»'), target_channel_dbid "
+               f"FROM (SELECT s.id, s.status, s.created_at, s.text_content, s.target_channel_dbid, q, "
+               f"ts_rank(to_tsvector('{PG_SEARCH_CONFIG}', coalesce(s.text_content, '')), q) AS rank "
+               f"FROM submissions s, to_tsquery('{PG_SEARCH_CONFIG}', %s) q "
+               f"WHERE to_tsvector('{PG_SEARCH_CONFIG}', coalesce(s.text_content, '')) @@ q AND s.target_channel_dbid IN ({placeholders}) "
+               f"ORDER BY rank DESC, s.id DESC LIMIT %s OFFSET %s) found ORDER BY rank DESC, id DESC")
+        params = [tsquery] + list(channel_dbids) + [limit, offset]
+    elif SEARCH_FTS:
+        fts_query = " ".join('"' + w.replace('"', '""') + ('"*' if len(w) >= 4 else '"') for w in words)
+        sql = ("SELECT s.id, s.status, s.created_at, snippet(submissions_fts, 0, '«', '»', '…', 14), s.target_channel_dbid "
+               "FROM submissions_fts JOIN submissions s ON s.id = submissions_fts.rowid "
+               f"WHERE submissions_fts MATCH ? AND s.target_channel_dbid IN ({placeholders}) "
+               "ORDER BY bm25(submissions_fts), s.id DESC LIMIT ? OFFSET ?")
+        params = [fts_query] + list(channel_dbids) + [limit, offset]
+    else:
+        sql = ("SELECT id, status, created_at, substr(text_content, 1, 120), target_channel_dbid FROM submissions "
+               f"WHERE target_channel_dbid IN ({placeholders})" + " AND text_content LIKE ?" * len(words) +
+               " ORDER BY id DESC LIMIT ? OFFSET ?")
+        params = list(channel_dbids) + ["%" + w + "%" for w in words] + [limit, offset]
+    t0 = time.perf_counter()
+    rows = read_fetch(sql, tuple(params))
+    metric_observe("search_query", time.perf_counter() - t0)
+    return rows
+
+# ========== КЭШ ПРАВ ДОСТУПА К КАНАЛАМ ==========
+# dbid -> (loaded_at, (owner_id, frozenset(модераторы))); грузится лениво, ограничен LRU и ACL_CACHE_TTL,
+# обновляется на месте в add_channel_admin / remove_channel_admin / remove_channel и сбрасывается шиной инвалидации.
+# Второй индекс: user_id -> (loaded_at, frozenset((dbid, bot_id))), где пользователь владелец или модератор (для /pending).
+# Поколения: загрузка запоминает поколение до запроса и кладёт результат, только если за это время
+# не было инвалидации — иначе прочитанное до изменения значение пережило бы сброс.
+_acl = OrderedDict()
+_user_channels = OrderedDict()
+_acl_lock = threading.Lock()
+_acl_gen = {}            # dbid -> поколение
+_acl_epoch = 0           # общий сброс _acl
+_user_channels_gen = 0   # любой сброс _user_channels
+
+def _lru_put(cache, key, value):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > ACL_CACHE_SIZE:
+        cache.popitem(last=False)
+
+def _acl_cached(cache, key):
+    # под _acl_lock: свежая запись или None
+    hit = cache.get(key)
+    if hit is None:
+        return None
+    if time.monotonic() - hit[0] >= ACL_CACHE_TTL:
+        cache.pop(key, None)
+        return None
+    cache.move_to_end(key)
+    return hit[1]
+
+def _acl_bump(dbid):
+    # под _acl_lock
+    _acl_gen[dbid] = _acl_gen.get(dbid, 0) + 1
+
+def _user_channels_reset(*user_ids):
+    # под _acl_lock; без аргументов — сброс всего индекса
+    global _user_channels_gen
+    if user_ids:
+        for uid in user_ids:
+            _user_channels.pop(uid, None)
+    else:
+        _user_channels.clear()
+    _user_channels_gen += 1
+
+def channel_acl(dbid):
+    with _acl_lock:
+        entry = _acl_cached(_acl, dbid)
+        if entry is not None:
+            metric_inc("acl_hit")
+            return entry
+        gen = (_acl_epoch, _acl_gen.get(dbid, 0))
+    metric_inc("acl_miss")
+    loaded_at = time.monotonic()
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("SELECT c.owner_id, a.admin_user_id FROM channels c LEFT JOIN channel_admins a ON a.channel_dbid = c.id WHERE c.id = %s", (dbid,))
+        else:
+            c.execute("SELECT c.owner_id, a.admin_user_id FROM channels c LEFT JOIN channel_admins a ON a.channel_dbid = c.id WHERE c.id = ?", (dbid,))
+        rows = c.fetchall()
+    finally:
+        c.close()
+    if not rows:
+        return None
+    entry = (rows[0][0], frozenset(r[1] for r in rows if r[1] is not None))
+    with _acl_lock:
+        if gen == (_acl_epoch, _acl_gen.get(dbid, 0)):
+            _lru_put(_acl, dbid, (loaded_at, entry))
+    return entry
+
+def is_channel_owner(dbid, user_id):
+    acl = channel_acl(dbid)
+    return bool(acl) and acl[0] == user_id
+
+def can_moderate(channel_dbid, user_id):
+    acl = channel_acl(channel_dbid)
+    return bool(acl) and (user_id == acl[0] or user_id in acl[1])
+
+def _acl_update(dbid, add=None, remove=None):
+    with _acl_lock:
+        _acl_bump(dbid)
+        hit = _acl.get(dbid)
+        if hit is not None:
+            mods = set(hit[1][1])
+            if add is not None:
+                mods.add(add)
+            if remove is not None:
+                mods.discard(remove)
+            _acl[dbid] = (hit[0], (hit[1][0], frozenset(mods)))
+        uids = [uid for uid in (add, remove) if uid is not None]
+        if uids:
+            _user_channels_reset(*uids)
+
+def _acl_forget_user(user_id):
+    with _acl_lock:
+        _user_channels_reset(user_id)
+
+def _acl_drop(dbid):
+    with _acl_lock:
+        _acl_bump(dbid)
+        _acl.pop(dbid, None)
+        _user_channels_reset()
+
+def _acl_on_invalidate(key):
+    # key — "<dbid>" или None
+    global _acl_epoch
+    with _acl_lock:
+        try:
+            dbid = int(key) if key is not None else None
+        except ValueError:
+            dbid = None
+        if dbid is None:
+            _acl.clear()
+            _acl_epoch += 1
+        else:
+            _acl_bump(dbid)
+            _acl.pop(dbid, None)
+        _user_channels_reset()
+
+on_invalidate("channels", _acl_on_invalidate)
+on_invalidate("channel_admins", _acl_on_invalidate)
+
+def moderated_channel_ids(user_id):
+    # каналы текущего бота, где пользователь модератор или владелец (один запрос на все боты, результат кэшируется)
+    bot_id = current_bot_id()
+    with _acl_lock:
+        cached = _acl_cached(_user_channels, user_id)
+        if cached is not None:
+            metric_inc("acl_hit")
+            return {dbid for dbid, b in cached if b == bot_id}
+        gen = _user_channels_gen
+    loaded_at = time.monotonic()
+    if USE_PG:
+        cur.execute("SELECT a.channel_dbid, c.bot_id FROM channel_admins a JOIN channels c ON c.id = a.channel_dbid WHERE a.admin_user_id = %s UNION SELECT id, bot_id FROM channels WHERE owner_id = %s", (user_id, user_id))
+    else:
+        cur.execute("SELECT a.channel_dbid, c.bot_id FROM channel_admins a JOIN channels c ON c.id = a.channel_dbid WHERE a.admin_user_id = ? UNION SELECT id, bot_id FROM channels WHERE owner_id = ?", (user_id, user_id))
+    pairs = frozenset((r[0], r[1]) for r in cur.fetchall())
+    with _acl_lock:
+        if gen == _user_channels_gen:
+            _lru_put(_user_channels, user_id, (loaded_at, pairs))
+    return {dbid for dbid, b in pairs if b == bot_id}
 
 # cooldowns
 def set_cooldown(user_id, channel_dbid, ts=None):
@@ -427,8 +2488,12 @@ def set_cooldown(user_id, channel_dbid, ts=None):
         except Exception:
             cur.execute("UPDATE cooldowns SET last_ts = ? WHERE user_id = ? AND channel_dbid = ?", (ts, user_id, channel_dbid))
         db.commit()
+    prefetch_invalidate("cooldowns", (user_id, channel_dbid), ts)
 
 def get_last_published(user_id, channel_dbid):
+    cached = prefetch_lookup("cooldowns", (user_id, channel_dbid))
+    if cached is not _MISSING:
+        return cached
     if USE_PG:
         cur.execute("SELECT last_ts FROM cooldowns WHERE user_id = %s AND channel_dbid = %s", (user_id, channel_dbid))
         r = cur.fetchone()
@@ -444,6 +2509,7 @@ def add_ban(channel_dbid, user_id, added_by):
         try:
             cur.execute("INSERT INTO bans (channel_dbid, user_id, added_by, created_at) VALUES (%s, %s, %s, %s)", (channel_dbid, user_id, added_by, ts))
             db.commit()
+            prefetch_invalidate("bans", (channel_dbid, user_id), True)
             return True
         except psycopg2.IntegrityError:
             return False
@@ -451,6 +2517,7 @@ def add_ban(channel_dbid, user_id, added_by):
         try:
             cur.execute("INSERT INTO bans (channel_dbid, user_id, added_by, created_at) VALUES (?, ?, ?, ?)", (channel_dbid, user_id, added_by, ts))
             db.commit()
+            prefetch_invalidate("bans", (channel_dbid, user_id), True)
             return True
         except sqlite3.IntegrityError:
             return False
@@ -462,8 +2529,12 @@ def remove_ban(channel_dbid, user_id):
     else:
         cur.execute("DELETE FROM bans WHERE channel_dbid = ? AND user_id = ?", (channel_dbid, user_id))
         db.commit()
+    prefetch_invalidate("bans", (channel_dbid, user_id), False)
 
 def is_banned(channel_dbid, user_id):
+    cached = prefetch_lookup("bans", (channel_dbid, user_id))
+    if cached is not _MISSING:
+        return cached
     if USE_PG:
         cur.execute("SELECT 1 FROM bans WHERE channel_dbid = %s AND user_id = %s", (channel_dbid, user_id))
         return bool(cur.fetchone())
@@ -471,6 +2542,31 @@ def is_banned(channel_dbid, user_id):
         cur.execute("SELECT 1 FROM bans WHERE channel_dbid = ? AND user_id = ?", (channel_dbid, user_id))
         return bool(cur.fetchone())
 
+# channel settings (ключ/значение)
+def get_channel_setting(channel_dbid, key, default=None):
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("SELECT value FROM channel_settings WHERE channel_dbid = %s AND key = %s", (channel_dbid, key))
+        else:
+            c.execute("SELECT value FROM channel_settings WHERE channel_dbid = ? AND key = ?", (channel_dbid, key))
+        r = c.fetchone()
+    finally:
+        c.close()
+    return r[0] if r else default
+
+def set_channel_setting(channel_dbid, key, value):
+    ts = now_ts()
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("INSERT INTO channel_settings (channel_dbid, key, value, updated_at) VALUES (%s, %s, %s, %s) ON CONFLICT (channel_dbid, key) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at", (channel_dbid, key, value, ts))
+        else:
+            c.execute("INSERT OR REPLACE INTO channel_settings (channel_dbid, key, value, updated_at) VALUES (?, ?, ?, ?)", (channel_dbid, key, value, ts))
+        db.commit()
+    finally:
+        c.close()
+
 # formatting
 def format_timedelta_seconds(sec):
     if sec <= 0:
@@ -481,6 +2577,358 @@ def format_timedelta_seconds(sec):
     seconds = td.seconds % 60
     return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
 
+# ========== ДЕГРАДИРОВАННЫЙ РЕЖИМ ==========
+# Пока БД или Bot API недоступны, webhook не обрабатывает апдейты, а дописывает их сырыми в SPOOL_PATH
+# и отвечает 200 (Telegram не копит повторы); фоновая задача проигрывает файл, когда breaker'ы закроются.
+# Строка spool — "<bot_id>\t<JSON апдейта>" (строки без bot_id, из старых версий, — основного бота).
+# Некритичные обработчики (справка, промо) в это время откладываются в очередь в памяти,
+# а имена пользователей/каналов берутся из кэша get_chat, даже устаревшего.
+# SPOOL_PATH общий для всех воркеров: запись и захват файла — под flock (file_lock), проигрывает тот,
+# кто переименовал файл в свой "<путь>.replay.<pid>".
+_spool_lock = threading.Lock()
+_deferred_calls = deque(maxlen=DEFERRED_CALLS_MAX)
+_chat_cache = OrderedDict()
+_chat_cache_lock = threading.Lock()
+CHAT_CACHE_TTL = 3600
+
+def degraded():
+    return db_breaker.is_open() or api_breaker.is_open()
+
+@contextmanager
+def file_lock(path):
+    # межпроцессная блокировка файла, общего для воркеров (flock на соседнем "<путь>.lock")
+    if fcntl is None:
+        yield
+        return
+    with open(path + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def claim_file(path):
+    # вызывать под file_lock(path): -> "<path>.replay.<pid>" с данными, которые теперь догружает этот процесс,
+    # или None. Сначала — свой недогруженный файл и брошенные умершими процессами (и ".replay" старых версий)
+    mine = f"{path}.replay.{os.getpid()}"
+    if os.path.exists(mine):
+        return mine
+    for orphan in glob.glob(glob.escape(path) + ".replay*"):
+        owner = orphan[len(path) + len(".replay"):].lstrip(".")
+        if owner.isdigit() and _pid_alive(int(owner)):
+            continue
+        try:
+            os.replace(orphan, mine)
+            return mine
+        except FileNotFoundError:
+            # уже забрал другой воркер
+            continue
+    try:
+        os.replace(path, mine)
+        return mine
+    except FileNotFoundError:
+        return None
+
+def spool_update(raw):
+    line = raw.decode("utf-8") if isinstance(raw, bytes) else raw
+    with _spool_lock, file_lock(SPOOL_PATH):
+        with open(SPOOL_PATH, "a", encoding="utf-8") as f:
+            f.write(f"{current_bot_id()}\t" + line.replace("\n", " ").strip() + "\n")
+    metric_inc("updates_spooled")
+
+def spool_handler_input(obj, update_type):
+    # апдейт восстанавливается из объекта, который получил обработчик (telebot хранит исходный JSON)
+    raw = getattr(obj, "json", None)
+    if raw is None or not update_type:
+        logger.error("Апдейт %s потерян: нечего вернуть в spool", update_type)
+        return
+    if isinstance(raw, str):
+        raw = decode_update(raw)
+    spool_update(json.dumps({"update_id": 0, update_type: raw}, ensure_ascii=False))
+
+def _spooled_update(line):
+    # -> (бот, Update) из строки spool
+    if line.startswith("{"):
+        b, body = default_bot, line
+    else:
+        bot_id, _, body = line.partition("\t")
+        b = BOTS.get(_int_or_none(bot_id), default_bot)
+    return b, telebot.types.Update.de_json(decode_update(body))
+
+def _respool(lines, processing):
+    # непроигранный остаток возвращается в начало файла, перед апдейтами, пришедшими за это время
+    with _spool_lock, file_lock(SPOOL_PATH):
+        newer = []
+        if os.path.exists(SPOOL_PATH):
+            with open(SPOOL_PATH, encoding="utf-8") as f:
+                newer = f.readlines()
+        tmp = f"{SPOOL_PATH}.tmp.{os.getpid()}"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(lines + newer)
+        os.replace(tmp, SPOOL_PATH)
+        os.remove(processing)
+
+def replay_spooled_updates():
+    if degraded():
+        return 0
+    with _spool_lock, file_lock(SPOOL_PATH):
+        # файл, брошенный упавшим процессом, доигрывается первым; нечего забирать — другой воркер уже забрал
+        processing = claim_file(SPOOL_PATH)
+    if processing is None:
+        return 0
+    with open(processing, encoding="utf-8") as f:
+        lines = [l for l in f if l.strip()]
+    done = 0
+    try:
+        while done < len(lines) and not degraded():
+            chunk = lines[done:done + UPDATE_BATCH_MAX]
+            # флуд-контроль не применяем: апдейты уже приняты, просто с задержкой
+            items = [_spooled_update(l) for l in chunk]
+            contexts = {}
+            for b, update in items:
+                if b not in contexts:
+                    with use_tenant(b):
+                        contexts[b] = prefetch_batch([u for ub, u in items if ub is b])
+                # по одному и в этом потоке: если breaker снова откроется в обработчике, апдейт и всё
+                # после него остаются в spool
+                with use_tenant(b), use_prefetch(contexts[b]), inline_handlers():
+                    b.process_new_updates([update])
+                done += 1
+                metric_inc("updates_replayed")
+                if degraded():
+                    break
+    except CircuitOpenError:
+        pass
+    finally:
+        if done < len(lines):
+            _respool(lines[done:], processing)
+        else:
+            os.remove(processing)
+    if done:
+        logger.info("Проиграно %s отложенных апдейтов, осталось %s", done, len(lines) - done)
+    return done
+
+def noncritical(fn):
+    # обработчик, который при недоступном Bot API не выполняется сразу, а ждёт в очереди
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if api_breaker.is_open():
+            _deferred_calls.append((bind_tenant(fn), args, kwargs))
+            metric_inc("deferred_calls")
+            return None
+        return fn(*args, **kwargs)
+    return wrapper
+
+def flush_deferred_calls():
+    while _deferred_calls and not api_breaker.is_open():
+        fn, args, kwargs = _deferred_calls.popleft()
+        try:
+            fn(*args, **kwargs)
+        except CircuitOpenError:
+            _deferred_calls.appendleft((fn, args, kwargs))
+            break
+        except Exception:
+            logger.exception("Отложенный вызов %s не удался", fn.__name__)
+
+def answer_callback_quietly(cq):
+    # отложенный обработчик отвечает на нажатие с опозданием — Telegram это отклонит, это не ошибка
+    try:
+        bot.answer_callback_query(cq.id)
+    except Exception:
+        pass
+
+def get_chat_cached(chat_id):
+    now = time.monotonic()
+    with _chat_cache_lock:
+        hit = _chat_cache.get(chat_id)
+    if hit is not None and (now - hit[0] < CHAT_CACHE_TTL or api_breaker.is_open()):
+        return hit[1]
+    try:
+        info = bot.get_chat(chat_id)
+    except CircuitOpenError:
+        if hit is not None:
+            return hit[1]
+        raise
+    with _chat_cache_lock:
+        _lru_put(_chat_cache, chat_id, (now, info))
+    return info
+
+# ========== ЖУРНАЛ ДЕЙСТВИЙ МОДЕРАТОРОВ ==========
+# Строки submission_actions не пишутся в транзакции обработчика: audit_log.log() кладёт их в буфер в памяти,
+# поток-писатель сбрасывает буфер одним executemany каждые AUDIT_FLUSH_MS мс или как только набралось
+# AUDIT_FLUSH_ROWS строк. Если БД недоступна или буфер переполнен, строки дописываются в AUDIT_FALLBACK_PATH
+# (JSON по строке) и догружаются следующим удачным сбросом. При остановке процесса буфер сбрасывается.
+class AuditLog:
+    def __init__(self, path):
+        self.path = path
+        self._buf = deque()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._closed = False
+        self._failing = False
+        self._thread = None
+        self._conn = None
+
+    def log(self, sub_id, moderator_id, action, note=None, ts=None):
+        self.log_many([(sub_id, moderator_id, action, note or "", ts or now_ts())])
+
+    def log_many(self, rows):
+        if not rows:
+            return
+        overflow = None
+        with self._cond:
+            self._buf.extend(rows)
+            if len(self._buf) > AUDIT_BUFFER_SIZE:
+                # писатель не успевает — лишнее уходит в файл, а не вытесняется
+                overflow = [self._buf.popleft() for _ in range(len(self._buf) - AUDIT_BUFFER_SIZE)]
+            if len(self._buf) >= AUDIT_FLUSH_ROWS:
+                self._cond.notify()
+        if overflow:
+            metric_inc("audit_overflow", len(overflow))
+            self._spill(overflow)
+
+    def _spill(self, rows):
+        if not rows:
+            return
+        with self._file_lock, file_lock(self.path):
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(json.dumps(row, ensure_ascii=False) + "\n" for row in rows)
+
+    def _connection(self):
+        # своё соединение: commit/rollback писателя не должны задевать транзакции обработчиков на общем db
+        if self._conn is None:
+            if USE_PG:
+                self._conn = pg_connect()
+            else:
+                self._conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
+        return self._conn
+
+    def _reset_connection(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _write(self, rows):
+        c = None
+        try:
+            conn = self._connection()
+            c = conn.cursor()
+            if USE_PG:
+                c.executemany("INSERT INTO submission_actions (submission_id, moderator_id, action, note, created_at) VALUES (%s, %s, %s, %s, %s)", rows)
+            else:
+                c.executemany("INSERT INTO submission_actions (submission_id, moderator_id, action, note, created_at) VALUES (?, ?, ?, ?, ?)", rows)
+            conn.commit()
+        except Exception:
+            if c is not None:
+                c.close()
+            # после обрыва соединение не переиспользуем — следующий сброс откроет новое
+            # (в том числе если на закрытом соединении не открылся даже курсор)
+            self._reset_connection()
+            raise
+        c.close()
+
+    def _spilled_files(self):
+        return ([self.path] if os.path.exists(self.path) else []) + glob.glob(glob.escape(self.path) + ".replay*")
+
+    def _load_spilled(self):
+        # файл общий для воркеров: догружает тот, кто его забрал (claim_file); свой недогруженный
+        # или брошенный умершим процессом — первым
+        for _ in range(2):
+            with self._file_lock, file_lock(self.path):
+                processing = claim_file(self.path)
+            if processing is None:
+                return
+            with open(processing, encoding="utf-8") as f:
+                rows = [tuple(json.loads(line)) for line in f if line.strip()]
+            if rows:
+                self._write(rows)
+            os.remove(processing)
+            if not rows:
+                continue
+            metric_inc("audit_replayed", len(rows))
+            logger.info("Догружено %s строк журнала действий из %s", len(rows), self.path)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                rows = list(self._buf)
+                self._buf.clear()
+            if degraded():
+                self._spill(rows)
+                return
+            try:
+                if self._spilled_files():
+                    self._load_spilled()
+                if rows:
+                    t0 = time.perf_counter()
+                    self._write(rows)
+                    metric_observe("audit_flush", time.perf_counter() - t0)
+                    metric_inc("audit_rows", len(rows))
+                self._failing = False
+            except Exception as e:
+                if not self._failing:
+                    logger.warning("Журнал действий не записан в БД (%s), строки сохраняются в %s", e, self.path)
+                self._failing = True
+                metric_inc("audit_spilled", len(rows))
+                self._spill(rows)
+
+    @contextmanager
+    def paused(self):
+        # пока открыт блок, в БД ничего не пишется: незаписанные строки остаются в буфере или файле (pending_days)
+        with self._flush_lock:
+            yield
+
+    def pending_days(self):
+        # дни (created_at // 86400), строки за которые ещё не в submission_actions
+        with self._cond:
+            days = {row[4] // 86400 for row in self._buf}
+        with self._file_lock, file_lock(self.path):
+            for path in self._spilled_files():
+                try:
+                    with open(path, encoding="utf-8") as f:
+                        days.update(json.loads(line)[4] // 86400 for line in f if line.strip())
+                except FileNotFoundError:
+                    # другой воркер как раз догрузил и удалил свой файл
+                    continue
+        return days
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed or len(self._buf) >= AUDIT_FLUSH_ROWS, timeout=AUDIT_FLUSH_MS / 1000)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="audit-log", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        self.flush()
+
+audit_log = AuditLog(AUDIT_FALLBACK_PATH)
+
 # ========== МАРКАПЫ ==========
 def main_menu():
     kb = types.InlineKeyboardMarkup()
@@ -496,6 +2944,35 @@ def channels_menu():
     kb.add(types.InlineKeyboardButton("◀️ Назад", callback_data="menu_back"))
     return kb
 
+# ========== НАВИГАЦИЯ (edit-in-place) ==========
+def nav_reply(cq, text, reply_markup=None, parse_mode=None):
+    # показать экран меню в ответ на нажатие кнопки: редактируем сообщение с кнопкой, если редактировать
+    # нельзя — шлём новое. Неизменённое содержимое распознаёт сам Telegram («message is not modified»):
+    # своя память об отрисованном в процессе устаревает при нескольких воркерах и правках с других экранов
+    msg = cq.message
+    if not NAV_EDIT_IN_PLACE or msg is None or msg.content_type != "text" or msg.chat.id != cq.from_user.id:
+        metric_inc("nav_send")
+        return bot.send_message(cq.from_user.id, text, parse_mode=parse_mode, reply_markup=reply_markup)
+    chat_id, message_id = msg.chat.id, msg.message_id
+    try:
+        if parse_mode is None and msg.text == text:
+            # текст тот же — достаточно заменить клавиатуру
+            res = bot.edit_message_reply_markup(chat_id, message_id, reply_markup=reply_markup)
+            metric_inc("nav_edit_markup")
+        else:
+            res = bot.edit_message_text(text, chat_id, message_id, parse_mode=parse_mode, reply_markup=reply_markup)
+            metric_inc("nav_edit_text")
+        return res if res is not True else msg
+    except telebot.apihelper.ApiTelegramException as e:
+        if "message is not modified" in str(e.description):
+            metric_inc("nav_skip_unchanged")
+            return msg
+        logger.info("edit-in-place невозможен (%s), отправляем новое сообщение", e.description)
+    except Exception:
+        logger.exception("edit-in-place не удался, отправляем новое сообщение")
+    metric_inc("nav_send_fallback")
+    return bot.send_message(cq.from_user.id, text, parse_mode=parse_mode, reply_markup=reply_markup)
+
 # ========== START / MENU ==========
 @bot.message_handler(commands=["start"])
 def cmd_start(message):
@@ -539,32 +3016,31 @@ def cq_menu(cq):
         kb.add(types.InlineKeyboardButton("Отправить в канал (по ссылке в канале)", callback_data="offer_via_deeplink_info"))
         kb.add(types.InlineKeyboardButton("Отправить в канал (по @username или ссылке)", callback_data="offer_via_username"))
         kb.add(types.InlineKeyboardButton("◀️ Назад", callback_data="menu_back"))
-        bot.send_message(cq.from_user.id, "Выберите способ отправки:", reply_markup=kb)
+        nav_reply(cq, "Выберите способ отправки:", reply_markup=kb)
     elif action == "channels":
-        show_channels_menu(cq.from_user.id)
+        show_channels_menu(cq.from_user.id, cq)
     elif action == "help":
         # разделённая справка: отправка поста и подключение бота
         kb = types.InlineKeyboardMarkup()
         kb.add(types.InlineKeyboardButton("✉️ Как отправить пост", callback_data="help_send"))
         kb.add(types.InlineKeyboardButton("🔌 Как подключить бота", callback_data="help_connect"))
         kb.add(types.InlineKeyboardButton("◀️ Назад", callback_data="menu_back"))
-        bot.send_message(cq.from_user.id,
-                         "Выберите тему помощи:",
-                         reply_markup=kb)
+        nav_reply(cq, "Выберите тему помощи:", reply_markup=kb)
     elif action == "back":
-        bot.send_message(cq.from_user.id, "Возврат в меню.", reply_markup=main_menu())
+        nav_reply(cq, "Возврат в меню.", reply_markup=main_menu())
     else:
-        bot.send_message(cq.from_user.id, "Неизвестное действие.", reply_markup=main_menu())
+        nav_reply(cq, "Неизвестное действие.", reply_markup=main_menu())
 
 @bot.callback_query_handler(func=lambda cq: cq.data == "menu_back")
 def cq_menu_back(cq):
     bot.answer_callback_query(cq.id)
-    bot.send_message(cq.from_user.id, "Возврат в меню.", reply_markup=main_menu())
+    nav_reply(cq, "Возврат в меню.", reply_markup=main_menu())
 
 # ========== HELP CALLBACKS ==========
 @bot.callback_query_handler(func=lambda cq: cq.data == "help_send")
+@noncritical
 def cq_help_send(cq):
-    bot.answer_callback_query(cq.id)
+    answer_callback_quietly(cq)
     text = (
         f"✉️ Как отправить пост через Телеформ:\n\n"
         f"1) Через кнопку в канале: владелец канала может отправить сообщение с кнопкой «Предложить пост» — подписчики нажимают и выбирают анонимно/не анонимно.\n\n"
@@ -573,11 +3049,13 @@ def cq_help_send(cq):
         f"Важно: действует ограничение по частоте — одна публикация в канал каждые {COOLDOWN_SECONDS//3600} ч. (персональный cooldown).\n\n"
         f"Если заявка отправлена — она попадёт модераторам канала для принятия/отклонения."
     )
-    bot.send_message(cq.from_user.id, text)
+    kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("◀️ Назад", callback_data="menu_help"))
+    nav_reply(cq, text, reply_markup=kb)
 
 @bot.callback_query_handler(func=lambda cq: cq.data == "help_connect")
+@noncritical
 def cq_help_connect(cq):
-    bot.answer_callback_query(cq.id)
+    answer_callback_quietly(cq)
     text = (
         "🔌 Как подключить бота к каналу — шаги и права:\n\n"
         "1) Добавьте бота в канал как участника.\n"
@@ -588,11 +3066,15 @@ def cq_help_connect(cq):
         "4) После подключения можно добавить модераторов, либо владелец будет получать заявки сам.\n\n"
         "Если при подключении возникают ошибки — убедитесь, что вы действительно админ канала и бот имеет права на отправку сообщений."
     )
-    bot.send_message(cq.from_user.id, text)
+    kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("◀️ Назад", callback_data="menu_help"))
+    nav_reply(cq, text, reply_markup=kb)
 
 # ========== CHANNEL MANAGEMENT ==========
-def show_channels_menu(user_id):
-    bot.send_message(user_id, "🔧 Управление каналами:", reply_markup=channels_menu())
+def show_channels_menu(user_id, cq=None):
+    if cq is not None:
+        nav_reply(cq, "🔧 Управление каналами:", reply_markup=channels_menu())
+    else:
+        bot.send_message(user_id, "🔧 Управление каналами:", reply_markup=channels_menu())
 
 @bot.callback_query_handler(func=lambda cq: cq.data == "add_channel")
 def cq_add_channel(cq):
@@ -600,9 +3082,8 @@ def cq_add_channel(cq):
     set_state(cq.from_user.id, "wait_channel")
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("❌ Отмена", callback_data="cancel"))
-    bot.send_message(cq.from_user.id,
-                     "📩 Перешли ЛЮБОЕ сообщение из своего канала (Forward)\n\nТы должен быть администратором этого канала.\n\nЕсли хочешь отменить — нажми «Отмена».",
-                     reply_markup=kb)
+    nav_reply(cq, "📩 Перешли ЛЮБОЕ сообщение из своего канала (Forward)\n\nТы должен быть администратором этого канала.\n\nЕсли хочешь отменить — нажми «Отмена».",
+              reply_markup=kb)
 
 @bot.message_handler(func=lambda m: get_state(m.from_user.id) == "wait_channel", content_types=['text','photo','video','document','sticker'])
 def handle_channel_forward(m):
@@ -659,7 +3140,8 @@ def handle_channel_forward(m):
     kb.add(types.InlineKeyboardButton("Добавить другого модератора", callback_data=f"set_mods_other:{dbid}"))
     kb.add(types.InlineKeyboardButton("Пропустить", callback_data=f"set_mods_skip:{dbid}"))
     # отправляем в канал сообщение с кнопкой "Предложить пост" (deep link)
-    bot_link = f"https://t.me/{BOT_USERNAME}?start=post_{dbid}" if BOT_USERNAME else None
+    username = bot_username()
+    bot_link = f"https://t.me/{username}?start=post_{dbid}" if username else None
     kb_channel = types.InlineKeyboardMarkup()
     if bot_link:
         kb_channel.add(types.InlineKeyboardButton("Предложить пост", url=bot_link))
@@ -676,23 +3158,23 @@ def cq_set_mods(cq):
     bot.answer_callback_query(cq.id)
     parts = cq.data.split(":" )
     if len(parts) != 2:
-        bot.send_message(cq.from_user.id, "Ошибка.")
+        nav_reply(cq, "Ошибка.")
         return
     cmd, dbid_str = parts[0], parts[1]
     dbid = int(dbid_str)
     if cmd == "set_mods_self":
         # добавляем владельца как модератора
         add_channel_admin(dbid, cq.from_user.id, cq.from_user.id)
-        bot.send_message(cq.from_user.id, "👌 Ты добавлен как модератор для этого канала.", reply_markup=channels_menu())
+        nav_reply(cq, "👌 Ты добавлен как модератор для этого канала.", reply_markup=channels_menu())
     elif cmd == "set_mods_other":
         # регистрируем состояние ожидания: перешли сообщение или укажи @username/ID
         set_state(cq.from_user.id, f"awaiting_first_mod:{dbid}")
         kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("❌ Отмена", callback_data="cancel"))
-        bot.send_message(cq.from_user.id, "Перешли сообщение от пользователя (forward) или отправь @username/ID, чтобы добавить его как модератора.", reply_markup=kb)
+        nav_reply(cq, "Перешли сообщение от пользователя (forward) или отправь @username/ID, чтобы добавить его как модератора.", reply_markup=kb)
     elif cmd == "set_mods_skip":
-        bot.send_message(cq.from_user.id, "Ок — модераторы можно добавить позже в меню канала.", reply_markup=channels_menu())
+        nav_reply(cq, "Ок — модераторы можно добавить позже в меню канала.", reply_markup=channels_menu())
     else:
-        bot.send_message(cq.from_user.id, "Неизвестная команда.", reply_markup=channels_menu())
+        nav_reply(cq, "Неизвестная команда.", reply_markup=channels_menu())
 
 @bot.message_handler(func=lambda m: isinstance(get_state(m.from_user.id), str) and get_state(m.from_user.id).startswith("awaiting_first_mod"), content_types=['text','photo','video','document'])
 def handle_first_mod(m):
@@ -731,14 +3213,14 @@ def cq_my_channels(cq):
     bot.answer_callback_query(cq.id)
     rows = list_channels_by_owner(cq.from_user.id)
     if not rows:
-        bot.send_message(cq.from_user.id, "📭 У тебя пока нет подключённых каналов.", reply_markup=channels_menu())
+        nav_reply(cq, "📭 У тебя пока нет подключённых каналов.", reply_markup=channels_menu())
         return
     kb = types.InlineKeyboardMarkup()
     for r in rows:
         dbid, channel_id, title = r
         kb.add(types.InlineKeyboardButton(title or str(channel_id), callback_data=f"channel:{dbid}"))
     kb.add(types.InlineKeyboardButton("◀️ Назад", callback_data="menu_channels"))
-    bot.send_message(cq.from_user.id, "📋 Твои каналы:", reply_markup=kb)
+    nav_reply(cq, "📋 Твои каналы:", reply_markup=kb)
 
 # меню конкретного канала: управление модераторами / удалить / ссылка для подписчиков
 @bot.callback_query_handler(func=lambda cq: cq.data and cq.data.startswith("channel:"))
@@ -747,18 +3229,20 @@ def cq_channel(cq):
     dbid = int(cq.data.split(":",1)[1])
     ch = get_channel_by_dbid(dbid)
     if not ch:
-        bot.send_message(cq.from_user.id, "Канал не найден.")
+        nav_reply(cq, "Канал не найден.")
         return
     _, owner_id, channel_id, title = ch
     kb = types.InlineKeyboardMarkup()
-    bot_link = f"https://t.me/{BOT_USERNAME}?start=post_{dbid}" if BOT_USERNAME else None
+    username = bot_username()
+    bot_link = f"https://t.me/{username}?start=post_{dbid}" if username else None
     if bot_link:
         kb.add(types.InlineKeyboardButton("🔗 Ссылка для подписчиков", url=bot_link))
     kb.add(types.InlineKeyboardButton("👥 Управление модераторами", callback_data=f"mods:{dbid}"))
+    kb.add(types.InlineKeyboardButton("🎯 Распределение заявок", callback_data=f"assign:{dbid}"))
     kb.add(types.InlineKeyboardButton("📣 Отправить готовое сообщение в канал", callback_data=f"promo_prepare:{dbid}"))
     kb.add(types.InlineKeyboardButton("🗑 Удалить канал", callback_data=f"delete:{dbid}"))
     kb.add(types.InlineKeyboardButton("◀️ Назад", callback_data="my_channels"))
-    bot.send_message(cq.from_user.id, f"⚙️ Управление: *{title or channel_id}*", parse_mode="Markdown", reply_markup=kb)
+    nav_reply(cq, f"⚙️ Управление: *{title or channel_id}*", parse_mode="Markdown", reply_markup=kb)
 
 # управление модераторами: список и добавление/удаление
 @bot.callback_query_handler(func=lambda cq: cq.data and cq.data.startswith("mods:"))
@@ -767,7 +3251,7 @@ def cq_mods(cq):
     dbid = int(cq.data.split(":",1)[1])
     ch = get_channel_by_dbid(dbid)
     if not ch:
-        bot.send_message(cq.from_user.id, "Канал не найден.")
+        nav_reply(cq, "Канал не найден.")
         return
     _, owner_id, channel_id, title = ch
     # показываем список модераторов
@@ -778,7 +3262,7 @@ def cq_mods(cq):
     else:
         for a in admins:
             try:
-                info = bot.get_chat(a)
+                info = get_chat_cached(a)
                 name = ("@" + info.username) if getattr(info, "username", None) else (getattr(info, "first_name", "") or str(a))
             except:
                 name = str(a)
@@ -789,24 +3273,23 @@ def cq_mods(cq):
         for a in admins:
             kb.add(types.InlineKeyboardButton(f"Удалить {a}", callback_data=f"delmod:{dbid}:{a}"))
     kb.add(types.InlineKeyboardButton("◀️ Назад", callback_data=f"channel:{dbid}"))
-    bot.send_message(cq.from_user.id, text, parse_mode="Markdown", reply_markup=kb)
+    nav_reply(cq, text, parse_mode="Markdown", reply_markup=kb)
 
 @bot.callback_query_handler(func=lambda cq: cq.data and cq.data.startswith("addmod:"))
 def cq_addmod(cq):
     bot.answer_callback_query(cq.id)
     dbid = int(cq.data.split(":",1)[1])
     # only owner can add mods
-    ch = get_channel_by_dbid(dbid)
-    if not ch:
+    acl = channel_acl(dbid)
+    if not acl:
         bot.send_message(cq.from_user.id, "Канал не найден.")
         return
-    owner_id = ch[1]
-    if cq.from_user.id != owner_id:
+    if cq.from_user.id != acl[0]:
         bot.send_message(cq.from_user.id, "Добавлять модераторов может только владелец канала.")
         return
     set_state(cq.from_user.id, f"awaiting_add_mod:{dbid}")
     kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("❌ Отмена", callback_data="cancel"))
-    bot.send_message(cq.from_user.id, "Перешли сообщение от пользователя (forward) или отправь @username/ID, чтобы добавить модератора.", reply_markup=kb)
+    nav_reply(cq, "Перешли сообщение от пользователя (forward) или отправь @username/ID, чтобы добавить модератора.", reply_markup=kb)
 
 @bot.message_handler(func=lambda m: isinstance(get_state(m.from_user.id), str) and get_state(m.from_user.id).startswith("awaiting_add_mod"), content_types=['text','photo','video','document'])
 def handle_add_mod(m):
@@ -846,16 +3329,39 @@ def cq_delmod(cq):
         bot.send_message(cq.from_user.id, "Ошибка.")
         return
     dbid = int(parts[1]); admin_id = int(parts[2])
-    ch = get_channel_by_dbid(dbid)
-    if not ch:
+    acl = channel_acl(dbid)
+    if not acl:
         bot.send_message(cq.from_user.id, "Канал не найден.")
         return
-    owner_id = ch[1]
-    if cq.from_user.id != owner_id:
+    if cq.from_user.id != acl[0]:
         bot.send_message(cq.from_user.id, "Удалять модераторов может только владелец канала.")
         return
     remove_channel_admin(dbid, admin_id)
-    bot.send_message(cq.from_user.id, f"Модератор {admin_id} удалён.")
+    kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("◀️ Назад", callback_data=f"mods:{dbid}"))
+    nav_reply(cq, f"Модератор {admin_id} удалён.", reply_markup=kb)
+
+# режим распределения заявок между модераторами (только владелец)
+@bot.callback_query_handler(func=lambda cq: cq.data and (cq.data.startswith("assign:") or cq.data.startswith("assign_set:")))
+def cq_assign_mode(cq):
+    bot.answer_callback_query(cq.id)
+    parts = cq.data.split(":")
+    dbid = int(parts[1])
+    acl = channel_acl(dbid)
+    if not acl:
+        nav_reply(cq, "Канал не найден.")
+        return
+    if cq.from_user.id != acl[0]:
+        nav_reply(cq, "Менять распределение заявок может только владелец канала.")
+        return
+    if parts[0] == "assign_set" and len(parts) == 3 and parts[2] in ASSIGN_MODES:
+        set_channel_setting(dbid, "assign_mode", parts[2])
+    mode = get_assign_mode(dbid)
+    kb = types.InlineKeyboardMarkup()
+    for m in ASSIGN_MODES:
+        mark = "✅ " if m == mode else ""
+        kb.add(types.InlineKeyboardButton(mark + ASSIGN_MODE_LABELS[m], callback_data=f"assign_set:{dbid}:{m}"))
+    kb.add(types.InlineKeyboardButton("◀️ Назад", callback_data=f"channel:{dbid}"))
+    nav_reply(cq, f"🎯 Кому отправлять новые заявки?\nСейчас: {ASSIGN_MODE_LABELS[mode]}.\n\nБез решения за {ASSIGN_TIMEOUT_SECONDS // 3600} ч. заявка передаётся следующему модератору.", reply_markup=kb)
 
 # ========== ADDED: Handler for offer via @username/link ==========
 @bot.callback_query_handler(func=lambda cq: cq.data == "offer_via_username")
@@ -863,7 +3369,7 @@ def cq_offer_via_username(cq):
     bot.answer_callback_query(cq.id)
     set_state(cq.from_user.id, "awaiting_channel_username")
     kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("❌ Отмена", callback_data="cancel"))
-    bot.send_message(cq.from_user.id, "Отправь @username канала или ссылку на канал (например https://t.me/yourchannel).", reply_markup=kb)
+    nav_reply(cq, "Отправь @username канала или ссылку на канал (например https://t.me/yourchannel).", reply_markup=kb)
 
 @bot.message_handler(func=lambda m: get_state(m.from_user.id) == "awaiting_channel_username", content_types=['text'])
 def handle_channel_by_username(m):
@@ -923,515 +3429,3490 @@ def handle_channel_by_username(m):
             if last:
                 getchat_arg = "@" + last if not last.lstrip("-").isdigit() and not last.startswith("@") else last
         else:
-            if text.startswith("@"):
-                getchat_arg = text
-            elif text.lstrip("-").isdigit():
-                getchat_arg = text
-            else:
-                getchat_arg = "@" + text
+            if text.startswith("@"):
+                getchat_arg = text
+            elif text.lstrip("-").isdigit():
+                getchat_arg = text
+            else:
+                getchat_arg = "@" + text
+
+        try:
+            chat = bot.get_chat(getchat_arg)
+            # возможные варианты ключей, которые могли быть сохранены
+            possible = set()
+            possible.add(str(chat.id))
+            # Bot API возвращает channel username without @
+            if getattr(chat, "username", None):
+                possible.add("@" + chat.username)
+                possible.add(chat.username)
+            # иногда id может быть negative like -100..., добавим вариант без -100 если кто-то сохранил так
+            cid = str(chat.id)
+            if cid.startswith("-100"):
+                possible.add(cid[4:])          # without -100
+                possible.add(cid.lstrip("-"))  # without minus
+            else:
+                possible.add("-100" + cid)
+                possible.add("-" + cid)
+
+            # поиск в БД по всем возможным вариантам
+            for k in possible:
+                if USE_PG:
+                    cur.execute("SELECT id, title, channel_id FROM channels WHERE channel_id = %s", (k,))
+                else:
+                    cur.execute("SELECT id, title, channel_id FROM channels WHERE channel_id = ?", (k,))
+                r = cur.fetchone()
+                if r:
+                    row = r
+                    break
+        except Exception:
+            # если get_chat не удался — продолжаем дальше и сообщим об ошибке позже
+            row = None
+
+    if not row:
+        bot.send_message(m.chat.id, "❌ Канал не найден или не подключён к боту. Убедитесь, что вы ввели корректный @username или ссылку, и что канал действительно подключён (через Forward).", reply_markup=main_menu())
+        return
+
+    dbid, title, stored_key = row
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("Анонимно", callback_data=f"deep_offer_anon:1:{dbid}"),
+           types.InlineKeyboardButton("Не анонимно", callback_data=f"deep_offer_anon:0:{dbid}"))
+    bot.send_message(m.chat.id, f"📣 Вы хотите отправить пост в канал *{title or stored_key}*? Выберите режим отправки:", parse_mode="Markdown", reply_markup=kb)
+
+# ========== DEEP LINK FLOW ==========
+@bot.callback_query_handler(func=lambda cq: cq.data and cq.data.startswith("deep_offer_anon:"))
+def cq_deeplink_offer(cq):
+    bot.answer_callback_query(cq.id)
+    try:
+        _, anon_str, dbid_str = cq.data.split(":" ,2)
+        anon_flag = True if anon_str == "1" else False
+        dbid = int(dbid_str)
+    except:
+        bot.send_message(cq.from_user.id, "Ошибка ссылки."); return
+    # cooldown check
+    last = get_last_published(cq.from_user.id, dbid)
+    if last:
+        elapsed = now_ts() - last
+        if elapsed < COOLDOWN_SECONDS:
+            left = COOLDOWN_SECONDS - elapsed
+            bot.send_message(cq.from_user.id, f"⏳ Вы уже публиковали в этот канал. Попробовать ещё можно через {format_timedelta_seconds(left)}.", reply_markup=main_menu())
+            return
+    # prompt for content
+    ch = get_channel_by_dbid(dbid)
+    if not ch:
+        bot.send_message(cq.from_user.id, "Канал не найден.", reply_markup=main_menu()); return
+    msg = bot.send_message(cq.from_user.id, f"📝 Отправьте текст, фото, видео или документ для канала *{ch[3] or ch[2]}*.\nДля отмены нажмите «Отмена».", parse_mode="Markdown", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("❌ Отмена", callback_data="cancel")))
+    set_state(cq.from_user.id, f"awaiting_submission:{1 if anon_flag else 0}:{dbid}")
+    bot.register_next_step_handler(msg, lambda m, anon=anon_flag, target=dbid: handle_submission(m, anon, target))
+
+# ========== РАСПРЕДЕЛЕНИЕ ЗАЯВОК МЕЖДУ МОДЕРАТОРАМИ ==========
+# broadcast — всем модераторам (как раньше); round_robin — по очереди; least_loaded — тому, у кого меньше pending
+ASSIGN_MODES = ("broadcast", "round_robin", "least_loaded")
+ASSIGN_MODE_LABELS = {
+    "broadcast": "всем модераторам",
+    "round_robin": "по очереди",
+    "least_loaded": "наименее загруженному",
+}
+
+def get_assign_mode(channel_dbid):
+    mode = get_channel_setting(channel_dbid, "assign_mode", "broadcast")
+    return mode if mode in ASSIGN_MODES else "broadcast"
+
+def _channel_moderators(channel_dbid):
+    acl = channel_acl(channel_dbid)
+    if not acl:
+        return []
+    return sorted(acl[1]) if acl[1] else [acl[0]]
+
+def _channel_load(channel_dbid):
+    # нагрузка считается по БД при каждом выборе: заявки назначают и решают все воркеры
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("SELECT a.moderator_id, COUNT(*) FROM submission_assignments a JOIN submissions s ON s.id = a.submission_id WHERE a.channel_dbid = %s AND s.status = 'pending' GROUP BY a.moderator_id", (channel_dbid,))
+        else:
+            c.execute("SELECT a.moderator_id, COUNT(*) FROM submission_assignments a JOIN submissions s ON s.id = a.submission_id WHERE a.channel_dbid = ? AND s.status = 'pending' GROUP BY a.moderator_id", (channel_dbid,))
+        return {r[0]: r[1] for r in c.fetchall()}
+    finally:
+        c.close()
+
+def _rr_take(channel_dbid):
+    # атомарно берём позицию round_robin канала из БД (следующий воркер получит следующую)
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("INSERT INTO assign_cursors (channel_dbid, next_idx) VALUES (%s, 1) ON CONFLICT (channel_dbid) DO UPDATE SET next_idx = assign_cursors.next_idx + 1 RETURNING next_idx", (channel_dbid,))
+            idx = c.fetchone()[0] - 1
+        else:
+            # UPDATE берёт блокировку записи до commit — SELECT ниже видит именно наше значение
+            c.execute("INSERT OR IGNORE INTO assign_cursors (channel_dbid, next_idx) VALUES (?, 0)", (channel_dbid,))
+            c.execute("UPDATE assign_cursors SET next_idx = next_idx + 1 WHERE channel_dbid = ?", (channel_dbid,))
+            c.execute("SELECT next_idx FROM assign_cursors WHERE channel_dbid = ?", (channel_dbid,))
+            idx = c.fetchone()[0] - 1
+        db.commit()
+        return idx
+    finally:
+        c.close()
+
+def _choose_moderator(channel_dbid, mode, moderators, exclude=None):
+    candidates = [m for m in moderators if m != exclude] or moderators
+    if not candidates:
+        return None
+    if mode == "least_loaded":
+        loads = _channel_load(channel_dbid)
+        return min(candidates, key=lambda m: (loads.get(m, 0), m))
+    return candidates[_rr_take(channel_dbid) % len(candidates)]
+
+def assign_submission(sub_id, channel_dbid, moderator_id):
+    ts = now_ts()
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("INSERT INTO submission_assignments (submission_id, channel_dbid, moderator_id, assigned_at) VALUES (%s, %s, %s, %s) ON CONFLICT (submission_id) DO UPDATE SET moderator_id = EXCLUDED.moderator_id, assigned_at = EXCLUDED.assigned_at", (sub_id, channel_dbid, moderator_id, ts))
+        else:
+            c.execute("INSERT OR REPLACE INTO submission_assignments (submission_id, channel_dbid, moderator_id, assigned_at) VALUES (?, ?, ?, ?)", (sub_id, channel_dbid, moderator_id, ts))
+        db.commit()
+    finally:
+        c.close()
+
+def release_assignment(sub_id):
+    # заявка решена — снимаем нагрузку с закреплённого модератора
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("DELETE FROM submission_assignments WHERE submission_id = %s", (sub_id,))
+        else:
+            c.execute("DELETE FROM submission_assignments WHERE submission_id = ?", (sub_id,))
+        db.commit()
+    finally:
+        c.close()
+
+def pick_recipients(channel_dbid, sub_id):
+    moderators = _channel_moderators(channel_dbid)
+    mode = get_assign_mode(channel_dbid)
+    if mode == "broadcast" or len(moderators) <= 1:
+        return moderators
+    chosen = _choose_moderator(channel_dbid, mode, moderators)
+    assign_submission(sub_id, channel_dbid, chosen)
+    metric_inc("assign_" + mode)
+    return [chosen]
+
+def deliver_submission(r, sub_id, author_id, content_type, text_content, file_id, anonymous, forward_message_id=None, flag=None):
+    # отправить модератору содержимое заявки и контрольное сообщение; возвращает message_id контрольного
+    try:
+        if anonymous or not forward_message_id:
+            note = f"Заявка #{sub_id} — анонимно" if anonymous else f"Заявка #{sub_id} — от пользователя {author_id}"
+            if content_type == 'text':
+                bot.send_message(r, f"{note}\n\n{(text_content or '')}")
+            elif content_type == 'photo':
+                bot.send_photo(r, file_id, caption=f"{note}\n\n{(text_content or '')}")
+            elif content_type == 'video':
+                bot.send_video(r, file_id, caption=f"{note}\n\n{(text_content or '')}")
+            elif content_type == 'document':
+                bot.send_document(r, file_id, caption=f"{note}\n\n{(text_content or '')}")
+        else:
+            bot.forward_message(r, author_id, forward_message_id)
+    except Exception:
+        # игнорируем сбои по получателям
+        pass
+    # send control message with buttons
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("✅ Принять", callback_data=f"accept:{sub_id}"),
+           types.InlineKeyboardButton("❌ Отклонить", callback_data=f"reject:{sub_id}"))
+    kb.add(types.InlineKeyboardButton("✉️ Ответить автору", callback_data=f"reply:{sub_id}"))
+    try:
+        ctl = bot.send_message(r, f"🔔 Контроль заявки #{sub_id}" + (f"\n⚠️ {flag}" if flag else ""), reply_markup=kb)
+        return ctl.message_id
+    except Exception:
+        logger.warning("Не удалось отправить контрольное сообщение модератору %s", r)
+        return None
+
+def _pop_control_messages_for(sub_id, chat_id):
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("DELETE FROM submission_messages WHERE submission_id = %s AND chat_id = %s RETURNING message_id", (sub_id, chat_id))
+            rows = c.fetchall()
+        else:
+            c.execute("SELECT message_id FROM submission_messages WHERE submission_id = ? AND chat_id = ?", (sub_id, chat_id))
+            rows = c.fetchall()
+            c.execute("DELETE FROM submission_messages WHERE submission_id = ? AND chat_id = ?", (sub_id, chat_id))
+        db.commit()
+        return [r[0] for r in rows]
+    finally:
+        c.close()
+
+def reassign_stale_submissions(limit=100):
+    # заявки, по которым назначенный модератор не принял решение за ASSIGN_TIMEOUT_SECONDS, передаём следующему
+    cutoff = now_ts() - ASSIGN_TIMEOUT_SECONDS
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("SELECT a.submission_id, a.channel_dbid, a.moderator_id, a.assigned_at, s.user_id, s.content_type, s.text_content, s.file_id, s.anonymous FROM submission_assignments a JOIN submissions s ON s.id = a.submission_id WHERE s.status = 'pending' AND a.assigned_at < %s ORDER BY a.assigned_at LIMIT %s", (cutoff, limit))
+        else:
+            c.execute("SELECT a.submission_id, a.channel_dbid, a.moderator_id, a.assigned_at, s.user_id, s.content_type, s.text_content, s.file_id, s.anonymous FROM submission_assignments a JOIN submissions s ON s.id = a.submission_id WHERE s.status = 'pending' AND a.assigned_at < ? ORDER BY a.assigned_at LIMIT ?", (cutoff, limit))
+        rows = c.fetchall()
+    finally:
+        c.close()
+    moved = 0
+    for sub_id, dbid, old_mod, assigned_at, author_id, ctype, txt, fid, anon in rows:
+        mode = get_assign_mode(dbid)
+        moderators = _channel_moderators(dbid)
+        new_mod = _choose_moderator(dbid, "least_loaded" if mode == "least_loaded" else "round_robin", moderators, exclude=old_mod)
+        # CAS по (moderator_id, assigned_at): если другой воркер уже переназначил — пропускаем
+        c = db.cursor()
+        try:
+            if USE_PG:
+                c.execute("UPDATE submission_assignments SET moderator_id = %s, assigned_at = %s WHERE submission_id = %s AND moderator_id = %s AND assigned_at = %s", (new_mod, now_ts(), sub_id, old_mod, assigned_at))
+            else:
+                c.execute("UPDATE submission_assignments SET moderator_id = ?, assigned_at = ? WHERE submission_id = ? AND moderator_id = ? AND assigned_at = ?", (new_mod, now_ts(), sub_id, old_mod, assigned_at))
+            won = c.rowcount == 1
+            db.commit()
+        finally:
+            c.close()
+        if not won or new_mod is None or new_mod == old_mod:
+            continue
+        with channel_tenant(dbid):
+            for message_id in _pop_control_messages_for(sub_id, old_mod):
+                try:
+                    bot.edit_message_text(f"🔔 Контроль заявки #{sub_id}\n\nЗаявка передана другому модератору (нет решения).", old_mod, message_id)
+                except Exception:
+                    pass
+            mid = deliver_submission(new_mod, sub_id, author_id, ctype, txt, fid, anon)
+        if mid:
+            save_control_messages(sub_id, [(new_mod, mid)])
+        moved += 1
+    if moved:
+        metric_inc("assign_reassigned", moved)
+        logger.info("Переназначено заявок: %s", moved)
+    return moved
+
+# ========== ОТПЕЧАТКИ ЗАЯВОК (поиск дубликатов) ==========
+# Медиа сравниваются точно по file_unique_id, текст — по хэшу нормализованного текста, а почти-дубликаты
+# по 64-битному SimHash слов. Индекс живёт в памяти по каналам: точные ключи в dict, SimHash разбит
+# на SIMHASH_MAX_DISTANCE + 1 полос (LSH) — при расстоянии не больше порога хотя бы одна полоса совпадает,
+# поэтому поиск проверяет только кандидатов из этих корзин. При старте индекс строится из submission_fingerprints
+# (недостающие текстовые отпечатки досчитываются по submissions), новые строки других воркеров
+# подтягиваются фоновой задачей. Режим на канал: channel_settings "dedup" = near (по умолчанию) / exact / off.
+DEDUP_MODES = ("near", "exact", "off")
+_SIMHASH_BANDS = SIMHASH_MAX_DISTANCE + 1
+_BAND_BITS = [64 // _SIMHASH_BANDS + (1 if i < 64 % _SIMHASH_BANDS else 0) for i in range(_SIMHASH_BANDS)]
+_SIMHASH_MIN_TOKENS = 8
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+def normalize_text(text):
+    return " ".join(_WORD_RE.findall(text.lower().replace("ё", "е")))
+
+def text_hash(text):
+    norm = normalize_text(text or "")
+    return hashlib.sha1(norm.encode("utf-8")).hexdigest() if norm else None
+
+def _to_signed64(v):
+    return v - (1 << 64) if v >= (1 << 63) else v
+
+def simhash(text):
+    # признаки — слова (шинглы по несколько слов слишком чувствительны к правке на коротких постах);
+    # совсем короткие тексты не хэшируем — на них SimHash даёт ложные совпадения
+    words = normalize_text(text or "").split()
+    if len(words) < _SIMHASH_MIN_TOKENS:
+        return None
+    weights = [0] * 64
+    for word in words:
+        h = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    value = 0
+    for bit in range(64):
+        if weights[bit] > 0:
+            value |= 1 << bit
+    return _to_signed64(value)
+
+def _bands(value):
+    u = value & 0xFFFFFFFFFFFFFFFF
+    result = []
+    for i, bits in enumerate(_BAND_BITS):
+        result.append((i, u & ((1 << bits) - 1)))
+        u >>= bits
+    return result
+
+def message_media_id(message):
+    ct = message.content_type
+    if ct == "photo":
+        return getattr(message.photo[-1], "file_unique_id", None)
+    if ct in ("video", "document"):
+        return getattr(getattr(message, ct), "file_unique_id", None)
+    return None
+
+class FingerprintIndex:
+    def __init__(self):
+        self.exact = {}     # (dbid, "m:<file_unique_id>" | "t:<sha1>") -> (submission_id, created_at)
+        self.bands = {}     # (dbid, band, value) -> {(simhash, submission_id, created_at), ...}
+        self.last_id = 0    # до какого submission_id загружена таблица
+        self.pruned_at = 0  # когда последний раз выкидывались записи старше окна поиска дублей
+        self.ready = False
+        self.lock = threading.Lock()
+
+    def add(self, sub_id, dbid, media_id, thash, shash, created_at):
+        entry = (shash, sub_id, created_at)
+        with self.lock:
+            if media_id:
+                self.exact[(dbid, "m:" + media_id)] = (sub_id, created_at)
+            if thash:
+                self.exact[(dbid, "t:" + thash)] = (sub_id, created_at)
+            if shash is not None:
+                # свои заявки попадают в индекс дважды (сразу и при очередной синхронизации) — корзины-множества
+                for band, value in _bands(shash):
+                    self.bands.setdefault((dbid, band, value), set()).add(entry)
+
+    def prune(self, since):
+        # записи старше окна поиска дублей find() уже не вернёт — освобождаем память; -> сколько выкинуто
+        removed = 0
+        with self.lock:
+            for key in [k for k, (_, created_at) in self.exact.items() if created_at < since]:
+                del self.exact[key]
+                removed += 1
+            for key in list(self.bands):
+                bucket = self.bands[key]
+                stale = {entry for entry in bucket if entry[2] < since}
+                if stale:
+                    bucket -= stale
+                    removed += len(stale)
+                    if not bucket:
+                        del self.bands[key]
+            self.pruned_at = time.monotonic()
+        return removed
+
+    def find(self, dbid, media_id, thash, shash, since):
+        # -> (submission_id, "exact" | "near") или None
+        with self.lock:
+            for key in (("m:" + media_id) if media_id else None, ("t:" + thash) if thash else None):
+                hit = self.exact.get((dbid, key)) if key else None
+                if hit and hit[1] >= since:
+                    return hit[0], "exact"
+            if shash is None:
+                return None
+            for band, value in _bands(shash):
+                for other, sub_id, created_at in self.bands.get((dbid, band, value), ()):
+                    if created_at >= since and bin((shash ^ other) & 0xFFFFFFFFFFFFFFFF).count("1") <= SIMHASH_MAX_DISTANCE:
+                        return sub_id, "near"
+        return None
+
+fingerprints = FingerprintIndex()
+
+def _find_exact_in_db(dbid, media_id, thash, since):
+    # пока индекс строится: точные совпадения через индексы таблицы
+    c = db.cursor()
+    try:
+        for column, value in (("media_id", media_id), ("text_hash", thash)):
+            if not value:
+                continue
+            if USE_PG:
+                c.execute(f"SELECT submission_id FROM submission_fingerprints WHERE channel_dbid = %s AND {column} = %s AND created_at >= %s LIMIT 1", (dbid, value, since))
+            else:
+                c.execute(f"SELECT submission_id FROM submission_fingerprints WHERE channel_dbid = ? AND {column} = ? AND created_at >= ? LIMIT 1", (dbid, value, since))
+            r = c.fetchone()
+            if r:
+                return r[0], "exact"
+    finally:
+        c.close()
+    return None
+
+def find_duplicate(dbid, media_id, thash, shash):
+    mode = get_channel_setting(dbid, "dedup", "near")
+    if mode == "off":
+        return None
+    since = now_ts() - DUPLICATE_WINDOW_SECONDS
+    if not fingerprints.ready:
+        return _find_exact_in_db(dbid, media_id, thash, since)
+    t0 = time.perf_counter()
+    hit = fingerprints.find(dbid, media_id, thash, shash if mode == "near" else None, since)
+    metric_observe("dedup_lookup", time.perf_counter() - t0)
+    return hit
+
+def save_fingerprint(sub_id, dbid, media_id, thash, shash):
+    ts = now_ts()
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("INSERT INTO submission_fingerprints (submission_id, channel_dbid, media_id, text_hash, simhash, created_at) VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (submission_id) DO NOTHING", (sub_id, dbid, media_id, thash, shash, ts))
+        else:
+            c.execute("INSERT OR IGNORE INTO submission_fingerprints (submission_id, channel_dbid, media_id, text_hash, simhash, created_at) VALUES (?, ?, ?, ?, ?, ?)", (sub_id, dbid, media_id, thash, shash, ts))
+        db.commit()
+    finally:
+        c.close()
+    fingerprints.add(sub_id, dbid, media_id, thash, shash, ts)
+
+def _backfill_text_fingerprints(batch=1000):
+    # заявки, сохранённые до появления отпечатков: считаем по тексту из submissions (только в окне поиска дублей)
+    since = now_ts() - DUPLICATE_WINDOW_SECONDS
+    while True:
+        c = db.cursor()
+        try:
+            if USE_PG:
+                c.execute("SELECT s.id, s.target_channel_dbid, s.text_content, s.created_at FROM submissions s LEFT JOIN submission_fingerprints f ON f.submission_id = s.id WHERE f.submission_id IS NULL AND s.text_content IS NOT NULL AND s.created_at >= %s ORDER BY s.id LIMIT %s", (since, batch))
+            else:
+                c.execute("SELECT s.id, s.target_channel_dbid, s.text_content, s.created_at FROM submissions s LEFT JOIN submission_fingerprints f ON f.submission_id = s.id WHERE f.submission_id IS NULL AND s.text_content IS NOT NULL AND s.created_at >= ? ORDER BY s.id LIMIT ?", (since, batch))
+            rows = c.fetchall()
+            if not rows:
+                return
+            values = [(r[0], r[1], None, text_hash(r[2]), simhash(r[2]), r[3]) for r in rows]
+            if USE_PG:
+                c.executemany("INSERT INTO submission_fingerprints (submission_id, channel_dbid, media_id, text_hash, simhash, created_at) VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (submission_id) DO NOTHING", values)
+            else:
+                c.executemany("INSERT OR IGNORE INTO submission_fingerprints (submission_id, channel_dbid, media_id, text_hash, simhash, created_at) VALUES (?, ?, ?, ?, ?, ?)", values)
+            db.commit()
+        finally:
+            c.close()
+
+def load_fingerprints(batch=5000):
+    # догружает в индекс строки с submission_id > последнего загруженного (при старте — все);
+    # раз в час заодно выкидывает из индекса вышедшие из окна поиска дублей
+    since = now_ts() - DUPLICATE_WINDOW_SECONDS
+    if fingerprints.ready and time.monotonic() - fingerprints.pruned_at >= 3600:
+        metric_inc("fingerprints_pruned", fingerprints.prune(since))
+    loaded = 0
+    while True:
+        c = db.cursor()
+        try:
+            if USE_PG:
+                c.execute("SELECT submission_id, channel_dbid, media_id, text_hash, simhash, created_at FROM submission_fingerprints WHERE submission_id > %s AND created_at >= %s ORDER BY submission_id LIMIT %s", (fingerprints.last_id, since, batch))
+            else:
+                c.execute("SELECT submission_id, channel_dbid, media_id, text_hash, simhash, created_at FROM submission_fingerprints WHERE submission_id > ? AND created_at >= ? ORDER BY submission_id LIMIT ?", (fingerprints.last_id, since, batch))
+            rows = c.fetchall()
+        finally:
+            c.close()
+        for sub_id, dbid, media_id, thash, shash, created_at in rows:
+            fingerprints.add(sub_id, dbid, media_id, thash, shash, created_at)
+        if rows:
+            # позицию двигает только синхронизация: так не пропускаются строки других воркеров
+            fingerprints.last_id = rows[-1][0]
+        loaded += len(rows)
+        if len(rows) < batch:
+            return loaded
+
+def build_fingerprint_index():
+    t0 = time.perf_counter()
+    _backfill_text_fingerprints()
+    loaded = load_fingerprints()
+    fingerprints.ready = True
+    logger.info("Индекс отпечатков заявок построен: %s записей за %.1f сек", loaded, time.perf_counter() - t0)
+
+# ========== АВТОМОДЕРАЦИЯ (правила канала) ==========
+# Правила канала из channel_rules компилируются в один объект на канал: все ключевые слова — в один
+# автомат Aho-Corasick (pyahocorasick, если установлен, иначе свой на dict). У regex берётся
+# обязательная литеральная подстрока и тоже кладётся в автомат: regex запускается, только если она
+# нашлась. Regex без такой подстроки собираются в одно выражение с именованной группой на правило.
+# Так проверка — один проход по тексту независимо от числа правил. Скомпилированное кэшируется
+# и сбрасывается при правке правил (в т.ч. в других воркерах).
+# Действия: reject — отклонить сразу, flag — отправить модераторам с пометкой, route:<user_id> —
+# отправить только этому модератору. Приоритет: reject > route > flag.
+RULE_KINDS = ("keyword", "regex", "max_links", "max_mentions", "content_types")
+RULE_MAX_PATTERN = 500
+_LINK_RE = re.compile(r"(?:https?://|www\.|t\.me/)\S+", re.IGNORECASE)
+_MENTION_RE = re.compile(r"(?<!\w)@\w{4,}")
+_rules_cache = {}
+_rules_lock = threading.Lock()
+
+def _fold(text):
+    return (text or "").lower().replace("ё", "е")
+
+def _required_literal(pattern):
+    # самая длинная цепочка литералов на верхнем уровне regex — без неё совпадение невозможно
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        return None
+    best = run = ""
+    for op, av in parsed:
+        if op is sre_constants.LITERAL:
+            run += chr(av)
+        else:
+            best = max(best, run, key=len)
+            run = ""
+    best = max(best, run, key=len)
+    return _fold(best) if len(best) >= 3 else None
+
+def _is_word_char(ch):
+    return ch.isalnum() or ch == "_"
+
+def _whole_word(text, start, end):
+    # вхождение text[start:end] не продолжает соседнее слово («кот» в «котлета» — нет); края-не-буквы не проверяются
+    if _is_word_char(text[start]) and start > 0 and _is_word_char(text[start - 1]):
+        return False
+    if _is_word_char(text[end - 1]) and end < len(text) and _is_word_char(text[end]):
+        return False
+    return True
+
+class KeywordAutomaton:
+    # Aho-Corasick: за один проход по тексту находит все вхождения всех ключевых слов
+    # (слова — (строка, значение); search отдаёт (позиция последнего символа, значение) каждого вхождения)
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        for word, rule_id in words:
+            node = 0
+            for ch in word:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                    self.goto[node][ch] = nxt
+                node = nxt
+            self.out[node] = self.out[node] + (rule_id,)
+        pending = deque(self.goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for ch, nxt in self.goto[node].items():
+                pending.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def search(self, text):
+        found = []
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node]:
+                found.extend((i, value) for value in out[node])
+        return found
+
+class _NativeAutomaton:
+    def __init__(self, words):
+        by_word = {}
+        for word, rule_id in words:
+            by_word.setdefault(word, []).append(rule_id)
+        self.automaton = ahocorasick.Automaton()
+        for word, rule_ids in by_word.items():
+            self.automaton.add_word(word, tuple(rule_ids))
+        self.automaton.make_automaton()
+
+    def search(self, text):
+        return [(end, value) for end, values in self.automaton.iter(text) for value in values]
+
+def validate_rule(kind, action, pattern):
+    # текст ошибки для пользователя или None
+    if kind not in RULE_KINDS:
+        return "Тип правила: " + ", ".join(RULE_KINDS)
+    if action not in ("reject", "flag") and not (action.startswith("route:") and action[6:].isdigit()):
+        return "Действие: reject, flag или route:<user_id>"
+    if not pattern or len(pattern) > RULE_MAX_PATTERN:
+        return f"Шаблон пустой или длиннее {RULE_MAX_PATTERN} символов."
+    if kind == "regex":
+        try:
+            compiled = re.compile(f"(?P<r0>{pattern})")
+        except re.error as e:
+            return f"Ошибка в регулярном выражении: {e}"
+        if len(compiled.groupindex) > 1:
+            return "Именованные группы в regex не поддерживаются."
+    if kind in ("max_links", "max_mentions") and not pattern.isdigit():
+        return "Для лимита укажите число."
+    return None
+
+class CompiledRules:
+    def __init__(self, rows):
+        self.actions = {}       # rule_id -> action
+        self.describe = {}      # rule_id -> "kind: pattern"
+        self.limits = []        # (rule_id, kind, max)
+        self.content_types = [] # (rule_id, {разрешённые типы})
+        keywords = []
+        regexes = []
+        self.guarded = {}       # rule_id -> regex, запускается при находке его литерала (ключ в автомате: -rule_id)
+        for rule_id, kind, pattern, action in rows:
+            if validate_rule(kind, action, pattern):
+                logger.warning("Правило %s пропущено: некорректно", rule_id)
+                continue
+            self.actions[rule_id] = action
+            self.describe[rule_id] = f"{kind}: {pattern}"
+            if kind == "keyword":
+                # ключевое слово совпадает только целым словом: длина нужна, чтобы проверить границы вхождения
+                keywords.extend((w, (rule_id, len(w))) for w in (_fold(x.strip()) for x in pattern.split(",")) if w)
+            elif kind == "regex":
+                literal = _required_literal(pattern)
+                if literal:
+                    self.guarded[rule_id] = re.compile(pattern, re.IGNORECASE)
+                    keywords.append((literal, (-rule_id, 0)))
+                else:
+                    regexes.append((rule_id, pattern, action))
+            elif kind in ("max_links", "max_mentions"):
+                self.limits.append((rule_id, kind, int(pattern)))
+            else:
+                self.content_types.append((rule_id, {t.strip() for t in pattern.split(",") if t.strip()}))
+        self.keywords = None
+        if keywords:
+            self.keywords = _NativeAutomaton(keywords) if ahocorasick is not None else KeywordAutomaton(keywords)
+        # reject-правила первыми: альтернативы в одной позиции пробуются по порядку
+        regexes.sort(key=lambda r: r[2] != "reject")
+        self.regex = re.compile("|".join(f"(?P<r{rule_id}>{p})" for rule_id, p, _ in regexes), re.IGNORECASE) if regexes else None
+
+    def match(self, content_type, text, links, mentions):
+        hits = set()
+        for rule_id, allowed in self.content_types:
+            if content_type not in allowed:
+                hits.add(rule_id)
+        for rule_id, kind, limit in self.limits:
+            if (links if kind == "max_links" else mentions) > limit:
+                hits.add(rule_id)
+        if text:
+            if self.keywords is not None:
+                folded = _fold(text)
+                tried = set()
+                for end, (rule_id, length) in self.keywords.search(folded):
+                    if rule_id > 0:
+                        if rule_id not in hits and _whole_word(folded, end + 1 - length, end + 1):
+                            hits.add(rule_id)
+                    elif rule_id not in tried:
+                        tried.add(rule_id)
+                        if self.guarded[-rule_id].search(text):
+                            hits.add(-rule_id)
+            if self.regex is not None:
+                for m in self.regex.finditer(text):
+                    hits.add(int(m.lastgroup[1:]))
+        return hits
+
+def list_channel_rules(channel_dbid):
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("SELECT id, kind, pattern, action FROM channel_rules WHERE channel_dbid = %s ORDER BY id", (channel_dbid,))
+        else:
+            c.execute("SELECT id, kind, pattern, action FROM channel_rules WHERE channel_dbid = ? ORDER BY id", (channel_dbid,))
+        return c.fetchall()
+    finally:
+        c.close()
+
+def add_channel_rule(channel_dbid, kind, pattern, action, added_by):
+    ts = now_ts()
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("INSERT INTO channel_rules (channel_dbid, kind, pattern, action, added_by, created_at) VALUES (%s, %s, %s, %s, %s, %s) RETURNING id", (channel_dbid, kind, pattern, action, added_by, ts))
+            rule_id = c.fetchone()[0]
+        else:
+            c.execute("INSERT INTO channel_rules (channel_dbid, kind, pattern, action, added_by, created_at) VALUES (?, ?, ?, ?, ?, ?)", (channel_dbid, kind, pattern, action, added_by, ts))
+            rule_id = c.lastrowid
+        db.commit()
+    finally:
+        c.close()
+    _rules_forget(channel_dbid)
+    return rule_id
+
+def remove_channel_rule(channel_dbid, rule_id):
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("DELETE FROM channel_rules WHERE channel_dbid = %s AND id = %s", (channel_dbid, rule_id))
+        else:
+            c.execute("DELETE FROM channel_rules WHERE channel_dbid = ? AND id = ?", (channel_dbid, rule_id))
+        removed = c.rowcount > 0
+        db.commit()
+    finally:
+        c.close()
+    _rules_forget(channel_dbid)
+    return removed
+
+def _rules_forget(channel_dbid):
+    with _rules_lock:
+        _rules_cache.pop(channel_dbid, None)
+
+def _rules_on_invalidate(key):
+    if key is None:
+        with _rules_lock:
+            _rules_cache.clear()
+    else:
+        _rules_forget(int(key))
+
+on_invalidate("channel_rules", _rules_on_invalidate)
+
+def compiled_rules(channel_dbid):
+    with _rules_lock:
+        rules = _rules_cache.get(channel_dbid, _MISSING)
+    if rules is not _MISSING:
+        return rules
+    rows = list_channel_rules(channel_dbid)
+    rules = CompiledRules(rows) if rows else None
+    with _rules_lock:
+        _rules_cache[channel_dbid] = rules
+    return rules
+
+def _count_entities(message, types_):
+    entities = (message.entities or []) + (getattr(message, "caption_entities", None) or [])
+    return sum(1 for e in entities if e.type in types_)
+
+def evaluate_rules(channel_dbid, message, text):
+    # -> None или (действие "reject" | "route" | "flag", [описания сработавших правил], route_to)
+    rules = compiled_rules(channel_dbid)
+    if rules is None:
+        return None
+    t0 = time.perf_counter()
+    links = _count_entities(message, ("url", "text_link")) or len(_LINK_RE.findall(text or ""))
+    mentions = _count_entities(message, ("mention", "text_mention")) or len(_MENTION_RE.findall(text or ""))
+    hits = rules.match(message.content_type, text, links, mentions)
+    metric_observe("rules_match", time.perf_counter() - t0)
+    if not hits:
+        return None
+    reasons = [rules.describe[r] for r in sorted(hits)]
+    actions = [rules.actions[r] for r in sorted(hits)]
+    if "reject" in actions:
+        return "reject", reasons, None
+    routes = [a for a in actions if a.startswith("route:")]
+    if routes:
+        return "route", reasons, int(routes[0][6:])
+    return "flag", reasons, None
+
+# ========== HANDLE SUBMISSION ==========
+def _reject_submission_from_user(chat_id, reason=""):
+    bot.send_message(chat_id, f"❌ Не удалось принять заявку. {reason}", reply_markup=main_menu())
+
+def handle_submission(message, anonymous=True, target_dbid=0):
+    uid = message.from_user.id
+    st = pop_state(uid)
+    if not st or not st.startswith("awaiting_submission"):
+        bot.send_message(uid, "Сначала начни через меню: /menu → Предложить пост.", reply_markup=main_menu())
+        return
+    # извлечь состояние (доп. валидация)
+    # content type
+    content_type = message.content_type
+    text_content = message.text if content_type == 'text' else None
+    file_id = None
+    file_size = None
+    if content_type == 'photo':
+        file_id = message.photo[-1].file_id
+        try:
+            file_size = message.photo[-1].file_size
+        except:
+            file_size = None
+    elif content_type == 'video':
+        file_id = message.video.file_id
+        file_size = getattr(message.video, 'file_size', None)
+    elif content_type == 'document':
+        file_id = message.document.file_id
+        file_size = getattr(message.document, 'file_size', None)
+    elif content_type == 'text':
+        file_id = None
+    else:
+        bot.send_message(uid, "Тип сообщения не поддерживается. Отправь текст, фото, видео или документ.", reply_markup=main_menu())
+        return
+
+    # basic validations
+    if content_type == 'text' and text_content and len(text_content) > MAX_TEXT_LENGTH:
+        _reject_submission_from_user(uid, f"Текст слишком длинный (макс {MAX_TEXT_LENGTH} символов).")
+        return
+    if file_size and file_size > MAX_FILE_SIZE:
+        _reject_submission_from_user(uid, "Файл слишком большой.")
+        return
+
+    # require target_dbid > 0 (no "ordinary" submissions allowed)
+    if not target_dbid or target_dbid <= 0:
+        bot.send_message(uid, "Ошибка: цель публикации не указана. Пожалуйста, отправляйте заявки только в подключённые каналы.", reply_markup=main_menu())
+        return
+
+    # recheck cooldown before saving
+    last = get_last_published(uid, target_dbid)
+    if last and (now_ts() - last) < COOLDOWN_SECONDS:
+        left = COOLDOWN_SECONDS - (now_ts() - last)
+        bot.send_message(uid, f"⏳ Вы уже публиковали в этот канал. Попробовать ещё можно через {format_timedelta_seconds(left)}.", reply_markup=main_menu())
+        return
+
+    # banned check (channel-specific)
+    if is_banned(target_dbid, uid):
+        _reject_submission_from_user(uid, "Вы заблокированы для этого канала.")
+        return
+
+    # правила автомодерации канала (по тексту или подписи к медиа)
+    verdict = evaluate_rules(target_dbid, message, message.text or message.caption)
+    if verdict:
+        metric_inc("rules_" + verdict[0])
+        if verdict[0] == "reject":
+            _reject_submission_from_user(uid, "Заявка не соответствует правилам канала.")
+            return
+
+    # дубликаты: такой же файл или (почти) такой же текст уже предлагали в этот канал
+    media_id = message_media_id(message)
+    thash = text_hash(text_content) if text_content else None
+    shash = simhash(text_content) if text_content else None
+    dup = find_duplicate(target_dbid, media_id, thash, shash)
+    if dup:
+        metric_inc("duplicates_" + dup[1])
+        _reject_submission_from_user(uid, "Такой пост уже предлагали в этот канал.")
+        return
+
+    sub_id = save_submission(uid, content_type, text_content, file_id, anonymous, target_dbid)
+    try:
+        save_fingerprint(sub_id, target_dbid, media_id, thash, shash)
+    except Exception:
+        logger.exception("Не удалось сохранить отпечаток заявки %s", sub_id)
+
+    # set cooldown at submission time to prevent spamming (persisted in DB)
+    try:
+        set_cooldown(uid, target_dbid, now_ts())
+    except Exception:
+        logger.exception("Не удалось установить cooldown при сохранении заявки")
+
+    # determine recipients: все модераторы (broadcast) или один назначенный (round_robin / least_loaded)
+    flag = None
+    if verdict and verdict[0] == "route" and verdict[2] in _channel_moderators(target_dbid):
+        recipients = [verdict[2]]
+        assign_submission(sub_id, target_dbid, verdict[2])
+    else:
+        recipients = pick_recipients(target_dbid, sub_id)
+    if verdict:
+        flag = "Сработали правила: " + "; ".join(verdict[1])
+
+    # модераторы с включённым дайджестом получат заявку в сводке, а не отдельным сообщением
+    digest_subs = digest_subscribers(target_dbid)
+    if digest_subs:
+        recipients = [r for r in recipients if r not in digest_subs]
+
+    # send submission to each recipient (moderators)
+    control_sent = []
+    for r in recipients:
+        mid = deliver_submission(r, sub_id, uid, content_type, text_content, file_id, anonymous, forward_message_id=message.message_id, flag=flag)
+        if mid:
+            control_sent.append((r, mid))
+    # запоминаем контрольные сообщения, чтобы после решения одного модератора обновить их у всех
+    save_control_messages(sub_id, control_sent)
+
+    bot.send_message(uid, "✅ Ваша заявка отправлена на рассмотрение. Спасибо!", reply_markup=main_menu())
+
+# ========== ADMIN ACTIONS ON SUBMISSIONS (с проверкой прав) ==========
+STATUS_LABELS = {
+    "pending": "ожидает",
+    "accepted": "принята",
+    "rejected": "отклонена",
+    "published": "опубликована",
+    "expired": "истекла",
+}
+
+def sync_control_messages(sub_id, status, moderator):
+    # один проход по всем контрольным сообщениям заявки: убираем кнопки и показываем итог,
+    # чтобы остальные модераторы не нажимали впустую
+    try:
+        rows = pop_control_messages(sub_id)
+    except Exception:
+        logger.exception("Не удалось загрузить контрольные сообщения заявки #%s", sub_id)
+        return
+    text = f"🔔 Контроль заявки #{sub_id}\n\nИтог: {STATUS_LABELS.get(status, status)}"
+    if moderator is not None:
+        who = ("@" + moderator.username) if getattr(moderator, "username", None) else str(moderator.id)
+        text += f" (модератор {who})."
+    else:
+        text += "."
+    for chat_id, message_id in rows:
+        try:
+            bot.edit_message_text(text, chat_id, message_id)
+            metric_inc("control_msg_synced")
+        except Exception:
+            # сообщение удалено или слишком старое — не критично
+            metric_inc("control_msg_sync_failed")
+
+@bot.callback_query_handler(func=lambda cq: cq.data and any(cq.data.startswith(pref) for pref in ("accept:", "reject:", "reply:", "republish:")))
+def cq_admin_submission_actions(cq):
+    bot.answer_callback_query(cq.id)
+    parts = cq.data.split(":",1)
+    action = parts[0]; sid = parts[1]
+    try:
+        sid = int(sid)
+    except:
+        bot.send_message(cq.from_user.id, "Неверный ID заявки."); return
+    submission = get_submission(sid)
+    if not submission:
+        bot.send_message(cq.from_user.id, "Заявка не найдена."); return
+    sub_id, user_id, content_type, text_content, file_id, status, created_at, anonymous, target_dbid = submission
+
+    # проверка прав: модератор канала или владелец
+    if target_dbid and target_dbid > 0:
+        acl = channel_acl(target_dbid)
+        if not acl:
+            bot.send_message(cq.from_user.id, "Канал не найден для этой заявки."); return
+        if cq.from_user.id != acl[0] and cq.from_user.id not in acl[1]:
+            bot.send_message(cq.from_user.id, "У вас нет прав модератора для этой заявки."); return
+    else:
+        bot.send_message(cq.from_user.id, "Невозможно модерировать заявку без привязки к каналу."); return
+
+    if action in ("accept", "reject") and status != "pending":
+        bot.send_message(cq.from_user.id, f"Заявка #{sub_id} уже обработана ({STATUS_LABELS.get(status, status)}).")
+        return
+
+    if action == "republish":
+        # повтор после неудачной публикации: заявка принята, но в канал не ушла
+        if status != "accepted":
+            bot.send_message(cq.from_user.id, f"Заявка #{sub_id} уже не ждёт публикации ({STATUS_LABELS.get(status, status)}).")
+            return
+        handle_publish_to_channel_by_dbid(cq.from_user.id, sub_id, target_dbid)
+        return
+
+    if action == "accept":
+        try:
+            won = transition_submission_status(sub_id, "pending", "accepted", moderator_id=cq.from_user.id)
+        except CircuitOpenError:
+            raise
+        except Exception:
+            bot.send_message(cq.from_user.id, f"⚠️ Не удалось обработать заявку #{sub_id}, попробуйте ещё раз.")
+            return
+        if not won:
+            # другой модератор успел раньше
+            bot.send_message(cq.from_user.id, f"Заявка #{sub_id} уже обработана другим модератором.")
+            return
+        release_assignment(sub_id)
+        sync_control_messages(sub_id, "accepted", cq.from_user)
+        bot.send_message(cq.from_user.id, f"✅ Заявка #{sub_id} принята.")
+        try:
+            bot.send_message(user_id, f"✅ Ваша заявка #{sub_id} принята модератором.")
+        except:
+            pass
+        # publish to channel
+        if target_dbid and target_dbid > 0:
+            handle_publish_to_channel_by_dbid(cq.from_user.id, sub_id, target_dbid)
+        return
+
+    if action == "reject":
+        try:
+            won = transition_submission_status(sub_id, "pending", "rejected", moderator_id=cq.from_user.id)
+        except CircuitOpenError:
+            raise
+        except Exception:
+            bot.send_message(cq.from_user.id, f"⚠️ Не удалось обработать заявку #{sub_id}, попробуйте ещё раз.")
+            return
+        if not won:
+            bot.send_message(cq.from_user.id, f"Заявка #{sub_id} уже обработана другим модератором.")
+            return
+        release_assignment(sub_id)
+        sync_control_messages(sub_id, "rejected", cq.from_user)
+        bot.send_message(cq.from_user.id, f"❌ Заявка #{sub_id} отклонена.")
+        try:
+            bot.send_message(user_id, f"❌ Ваша заявка #{sub_id} отклонена модератором.")
+        except:
+            pass
+        return
+
+    if action == "reply":
+        # set state to awaiting reply for this moderator
+        set_state(cq.from_user.id, f"awaiting_reply:{sub_id}")
+        msg = bot.send_message(cq.from_user.id, f"✍️ Напишите ответ автору заявки #{sub_id} (или нажмите Отмена).", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("❌ Отмена", callback_data="cancel")))
+        bot.register_next_step_handler(msg, lambda m, sid=sub_id: send_reply_to_author(m, sid))
+        return
+
+# ========== PUBLISH TO CHANNEL (с логами и проверками) ==========
+def handle_publish_to_channel_by_dbid(requester_id, sub_id, chan_dbid):
+    ch = get_channel_by_dbid(chan_dbid)
+    if not ch:
+        bot.send_message(requester_id, "Канал не найден."); return
+    _, owner_id, channel_id, title = ch
+    sub = get_submission(sub_id)
+    if not sub:
+        bot.send_message(requester_id, "Заявка не найдена."); return
+    sub_id, user_id, content_type, text_content, file_id, status, created_at, anonymous, target_dbid = sub
+
+    author_str = ""
+    if anonymous == 0:
+        try:
+            info = get_chat_cached(user_id)
+            if getattr(info, "username", None):
+                author_str = f"Автор: @{info.username}\n\n"
+            else:
+                name = (getattr(info, "first_name", "") or "") + (" " + getattr(info, "last_name", "") if getattr(info, "last_name", None) else "")
+                author_str = f"Автор: {name}\n\n"
+        except:
+            author_str = ""
+
+    target = channel_id
+    try:
+        if content_type == 'text':
+            bot.send_message(target, author_str + (text_content or ""))
+        elif content_type == 'photo':
+            bot.send_photo(target, file_id, caption=(author_str + (text_content or "")))
+        elif content_type == 'video':
+            bot.send_video(target, file_id, caption=(author_str + (text_content or "")))
+        elif content_type == 'document':
+            bot.send_document(target, file_id, caption=(author_str + (text_content or "")))
+        # mark as published (только из accepted — повторная публикация не пройдёт); пост уже в канале —
+        # сбой БД здесь не должен превращаться в «ошибку публикации» с кнопкой повтора
+        try:
+            transition_submission_status(sub_id, "accepted", "published", moderator_id=requester_id)
+        except Exception:
+            pass
+        # set cooldown for this user-channel
+        set_cooldown(user_id, chan_dbid, now_ts())
+        # notify requester (moderator) and author
+        bot.send_message(requester_id, f"✅ Заявка #{sub_id} опубликована в {title or channel_id}.")
+        try:
+            bot.send_message(user_id, f"✅ Ваше сообщение #{sub_id} опубликовано в канал *{title or channel_id}*.", parse_mode="Markdown")
+        except:
+            pass
+    except Exception as e:
+        # заявка остаётся accepted (кнопки модерации уже сняты) — публикацию можно повторить
+        kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("🔁 Повторить публикацию", callback_data=f"republish:{sub_id}"))
+        bot.send_message(requester_id, f"Ошибка при публикации: {e}\nУбедитесь, что бот админ в канале и имеет права на отправку сообщений.", reply_markup=kb)
+
+# ========== SEND REPLY TO AUTHOR ==========
+def send_reply_to_author(message, sub_id):
+    state = pop_state(message.from_user.id)
+    try:
+        sub = get_submission(sub_id)
+        if not sub:
+            bot.send_message(message.from_user.id, "Заявка не найдена."); return
+        user_id = sub[1]
+        bot.send_message(user_id, f"✉️ Ответ модератора по заявке #{sub_id}:\n\n{message.text}")
+        bot.send_message(message.from_user.id, "Ответ отправлен.")
+        audit_log.log(sub_id, message.from_user.id, "reply", message.text)
+    except Exception:
+        bot.send_message(message.from_user.id, "Не удалось отправить ответ (возможно, пользователь закрыл диалог).")
+
+# ========== PROMO PREPARE (owner posts a ready message with bot link) ==========
+@bot.callback_query_handler(func=lambda cq: cq.data and cq.data.startswith("promo_prepare:"))
+@noncritical
+def cq_promo_prepare(cq):
+    answer_callback_quietly(cq)
+    dbid = int(cq.data.split(":",1)[1])
+    acl = channel_acl(dbid)
+    if not acl:
+        bot.send_message(cq.from_user.id, "Канал не найден."); return
+    if cq.from_user.id != acl[0]:
+        bot.send_message(cq.from_user.id, "Эту операцию может выполнять только владелец канала."); return
+    ch = get_channel_by_dbid(dbid)
+    if not ch:
+        bot.send_message(cq.from_user.id, "Канал не найден."); return
+    _, owner_id, channel_id, title = ch
+    username = bot_username()
+    bot_link = f"https://t.me/{username}?start=post_{dbid}" if username else None
+    text = f"📣 Хотите отправить пост в канал *{title or channel_id}*? Нажмите кнопку и предложите пост через бота — он попадёт на модерацию."
+    kb = types.InlineKeyboardMarkup()
+    if bot_link:
+        kb.add(types.InlineKeyboardButton("Предложить пост", url=bot_link))
+    try:
+        # try to send using numeric id or username
+        try:
+            bot.send_message(channel_id, text, parse_mode="Markdown", reply_markup=kb)
+        except Exception:
+            # maybe stored channel_id is @username, resolve and send
+            if str(channel_id).startswith('@'):
+                try:
+                    bot.send_message(channel_id, text, parse_mode="Markdown", reply_markup=kb)
+                except Exception as e:
+                    raise e
+        bot.send_message(cq.from_user.id, "Готовое сообщение отправлено в канал.", reply_markup=channels_menu())
+    except Exception as e:
+        bot.send_message(cq.from_user.id, f"Ошибка при отправке в канал: {e}", reply_markup=channels_menu())
+
+# ========== DELETE CHANNEL ==========
+@bot.callback_query_handler(func=lambda cq: cq.data and cq.data.startswith("delete:"))
+def cq_delete(cq):
+    bot.answer_callback_query(cq.id)
+    dbid = int(cq.data.split(":",1)[1])
+    acl = channel_acl(dbid)
+    if not acl:
+        bot.send_message(cq.from_user.id, "Канал не найден."); return
+    if cq.from_user.id != acl[0]:
+        bot.send_message(cq.from_user.id, "Удалять канал может только его владелец."); return
+    ch = get_channel_by_dbid(dbid)
+    if not ch:
+        bot.send_message(cq.from_user.id, "Канал не найден."); return
+    title = ch[3]
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    kb.add(types.InlineKeyboardButton("✅ Да, удалить", callback_data=f"delete_yes:{dbid}"),
+           types.InlineKeyboardButton("❌ Отмена", callback_data="my_channels"))
+    nav_reply(cq, f"Вы действительно хотите удалить канал *{title or ''}*?", parse_mode="Markdown", reply_markup=kb)
+
+@bot.callback_query_handler(func=lambda cq: cq.data and cq.data.startswith("delete_yes:"))
+def cq_delete_yes(cq):
+    bot.answer_callback_query(cq.id)
+    dbid = int(cq.data.split(":",1)[1])
+    acl = channel_acl(dbid)
+    if not acl:
+        bot.send_message(cq.from_user.id, "Канал не найден."); return
+    if cq.from_user.id != acl[0]:
+        bot.send_message(cq.from_user.id, "Удалять канал может только владелец."); return
+    remove_channel(dbid)
+    nav_reply(cq, "Канал удалён.", reply_markup=main_menu())
+
+# ========== Бан пользователя для канала (owner только) ==========
+@bot.message_handler(commands=['ban'])
+def cmd_ban(message):
+    # формат: /ban <channel_dbid> <user_id>
+    parts = (message.text or "").split()
+    if len(parts) != 3:
+        bot.send_message(message.chat.id, "Использование: /ban <channel_dbid> <user_id>")
+        return
+    try:
+        dbid = int(parts[1]); uid = int(parts[2])
+    except:
+        bot.send_message(message.chat.id, "Неверные аргументы.")
+        return
+    acl = channel_acl(dbid)
+    if not acl:
+        bot.send_message(message.chat.id, "Канал не найден.")
+        return
+    if message.from_user.id != acl[0]:
+        bot.send_message(message.chat.id, "Только владелец канала может банить пользователей.")
+        return
+    res = add_ban(dbid, uid, message.from_user.id)
+    bot.send_message(message.chat.id, "Пользователь заблокирован для этого канала." if res else "Пользователь уже заблокирован.")
+
+@bot.message_handler(commands=['unban'])
+def cmd_unban(message):
+    # формат: /unban <channel_dbid> <user_id>
+    parts = (message.text or "").split()
+    if len(parts) != 3:
+        bot.send_message(message.chat.id, "Использование: /unban <channel_dbid> <user_id>")
+        return
+    try:
+        dbid = int(parts[1]); uid = int(parts[2])
+    except:
+        bot.send_message(message.chat.id, "Неверные аргументы.")
+        return
+    acl = channel_acl(dbid)
+    if not acl:
+        bot.send_message(message.chat.id, "Канал не найден.")
+        return
+    if message.from_user.id != acl[0]:
+        bot.send_message(message.chat.id, "Только владелец канала может снимать блокировку.")
+        return
+    remove_ban(dbid, uid)
+    bot.send_message(message.chat.id, "Пользователь разблокирован.")
+
+# ========== Правила автомодерации (owner только) ==========
+@bot.message_handler(commands=['rules'])
+def cmd_rules(message):
+    # формат: /rules <channel_dbid>
+    parts = (message.text or "").split()
+    if len(parts) != 2:
+        bot.send_message(message.chat.id, "Использование: /rules <channel_dbid>")
+        return
+    try:
+        dbid = int(parts[1])
+    except:
+        bot.send_message(message.chat.id, "Неверные аргументы.")
+        return
+    if not can_moderate(dbid, message.from_user.id):
+        bot.send_message(message.chat.id, "Вы не модератор этого канала.")
+        return
+    rows = list_channel_rules(dbid)
+    if not rows:
+        text = "Правил нет."
+    else:
+        text = "Правила канала:\n" + "\n".join(f"#{rid} {kind} → {action}: {pattern}" for rid, kind, pattern, action in rows)
+    text += ("\n\nДобавить: /addrule <channel_dbid> <тип> <действие> <шаблон>\nТипы: " + ", ".join(RULE_KINDS) +
+             "\nkeyword — слова через запятую, совпадают только целым словом («кот» не сработает на «котлета»; "
+             "для части слова — regex)\nДействия: reject, flag, route:<user_id>\nУдалить: /delrule <channel_dbid> <id>")
+    bot.send_message(message.chat.id, text)
+
+@bot.message_handler(commands=['addrule'])
+def cmd_addrule(message):
+    # формат: /addrule <channel_dbid> <kind> <action> <pattern...>
+    parts = (message.text or "").split(None, 4)
+    if len(parts) != 5:
+        bot.send_message(message.chat.id, "Использование: /addrule <channel_dbid> <тип> <действие> <шаблон>")
+        return
+    try:
+        dbid = int(parts[1])
+    except:
+        bot.send_message(message.chat.id, "Неверные аргументы.")
+        return
+    if not is_channel_owner(dbid, message.from_user.id):
+        bot.send_message(message.chat.id, "Только владелец канала может менять правила.")
+        return
+    kind, action, pattern = parts[2], parts[3], parts[4].strip()
+    error = validate_rule(kind, action, pattern)
+    if error:
+        bot.send_message(message.chat.id, error)
+        return
+    rule_id = add_channel_rule(dbid, kind, pattern, action, message.from_user.id)
+    bot.send_message(message.chat.id, f"Правило #{rule_id} добавлено.")
+
+@bot.message_handler(commands=['delrule'])
+def cmd_delrule(message):
+    # формат: /delrule <channel_dbid> <rule_id>
+    parts = (message.text or "").split()
+    if len(parts) != 3:
+        bot.send_message(message.chat.id, "Использование: /delrule <channel_dbid> <id>")
+        return
+    try:
+        dbid = int(parts[1]); rule_id = int(parts[2])
+    except:
+        bot.send_message(message.chat.id, "Неверные аргументы.")
+        return
+    if not is_channel_owner(dbid, message.from_user.id):
+        bot.send_message(message.chat.id, "Только владелец канала может менять правила.")
+        return
+    bot.send_message(message.chat.id, "Правило удалено." if remove_channel_rule(dbid, rule_id) else "Правило не найдено.")
+
+# ========== UNIVERSAL CANCEL ==========
+@bot.callback_query_handler(func=lambda cq: cq.data == "cancel")
+def cq_cancel(cq):
+    bot.answer_callback_query(cq.id, "Действие отменено.")
+    pop_state(cq.from_user.id)
+    nav_reply(cq, "Действие отменено.", reply_markup=main_menu())
+
+# ========== UNEXPECTED INPUT HANDLER (when in state) ==========
+@bot.message_handler(func=lambda m: get_state(m.from_user.id) is not None)
+def handle_unexpected_input(m):
+    st = get_state(m.from_user.id)
+    bot.send_message(m.chat.id, "Я сейчас ожидаю конкретные данные — либо отправь их, либо нажми «Отмена». Для возврата в меню напиши /menu", reply_markup=types.ReplyKeyboardRemove())
+
+# ========== DEFAULT PRIVATE MESSAGE HANDLER ==========
+@bot.message_handler(func=lambda m: (m.chat.type == 'private') and (get_state(m.from_user.id) is None) and (m.text is not None) and (not m.text.startswith('/')) , content_types=['text'])
+def handle_private_default(m):
+    bot.send_message(m.chat.id, "Чтобы войти в меню напишите /start")
+
+# ========== Показать pending заявки для модератора ==========
+@bot.message_handler(commands=['pending'])
+def cmd_pending(message):
+    uid = message.from_user.id
+    # найдем все каналы, где пользователь модератор или владелец
+    watch_dbids = moderated_channel_ids(uid)
+    if not watch_dbids:
+        bot.send_message(uid, "Вы не модератор и не владелец ни одного канала.")
+        return
+    # получить pending заявки для этих каналов
+    rows = list_pending_submissions(watch_dbids, limit=20)
+    if not rows:
+        bot.send_message(uid, "Нет ожидающих заявок.")
+        return
+    for r in rows:
+        sid, user_id, ctype, txt, fid, created_at, anon, tdb = r
+        title = f"Заявка #{sid} — {'анонимно' if anon else 'неанонимно'} — канал {tdb}"
+        if ctype == 'text':
+            sent = bot.send_message(uid, f"{title}\n\n{(txt or '')[:1000]}", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("✅ Принять", callback_data=f"accept:{sid}"), types.InlineKeyboardButton("❌ Отклонить", callback_data=f"reject:{sid}"), types.InlineKeyboardButton("✉️ Ответить автору", callback_data=f"reply:{sid}")))
+        else:
+            sent = bot.send_message(uid, f"{title}\nТип: {ctype}\nID файла: {fid}", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("✅ Принять", callback_data=f"accept:{sid}"), types.InlineKeyboardButton("❌ Отклонить", callback_data=f"reject:{sid}"), types.InlineKeyboardButton("✉️ Ответить автору", callback_data=f"reply:{sid}")))
+        save_control_messages(sid, [(uid, sent.message_id)])
+
+# ========== Поиск по заявкам ==========
+# /search <channel_dbid|*> <запрос>; листание — кнопками (callback search:<dbid>:<offset>), сам запрос
+# берётся из первой строки сообщения с результатами, чтобы не хранить его между воркерами
+SEARCH_HEADER = "🔎 "
+
+def render_search(user_id, dbid, query, offset):
+    dbids = moderated_channel_ids(user_id) if dbid == 0 else ([dbid] if can_moderate(dbid, user_id) else [])
+    if not dbids:
+        return "Вы не модератор этого канала.", None
+    rows = search_submissions(dbids, query, SEARCH_PAGE_SIZE + 1, offset)
+    has_next = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+    lines = [SEARCH_HEADER + query, ""]
+    if not rows:
+        lines.append("Ничего не найдено." if offset == 0 else "Больше результатов нет.")
+    for sid, status, created_at, snippet, tdb in rows:
+        when = time.strftime("%d.%m.%Y", time.localtime(created_at or 0))
+        lines.append(f"#{sid} · {STATUS_LABELS.get(status, status)} · {when} · канал {tdb}\n{(snippet or '')[:300]}\n")
+    kb = types.InlineKeyboardMarkup()
+    nav = []
+    if offset > 0:
+        nav.append(types.InlineKeyboardButton("◀️", callback_data=f"search:{dbid}:{max(0, offset - SEARCH_PAGE_SIZE)}"))
+    if has_next:
+        nav.append(types.InlineKeyboardButton("▶️", callback_data=f"search:{dbid}:{offset + SEARCH_PAGE_SIZE}"))
+    if nav:
+        kb.row(*nav)
+    return "\n".join(lines), kb
+
+@bot.message_handler(commands=['search'])
+def cmd_search(message):
+    # формат: /search <channel_dbid|*> <запрос>
+    parts = (message.text or "").split(None, 2)
+    if len(parts) != 3:
+        bot.send_message(message.chat.id, "Использование: /search <channel_dbid|*> <запрос>")
+        return
+    try:
+        dbid = 0 if parts[1] == "*" else int(parts[1])
+    except:
+        bot.send_message(message.chat.id, "Неверные аргументы.")
+        return
+    query = " ".join(parts[2].split())[:200]
+    text, kb = render_search(message.from_user.id, dbid, query, 0)
+    bot.send_message(message.chat.id, text, reply_markup=kb)
+
+@bot.callback_query_handler(func=lambda cq: cq.data and cq.data.startswith("search:"))
+def cq_search(cq):
+    bot.answer_callback_query(cq.id)
+    try:
+        _, dbid_str, offset_str = cq.data.split(":")
+        dbid = int(dbid_str); offset = max(0, int(offset_str))
+    except ValueError:
+        nav_reply(cq, "Ошибка.")
+        return
+    header = (cq.message.text or "").split("\n", 1)[0]
+    if not header.startswith(SEARCH_HEADER):
+        nav_reply(cq, "Ошибка.")
+        return
+    text, kb = render_search(cq.from_user.id, dbid, header[len(SEARCH_HEADER):], offset)
+    nav_reply(cq, text, reply_markup=kb)
+
+# ========== ДАЙДЖЕСТЫ ДЛЯ МОДЕРАТОРОВ ==========
+def digest_subscribers(channel_dbid):
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("SELECT moderator_id FROM moderator_digests WHERE channel_dbid = %s", (channel_dbid,))
+        else:
+            c.execute("SELECT moderator_id FROM moderator_digests WHERE channel_dbid = ?", (channel_dbid,))
+        return {r[0] for r in c.fetchall()}
+    finally:
+        c.close()
+
+def set_digest(channel_dbid, moderator_id, window_seconds):
+    # включение: позиция ставится на последнюю заявку канала — всё более раннее уже было разослано поштучно
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("SELECT COALESCE(MAX(id), 0) FROM submissions WHERE target_channel_dbid = %s", (channel_dbid,))
+            last_id = c.fetchone()[0]
+            c.execute("INSERT INTO moderator_digests (channel_dbid, moderator_id, window_seconds, last_submission_id, last_sent_at) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (channel_dbid, moderator_id) DO UPDATE SET window_seconds = EXCLUDED.window_seconds", (channel_dbid, moderator_id, window_seconds, last_id, now_ts()))
+        else:
+            c.execute("SELECT COALESCE(MAX(id), 0) FROM submissions WHERE target_channel_dbid = ?", (channel_dbid,))
+            last_id = c.fetchone()[0]
+            c.execute("INSERT INTO moderator_digests (channel_dbid, moderator_id, window_seconds, last_submission_id, last_sent_at) VALUES (?, ?, ?, ?, ?) ON CONFLICT (channel_dbid, moderator_id) DO UPDATE SET window_seconds = excluded.window_seconds", (channel_dbid, moderator_id, window_seconds, last_id, now_ts()))
+        db.commit()
+    finally:
+        c.close()
+
+def remove_digest(channel_dbid, moderator_id):
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("DELETE FROM moderator_digests WHERE channel_dbid = %s AND moderator_id = %s", (channel_dbid, moderator_id))
+        else:
+            c.execute("DELETE FROM moderator_digests WHERE channel_dbid = ? AND moderator_id = ?", (channel_dbid, moderator_id))
+        db.commit()
+    finally:
+        c.close()
+
+def _advance_digest(channel_dbid, moderator_id, old, new):
+    # old / new — (last_submission_id, sent_ids JSON, last_sent_at); CAS по всем трём:
+    # если другой воркер уже отправил этот дайджест — rowcount 0
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("UPDATE moderator_digests SET last_submission_id = %s, sent_ids = %s, last_sent_at = %s WHERE channel_dbid = %s AND moderator_id = %s AND last_submission_id = %s AND sent_ids = %s AND last_sent_at = %s", new + (channel_dbid, moderator_id) + old)
+        else:
+            c.execute("UPDATE moderator_digests SET last_submission_id = ?, sent_ids = ?, last_sent_at = ? WHERE channel_dbid = ? AND moderator_id = ? AND last_submission_id = ? AND sent_ids = ? AND last_sent_at = ?", new + (channel_dbid, moderator_id) + old)
+        won = c.rowcount == 1
+        db.commit()
+        return won
+    finally:
+        c.close()
+
+def _digest_window(channel_dbid, last_id, sent_ids, ts):
+    # -> (id новых pending-заявок по порядку, новая позиция). Позиция — наибольший id среди заявок старше
+    # DIGEST_SETTLE_SECONDS: всё ниже уже закоммичено; более свежие выше позиции сверяются с sent_ids
+    if USE_PG:
+        rows = read_fetch("SELECT id FROM submissions WHERE status = 'pending' AND target_channel_dbid = %s AND id > %s ORDER BY id", (channel_dbid, last_id))
+        settled = read_fetch("SELECT MAX(id) FROM submissions WHERE target_channel_dbid = %s AND id > %s AND created_at <= %s", (channel_dbid, last_id, ts - DIGEST_SETTLE_SECONDS), one=True)
+    else:
+        rows = read_fetch("SELECT id FROM submissions WHERE status = 'pending' AND target_channel_dbid = ? AND id > ? ORDER BY id", (channel_dbid, last_id))
+        settled = read_fetch("SELECT MAX(id) FROM submissions WHERE target_channel_dbid = ? AND id > ? AND created_at <= ?", (channel_dbid, last_id, ts - DIGEST_SETTLE_SECONDS), one=True)
+    new_ids = [r[0] for r in rows if r[0] not in sent_ids]
+    return new_ids, max(last_id, (settled[0] if settled else None) or 0)
+
+def send_digests():
+    ts = now_ts()
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("SELECT channel_dbid, moderator_id, last_submission_id, sent_ids, last_sent_at FROM moderator_digests WHERE last_sent_at + window_seconds <= %s", (ts,))
+        else:
+            c.execute("SELECT channel_dbid, moderator_id, last_submission_id, sent_ids, last_sent_at FROM moderator_digests WHERE last_sent_at + window_seconds <= ?", (ts,))
+        due = c.fetchall()
+    finally:
+        c.close()
+    sent = 0
+    for dbid, mod_id, last_id, sent_raw, last_sent_at in due:
+        sent_ids = set(json.loads(sent_raw or "[]"))
+        new_ids, position = _digest_window(dbid, last_id, sent_ids, ts)
+        remembered = sorted(i for i in sent_ids.union(new_ids) if i > position)
+        old = (last_id, sent_raw, last_sent_at)
+        new = (position, json.dumps(remembered), ts)
+        # сначала забираем окно (CAS), потом отправляем; при ошибке отправки возвращаем позицию.
+        # Пусто — просто сдвигаем время и позицию
+        if not _advance_digest(dbid, mod_id, old, new) or not new_ids:
+            continue
+        with channel_tenant(dbid):
+            sent += _send_digest(dbid, mod_id, new_ids, len(sent_ids), old, new)
+    if sent:
+        metric_inc("digest_sent", sent)
+    return sent
+
+def _send_digest(dbid, mod_id, new_ids, already_sent, old, new):
+    # -> 1, если дайджест отправлен; при ошибке отправки окно возвращается
+    ch = get_channel_by_dbid(dbid)
+    title = (ch[3] or ch[2]) if ch else str(dbid)
+    # между новыми могут оказаться уже показанные — их не больше already_sent
+    wanted = set(new_ids[:REVIEW_PAGE_SIZE])
+    preview = [r for r in list_pending_submissions([dbid], after_id=new_ids[0] - 1, newest_first=False,
+                                                   limit=REVIEW_PAGE_SIZE + already_sent) if r[0] in wanted]
+    lines = [f"📬 Дайджест канала {title}: новых заявок — {len(new_ids)}.", ""]
+    for sid, user_id, ctype, txt, fid, created_at, anon, tdb in preview:
+        lines.append(f"#{sid} · {ctype} · {((txt or '').replace(chr(10), ' ')[:60]) or '—'}")
+    if len(new_ids) > len(preview):
+        lines.append(f"… и ещё {len(new_ids) - len(preview)}")
+    kb = types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("🗂 Открыть на просмотр", callback_data=f"review:{dbid}:0"))
+    try:
+        bot.send_message(mod_id, "\n".join(lines), reply_markup=kb)
+        return 1
+    except Exception:
+        logger.warning("Не удалось отправить дайджест модератору %s", mod_id)
+        _advance_digest(dbid, mod_id, new, old)
+        return 0
+
+@bot.message_handler(commands=['digest'])
+def cmd_digest(message):
+    # формат: /digest <channel_dbid> <минуты|off>
+    parts = (message.text or "").split()
+    if len(parts) not in (2, 3):
+        bot.send_message(message.chat.id, "Использование: /digest <channel_dbid> [минуты|off]")
+        return
+    try:
+        dbid = int(parts[1])
+    except:
+        bot.send_message(message.chat.id, "Неверные аргументы.")
+        return
+    if not can_moderate(dbid, message.from_user.id):
+        bot.send_message(message.chat.id, "Вы не модератор этого канала.")
+        return
+    arg = parts[2] if len(parts) == 3 else None
+    if arg == "off":
+        remove_digest(dbid, message.from_user.id)
+        bot.send_message(message.chat.id, "Дайджест выключен — заявки снова будут приходить по одной.")
+        return
+    try:
+        window = int(arg) * 60 if arg else DIGEST_DEFAULT_WINDOW
+    except ValueError:
+        bot.send_message(message.chat.id, "Неверные аргументы.")
+        return
+    window = max(window, 60)
+    set_digest(dbid, message.from_user.id, window)
+    bot.send_message(message.chat.id, f"Дайджест включён: сводка новых заявок раз в {window // 60} мин.")
+
+# постраничный просмотр pending заявок канала (из дайджеста)
+@bot.callback_query_handler(func=lambda cq: cq.data and cq.data.startswith("review:"))
+def cq_review(cq):
+    bot.answer_callback_query(cq.id)
+    try:
+        _, dbid_str, offset_str = cq.data.split(":")
+        dbid = int(dbid_str); offset = max(0, int(offset_str))
+    except ValueError:
+        nav_reply(cq, "Ошибка.")
+        return
+    if not can_moderate(dbid, cq.from_user.id):
+        nav_reply(cq, "Вы не модератор этого канала.")
+        return
+    rows = list_pending_submissions([dbid], limit=REVIEW_PAGE_SIZE + 1, offset=offset, newest_first=False)
+    has_next = len(rows) > REVIEW_PAGE_SIZE
+    rows = rows[:REVIEW_PAGE_SIZE]
+    if not rows:
+        nav_reply(cq, "Нет ожидающих заявок.")
+        return
+    lines = [f"🗂 Ожидающие заявки (с {offset + 1}):", ""]
+    kb = types.InlineKeyboardMarkup()
+    for sid, user_id, ctype, txt, fid, created_at, anon, tdb in rows:
+        lines.append(f"#{sid} — {'анонимно' if anon else 'неанонимно'} · {ctype}\n{(txt or '')[:200] or ('ID файла: ' + str(fid))}\n")
+        kb.add(types.InlineKeyboardButton(f"✅ #{sid}", callback_data=f"accept:{sid}"),
+               types.InlineKeyboardButton(f"❌ #{sid}", callback_data=f"reject:{sid}"),
+               types.InlineKeyboardButton(f"✉️ #{sid}", callback_data=f"reply:{sid}"))
+    nav = []
+    if offset > 0:
+        nav.append(types.InlineKeyboardButton("◀️", callback_data=f"review:{dbid}:{max(0, offset - REVIEW_PAGE_SIZE)}"))
+    nav.append(types.InlineKeyboardButton("🔄", callback_data=f"review:{dbid}:{offset}"))
+    if has_next:
+        nav.append(types.InlineKeyboardButton("▶️", callback_data=f"review:{dbid}:{offset + REVIEW_PAGE_SIZE}"))
+    kb.row(*nav)
+    nav_reply(cq, "\n".join(lines), reply_markup=kb)
+
+# ========== ПАКЕТНАЯ ОБРАБОТКА АПДЕЙТОВ ==========
+# callback_data с dbid канала: префикс -> позиция dbid после split(":")
+_CHANNEL_CALLBACKS = {
+    "channel": 1, "mods": 1, "addmod": 1, "delmod": 1, "promo_prepare": 1, "delete": 1, "delete_yes": 1,
+    "set_mods_self": 1, "set_mods_other": 1, "set_mods_skip": 1, "assign": 1, "assign_set": 1,
+    "review": 1, "search": 1, "deep_offer_anon": 2,
+}
+_SUBMISSION_CALLBACKS = ("accept", "reject", "reply", "republish")
+
+def _int_or_none(v):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return None
+
+def _state_channel(state):
+    # awaiting_submission:<anon>:<dbid>, awaiting_add_mod:<dbid>, awaiting_first_mod:<dbid>
+    if not state:
+        return None
+    parts = state.split(":")
+    if parts[0] == "awaiting_submission" and len(parts) == 3:
+        return _int_or_none(parts[2])
+    if parts[0] in ("awaiting_add_mod", "awaiting_first_mod") and len(parts) == 2:
+        return _int_or_none(parts[1])
+    return None
+
+def _in_query(c, sql, values):
+    values = tuple(values)
+    ph = '%s' if USE_PG else '?'
+    c.execute(sql.replace("{in}", ','.join(ph for _ in values)), values)
+    metric_inc("prefetch_queries")
+    return c.fetchall()
+
+def _pair_query(c, sql, left, right):
+    left, right = tuple(left), tuple(right)
+    ph = '%s' if USE_PG else '?'
+    c.execute(sql.replace("{in1}", ','.join(ph for _ in left)).replace("{in2}", ','.join(ph for _ in right)), left + right)
+    metric_inc("prefetch_queries")
+    return c.fetchall()
+
+def prefetch_for_updates(updates):
+    # собрать user_id / dbid каналов / id заявок из пакета и загрузить их по одному запросу на таблицу
+    ctx = PrefetchContext()
+    ctx.bot_id = bot_id = current_bot_id()
+    user_ids, channel_ids, sub_ids = set(), set(), set()
+    for u in updates:
+        if u.message is not None and u.message.from_user is not None:
+            user_ids.add(u.message.from_user.id)
+            parts = (u.message.text or "").split()
+            if len(parts) > 1 and parts[0].startswith("/start") and parts[1].startswith("post_"):
+                dbid = _int_or_none(parts[1][5:])
+                if dbid is not None:
+                    channel_ids.add(dbid)
+        elif u.callback_query is not None:
+            user_ids.add(u.callback_query.from_user.id)
+            parts = (u.callback_query.data or "").split(":")
+            if parts[0] in _CHANNEL_CALLBACKS and len(parts) > _CHANNEL_CALLBACKS[parts[0]]:
+                dbid = _int_or_none(parts[_CHANNEL_CALLBACKS[parts[0]]])
+                if dbid is not None:
+                    channel_ids.add(dbid)
+            elif parts[0] in _SUBMISSION_CALLBACKS and len(parts) == 2:
+                sid = _int_or_none(parts[1])
+                if sid is not None:
+                    sub_ids.add(sid)
+    if not user_ids and not sub_ids and not channel_ids:
+        return ctx
+    c = db.cursor()
+    try:
+        if user_ids:
+            ctx.states = dict.fromkeys(user_ids)
+            for uid, state in _in_query(c, f"SELECT user_id, state FROM user_states WHERE bot_id = {int(bot_id)} AND user_id IN ({{in}})", user_ids):
+                ctx.states[uid] = state
+                dbid = _state_channel(state)
+                if dbid is not None:
+                    channel_ids.add(dbid)
+        if sub_ids:
+            ctx.submissions = dict.fromkeys(sub_ids)
+            for row in _in_query(c, "SELECT id, user_id, content_type, text_content, file_id, status, created_at, anonymous, target_channel_dbid FROM submissions WHERE id IN ({in})", sub_ids):
+                ctx.submissions[row[0]] = row
+                if row[8]:
+                    channel_ids.add(row[8])
+        if channel_ids:
+            ctx.channels = dict.fromkeys(channel_ids)
+            # каналы других ботов процесса для этого пакета не существуют (как в get_channel_by_dbid)
+            for row in _in_query(c, f"SELECT id, owner_id, channel_id, title FROM channels WHERE bot_id = {int(bot_id)} AND id IN ({{in}})", channel_ids):
+                ctx.channels[row[0]] = row
+            ctx.admins = {dbid: [] for dbid in channel_ids}
+            for dbid, admin_id in _in_query(c, "SELECT channel_dbid, admin_user_id FROM channel_admins WHERE channel_dbid IN ({in})", channel_ids):
+                ctx.admins[dbid].append(admin_id)
+            if user_ids:
+                ctx.cooldowns = {(uid, dbid): None for uid in user_ids for dbid in channel_ids}
+                for uid, dbid, last_ts in _pair_query(c, "SELECT user_id, channel_dbid, last_ts FROM cooldowns WHERE user_id IN ({in1}) AND channel_dbid IN ({in2})", user_ids, channel_ids):
+                    ctx.cooldowns[(uid, dbid)] = last_ts
+                ctx.bans = {(dbid, uid): False for uid in user_ids for dbid in channel_ids}
+                for dbid, uid in _pair_query(c, "SELECT channel_dbid, user_id FROM bans WHERE channel_dbid IN ({in1}) AND user_id IN ({in2})", channel_ids, user_ids):
+                    ctx.bans[(dbid, uid)] = True
+    finally:
+        c.close()
+    return ctx
+
+def prefetch_batch(updates):
+    if len(updates) < 2:
+        # одиночный апдейт (пакетирование выключено или пакет из одного): обработчик сам прочитает только нужное,
+        # пакетные IN-запросы здесь ничего не экономят, а лишь добавляют запросы
+        ctx = PrefetchContext()
+    else:
+        try:
+            ctx = prefetch_for_updates(updates)
+        except Exception:
+            # предзагрузка — только оптимизация; без неё обработчики сходят в БД сами
+            logger.exception("Не удалось выполнить предзагрузку пакета")
+            ctx = PrefetchContext()
+        with _live_prefetch_lock:
+            _live_prefetch.add(ctx)
+    metric_inc("update_batches")
+    metric_inc("updates_processed", len(updates))
+    return ctx
+
+def _update_sender(update):
+    for update_type in ("message", "callback_query"):
+        obj = getattr(update, update_type, None)
+        if obj is not None and obj.from_user is not None:
+            return obj.from_user.id
+    return None
+
+def _process_sender_updates(b, ctx, updates):
+    # апдейты одного пользователя — по очереди и целиком в этом потоке: фильтры следующего апдейта
+    # видят состояние, записанное обработчиком предыдущего
+    with use_tenant(b), use_prefetch(ctx), inline_handlers():
+        for i, update in enumerate(updates):
+            try:
+                b.process_new_updates([update])
+            except CircuitOpenError as e:
+                logger.warning("Обработка пакета прервана (%s), остаток апдейтов пользователя возвращён в spool", e)
+                for rest in updates[i:]:
+                    for update_type in ("message", "callback_query"):
+                        obj = getattr(rest, update_type, None)
+                        if obj is not None:
+                            spool_handler_input(obj, update_type)
+                return
+            except Exception:
+                logger.exception("Не удалось обработать апдейт %s", update.update_id)
+
+def process_update_batch(updates, b=None):
+    # пакет одного бота (по умолчанию — текущего). process_new_updates раскладывает пакет по типам
+    # и раздаёт обработчики в пул — порядок апдейтов одного чата терялся бы; поэтому пакет делится
+    # по отправителю: разные пользователи параллельно, апдейты одного — строго в порядке прихода
+    if not updates:
+        return
+    b = b or current_bot()
+    with use_tenant(b):
+        ctx = prefetch_batch(updates)
+    if len(updates) == 1:
+        with use_tenant(b), use_prefetch(ctx):
+            b.process_new_updates(updates)
+        return
+    by_sender = OrderedDict()
+    for update in updates:
+        sender = _update_sender(update)
+        by_sender.setdefault(sender if sender is not None else ("update", update.update_id), []).append(update)
+    for group in by_sender.values():
+        if b.threaded:
+            b.worker_pool.put(_process_sender_updates, b, ctx, group)
+        else:
+            _process_sender_updates(b, ctx, group)
+
+# накопление апдейтов из webhook в пакеты (включается UPDATE_BATCH_WINDOW_MS > 0); в очереди — (бот, апдейт),
+# окно общее, пакет делится по ботам
+_update_queue = queue.Queue()
+
+def _update_batcher():
+    while True:
+        batch = [_update_queue.get()]
+        deadline = time.monotonic() + UPDATE_BATCH_WINDOW_MS / 1000.0
+        while len(batch) < UPDATE_BATCH_MAX:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                batch.append(_update_queue.get(timeout=left))
+            except queue.Empty:
+                break
+        by_bot = OrderedDict()
+        for b, update in batch:
+            by_bot.setdefault(b, []).append(update)
+        for b, updates in by_bot.items():
+            try:
+                process_update_batch(updates, b)
+            except Exception:
+                logger.exception("Не удалось обработать пакет апдейтов")
+
+if UPDATE_BATCH_WINDOW_MS > 0:
+    threading.Thread(target=_update_batcher, name="update-batcher", daemon=True).start()
+
+# ========== БЫСТРЫЙ РАЗБОР АПДЕЙТОВ ==========
+# Обработчикам нужны только сообщения и нажатия кнопок; остальное Telegram не шлёт (allowed_updates),
+# а если всё же пришло — отбрасываем по сырому JSON, не собирая объекты telebot.
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+def decode_update(raw):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def update_is_relevant(data):
+    if "callback_query" in data:
+        return True
+    m = data.get("message")
+    if not m:
+        # edited_message, channel_post, my_chat_member и т.п. — обработчиков нет
+        return False
+    chat_type = (m.get("chat") or {}).get("type")
+    if chat_type == "private":
+        return True
+    # в группах реагируем только на команды, остальная переписка нас не касается
+    text = m.get("text") or ""
+    return text.startswith("/")
+
+# ========== ЗАЩИТА ОТ ФЛУДА НА ВХОДЕ ==========
+# Проверка выполняется по сырому JSON апдейта — до сборки объектов telebot и до любых запросов
+# обработчиков к БД. Лишние апдейты отбрасываются (повтор того же нажатия/текста — «склеивается»).
+_flood_buckets = OrderedDict()   # key -> [tokens, ts]
+_flood_last_payload = OrderedDict()
+_flood_lock = threading.Lock()
+FLOOD_BUCKETS_MAX = 100000
+_flood_conns = []   # свободные соединения общего бакета; запрос к БД идёт без _flood_lock
+_flood_retry_at = 0
+_flood_warned_at = 0
+
+def _take_local(key, rate, burst, now):
+    with _flood_lock:
+        b = _flood_buckets.get(key)
+        if b is None:
+            b = [burst, now]
+        else:
+            b[0] = min(burst, b[0] + (now - b[1]) * rate)
+            b[1] = now
+        allowed = b[0] >= 1
+        if allowed:
+            b[0] -= 1
+        _flood_buckets[key] = b
+        _flood_buckets.move_to_end(key)
+        while len(_flood_buckets) > FLOOD_BUCKETS_MAX:
+            _flood_buckets.popitem(last=False)
+        return allowed
+
+def _flood_connect():
+    if USE_PG:
+        conn = pg_connect()
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+    return sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30, isolation_level=None)
+
+def _take_shared(key, rate, burst, now):
+    # общий бакет в БД: соединение в autocommit из маленького пула (у каждого параллельного запроса своё),
+    # атомарно одним запросом (PG) / IMMEDIATE-транзакцией (SQLite). _flood_lock держим только на взятие
+    # и возврат соединения — медленная БД не останавливает локальный учёт и другие потоки
+    with _flood_lock:
+        conn = _flood_conns.pop() if _flood_conns else None
+    try:
+        if conn is None:
+            conn = _flood_connect()
+        c = conn.cursor()
+        try:
+            if USE_PG:
+                refill = "LEAST(%(burst)s, rate_buckets.tokens + (EXCLUDED.updated_at - rate_buckets.updated_at) * %(rate)s)"
+                c.execute(
+                    "INSERT INTO rate_buckets (bucket_key, tokens, updated_at, allowed) VALUES (%(key)s, %(burst)s - 1, %(now)s, 1) "
+                    f"ON CONFLICT (bucket_key) DO UPDATE SET tokens = CASE WHEN {refill} >= 1 THEN {refill} - 1 ELSE {refill} END, "
+                    f"allowed = CASE WHEN {refill} >= 1 THEN 1 ELSE 0 END, updated_at = EXCLUDED.updated_at RETURNING allowed",
+                    {"key": key, "burst": burst, "rate": rate, "now": now})
+                allowed = c.fetchone()[0] == 1
+            else:
+                c.execute("BEGIN IMMEDIATE")
+                try:
+                    c.execute("SELECT tokens, updated_at FROM rate_buckets WHERE bucket_key = ?", (key,))
+                    r = c.fetchone()
+                    tokens = burst if r is None else min(burst, r[0] + (now - r[1]) * rate)
+                    allowed = tokens >= 1
+                    if allowed:
+                        tokens -= 1
+                    c.execute("INSERT OR REPLACE INTO rate_buckets (bucket_key, tokens, updated_at, allowed) VALUES (?, ?, ?, ?)", (key, tokens, now, 1 if allowed else 0))
+                    c.execute("COMMIT")
+                except Exception:
+                    c.execute("ROLLBACK")
+                    raise
+        finally:
+            c.close()
+    except Exception:
+        # сломанное соединение в пул не возвращаем: следующий вызов подключится заново
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        raise
+    with _flood_lock:
+        _flood_conns.append(conn)
+    return allowed
+
+def _take(key, rate, burst, now):
+    global _flood_retry_at, _flood_warned_at
+    if FLOOD_SHARED and time.monotonic() >= _flood_retry_at:
+        try:
+            return _take_shared(key, rate, burst, now)
+        except Exception as e:
+            # БД недоступна — несколько секунд считаем локально (без попыток подключения на каждом апдейте),
+            # приём апдейтов не роняем; предупреждение — не чаще раза в минуту
+            metric_inc("flood_shared_errors")
+            _flood_retry_at = time.monotonic() + 5
+            if _flood_retry_at - _flood_warned_at >= 60:
+                _flood_warned_at = _flood_retry_at
+                logger.warning("Общий rate limiter недоступен (%s), используем локальный", e)
+    return _take_local(key, rate, burst, now)
+
+def update_origin(data):
+    # (user_id, chat_id, payload) из сырого апдейта без сборки объектов
+    for kind in ("message", "edited_message", "callback_query", "channel_post", "edited_channel_post", "my_chat_member", "chat_member"):
+        obj = data.get(kind)
+        if not obj:
+            continue
+        user_id = (obj.get("from") or {}).get("id")
+        if kind == "callback_query":
+            chat_id = ((obj.get("message") or {}).get("chat") or {}).get("id", user_id)
+            payload = ("cq", obj.get("data"))
+        else:
+            chat_id = (obj.get("chat") or {}).get("id")
+            payload = (kind, obj.get("text") or obj.get("caption"))
+        return user_id, chat_id, payload
+    return None, None, None
+
+def ingress_admit(data):
+    user_id, chat_id, payload = update_origin(data)
+    if user_id is None and chat_id is None:
+        return True
+    now = time.monotonic() if not FLOOD_SHARED else time.time()
+    allowed = True
+    if user_id is not None:
+        allowed = _take(f"u:{user_id}", FLOOD_USER_RATE, FLOOD_USER_BURST, now)
+    if allowed and chat_id is not None and chat_id != user_id:
+        allowed = _take(f"c:{chat_id}", FLOOD_CHAT_RATE, FLOOD_CHAT_BURST, now)
+    key = user_id if user_id is not None else chat_id
+    with _flood_lock:
+        last = _flood_last_payload.get(key)
+        if allowed:
+            _flood_last_payload[key] = payload
+            _flood_last_payload.move_to_end(key)
+            while len(_flood_last_payload) > FLOOD_BUCKETS_MAX:
+                _flood_last_payload.popitem(last=False)
+    if not allowed:
+        metric_inc("flood_coalesced" if last == payload else "flood_dropped")
+    return allowed
+
+def admit_update(data):
+    # фильтр типов + защита от флуда по сырому dict; None — апдейт отброшен
+    if not update_is_relevant(data):
+        metric_inc("updates_filtered")
+        return None
+    if FLOOD_CONTROL and not ingress_admit(data):
+        # у отброшенного нажатия кнопки иначе так и крутились бы «часики»
+        cq = data.get("callback_query")
+        if cq and cq.get("id"):
+            try:
+                current_bot().answer_callback_query(cq["id"], "Слишком часто, подождите немного.")
+            except Exception:
+                pass
+        return None
+    t0 = time.perf_counter()
+    update = telebot.types.Update.de_json(data)
+    metric_observe("update_build", time.perf_counter() - t0)
+    return update
+
+def cleanup_rate_buckets():
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("DELETE FROM rate_buckets WHERE updated_at < %s", (time.time() - 3600,))
+        else:
+            c.execute("DELETE FROM rate_buckets WHERE updated_at < ?", (time.time() - 3600,))
+        db.commit()
+    finally:
+        c.close()
+
+# ========== ЖУРНАЛ АПДЕЙТОВ И ВОСПРОИЗВЕДЕНИЕ ==========
+# С UPDATE_JOURNAL_DIR каждый принятый апдейт (как пришёл, до флуд-контроля) дописывается строкой
+# {"ts": время приёма, "bot": bot_id, "update": JSON} в gzip-сегмент updates-<время>-<pid>-<n>.jsonl.gz. Сегмент ротируется
+# по объёму или времени, старые сверх UPDATE_JOURNAL_KEEP удаляются. Раз в секунду — sync flush, поэтому
+# сегмент упавшего процесса читается до последнего сброса.
+# python main.py --replay <каталог|файлы> [--speed N] прогоняет журнал через обработчики на чистой базе
+# и фейковом Bot API: --speed 0 — как можно быстрее, 1 — в исходном темпе, 2 — вдвое быстрее и т.д.
+# В конце печатается отчёт: пропускная способность, перцентили задержки, вызовы Bot API.
+class UpdateJournal:
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._file = None
+        self._comp = None
+        self._bytes = 0
+        self._opened_at = 0
+        self._flushed_at = 0
+        self._seq = 0
+
+    def _open(self, now):
+        os.makedirs(self.directory, exist_ok=True)
+        self._seq += 1
+        name = f"updates-{time.strftime('%Y%m%d-%H%M%S', time.gmtime(now))}-{os.getpid()}-{self._seq:04d}.jsonl.gz"
+        self._file = open(os.path.join(self.directory, name), "ab")
+        self._comp = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self._bytes = 0
+        self._opened_at = now
+
+    def _close(self):
+        if self._file is not None:
+            self._file.write(self._comp.flush())
+            self._file.close()
+            self._file = None
+
+    def _prune(self):
+        segments = sorted(f for f in os.listdir(self.directory) if f.startswith("updates-") and f.endswith(".jsonl.gz"))
+        for name in segments[:-UPDATE_JOURNAL_KEEP] if UPDATE_JOURNAL_KEEP > 0 else []:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def append(self, raw, bot_id, now=None):
+        now = now or time.time()
+        if isinstance(raw, str):
+            raw = raw.encode("utf-8")
+        line = b'{"ts":%.3f,"bot":%d,"update":%s}\n' % (now, bot_id, raw.replace(b"\n", b" ").strip())
+        with self._lock:
+            if self._file is None or self._bytes >= UPDATE_JOURNAL_SEGMENT_BYTES or now - self._opened_at >= UPDATE_JOURNAL_SEGMENT_SECONDS:
+                self._close()
+                self._open(now)
+                self._prune()
+            self._file.write(self._comp.compress(line))
+            self._bytes += len(line)
+            if now - self._flushed_at >= 1:
+                self._file.write(self._comp.flush(zlib.Z_SYNC_FLUSH))
+                self._file.flush()
+                self._flushed_at = now
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+update_journal = None
+if UPDATE_JOURNAL_DIR:
+    update_journal = UpdateJournal(UPDATE_JOURNAL_DIR)
+    atexit.register(update_journal.close)
+
+def journal_update(raw):
+    # журнал не должен мешать приёму апдейтов
+    try:
+        update_journal.append(raw, current_bot_id())
+    except Exception:
+        metric_inc("journal_errors")
+        logger.exception("Не удалось записать апдейт в журнал")
+
+def _journal_lines(path):
+    # построчно из gzip-сегмента; оборванный хвост (сегмент упавшего процесса) пропускается
+    decomp = zlib.decompressobj(31)
+    tail = b""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1 << 16)
+            if not chunk:
+                break
+            try:
+                data = decomp.decompress(chunk)
+                while decomp.eof and decomp.unused_data:
+                    # следующий gzip-член (дописанный в тот же файл)
+                    rest = decomp.unused_data
+                    decomp = zlib.decompressobj(31)
+                    data += decomp.decompress(rest)
+            except zlib.error:
+                logger.warning("Сегмент %s повреждён, читаю до места повреждения", path)
+                break
+            lines = (tail + data).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                if line.strip():
+                    yield line
+
+def iter_journal(paths):
+    # (ts, bot_id, сырой JSON апдейта) из всех сегментов по времени приёма; сегменты разных воркеров сливаются
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(".jsonl.gz")]
+        else:
+            files.append(path)
+    def entries(path):
+        for line in _journal_lines(path):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            yield record["ts"], record.get("bot", DEFAULT_BOT_ID), record["update"]
+    return heapq.merge(*(entries(f) for f in files), key=lambda e: e[0])
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+def replay_journal(paths, speed=0.0):
+    latencies = []
+    types_seen = {}
+    first_ts = None
+    lag_max = 0.0
+    started = time.perf_counter()
+    for ts, bot_id, data in iter_journal(paths):
+        if first_ts is None:
+            first_ts = ts
+        if speed > 0:
+            due = started + (ts - first_ts) / speed
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                lag_max = max(lag_max, -delay)
+        kind = next((k for k in data if k != "update_id"), "unknown")
+        types_seen[kind] = types_seen.get(kind, 0) + 1
+        t0 = time.perf_counter()
+        try:
+            # как при проигрывании spool: флуд-контроль не применяем, апдейты уже были приняты
+            process_update_batch([telebot.types.Update.de_json(data)], BOTS.get(bot_id, default_bot))
+        except Exception:
+            metric_inc("replay_errors")
+            logger.exception("Ошибка при воспроизведении апдейта %s", data.get("update_id"))
+        latencies.append(time.perf_counter() - t0)
+    audit_log.flush()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        "updates": len(latencies),
+        "seconds": round(elapsed, 3),
+        "throughput_per_sec": round(len(latencies) / elapsed, 1) if elapsed > 0 else 0,
+        "latency_ms": {"p50": ms(_percentile(latencies, 0.5)), "p90": ms(_percentile(latencies, 0.9)),
+                       "p99": ms(_percentile(latencies, 0.99)), "max": ms(latencies[-1]) if latencies else 0,
+                       "mean": ms(sum(latencies) / len(latencies)) if latencies else 0},
+        "max_lag_ms": ms(lag_max),
+        "errors": METRICS.get("replay_errors", 0),
+        "update_types": types_seen,
+        "api_calls": dict(sorted(REPLAY_API_CALLS.items())),
+    }
+
+# ========== WEBHOOK: Flask-приложение для Telegram ==========
+app = Flask(__name__)
+
+# health check
+@app.route("/", methods=["GET"])
+def index():
+    return "OK", 200
+
+# счётчики процесса (навигация, отправки и т.д.)
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return app.response_class(json.dumps(metrics_snapshot(), sort_keys=True), mimetype="application/json")
+
+# путь основного бота; у остальных — /webhook/<их токен>
+WEBHOOK_PATH = f"/webhook/{TOKEN}"
+
+@app.route("/webhook/<token>", methods=["POST"])
+def telegram_webhook(token):
+    # путь с токеном определяет бота; чужой токен — 404, как и раньше для любого другого пути
+    b = BOTS_BY_TOKEN.get(token)
+    if b is None:
+        return abort(404)
+    with use_tenant(b):
+        return _handle_webhook_update()
+
+def _handle_webhook_update():
+    if request.headers.get("content-type") == "application/json":
+        raw = request.get_data()
+        if update_journal is not None:
+            journal_update(raw)
+        try:
+            t0 = time.perf_counter()
+            data = decode_update(raw)
+            metric_observe("update_decode", time.perf_counter() - t0)
+            if degraded():
+                # БД или Bot API недоступны: сохраняем апдейт для повтора и подтверждаем Telegram'у
+                if update_is_relevant(data):
+                    spool_update(raw)
+                return "", 200
+            update = admit_update(data)
+            if update is None:
+                # отвечаем 200, чтобы Telegram не повторял отброшенный апдейт
+                return "", 200
+            if UPDATE_BATCH_WINDOW_MS > 0:
+                _update_queue.put((current_bot(), update))
+            else:
+                process_update_batch([update])
+        except CircuitOpenError:
+            # breaker открылся до обработчиков (предзагрузка, общий флуд-контроль); отказ внутри обработчика
+            # возвращает апдейт в spool сам (TeleformBot._exec_task)
+            spool_update(raw)
+            return "", 200
+        except Exception as e:
+            logger.exception("Failed to process update: %s", e)
+            return "", 500
+        return "", 200
+    else:
+        return abort(403)
+
+def setup_webhook():
+    # для каждого бота процесса; ошибка одного не мешает остальным
+    failed = None
+    for b in BOTS.values():
+        try:
+            _setup_bot_webhook(b)
+        except Exception as e:
+            failed = e
+    if failed is not None:
+        raise failed
+
+def _setup_bot_webhook(b):
+    webhook_url = WEBHOOK_BASE.rstrip("/") + f"/webhook/{b.token}"
+    try:
+        logger.info("Removing old webhook (if any)...")
+        b.remove_webhook()
+    except Exception:
+        pass
+    try:
+        logger.info("Setting webhook for bot %s", b.bot_id)
+        ok = b.set_webhook(url=webhook_url, allowed_updates=ALLOWED_UPDATES)
+        if not ok:
+            logger.error("set_webhook returned False")
+        else:
+            logger.info("Webhook установлен успешно")
+    except Exception as e:
+        logger.exception("Не удалось установить webhook: %s", e)
+        raise
+
+# ========== LONG POLLING (альтернатива webhook) ==========
+# getUpdates пакетами до 100 штук; пакет предзагружается целиком и раздаётся пулу потоков так,
+# что апдейты одного чата всегда идут в один поток (порядок внутри чата сохраняется).
+# Позиция хранится в bot_offsets: update_offset — всё ниже уже обработано, done_ids — обработанные
+# апдейты выше позиции (пул завершает их не по порядку), чтобы после рестарта ничего не повторить.
+# Каждый бот процесса опрашивается своим потоком со своей позицией; пул обработчиков общий.
+POLL_OFFSET_NAME = "main"
+
+def poll_offset_name(b):
+    # у основного бота — прежнее имя, чтобы не потерять позицию при переходе на несколько ботов
+    return POLL_OFFSET_NAME if b is default_bot else f"bot{b.bot_id}"
+
+def load_poll_offset(name=POLL_OFFSET_NAME):
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("SELECT update_offset, done_ids FROM bot_offsets WHERE name = %s", (name,))
+        else:
+            c.execute("SELECT update_offset, done_ids FROM bot_offsets WHERE name = ?", (name,))
+        r = c.fetchone()
+    finally:
+        c.close()
+    if not r:
+        return None, set()
+    return r[0], set(json.loads(r[1] or "[]"))
+
+def save_poll_offset(offset, done_ids, name=POLL_OFFSET_NAME):
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("INSERT INTO bot_offsets (name, update_offset, done_ids) VALUES (%s, %s, %s) ON CONFLICT (name) DO UPDATE SET update_offset = EXCLUDED.update_offset, done_ids = EXCLUDED.done_ids", (name, offset, json.dumps(sorted(done_ids))))
+        else:
+            c.execute("INSERT OR REPLACE INTO bot_offsets (name, update_offset, done_ids) VALUES (?, ?, ?)", (name, offset, json.dumps(sorted(done_ids))))
+        db.commit()
+    finally:
+        c.close()
+
+class PollProgress:
+    # отслеживает завершённые апдейты пакета и двигает позицию; в БД она пишется после пакета (flush)
+    # и внутри долгого пакета не чаще раза в POLL_OFFSET_SAVE_SECONDS — не запросом с commit на каждый апдейт.
+    # После падения заново обработается не больше этого окна.
+    def __init__(self, offset, done_ids, name=POLL_OFFSET_NAME):
+        self.offset = offset
+        self.done = set(done_ids)
+        self.name = name
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.saved_at = time.monotonic()
+
+    def complete(self, update_id):
+        with self.lock:
+            self.done.add(update_id)
+            if self.offset is None:
+                self.offset = min(self.done)
+            while self.offset in self.done:
+                self.done.discard(self.offset)
+                self.offset += 1
+            self.dirty = True
+            if time.monotonic() - self.saved_at >= POLL_OFFSET_SAVE_SECONDS:
+                self._save()
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self._save()
+
+    def _save(self):
+        # под self.lock
+        save_poll_offset(self.offset, self.done, self.name)
+        self.dirty = False
+        self.saved_at = time.monotonic()
+
+def _update_chat_id(data):
+    user_id, chat_id, _ = update_origin(data)
+    return chat_id if chat_id is not None else (user_id or 0)
+
+def _poll_worker(q):
+    while True:
+        item = q.get()
+        try:
+            b, ctx, update, update_id, progress = item
+            try:
+                if update is not None:
+                    with use_tenant(b), use_prefetch(ctx):
+                        b.process_new_updates([update])
+            except Exception:
+                logger.exception("Ошибка обработки апдейта %s", update_id)
+            progress.complete(update_id)
+        finally:
+            q.task_done()
+
+def run_polling():
+    queues = [queue.Queue() for _ in range(max(1, POLL_WORKERS))]
+    for i, q in enumerate(queues):
+        threading.Thread(target=_poll_worker, args=(q,), name=f"poll-worker-{i}", daemon=True).start()
+    loops = [threading.Thread(target=_poll_bot, args=(b, queues), name=f"poll-{b.bot_id}", daemon=True) for b in BOTS.values()]
+    for t in loops:
+        t.start()
+    for t in loops:
+        t.join()
+
+def _poll_bot(b, queues):
+    try:
+        b.remove_webhook()
+    except Exception:
+        logger.exception("Не удалось снять webhook перед polling")
+    # обработчики выполняются прямо в потоках пула — так сохраняется порядок внутри чата
+    b.threaded = False
+    name = poll_offset_name(b)
+    offset, done_ids = load_poll_offset(name)
+    progress = PollProgress(offset, done_ids, name)
+    logger.info("Long polling бота %s запущен (offset=%s, workers=%s)", b.bot_id, offset, len(queues))
+    with use_tenant(b):
+        _poll_loop(b, queues, progress)
+
+def _poll_loop(b, queues, progress):
+    while True:
+        if db_breaker.is_open():
+            # без БД апдейты не забираем: Telegram хранит их сам, пока offset не подтверждён
+            time.sleep(1)
+            continue
+        try:
+            raw = telebot.apihelper.get_updates(b.token, offset=progress.offset, limit=100, timeout=POLL_TIMEOUT,
+                                                allowed_updates=ALLOWED_UPDATES, long_polling_timeout=POLL_TIMEOUT)
+        except Exception:
+            logger.exception("getUpdates не удался, повтор через 3 сек")
+            time.sleep(3)
+            continue
+        metric_inc("poll_requests")
+        if update_journal is not None:
+            for data in raw:
+                journal_update(json.dumps(data, ensure_ascii=False))
+        if progress.offset is None and raw:
+            progress.offset = raw[0]["update_id"]
+        items = []
+        for data in raw:
+            update_id = data["update_id"]
+            if update_id in progress.done or (progress.offset is not None and update_id < progress.offset):
+                # уже обработан до рестарта
+                continue
+            items.append((data, admit_update(data)))
+        if not items:
+            if raw and progress.offset is not None:
+                # весь пакет — повторы: подтверждаем его Telegram'у следующим запросом
+                with progress.lock:
+                    progress.offset = max(progress.offset, raw[-1]["update_id"] + 1)
+                    progress.done = {i for i in progress.done if i >= progress.offset}
+                    progress._save()
+            continue
+        ctx = prefetch_batch([u for _, u in items if u is not None])
+        for data, update in items:
+            q = queues[hash(_update_chat_id(data)) % len(queues)]
+            q.put((b, ctx, update, data["update_id"], progress))
+        # следующий getUpdates только после обработки пакета: offset подтверждает всё полученное
+        # (join ждёт и апдейты других ботов в тех же очередях — не дольше их пакета)
+        for q in queues:
+            q.join()
+        try:
+            progress.flush()
+        except Exception:
+            # позиция сохранится со следующим пакетом; в памяти она уже сдвинута
+            logger.exception("Не удалось сохранить позицию long polling")
+
+# ========== ХРАНЕНИЕ И АРХИВ ==========
+# Решённые заявки (accepted / rejected / published / expired) старше срока хранения канала переносятся вместе с
+# действиями модераторов в submissions_archive / submission_actions_archive (SQLite — в подключённый
+# файл ARCHIVE_DB_PATH), их контрольные сообщения и назначения удаляются. Pending не трогаются.
+# Перенос — короткими транзакциями по RETENTION_BATCH строк, чтобы не держать блокировки.
+# На Postgres submissions и submission_actions ещё и разбиты на помесячные партиции: старые партиции,
+# опустевшие после переноса, удаляются целиком, новые создаются заранее.
+DECIDED_STATUSES = ("accepted", "rejected", "published", "expired")
+
+def channel_retention_days(channel_dbid):
+    value = get_channel_setting(channel_dbid, "retention_days")
+    try:
+        return int(value) if value is not None else RETENTION_DAYS
+    except ValueError:
+        return RETENTION_DAYS
+
+def _archive_batch(c, ids, ts):
+    ph = '%s' if USE_PG else '?'
+    if USE_PG:
+        c.execute(f"WITH moved AS (DELETE FROM submissions WHERE id = ANY(%s) RETURNING {SUBMISSION_COLUMNS}) "
+                  f"INSERT INTO submissions_archive ({SUBMISSION_COLUMNS}, archived_at) SELECT {SUBMISSION_COLUMNS}, %s FROM moved ON CONFLICT (id) DO NOTHING", (ids, ts))
+        c.execute(f"WITH moved AS (DELETE FROM submission_actions WHERE submission_id = ANY(%s) RETURNING {ACTION_COLUMNS}) "
+                  f"INSERT INTO submission_actions_archive ({ACTION_COLUMNS}, archived_at) SELECT {ACTION_COLUMNS}, %s FROM moved ON CONFLICT (id) DO NOTHING", (ids, ts))
+        c.execute("DELETE FROM submission_messages WHERE submission_id = ANY(%s)", (ids,))
+        c.execute("DELETE FROM submission_assignments WHERE submission_id = ANY(%s)", (ids,))
+    else:
+        placeholders = ','.join(ph for _ in ids)
+        c.execute(f"INSERT OR IGNORE INTO archive.submissions_archive ({SUBMISSION_COLUMNS}, archived_at) SELECT {SUBMISSION_COLUMNS}, ? FROM submissions WHERE id IN ({placeholders})", (ts, *ids))
+        c.execute(f"INSERT OR IGNORE INTO archive.submission_actions_archive ({ACTION_COLUMNS}, archived_at) SELECT {ACTION_COLUMNS}, ? FROM submission_actions WHERE submission_id IN ({placeholders})", (ts, *ids))
+        for table, column in (("submission_actions", "submission_id"), ("submission_messages", "submission_id"),
+                              ("submission_assignments", "submission_id"), ("submissions", "id")):
+            c.execute(f"DELETE FROM {table} WHERE {column} IN ({placeholders})", tuple(ids))
+
+def archive_channel_submissions(channel_dbid, cutoff, budget):
+    # переносит решённые заявки канала (channel_dbid None — удалённых каналов) старше cutoff; -> число строк
+    moved = 0
+    ph = '%s' if USE_PG else '?'
+    statuses = ','.join(ph for _ in DECIDED_STATUSES)
+    if channel_dbid is None:
+        where = "target_channel_dbid NOT IN (SELECT id FROM channels)"
+        params = ()
+    else:
+        where = f"target_channel_dbid = {ph}"
+        params = (channel_dbid,)
+    while moved < budget:
+        c = db.cursor()
+        try:
+            c.execute(f"SELECT id FROM submissions WHERE {where} AND status IN ({statuses}) AND created_at < {ph} ORDER BY id LIMIT {ph}",
+                      params + DECIDED_STATUSES + (cutoff, min(RETENTION_BATCH, budget - moved)))
+            ids = [r[0] for r in c.fetchall()]
+            if not ids:
+                break
+            _archive_batch(c, ids, now_ts())
+            db.commit()
+        finally:
+            c.close()
+        moved += len(ids)
+        metric_inc("retention_archived", len(ids))
+        # пауза между порциями — даём пройти запросам обработчиков
+        time.sleep(0.05)
+    return moved
+
+def drop_empty_pg_partitions(table, older_than):
+    # партиции целиком старше older_than, в которых не осталось строк (всё ушло в архив)
+    c = db.cursor()
+    try:
+        c.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = %s", (table,))
+        partitions = [r[0] for r in c.fetchall()]
+        for name in partitions:
+            suffix = name.rsplit("_p", 1)[-1]
+            if not suffix.isdigit() or len(suffix) != 6:
+                continue
+            end = month_bounds(calendar.timegm((int(suffix[:4]), int(suffix[4:]), 1, 0, 0, 0)))[1]
+            if end >= older_than:
+                continue
+            c.execute(f"SELECT 1 FROM {name} LIMIT 1")
+            if c.fetchone() is None:
+                c.execute(f"DROP TABLE {name}")
+                db.commit()
+                logger.info("Удалена пустая партиция %s", name)
+    finally:
+        c.close()
+
+def sweep_retention():
+    t0 = time.perf_counter()
+    budget = RETENTION_MAX_ROWS
+    c = db.cursor()
+    try:
+        c.execute("SELECT id FROM channels")
+        channel_ids = [r[0] for r in c.fetchall()]
+    finally:
+        c.close()
+    moved = 0
+    for dbid in channel_ids + [None]:
+        days = channel_retention_days(dbid) if dbid is not None else RETENTION_DAYS
+        if days <= 0 or moved >= budget:
+            continue
+        moved += archive_channel_submissions(dbid, now_ts() - days * 86400, budget - moved)
+    # отпечатки вне окна поиска дублей больше не нужны
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("DELETE FROM submission_fingerprints WHERE submission_id IN (SELECT submission_id FROM submission_fingerprints WHERE created_at < %s LIMIT %s)", (now_ts() - DUPLICATE_WINDOW_SECONDS, RETENTION_BATCH * 10))
+        else:
+            c.execute("DELETE FROM submission_fingerprints WHERE submission_id IN (SELECT submission_id FROM submission_fingerprints WHERE created_at < ? LIMIT ?)", (now_ts() - DUPLICATE_WINDOW_SECONDS, RETENTION_BATCH * 10))
+        db.commit()
+    finally:
+        c.close()
+    if USE_PG and PG_PARTITIONING:
+        for table in PARTITIONED_TABLES:
+            ensure_pg_partitions(table, now_ts())
+            drop_empty_pg_partitions(table, now_ts() - 31 * 86400)
+    metric_observe("retention_sweep", time.perf_counter() - t0)
+    if moved:
+        logger.info("Архивировано заявок: %s за %.1f сек", moved, time.perf_counter() - t0)
+    return moved
+
+@bot.message_handler(commands=['retention'])
+def cmd_retention(message):
+    # формат: /retention <channel_dbid> [дни|0]
+    parts = (message.text or "").split()
+    if len(parts) not in (2, 3):
+        bot.send_message(message.chat.id, "Использование: /retention <channel_dbid> [дни, 0 — хранить всегда]")
+        return
+    try:
+        dbid = int(parts[1])
+        days = int(parts[2]) if len(parts) == 3 else None
+    except ValueError:
+        bot.send_message(message.chat.id, "Неверные аргументы.")
+        return
+    if not is_channel_owner(dbid, message.from_user.id):
+        bot.send_message(message.chat.id, "Только владелец канала может менять срок хранения.")
+        return
+    if days is None:
+        days = channel_retention_days(dbid)
+        bot.send_message(message.chat.id, f"Решённые заявки переносятся в архив через {days} дн." if days > 0 else "Заявки хранятся без ограничения срока.")
+        return
+    set_channel_setting(dbid, "retention_days", str(max(0, days)))
+    bot.send_message(message.chat.id, "Срок хранения обновлён.")
 
+# ========== ВЫГРУЗКА ЗАЯВОК И ИСТОРИИ МОДЕРАЦИИ ==========
+# Строки читаются потоком через отдельное соединение: на Postgres — серверный (именованный) курсор,
+# на SQLite — fetchmany; в памяти одновременно не больше EXPORT_FETCH_SIZE строк. Выгружаются и
+# горячие таблицы, и архив. Формат JSONL или CSV, опционально gzip (сжатие тоже потоковое).
+EXPORT_KINDS = {
+    "submissions": (SUBMISSION_COLUMNS, [
+        f"SELECT {SUBMISSION_COLUMNS} FROM submissions_archive WHERE target_channel_dbid = {{ph}} ORDER BY id",
+        f"SELECT {SUBMISSION_COLUMNS} FROM submissions WHERE target_channel_dbid = {{ph}} ORDER BY id",
+    ]),
+    "actions": (ACTION_COLUMNS, [
+        "SELECT " + ", ".join("a." + col.strip() for col in ACTION_COLUMNS.split(",")) + " FROM submission_actions_archive a JOIN submissions_archive s ON s.id = a.submission_id WHERE s.target_channel_dbid = {ph} ORDER BY a.id",
+        "SELECT " + ", ".join("a." + col.strip() for col in ACTION_COLUMNS.split(",")) + " FROM submission_actions a JOIN submissions s ON s.id = a.submission_id WHERE s.target_channel_dbid = {ph} ORDER BY a.id",
+    ]),
+}
+EXPORT_FORMATS = ("jsonl", "csv")
+
+@contextmanager
+def export_connection():
+    # отдельное соединение: длинное чтение не держит транзакцию общего соединения обработчиков;
+    # на Postgres — по возможности с реплики
+    replica = replica_for_read()
+    conn = None
+    if replica is not None:
         try:
-            chat = bot.get_chat(getchat_arg)
-            # возможные варианты ключей, которые могли быть сохранены
-            possible = set()
-            possible.add(str(chat.id))
-            # Bot API возвращает channel username without @
-            if getattr(chat, "username", None):
-                possible.add("@" + chat.username)
-                possible.add(chat.username)
-            # иногда id может быть negative like -100..., добавим вариант без -100 если кто-то сохранил так
-            cid = str(chat.id)
-            if cid.startswith("-100"):
-                possible.add(cid[4:])          # without -100
-                possible.add(cid.lstrip("-"))  # without minus
+            conn = replica.connect()
+        except psycopg2.OperationalError as e:
+            replica.mark_down(e)
+    if conn is None:
+        if USE_PG:
+            conn = pg_connect()
+        else:
+            conn = sqlite3.connect(DB_PATH, check_same_thread=False, timeout=30)
+            conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_PATH,))
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def iter_export_rows(channel_dbid, kind):
+    columns, queries = EXPORT_KINDS[kind]
+    ph = '%s' if USE_PG else '?'
+    with export_connection() as conn:
+        for i, sql in enumerate(queries):
+            if USE_PG:
+                c = conn.cursor(name=f"teleform_export_{i}")
+                c.itersize = EXPORT_FETCH_SIZE
             else:
-                possible.add("-100" + cid)
-                possible.add("-" + cid)
+                c = conn.cursor()
+            try:
+                c.execute(sql.format(ph=ph), (channel_dbid,))
+                while True:
+                    rows = c.fetchmany(EXPORT_FETCH_SIZE)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield row
+            finally:
+                c.close()
 
-            # поиск в БД по всем возможным вариантам
-            for k in possible:
-                if USE_PG:
-                    cur.execute("SELECT id, title, channel_id FROM channels WHERE channel_id = %s", (k,))
-                else:
-                    cur.execute("SELECT id, title, channel_id FROM channels WHERE channel_id = ?", (k,))
-                r = cur.fetchone()
-                if r:
-                    row = r
-                    break
-        except Exception:
-            # если get_chat не удался — продолжаем дальше и сообщим об ошибке позже
-            row = None
+def export_header(kind, fmt):
+    if fmt != "csv":
+        return b""
+    buf = io.StringIO()
+    csv.writer(buf).writerow([col.strip() for col in EXPORT_KINDS[kind][0].split(",")])
+    return buf.getvalue().encode("utf-8")
 
-    if not row:
-        bot.send_message(m.chat.id, "❌ Канал не найден или не подключён к боту. Убедитесь, что вы ввели корректный @username или ссылку, и что канал действительно подключён (через Forward).", reply_markup=main_menu())
-        return
+def export_chunks(channel_dbid, kind, fmt, rows_per_chunk=500):
+    # сериализованные строки порциями (без заголовка CSV — его добавляет вызывающий)
+    names = [col.strip() for col in EXPORT_KINDS[kind][0].split(",")]
+    buf = io.StringIO()
+    writer = csv.writer(buf) if fmt == "csv" else None
+    pending = 0
+    for row in iter_export_rows(channel_dbid, kind):
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            buf.write(json.dumps(dict(zip(names, row)), ensure_ascii=False))
+            buf.write("\n")
+        pending += 1
+        if pending >= rows_per_chunk:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate()
+            pending = 0
+    if pending:
+        yield buf.getvalue().encode("utf-8")
 
-    dbid, title, stored_key = row
-    kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton("Анонимно", callback_data=f"deep_offer_anon:1:{dbid}"),
-           types.InlineKeyboardButton("Не анонимно", callback_data=f"deep_offer_anon:0:{dbid}"))
-    bot.send_message(m.chat.id, f"📣 Вы хотите отправить пост в канал *{title or stored_key}*? Выберите режим отправки:", parse_mode="Markdown", reply_markup=kb)
+def export_stream(channel_dbid, kind, fmt, compress=False):
+    # поток байтов для HTTP-ответа
+    comp = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    header = export_header(kind, fmt)
+    if header:
+        yield comp.compress(header) if comp else header
+    for chunk in export_chunks(channel_dbid, kind, fmt):
+        out = comp.compress(chunk) if comp else chunk
+        if out:
+            yield out
+    if comp:
+        yield comp.flush()
+    metric_inc("exports")
 
-# ========== DEEP LINK FLOW ==========
-@bot.callback_query_handler(func=lambda cq: cq.data and cq.data.startswith("deep_offer_anon:"))
-def cq_deeplink_offer(cq):
-    bot.answer_callback_query(cq.id)
-    try:
-        _, anon_str, dbid_str = cq.data.split(":" ,2)
-        anon_flag = True if anon_str == "1" else False
-        dbid = int(dbid_str)
-    except:
-        bot.send_message(cq.from_user.id, "Ошибка ссылки."); return
-    # cooldown check
-    last = get_last_published(cq.from_user.id, dbid)
-    if last:
-        elapsed = now_ts() - last
-        if elapsed < COOLDOWN_SECONDS:
-            left = COOLDOWN_SECONDS - elapsed
-            bot.send_message(cq.from_user.id, f"⏳ Вы уже публиковали в этот канал. Попробовать ещё можно через {format_timedelta_seconds(left)}.", reply_markup=main_menu())
-            return
-    # prompt for content
-    ch = get_channel_by_dbid(dbid)
-    if not ch:
-        bot.send_message(cq.from_user.id, "Канал не найден.", reply_markup=main_menu()); return
-    msg = bot.send_message(cq.from_user.id, f"📝 Отправьте текст, фото, видео или документ для канала *{ch[3] or ch[2]}*.\nДля отмены нажмите «Отмена».", parse_mode="Markdown", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("❌ Отмена", callback_data="cancel")))
-    set_state(cq.from_user.id, f"awaiting_submission:{1 if anon_flag else 0}:{dbid}")
-    bot.register_next_step_handler(msg, lambda m, anon=anon_flag, target=dbid: handle_submission(m, anon, target))
+def export_to_files(channel_dbid, kind, fmt, compress=True, part_bytes=None):
+    # выгрузка во временные файлы не больше part_bytes каждый (для отправки документами);
+    # каждая часть — самостоятельный файл: свой заголовок CSV и свой gzip-поток
+    part_bytes = part_bytes or EXPORT_PART_BYTES
+    header = export_header(kind, fmt)
+    parts = []
+    f = comp = None
+    size = 0
 
-# ========== HANDLE SUBMISSION ==========
-def _reject_submission_from_user(chat_id, reason=""):
-    bot.send_message(chat_id, f"❌ Не удалось принять заявку. {reason}", reply_markup=main_menu())
+    def close_part():
+        if comp is not None:
+            f.write(comp.flush())
+        f.flush()
+        f.seek(0)
 
-def handle_submission(message, anonymous=True, target_dbid=0):
-    uid = message.from_user.id
-    st = pop_state(uid)
-    if not st or not st.startswith("awaiting_submission"):
-        bot.send_message(uid, "Сначала начни через меню: /menu → Предложить пост.", reply_markup=main_menu())
+    for chunk in export_chunks(channel_dbid, kind, fmt):
+        if f is None or size >= part_bytes:
+            if f is not None:
+                close_part()
+            f = tempfile.TemporaryFile()
+            parts.append(f)
+            comp = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+            size = 0
+            chunk = header + chunk
+        # sync flush: иначе сжатое копится внутри compressobj и размер части не виден
+        out = comp.compress(chunk) + comp.flush(zlib.Z_SYNC_FLUSH) if comp else chunk
+        f.write(out)
+        size += len(out)
+    if f is None:
+        f = tempfile.TemporaryFile()
+        parts.append(f)
+        comp = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        f.write(comp.compress(header) if comp else header)
+    close_part()
+    return parts
+
+def _send_export(chat_id, channel_dbid, kind, fmt, compress):
+    t0 = time.perf_counter()
+    parts = []
+    try:
+        parts = export_to_files(channel_dbid, kind, fmt, compress)
+        ext = fmt + (".gz" if compress else "")
+        for i, f in enumerate(parts, 1):
+            suffix = f"_part{i}" if len(parts) > 1 else ""
+            bot.send_document(chat_id, f, visible_file_name=f"channel{channel_dbid}_{kind}{suffix}.{ext}")
+        metric_inc("exports")
+        metric_observe("export", time.perf_counter() - t0)
+    except Exception:
+        logger.exception("Выгрузка канала %s не удалась", channel_dbid)
+        bot.send_message(chat_id, "Не удалось подготовить выгрузку.")
+    finally:
+        for f in parts:
+            f.close()
+
+@bot.message_handler(commands=['export'])
+def cmd_export(message):
+    # формат: /export <channel_dbid> [submissions|actions] [jsonl|csv] [gz]
+    parts = (message.text or "").split()
+    if len(parts) < 2:
+        bot.send_message(message.chat.id, "Использование: /export <channel_dbid> [submissions|actions] [jsonl|csv] [gz]")
         return
-    # извлечь состояние (доп. валидация)
-    # content type
-    content_type = message.content_type
-    text_content = message.text if content_type == 'text' else None
-    file_id = None
-    file_size = None
-    if content_type == 'photo':
-        file_id = message.photo[-1].file_id
-        try:
-            file_size = message.photo[-1].file_size
-        except:
-            file_size = None
-    elif content_type == 'video':
-        file_id = message.video.file_id
-        file_size = getattr(message.video, 'file_size', None)
-    elif content_type == 'document':
-        file_id = message.document.file_id
-        file_size = getattr(message.document, 'file_size', None)
-    elif content_type == 'text':
-        file_id = None
-    else:
-        bot.send_message(uid, "Тип сообщения не поддерживается. Отправь текст, фото, видео или документ.", reply_markup=main_menu())
+    try:
+        dbid = int(parts[1])
+    except ValueError:
+        bot.send_message(message.chat.id, "Неверные аргументы.")
         return
-
-    # basic validations
-    if content_type == 'text' and text_content and len(text_content) > MAX_TEXT_LENGTH:
-        _reject_submission_from_user(uid, f"Текст слишком длинный (макс {MAX_TEXT_LENGTH} символов).")
+    opts = parts[2:]
+    kind = next((o for o in opts if o in EXPORT_KINDS), "submissions")
+    fmt = next((o for o in opts if o in EXPORT_FORMATS), "jsonl")
+    compress = "gz" in opts
+    if any(o not in EXPORT_KINDS and o not in EXPORT_FORMATS and o != "gz" for o in opts):
+        bot.send_message(message.chat.id, "Неверные аргументы.")
         return
-    if file_size and file_size > MAX_FILE_SIZE:
-        _reject_submission_from_user(uid, "Файл слишком большой.")
+    if not is_channel_owner(dbid, message.from_user.id):
+        bot.send_message(message.chat.id, "Только владелец канала может выгружать заявки.")
         return
+    bot.send_message(message.chat.id, "Готовлю выгрузку, пришлю файлом.")
+    # выгрузка может быть долгой — не занимаем поток обработчиков
+    threading.Thread(target=bind_tenant(_send_export), args=(message.chat.id, dbid, kind, fmt, compress), name="export", daemon=True).start()
 
-    # require target_dbid > 0 (no "ordinary" submissions allowed)
-    if not target_dbid or target_dbid <= 0:
-        bot.send_message(uid, "Ошибка: цель публикации не указана. Пожалуйста, отправляйте заявки только в подключённые каналы.", reply_markup=main_menu())
-        return
+@app.route("/admin/export/<int:channel_dbid>", methods=["GET"])
+def admin_export(channel_dbid):
+    if not ADMIN_TOKEN or request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        return abort(404)
+    kind = request.args.get("kind", "submissions")
+    fmt = request.args.get("format", "jsonl")
+    if kind not in EXPORT_KINDS or fmt not in EXPORT_FORMATS:
+        return abort(400)
+    compress = request.args.get("gzip") == "1"
+    filename = f"channel{channel_dbid}_{kind}.{fmt}" + (".gz" if compress else "")
+    mimetype = "application/gzip" if compress else ("text/csv" if fmt == "csv" else "application/x-ndjson")
+    return Response(stream_with_context(export_stream(channel_dbid, kind, fmt, compress)), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
 
-    # recheck cooldown before saving
-    last = get_last_published(uid, target_dbid)
-    if last and (now_ts() - last) < COOLDOWN_SECONDS:
-        left = COOLDOWN_SECONDS - (now_ts() - last)
-        bot.send_message(uid, f"⏳ Вы уже публиковали в этот канал. Попробовать ещё можно через {format_timedelta_seconds(left)}.", reply_markup=main_menu())
-        return
+# ========== СТАТИСТИКА КАНАЛОВ ==========
+# Объём заявок, доля принятых и медиана времени до решения берутся из свёрток channel_daily_stats /
+# channel_decision_hist (строка на канал и день). Свёртки обновляются в той же транзакции, что и заявка:
+# save_submission, set_submission_status, transition_submission_status — так /stats стоит O(дней),
+# а не O(заявок). Для данных, появившихся до свёрток, есть пересчёт из submissions / submission_actions
+# (вместе с архивом), а периодическая сверка последних дней чинит расхождения.
+STATS_COLUMNS = ("submitted", "accepted", "rejected", "published")
+# верхние границы корзин времени до решения (сек); корзина len(DECISION_BUCKETS) — дольше недели
+DECISION_BUCKETS = (60, 300, 900, 1800, 3600, 2 * 3600, 4 * 3600, 8 * 3600, 12 * 3600,
+                    86400, 2 * 86400, 4 * 86400, 7 * 86400)
 
-    # banned check (channel-specific)
-    if is_banned(target_dbid, uid):
-        _reject_submission_from_user(uid, "Вы заблокированы для этого канала.")
+def decision_bucket(seconds):
+    return bisect.bisect_left(DECISION_BUCKETS, seconds)
+
+def record_channel_stat(c, channel_dbid, ts, column, decision_seconds=None):
+    # +1 к счётчику column за день ts; коммит — у вызывающего, в его транзакции
+    day = ts // 86400
+    seconds = max(0, decision_seconds) if decision_seconds is not None else 0
+    if USE_PG:
+        c.execute(f"INSERT INTO channel_daily_stats (channel_dbid, day, {column}, decision_seconds) VALUES (%s, %s, 1, %s) "
+                  f"ON CONFLICT (channel_dbid, day) DO UPDATE SET {column} = channel_daily_stats.{column} + 1, "
+                  "decision_seconds = channel_daily_stats.decision_seconds + EXCLUDED.decision_seconds", (channel_dbid, day, seconds))
+        if decision_seconds is not None:
+            c.execute("INSERT INTO channel_decision_hist (channel_dbid, day, bucket, count) VALUES (%s, %s, %s, 1) "
+                      "ON CONFLICT (channel_dbid, day, bucket) DO UPDATE SET count = channel_decision_hist.count + 1", (channel_dbid, day, decision_bucket(seconds)))
+    else:
+        c.execute("INSERT OR IGNORE INTO channel_daily_stats (channel_dbid, day) VALUES (?, ?)", (channel_dbid, day))
+        c.execute(f"UPDATE channel_daily_stats SET {column} = {column} + 1, decision_seconds = decision_seconds + ? WHERE channel_dbid = ? AND day = ?", (seconds, channel_dbid, day))
+        if decision_seconds is not None:
+            bucket = decision_bucket(seconds)
+            c.execute("INSERT OR IGNORE INTO channel_decision_hist (channel_dbid, day, bucket) VALUES (?, ?, ?)", (channel_dbid, day, bucket))
+            c.execute("UPDATE channel_decision_hist SET count = count + 1 WHERE channel_dbid = ? AND day = ? AND bucket = ?", (channel_dbid, day, bucket))
+
+def record_status_change(c, sub_id, old_status, new_status, ts):
+    # решение считается в день решения; время до решения — только для перехода из pending
+    if new_status not in STATS_COLUMNS:
+        return
+    if USE_PG:
+        c.execute("SELECT target_channel_dbid, created_at FROM submissions WHERE id = %s", (sub_id,))
+    else:
+        c.execute("SELECT target_channel_dbid, created_at FROM submissions WHERE id = ?", (sub_id,))
+    row = c.fetchone()
+    if not row:
         return
+    channel_dbid, created_at = row
+    seconds = ts - (created_at or ts) if old_status == "pending" and new_status in ("accepted", "rejected") else None
+    record_channel_stat(c, channel_dbid, ts, new_status, seconds)
 
-    sub_id = save_submission(uid, content_type, text_content, file_id, anonymous, target_dbid)
+def compute_channel_stats(c, channel_dbid, day_from, day_to):
+    # пересчёт из исходных таблиц (горячих и архивных) за дни [day_from, day_to]:
+    # -> ({day: [submitted, accepted, rejected, published, decision_seconds]}, {(day, bucket): count})
+    ph = '%s' if USE_PG else '?'
+    lo, hi = day_from * 86400, (day_to + 1) * 86400
+    days, hist = {}, {}
+    for table in ("submissions", "submissions_archive"):
+        c.execute(f"SELECT created_at / 86400, COUNT(*) FROM {table} WHERE target_channel_dbid = {ph} AND created_at >= {ph} AND created_at < {ph} GROUP BY created_at / 86400", (channel_dbid, lo, hi))
+        for day, n in c.fetchall():
+            days.setdefault(int(day), [0, 0, 0, 0, 0])[0] += n
+    for actions, subs in (("submission_actions", "submissions"), ("submission_actions_archive", "submissions_archive")):
+        c.execute(f"SELECT a.action, a.created_at, s.created_at FROM {actions} a JOIN {subs} s ON s.id = a.submission_id "
+                  f"WHERE s.target_channel_dbid = {ph} AND a.created_at >= {ph} AND a.created_at < {ph} AND a.action IN ({ph}, {ph}, {ph})",
+                  (channel_dbid, lo, hi, *STATS_COLUMNS[1:]))
+        while True:
+            rows = c.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            for action, acted_at, created_at in rows:
+                day = acted_at // 86400
+                counters = days.setdefault(day, [0, 0, 0, 0, 0])
+                counters[STATS_COLUMNS.index(action)] += 1
+                if action != "published":
+                    seconds = max(0, acted_at - (created_at or acted_at))
+                    counters[4] += seconds
+                    key = (day, decision_bucket(seconds))
+                    hist[key] = hist.get(key, 0) + 1
+    return days, hist
 
-    # set cooldown at submission time to prevent spamming (persisted in DB)
+def _write_channel_stats(c, channel_dbid, day_from, day_to, days, hist):
+    ph = '%s' if USE_PG else '?'
+    for table in ("channel_daily_stats", "channel_decision_hist"):
+        c.execute(f"DELETE FROM {table} WHERE channel_dbid = {ph} AND day >= {ph} AND day <= {ph}", (channel_dbid, day_from, day_to))
+    if days:
+        c.executemany(f"INSERT INTO channel_daily_stats (channel_dbid, day, submitted, accepted, rejected, published, decision_seconds) VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph})",
+                      [(channel_dbid, day, *counters) for day, counters in days.items()])
+    if hist:
+        c.executemany(f"INSERT INTO channel_decision_hist (channel_dbid, day, bucket, count) VALUES ({ph}, {ph}, {ph}, {ph})",
+                      [(channel_dbid, day, bucket, n) for (day, bucket), n in hist.items()])
+
+def rebuild_channel_stats(channel_dbid, day_from=0, day_to=None):
+    # свёртки канала за диапазон дней заменяются пересчитанными; по умолчанию — за всё время
+    if day_to is None:
+        day_to = now_ts() // 86400
+    c = db.cursor()
     try:
-        set_cooldown(uid, target_dbid, now_ts())
+        days, hist = compute_channel_stats(c, channel_dbid, day_from, day_to)
+        _write_channel_stats(c, channel_dbid, day_from, day_to, days, hist)
+        db.commit()
     except Exception:
-        logger.exception("Не удалось установить cooldown при сохранении заявки")
+        db.rollback()
+        raise
+    finally:
+        c.close()
 
-    # determine recipients: channel moderators if any, else owner
-    recipients = []
-    admins = list_channel_admins(target_dbid)
-    if admins:
-        recipients = admins[:]
-    else:
-        ch = get_channel_by_dbid(target_dbid)
-        if ch:
-            recipients = [ch[1]]
+def _stats_channel_ids():
+    c = db.cursor()
+    try:
+        c.execute("SELECT id FROM channels")
+        return [r[0] for r in c.fetchall()]
+    finally:
+        c.close()
 
-    # send submission to each recipient (moderators)
-    for r in recipients:
+def backfill_channel_stats():
+    # первичное заполнение свёрток; пропускается, если они уже есть
+    c = db.cursor()
+    try:
+        c.execute("SELECT 1 FROM channel_daily_stats LIMIT 1")
+        if c.fetchone():
+            return 0
+    finally:
+        c.close()
+    t0 = time.perf_counter()
+    channel_ids = _stats_channel_ids()
+    for dbid in channel_ids:
+        rebuild_channel_stats(dbid)
+    metric_observe("stats_backfill", time.perf_counter() - t0)
+    logger.info("Статистика пересчитана для %s каналов за %.1f сек", len(channel_ids), time.perf_counter() - t0)
+    return len(channel_ids)
+
+def check_channel_stats():
+    # сверка свёрток последних STATS_CHECK_DAYS завершённых дней с исходными таблицами; расхождения переписываются.
+    # submission_actions пишется асинхронно (audit_log): буферы других воркеров отсюда не видны, поэтому
+    # сверяются только дни, закончившиеся больше STATS_SETTLE_SECONDS назад; дни со строками в своём буфере
+    # или в общем fallback-файле (сбой БД дольше этого срока) тоже пропускаются
+    day_to = (now_ts() - STATS_SETTLE_SECONDS) // 86400 - 1
+    day_from = day_to - STATS_CHECK_DAYS + 1
+    ph = '%s' if USE_PG else '?'
+    repaired = 0
+    audit_log.flush()
+    for dbid in _stats_channel_ids():
+        c = db.cursor()
         try:
-            if anonymous:
-                note = f"Заявка #{sub_id} — анонимно"
-                if content_type == 'text':
-                    bot.send_message(r, f"{note}\n\n{(text_content or '')}")
-                elif content_type == 'photo':
-                    bot.send_photo(r, file_id, caption=f"{note}\n\n{(text_content or '')}")
-                elif content_type == 'video':
-                    bot.send_video(r, file_id, caption=f"{note}\n\n{(text_content or '')}")
-                elif content_type == 'document':
-                    bot.send_document(r, file_id, caption=f"{note}\n\n{(text_content or '')}")
-            else:
-                bot.forward_message(r, uid, message.message_id)
+            with audit_log.paused():
+                days, hist = compute_channel_stats(c, dbid, day_from, day_to)
+                c.execute(f"SELECT day, submitted, accepted, rejected, published, decision_seconds FROM channel_daily_stats WHERE channel_dbid = {ph} AND day >= {ph} AND day <= {ph}", (dbid, day_from, day_to))
+                stored = {int(r[0]): [int(v) for v in r[1:]] for r in c.fetchall() if any(r[1:])}
+                pending = audit_log.pending_days()
+            mismatched = sorted(day for day in set(stored) | set(days) if day not in pending and stored.get(day) != days.get(day))
+            if not mismatched:
+                db.commit()
+                continue
+            logger.warning("Статистика канала %s расходится с заявками (%s дн.), пересчитываю", dbid, len(mismatched))
+            for day in mismatched:
+                _write_channel_stats(c, dbid, day, day, {day: days[day]} if day in days else {},
+                                     {key: n for key, n in hist.items() if key[0] == day})
+            db.commit()
+            repaired += 1
+            metric_inc("stats_repaired")
         except Exception:
-            # игнорируем сбои по получателям
-            pass
-        # send control message with buttons
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("✅ Принять", callback_data=f"accept:{sub_id}"),
-               types.InlineKeyboardButton("❌ Отклонить", callback_data=f"reject:{sub_id}"))
-        kb.add(types.InlineKeyboardButton("✉️ Ответить автору", callback_data=f"reply:{sub_id}"))
-        bot.send_message(r, f"🔔 Контроль заявки #{sub_id}", reply_markup=kb)
+            db.rollback()
+            raise
+        finally:
+            c.close()
+    return repaired
 
-    bot.send_message(uid, "✅ Ваша заявка отправлена на рассмотрение. Спасибо!", reply_markup=main_menu())
+def median_from_hist(hist):
+    # медиана по корзинам с линейной интерполяцией внутри корзины; None — если решений не было
+    total = sum(hist.values())
+    if not total:
+        return None
+    half = total / 2
+    seen = 0
+    for bucket in sorted(hist):
+        n = hist[bucket]
+        if seen + n >= half:
+            lower = DECISION_BUCKETS[bucket - 1] if bucket > 0 else 0
+            if bucket >= len(DECISION_BUCKETS):
+                return lower
+            return int(lower + (DECISION_BUCKETS[bucket] - lower) * (half - seen) / n)
+        seen += n
+    return None
 
-# ========== ADMIN ACTIONS ON SUBMISSIONS (с проверкой прав) ==========
-@bot.callback_query_handler(func=lambda cq: cq.data and any(cq.data.startswith(pref) for pref in ("accept:", "reject:", "reply:")))
-def cq_admin_submission_actions(cq):
-    bot.answer_callback_query(cq.id)
-    parts = cq.data.split(":",1)
-    action = parts[0]; sid = parts[1]
+def channel_stats(channel_dbid, days):
+    since = now_ts() // 86400 - days + 1
+    c = db.cursor()
     try:
-        sid = int(sid)
-    except:
-        bot.send_message(cq.from_user.id, "Неверный ID заявки."); return
-    submission = get_submission(sid)
-    if not submission:
-        bot.send_message(cq.from_user.id, "Заявка не найдена."); return
-    sub_id, user_id, content_type, text_content, file_id, status, created_at, anonymous, target_dbid = submission
+        if USE_PG:
+            c.execute("SELECT COALESCE(SUM(submitted), 0), COALESCE(SUM(accepted), 0), COALESCE(SUM(rejected), 0), COALESCE(SUM(published), 0), COALESCE(SUM(decision_seconds), 0) "
+                      "FROM channel_daily_stats WHERE channel_dbid = %s AND day >= %s", (channel_dbid, since))
+            totals = [int(v) for v in c.fetchone()]
+            c.execute("SELECT bucket, SUM(count) FROM channel_decision_hist WHERE channel_dbid = %s AND day >= %s GROUP BY bucket", (channel_dbid, since))
+        else:
+            c.execute("SELECT COALESCE(SUM(submitted), 0), COALESCE(SUM(accepted), 0), COALESCE(SUM(rejected), 0), COALESCE(SUM(published), 0), COALESCE(SUM(decision_seconds), 0) "
+                      "FROM channel_daily_stats WHERE channel_dbid = ? AND day >= ?", (channel_dbid, since))
+            totals = [int(v) for v in c.fetchone()]
+            c.execute("SELECT bucket, SUM(count) FROM channel_decision_hist WHERE channel_dbid = ? AND day >= ? GROUP BY bucket", (channel_dbid, since))
+        hist = {int(b): int(n) for b, n in c.fetchall()}
+    finally:
+        c.close()
+    stats = dict(zip(STATS_COLUMNS, totals))
+    decided = stats["accepted"] + stats["rejected"]
+    stats["decided"] = decided
+    stats["mean"] = totals[4] // decided if decided else None
+    stats["median"] = median_from_hist(hist)
+    return stats
 
-    # проверка прав: модератор канала или владелец
-    if target_dbid and target_dbid > 0:
-        ch = get_channel_by_dbid(target_dbid)
-        if not ch:
-            bot.send_message(cq.from_user.id, "Канал не найден для этой заявки."); return
-        owner_id = ch[1]
-        admins = list_channel_admins(target_dbid)
-        if cq.from_user.id != owner_id and cq.from_user.id not in admins:
-            bot.send_message(cq.from_user.id, "У вас нет прав модератора для этой заявки."); return
+def render_channel_stats(title, days, stats):
+    lines = [f"📊 {title} — за {days} дн.", f"Заявок: {stats['submitted']}"]
+    if stats["decided"]:
+        rate = stats["accepted"] * 100 / stats["decided"]
+        lines.append(f"Решено: {stats['decided']} — принято {stats['accepted']} ({rate:.0f}%), отклонено {stats['rejected']}")
     else:
-        bot.send_message(cq.from_user.id, "Невозможно модерировать заявку без привязки к каналу."); return
+        lines.append("Решений пока нет.")
+    lines.append(f"Опубликовано: {stats['published']}")
+    median = stats["median"]
+    if median is not None:
+        if median >= DECISION_BUCKETS[-1]:
+            lines.append(f"Медиана до решения: больше {DECISION_BUCKETS[-1] // 86400} дн.")
+        elif median < DECISION_BUCKETS[0]:
+            # внутри первой корзины интерполяция ничего не знает о распределении — только диапазон
+            lines.append(f"Медиана до решения: до {DECISION_BUCKETS[0] // 60} мин (среднее {format_timedelta_seconds(stats['mean'])})")
+        else:
+            lines.append(f"Медиана до решения: ~{format_timedelta_seconds(median)} (среднее {format_timedelta_seconds(stats['mean'])})")
+    return "\n".join(lines)
 
-    if action == "accept":
-        set_submission_status(sub_id, "accepted", moderator_id=cq.from_user.id)
-        bot.send_message(cq.from_user.id, f"✅ Заявка #{sub_id} принята.")
-        try:
-            bot.send_message(user_id, f"✅ Ваша заявка #{sub_id} принята модератором.")
-        except:
-            pass
-        # publish to channel
-        if target_dbid and target_dbid > 0:
-            handle_publish_to_channel_by_dbid(cq.from_user.id, sub_id, target_dbid)
+@bot.message_handler(commands=['stats'])
+def cmd_stats(message):
+    # формат: /stats <channel_dbid> [дни]
+    parts = (message.text or "").split()
+    if len(parts) not in (2, 3):
+        bot.send_message(message.chat.id, "Использование: /stats <channel_dbid> [дни, по умолчанию 30]")
         return
-
-    if action == "reject":
-        set_submission_status(sub_id, "rejected", moderator_id=cq.from_user.id)
-        bot.send_message(cq.from_user.id, f"❌ Заявка #{sub_id} отклонена.")
-        try:
-            bot.send_message(user_id, f"❌ Ваша заявка #{sub_id} отклонена модератором.")
-        except:
-            pass
+    try:
+        dbid = int(parts[1])
+        days = int(parts[2]) if len(parts) == 3 else 30
+    except ValueError:
+        bot.send_message(message.chat.id, "Неверные аргументы.")
         return
-
-    if action == "reply":
-        # set state to awaiting reply for this moderator
-        set_state(cq.from_user.id, f"awaiting_reply:{sub_id}")
-        msg = bot.send_message(cq.from_user.id, f"✍️ Напишите ответ автору заявки #{sub_id} (или нажмите Отмена).", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("❌ Отмена", callback_data="cancel")))
-        bot.register_next_step_handler(msg, lambda m, sid=sub_id: send_reply_to_author(m, sid))
+    days = max(1, min(days, 3650))
+    ch = get_channel_by_dbid(dbid)
+    if not ch or not can_moderate(dbid, message.from_user.id):
+        bot.send_message(message.chat.id, "Нет прав на этот канал.")
         return
+    bot.send_message(message.chat.id, render_channel_stats(ch[3] or str(ch[2]), days, channel_stats(dbid, days)))
 
-# ========== PUBLISH TO CHANNEL (с логами и проверками) ==========
-def handle_publish_to_channel_by_dbid(requester_id, sub_id, chan_dbid):
-    ch = get_channel_by_dbid(chan_dbid)
-    if not ch:
-        bot.send_message(requester_id, "Канал не найден."); return
-    _, owner_id, channel_id, title = ch
-    sub = get_submission(sub_id)
-    if not sub:
-        bot.send_message(requester_id, "Заявка не найдена."); return
-    sub_id, user_id, content_type, text_content, file_id, status, created_at, anonymous, target_dbid = sub
+# ========== РАССЫЛКИ АВТОРАМ ЗАЯВОК ==========
+# Владелец канала рассылает объявление всем, кто присылал заявки в канал (без забаненных). Рассылка —
+# задача в broadcast_jobs: её выполняет фоновый поток того воркера, который взял аренду (CAS по lease_until),
+# обработчики не блокируются. Получатели читаются порциями по возрастанию user_id, позиция и счётчики
+# сохраняются каждые BROADCAST_CHECKPOINT_EVERY отправок — после рестарта рассылка продолжается с
+# чекпоинта (повторно может уйти не больше одной порции между чекпоинтами). Отправка идёт через общий
+# token bucket (с FLOOD_SHARED — один на все воркеры). 403/400 (бот заблокирован, чат удалён) —
+# окончательный отказ получателя; остальные ошибки прерывают проход, задача подхватится следующим.
+BROADCAST_COLUMNS = "id, channel_dbid, owner_id, text, status, total, sent, failed, last_user_id, progress_chat_id, progress_message_id"
+BROADCAST_STATUS_LABELS = {"new": "ожидает запуска", "running": "идёт", "paused": "на паузе", "cancelled": "отменена", "done": "завершена"}
+# допустимые переходы по кнопкам: действие -> (из каких статусов, в какой)
+BROADCAST_ACTIONS = {
+    "start": (("new",), "running"),
+    "pause": (("running",), "paused"),
+    "resume": (("paused",), "running"),
+    "cancel": (("new", "running", "paused"), "cancelled"),
+}
+_broadcast_worker = f"{os.getpid()}-{random.getrandbits(32):08x}"
 
-    author_str = ""
-    if anonymous == 0:
-        try:
-            info = bot.get_chat(user_id)
-            if getattr(info, "username", None):
-                author_str = f"Автор: @{info.username}\n\n"
-            else:
-                name = (getattr(info, "first_name", "") or "") + (" " + getattr(info, "last_name", "") if getattr(info, "last_name", None) else "")
-                author_str = f"Автор: {name}\n\n"
-        except:
-            author_str = ""
+def _recipients_sql(ph):
+    return (f"SELECT user_id FROM submissions WHERE target_channel_dbid = {ph} AND user_id > {ph} "
+            f"UNION SELECT user_id FROM submissions_archive WHERE target_channel_dbid = {ph} AND user_id > {ph}")
+
+def broadcast_recipients(channel_dbid, after_user_id, limit):
+    ph = '%s' if USE_PG else '?'
+    c = db.cursor()
+    try:
+        c.execute(f"SELECT user_id FROM ({_recipients_sql(ph)}) u WHERE user_id NOT IN (SELECT user_id FROM bans WHERE channel_dbid = {ph}) ORDER BY user_id LIMIT {ph}",
+                  (channel_dbid, after_user_id, channel_dbid, after_user_id, channel_dbid, limit))
+        return [r[0] for r in c.fetchall()]
+    finally:
+        c.close()
+
+def count_broadcast_recipients(channel_dbid):
+    ph = '%s' if USE_PG else '?'
+    c = db.cursor()
+    try:
+        c.execute(f"SELECT COUNT(*) FROM ({_recipients_sql(ph)}) u WHERE user_id NOT IN (SELECT user_id FROM bans WHERE channel_dbid = {ph})",
+                  (channel_dbid, 0, channel_dbid, 0, channel_dbid))
+        return c.fetchone()[0]
+    finally:
+        c.close()
+
+def create_broadcast_job(channel_dbid, owner_id, text):
+    # -> id новой задачи; None — у канала уже есть незавершённая (idx_broadcast_jobs_active)
+    ts = now_ts()
+    total = count_broadcast_recipients(channel_dbid)
+    c = db.cursor()
+    try:
+        if USE_PG:
+            try:
+                c.execute("INSERT INTO broadcast_jobs (channel_dbid, owner_id, text, status, total, created_at, updated_at) VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id", (channel_dbid, owner_id, text, "new", total, ts, ts))
+                job_id = c.fetchone()[0]
+            except psycopg2.IntegrityError:
+                db.rollback()
+                return None
+        else:
+            try:
+                c.execute("INSERT INTO broadcast_jobs (channel_dbid, owner_id, text, status, total, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)", (channel_dbid, owner_id, text, "new", total, ts, ts))
+                job_id = c.lastrowid
+            except sqlite3.IntegrityError:
+                db.rollback()
+                return None
+        db.commit()
+        return job_id
+    finally:
+        c.close()
+
+def get_broadcast_job(job_id):
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute(f"SELECT {BROADCAST_COLUMNS} FROM broadcast_jobs WHERE id = %s", (job_id,))
+        else:
+            c.execute(f"SELECT {BROADCAST_COLUMNS} FROM broadcast_jobs WHERE id = ?", (job_id,))
+        return c.fetchone()
+    finally:
+        c.close()
+
+def active_broadcast_job(channel_dbid):
+    # последняя незавершённая рассылка канала (у канала одновременно может быть только одна)
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute(f"SELECT {BROADCAST_COLUMNS} FROM broadcast_jobs WHERE channel_dbid = %s AND status IN ('new', 'running', 'paused') ORDER BY id DESC LIMIT 1", (channel_dbid,))
+        else:
+            c.execute(f"SELECT {BROADCAST_COLUMNS} FROM broadcast_jobs WHERE channel_dbid = ? AND status IN ('new', 'running', 'paused') ORDER BY id DESC LIMIT 1", (channel_dbid,))
+        return c.fetchone()
+    finally:
+        c.close()
 
-    target = channel_id
+def set_broadcast_progress_message(job_id, chat_id, message_id):
+    c = db.cursor()
     try:
-        if content_type == 'text':
-            bot.send_message(target, author_str + (text_content or ""))
-        elif content_type == 'photo':
-            bot.send_photo(target, file_id, caption=(author_str + (text_content or "")))
-        elif content_type == 'video':
-            bot.send_video(target, file_id, caption=(author_str + (text_content or "")))
-        elif content_type == 'document':
-            bot.send_document(target, file_id, caption=(author_str + (text_content or "")))
-        # mark as published
-        set_submission_status(sub_id, "published", moderator_id=requester_id)
-        # set cooldown for this user-channel
-        set_cooldown(user_id, chan_dbid, now_ts())
-        # notify requester (moderator) and author
-        bot.send_message(requester_id, f"✅ Заявка #{sub_id} опубликована в {title or channel_id}.")
-        try:
-            bot.send_message(user_id, f"✅ Ваше сообщение #{sub_id} опубликовано в канал *{title or channel_id}*.", parse_mode="Markdown")
-        except:
-            pass
-    except Exception as e:
-        bot.send_message(requester_id, f"Ошибка при публикации: {e}\nУбедитесь, что бот админ в канале и имеет права на отправку сообщений.")
+        if USE_PG:
+            c.execute("UPDATE broadcast_jobs SET progress_chat_id = %s, progress_message_id = %s WHERE id = %s", (chat_id, message_id, job_id))
+        else:
+            c.execute("UPDATE broadcast_jobs SET progress_chat_id = ?, progress_message_id = ? WHERE id = ?", (chat_id, message_id, job_id))
+        db.commit()
+    finally:
+        c.close()
 
-# ========== SEND REPLY TO AUTHOR ==========
-def send_reply_to_author(message, sub_id):
-    state = pop_state(message.from_user.id)
+def transition_broadcast_job(job_id, action):
+    # CAS по статусу, как у заявок; -> True, если переход выполнен
+    from_statuses, to_status = BROADCAST_ACTIONS[action]
+    ph = '%s' if USE_PG else '?'
+    c = db.cursor()
     try:
-        sub = get_submission(sub_id)
-        if not sub:
-            bot.send_message(message.from_user.id, "Заявка не найдена."); return
-        user_id = sub[1]
-        bot.send_message(user_id, f"✉️ Ответ модератора по заявке #{sub_id}:\n\n{message.text}")
-        bot.send_message(message.from_user.id, "Ответ отправлен.")
-        # логируем действие reply
-        try:
+        c.execute(f"UPDATE broadcast_jobs SET status = {ph}, updated_at = {ph} WHERE id = {ph} AND status IN ({','.join(ph for _ in from_statuses)})",
+                  (to_status, now_ts(), job_id, *from_statuses))
+        won = c.rowcount == 1
+        db.commit()
+        return won
+    finally:
+        c.close()
+
+def claim_broadcast_job():
+    # берём одну идущую рассылку, аренда которой свободна или уже наша; -> строка задачи или None
+    ts = now_ts()
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("SELECT id FROM broadcast_jobs WHERE status = 'running' AND (lease_until < %s OR lease_owner = %s) ORDER BY id LIMIT 1", (ts, _broadcast_worker))
+        else:
+            c.execute("SELECT id FROM broadcast_jobs WHERE status = 'running' AND (lease_until < ? OR lease_owner = ?) ORDER BY id LIMIT 1", (ts, _broadcast_worker))
+        row = c.fetchone()
+        if not row:
+            db.commit()
+            return None
+        if USE_PG:
+            c.execute("UPDATE broadcast_jobs SET lease_owner = %s, lease_until = %s WHERE id = %s AND status = 'running' AND (lease_until < %s OR lease_owner = %s)", (_broadcast_worker, ts + BROADCAST_LEASE_SECONDS, row[0], ts, _broadcast_worker))
+        else:
+            c.execute("UPDATE broadcast_jobs SET lease_owner = ?, lease_until = ? WHERE id = ? AND status = 'running' AND (lease_until < ? OR lease_owner = ?)", (_broadcast_worker, ts + BROADCAST_LEASE_SECONDS, row[0], ts, _broadcast_worker))
+        won = c.rowcount == 1
+        db.commit()
+    finally:
+        c.close()
+    return get_broadcast_job(row[0]) if won else None
+
+def checkpoint_broadcast_job(job_id, last_user_id, sent, failed, finished=False):
+    # сохраняет позицию и счётчики, продлевает аренду; -> текущий статус или None, если аренда потеряна
+    ts = now_ts()
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("UPDATE broadcast_jobs SET last_user_id = %s, sent = sent + %s, failed = failed + %s, updated_at = %s, lease_until = %s WHERE id = %s AND lease_owner = %s",
+                      (last_user_id, sent, failed, ts, ts + BROADCAST_LEASE_SECONDS, job_id, _broadcast_worker))
+        else:
+            c.execute("UPDATE broadcast_jobs SET last_user_id = ?, sent = sent + ?, failed = failed + ?, updated_at = ?, lease_until = ? WHERE id = ? AND lease_owner = ?",
+                      (last_user_id, sent, failed, ts, ts + BROADCAST_LEASE_SECONDS, job_id, _broadcast_worker))
+        if c.rowcount != 1:
+            db.commit()
+            return None
+        if finished:
             if USE_PG:
-                cur.execute("INSERT INTO submission_actions (submission_id, moderator_id, action, note, created_at) VALUES (%s, %s, %s, %s, %s)", (sub_id, message.from_user.id, 'reply', message.text or '', now_ts()))
-                db.commit()
+                c.execute("UPDATE broadcast_jobs SET status = 'done' WHERE id = %s AND status = 'running'", (job_id,))
             else:
-                cur.execute("INSERT INTO submission_actions (submission_id, moderator_id, action, note, created_at) VALUES (?, ?, ?, ?, ?)", (sub_id, message.from_user.id, 'reply', message.text or '', now_ts()))
-                db.commit()
-        except Exception:
-            pass
-    except Exception:
-        bot.send_message(message.from_user.id, "Не удалось отправить ответ (возможно, пользователь закрыл диалог).")
+                c.execute("UPDATE broadcast_jobs SET status = 'done' WHERE id = ? AND status = 'running'", (job_id,))
+        if USE_PG:
+            c.execute("SELECT status FROM broadcast_jobs WHERE id = %s", (job_id,))
+        else:
+            c.execute("SELECT status FROM broadcast_jobs WHERE id = ?", (job_id,))
+        status = c.fetchone()[0]
+        db.commit()
+        return status
+    finally:
+        c.close()
 
-# ========== PROMO PREPARE (owner posts a ready message with bot link) ==========
-@bot.callback_query_handler(func=lambda cq: cq.data and cq.data.startswith("promo_prepare:"))
-def cq_promo_prepare(cq):
-    bot.answer_callback_query(cq.id)
-    dbid = int(cq.data.split(":",1)[1])
-    ch = get_channel_by_dbid(dbid)
-    if not ch:
-        bot.send_message(cq.from_user.id, "Канал не найден."); return
-    _, owner_id, channel_id, title = ch
-    if cq.from_user.id != owner_id:
-        bot.send_message(cq.from_user.id, "Эту операцию может выполнять только владелец канала."); return
-    bot_link = f"https://t.me/{BOT_USERNAME}?start=post_{dbid}" if BOT_USERNAME else None
-    text = f"📣 Хотите отправить пост в канал *{title or channel_id}*? Нажмите кнопку и предложите пост через бота — он попадёт на модерацию."
+def release_broadcast_job(job_id):
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("UPDATE broadcast_jobs SET lease_owner = NULL, lease_until = 0 WHERE id = %s AND lease_owner = %s", (job_id, _broadcast_worker))
+        else:
+            c.execute("UPDATE broadcast_jobs SET lease_owner = NULL, lease_until = 0 WHERE id = ? AND lease_owner = ?", (job_id, _broadcast_worker))
+        db.commit()
+    finally:
+        c.close()
+
+def render_broadcast(job):
+    job_id, dbid, owner_id, text, status, total, sent, failed = job[:8]
+    done = sent + failed
+    percent = done * 100 // total if total else 100
+    lines = [f"📣 Рассылка #{job_id} — {BROADCAST_STATUS_LABELS.get(status, status)}",
+             f"Получателей: {total}",
+             f"Отправлено: {sent}, не доставлено: {failed} ({percent}%)",
+             "", (text or "")[:300]]
     kb = types.InlineKeyboardMarkup()
-    if bot_link:
-        kb.add(types.InlineKeyboardButton("Предложить пост", url=bot_link))
+    if status == "new":
+        kb.row(types.InlineKeyboardButton("▶️ Начать", callback_data=f"bcast:start:{job_id}"),
+               types.InlineKeyboardButton("✖️ Отменить", callback_data=f"bcast:cancel:{job_id}"))
+    elif status == "running":
+        kb.row(types.InlineKeyboardButton("⏸ Пауза", callback_data=f"bcast:pause:{job_id}"),
+               types.InlineKeyboardButton("🔄", callback_data=f"bcast:show:{job_id}"),
+               types.InlineKeyboardButton("✖️ Отменить", callback_data=f"bcast:cancel:{job_id}"))
+    elif status == "paused":
+        kb.row(types.InlineKeyboardButton("▶️ Продолжить", callback_data=f"bcast:resume:{job_id}"),
+               types.InlineKeyboardButton("✖️ Отменить", callback_data=f"bcast:cancel:{job_id}"))
+    return "\n".join(lines), kb
+
+def update_broadcast_progress(job_id):
+    job = get_broadcast_job(job_id)
+    if not job or not job[9]:
+        return
+    text, kb = render_broadcast(job)
     try:
-        # try to send using numeric id or username
+        bot.edit_message_text(text, job[9], job[10], reply_markup=kb)
+    except telebot.apihelper.ApiTelegramException as e:
+        if "message is not modified" not in str(e.description):
+            logger.info("Не удалось обновить прогресс рассылки #%s: %s", job_id, e.description)
+    except Exception:
+        logger.warning("Не удалось обновить прогресс рассылки #%s", job_id)
+
+def wait_bulk_send_slot():
+    # лимит массовых отправок (рассылки, уведомления обслуживания) — у каждого бота свой, как и у Telegram
+    while not _take(f"broadcast:{current_bot_id()}", BROADCAST_RATE, max(1.0, BROADCAST_RATE), time.time()):
+        time.sleep(1 / BROADCAST_RATE)
+
+def _broadcast_send(user_id, text):
+    # -> True — доставлено, False — получатель недоступен насовсем; прочие ошибки пробрасываются
+    # (сетевые сбои и короткие 429 транспорт уже повторил сам, долгий retry_after пережидаем здесь — это фон)
+    while True:
+        wait_bulk_send_slot()
         try:
-            bot.send_message(channel_id, text, parse_mode="Markdown", reply_markup=kb)
-        except Exception:
-            # maybe stored channel_id is @username, resolve and send
-            if str(channel_id).startswith('@'):
-                try:
-                    bot.send_message(channel_id, text, parse_mode="Markdown", reply_markup=kb)
-                except Exception as e:
-                    raise e
-        bot.send_message(cq.from_user.id, "Готовое сообщение отправлено в канал.", reply_markup=channels_menu())
-    except Exception as e:
-        bot.send_message(cq.from_user.id, f"Ошибка при отправке в канал: {e}", reply_markup=channels_menu())
+            bot.send_message(user_id, text)
+            return True
+        except telebot.apihelper.ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = ((e.result_json or {}).get("parameters") or {}).get("retry_after", 1)
+                time.sleep(min(60, retry_after))
+                continue
+            if e.error_code in (400, 403):
+                metric_inc("broadcast_undeliverable")
+                return False
+            raise
 
-# ========== DELETE CHANNEL ==========
-@bot.callback_query_handler(func=lambda cq: cq.data and cq.data.startswith("delete:"))
-def cq_delete(cq):
-    bot.answer_callback_query(cq.id)
-    dbid = int(cq.data.split(":",1)[1])
+def run_broadcast_job(job):
+    job_id, dbid, text, position = job[0], job[1], job[3], job[8]
     ch = get_channel_by_dbid(dbid)
-    if not ch:
-        bot.send_message(cq.from_user.id, "Канал не найден."); return
-    _, owner_id, _, title = ch
-    if cq.from_user.id != owner_id:
-        bot.send_message(cq.from_user.id, "Удалять канал может только его владелец."); return
-    kb = types.InlineKeyboardMarkup(row_width=2)
-    kb.add(types.InlineKeyboardButton("✅ Да, удалить", callback_data=f"delete_yes:{dbid}"),
-           types.InlineKeyboardButton("❌ Отмена", callback_data="my_channels"))
-    bot.send_message(cq.from_user.id, f"Вы действительно хотите удалить канал *{title or ''}*?", parse_mode="Markdown", reply_markup=kb)
+    body = f"📣 {(ch[3] or ch[2]) if ch else dbid}:\n\n{text}"
+    sent = failed = 0
+    last_progress = time.monotonic()
+    while True:
+        recipients = broadcast_recipients(dbid, position, BROADCAST_BATCH)
+        if not recipients:
+            checkpoint_broadcast_job(job_id, position, sent, failed, finished=True)
+            release_broadcast_job(job_id)
+            update_broadcast_progress(job_id)
+            logger.info("Рассылка #%s завершена", job_id)
+            return
+        for user_id in recipients:
+            try:
+                delivered = _broadcast_send(user_id, body)
+            except Exception:
+                # прогресс до этого получателя сохраняем, аренду отпускаем — продолжит следующий проход
+                checkpoint_broadcast_job(job_id, position, sent, failed)
+                release_broadcast_job(job_id)
+                raise
+            if delivered:
+                sent += 1
+            else:
+                failed += 1
+            position = user_id
+            if sent + failed < BROADCAST_CHECKPOINT_EVERY:
+                continue
+            metric_inc("broadcast_sent", sent)
+            status = checkpoint_broadcast_job(job_id, position, sent, failed)
+            sent = failed = 0
+            if status != "running":
+                # пауза / отмена владельцем или аренду перехватил другой воркер
+                if status is not None:
+                    release_broadcast_job(job_id)
+                    update_broadcast_progress(job_id)
+                return
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                update_broadcast_progress(job_id)
+                last_progress = time.monotonic()
 
-@bot.callback_query_handler(func=lambda cq: cq.data and cq.data.startswith("delete_yes:"))
-def cq_delete_yes(cq):
-    bot.answer_callback_query(cq.id)
-    dbid = int(cq.data.split(":",1)[1])
-    ch = get_channel_by_dbid(dbid)
-    if not ch:
-        bot.send_message(cq.from_user.id, "Канал не найден."); return
-    if cq.from_user.id != ch[1]:
-        bot.send_message(cq.from_user.id, "Удалять канал может только владелец."); return
-    remove_channel(dbid)
-    bot.send_message(cq.from_user.id, "Канал удалён.", reply_markup=main_menu())
+def run_broadcasts():
+    while True:
+        job = claim_broadcast_job()
+        if job is None:
+            return
+        with channel_tenant(job[1]):
+            run_broadcast_job(job)
 
-# ========== Бан пользователя для канала (owner только) ==========
-@bot.message_handler(commands=['ban'])
-def cmd_ban(message):
-    # формат: /ban <channel_dbid> <user_id>
-    parts = (message.text or "").split()
-    if len(parts) != 3:
-        bot.send_message(message.chat.id, "Использование: /ban <channel_dbid> <user_id>")
+@bot.message_handler(commands=['broadcast'])
+def cmd_broadcast(message):
+    # формат: /broadcast <channel_dbid> [текст]; без текста — показать текущую рассылку канала
+    parts = (message.text or "").split(maxsplit=2)
+    if len(parts) < 2:
+        bot.send_message(message.chat.id, "Использование: /broadcast <channel_dbid> <текст объявления>")
         return
     try:
-        dbid = int(parts[1]); uid = int(parts[2])
-    except:
+        dbid = int(parts[1])
+    except ValueError:
         bot.send_message(message.chat.id, "Неверные аргументы.")
         return
-    ch = get_channel_by_dbid(dbid)
-    if not ch:
-        bot.send_message(message.chat.id, "Канал не найден.")
+    if not is_channel_owner(dbid, message.from_user.id):
+        bot.send_message(message.chat.id, "Только владелец канала может делать рассылки.")
         return
-    if message.from_user.id != ch[1]:
-        bot.send_message(message.chat.id, "Только владелец канала может банить пользователей.")
+    job = active_broadcast_job(dbid)
+    if len(parts) == 3 and not job:
+        if len(parts[2]) > 4000:
+            bot.send_message(message.chat.id, "Слишком длинный текст (не больше 4000 символов).")
+            return
+        job_id = create_broadcast_job(dbid, message.from_user.id, parts[2])
+        if job_id is not None:
+            text, kb = render_broadcast(get_broadcast_job(job_id))
+            sent = bot.send_message(message.chat.id, text, reply_markup=kb)
+            set_broadcast_progress_message(job_id, message.chat.id, sent.message_id)
+            return
+        # параллельная команда успела создать свою рассылку первой
+        job = active_broadcast_job(dbid)
+    if not job:
+        bot.send_message(message.chat.id, "Активных рассылок нет.")
         return
-    res = add_ban(dbid, uid, message.from_user.id)
-    bot.send_message(message.chat.id, "Пользователь заблокирован для этого канала." if res else "Пользователь уже заблокирован.")
+    if len(parts) == 3:
+        bot.send_message(message.chat.id, "У канала уже есть незавершённая рассылка — завершите или отмените её.")
+    text, kb = render_broadcast(job)
+    sent = bot.send_message(message.chat.id, text, reply_markup=kb)
+    set_broadcast_progress_message(job[0], message.chat.id, sent.message_id)
 
-@bot.message_handler(commands=['unban'])
-def cmd_unban(message):
-    # формат: /unban <channel_dbid> <user_id>
-    parts = (message.text or "").split()
-    if len(parts) != 3:
-        bot.send_message(message.chat.id, "Использование: /unban <channel_dbid> <user_id>")
-        return
+@bot.callback_query_handler(func=lambda cq: cq.data and cq.data.startswith("bcast:"))
+def cq_broadcast(cq):
     try:
-        dbid = int(parts[1]); uid = int(parts[2])
-    except:
-        bot.send_message(message.chat.id, "Неверные аргументы.")
-        return
-    ch = get_channel_by_dbid(dbid)
-    if not ch:
-        bot.send_message(message.chat.id, "Канал не найден.")
+        _, action, job_id = cq.data.split(":")
+        job_id = int(job_id)
+    except ValueError:
+        bot.answer_callback_query(cq.id, "Ошибка.")
         return
-    if message.from_user.id != ch[1]:
-        bot.send_message(message.chat.id, "Только владелец канала может снимать блокировку.")
+    job = get_broadcast_job(job_id)
+    if not job or not is_channel_owner(job[1], cq.from_user.id):
+        bot.answer_callback_query(cq.id, "Нет доступа.")
         return
-    remove_ban(dbid, uid)
-    bot.send_message(message.chat.id, "Пользователь разблокирован.")
+    if action in BROADCAST_ACTIONS and not transition_broadcast_job(job_id, action):
+        bot.answer_callback_query(cq.id, "Статус рассылки уже изменился.")
+    else:
+        bot.answer_callback_query(cq.id)
+    set_broadcast_progress_message(job_id, cq.message.chat.id, cq.message.message_id)
+    text, kb = render_broadcast(get_broadcast_job(job_id))
+    nav_reply(cq, text, reply_markup=kb)
 
-# ========== UNIVERSAL CANCEL ==========
-@bot.callback_query_handler(func=lambda cq: cq.data == "cancel")
-def cq_cancel(cq):
-    bot.answer_callback_query(cq.id, "Действие отменено.")
-    pop_state(cq.from_user.id)
-    bot.send_message(cq.from_user.id, "Действие отменено.", reply_markup=main_menu())
+# ========== ОБСЛУЖИВАНИЕ БД ==========
+# Раз в MAINTENANCE_INTERVAL один из воркеров (CAS по maintenance_runs) закрывает давние pending-заявки
+# статусом expired, удаляет брошенные user_states и отжившие cooldowns — порциями, каждая своей
+# короткой транзакцией. Авторам истёкших заявок уходит одно сообщение на автора через общий лимит
+# рассылок. В окно MAINTENANCE_HOURS раз в сутки — ANALYZE и VACUUM (SQLite — incremental_vacuum).
+# Итог каждой задачи (строк и секунд) пишется в лог, метрики и maintenance_runs.
+def claim_maintenance(task, min_interval):
+    # -> True, если задачу сейчас выполняет этот воркер
+    ts = now_ts()
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("INSERT INTO maintenance_runs (task) VALUES (%s) ON CONFLICT (task) DO NOTHING", (task,))
+            c.execute("UPDATE maintenance_runs SET last_run_at = %s WHERE task = %s AND last_run_at <= %s", (ts, task, ts - min_interval))
+        else:
+            c.execute("INSERT OR IGNORE INTO maintenance_runs (task) VALUES (?)", (task,))
+            c.execute("UPDATE maintenance_runs SET last_run_at = ? WHERE task = ? AND last_run_at <= ?", (ts, task, ts - min_interval))
+        won = c.rowcount == 1
+        db.commit()
+        return won
+    finally:
+        c.close()
 
-# ========== UNEXPECTED INPUT HANDLER (when in state) ==========
-@bot.message_handler(func=lambda m: get_state(m.from_user.id) is not None)
-def handle_unexpected_input(m):
-    st = get_state(m.from_user.id)
-    bot.send_message(m.chat.id, "Я сейчас ожидаю конкретные данные — либо отправь их, либо нажми «Отмена». Для возврата в меню напиши /menu", reply_markup=types.ReplyKeyboardRemove())
+def record_maintenance(task, rows, seconds):
+    ts = now_ts()
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("INSERT INTO maintenance_runs (task, last_run_at, rows_processed, seconds) VALUES (%s, %s, %s, %s) ON CONFLICT (task) DO UPDATE SET last_run_at = EXCLUDED.last_run_at, rows_processed = EXCLUDED.rows_processed, seconds = EXCLUDED.seconds", (task, ts, rows, seconds))
+        else:
+            c.execute("INSERT OR REPLACE INTO maintenance_runs (task, last_run_at, rows_processed, seconds) VALUES (?, ?, ?, ?)", (task, ts, rows, seconds))
+        db.commit()
+    finally:
+        c.close()
+    metric_observe("maintenance_" + task, seconds)
+    if rows:
+        metric_inc("maintenance_rows_" + task, rows)
+    logger.info("Обслуживание %s: %s строк за %.2f сек", task, rows, seconds)
 
-# ========== DEFAULT PRIVATE MESSAGE HANDLER ==========
-@bot.message_handler(func=lambda m: (m.chat.type == 'private') and (get_state(m.from_user.id) is None) and (m.text is not None) and (not m.text.startswith('/')) , content_types=['text'])
-def handle_private_default(m):
-    bot.send_message(m.chat.id, "Чтобы войти в меню напишите /start")
+def _expire_pending_batch(cutoff, limit):
+    # -> [(sub_id, user_id, channel_dbid, created_at)] заявок, которые закрыл именно этот вызов
+    ts = now_ts()
+    c = db.cursor()
+    try:
+        if USE_PG:
+            c.execute("UPDATE submissions SET status = 'expired' WHERE id IN (SELECT id FROM submissions WHERE status = 'pending' AND created_at < %s ORDER BY created_at LIMIT %s FOR UPDATE SKIP LOCKED) AND status = 'pending' "
+                      "RETURNING id, user_id, target_channel_dbid, created_at", (cutoff, limit))
+            expired = c.fetchall()
+        else:
+            c.execute("SELECT id, user_id, target_channel_dbid, created_at FROM submissions WHERE status = 'pending' AND created_at < ? ORDER BY created_at LIMIT ?", (cutoff, limit))
+            expired = []
+            for row in c.fetchall():
+                # CAS поштучно: заявку могли принять между выборкой и обновлением
+                c.execute("UPDATE submissions SET status = 'expired' WHERE id = ? AND status = 'pending'", (row[0],))
+                if c.rowcount == 1:
+                    expired.append(row)
+        db.commit()
+        audit_log.log_many([(r[0], None, "expired", "", ts) for r in expired])
+        return expired
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        c.close()
 
-# ========== Показать pending заявки для модератора ==========
-@bot.message_handler(commands=['pending'])
-def cmd_pending(message):
-    uid = message.from_user.id
-    # найдем все каналы, где пользователь модератор или владелец
+def expire_pending_submissions(budget):
+    if PENDING_EXPIRE_DAYS <= 0:
+        return 0
+    cutoff = now_ts() - PENDING_EXPIRE_DAYS * 86400
+    if EXPIRE_NOTIFY_MAX > 0:
+        # каждая закрытая заявка — отправки; остаток дождётся следующего прохода, оставаясь pending
+        budget = min(budget, EXPIRE_NOTIFY_MAX)
+    expired = []
+    while len(expired) < budget:
+        batch = _expire_pending_batch(cutoff, min(MAINTENANCE_BATCH, budget - len(expired)))
+        if not batch:
+            break
+        for sub_id, user_id, dbid, created_at in batch:
+            prefetch_invalidate("submissions", sub_id)
+            release_assignment(sub_id)
+        expired.extend(batch)
+    if expired:
+        notify_expired_submissions(expired, cutoff - EXPIRE_EDIT_DAYS * 86400)
+    return len(expired)
+
+def notify_expired_submissions(expired, edit_since):
+    # модераторам — итог в контрольных сообщениях (созданных не раньше edit_since), авторам — одно сообщение
+    # на автора; (бот канала, автор) -> заявки: автору пишет тот бот, через которого он отправлял
+    by_author = {}
+    titles = {}
+    for sub_id, user_id, dbid, created_at in expired:
+        b = channel_bot(dbid)
+        by_author.setdefault((b, user_id), []).append((sub_id, dbid))
+        with use_tenant(b):
+            if dbid not in titles:
+                ch = get_channel_by_dbid(dbid)
+                titles[dbid] = (ch[3] or ch[2]) if ch else str(dbid)
+            if (created_at or 0) >= edit_since:
+                wait_bulk_send_slot()
+                sync_control_messages(sub_id, "expired", None)
+    for (b, user_id), items in by_author.items():
+        lines = [f"⌛ Заявки не были рассмотрены за {PENDING_EXPIRE_DAYS} дн. и закрыты:"]
+        lines += [f"#{sub_id} — {titles[dbid]}" for sub_id, dbid in items[:20]]
+        if len(items) > 20:
+            lines.append(f"… и ещё {len(items) - 20}")
+        lines.append("Их можно отправить заново.")
+        try:
+            with use_tenant(b):
+                _broadcast_send(user_id, "\n".join(lines))
+        except Exception:
+            logger.warning("Не удалось уведомить автора %s об истёкших заявках", user_id)
+
+def _purge_batches(table, key, where, params, budget):
+    # DELETE порциями по ключу (в том числе составному: "bot_id, user_id"); -> число удалённых строк
+    ph = '%s' if USE_PG else '?'
+    deleted = 0
+    while deleted < budget:
+        limit = min(MAINTENANCE_BATCH, budget - deleted)
+        c = db.cursor()
+        try:
+            c.execute(f"DELETE FROM {table} WHERE ({key}) IN (SELECT {key} FROM {table} WHERE {where.format(ph=ph)} LIMIT {ph})", (*params, limit))
+            n = c.rowcount
+            db.commit()
+        finally:
+            c.close()
+        deleted += n
+        if n < limit:
+            break
+    return deleted
+
+def expire_user_states(budget):
+    # брошенные диалоги: например, awaiting_submission:* от тех, кто так ничего и не прислал
+    return _purge_batches("user_states", "bot_id, user_id", "updated_at < {ph}", (now_ts() - STATE_EXPIRE_SECONDS,), budget)
+
+def expire_cooldowns(budget):
+    # cooldown старше COOLDOWN_SECONDS уже ничего не ограничивает — отсутствие строки означает то же самое
+    return _purge_batches("cooldowns", "id", "last_ts < {ph}", (now_ts() - COOLDOWN_SECONDS,), budget)
+
+def in_maintenance_window():
+    try:
+        start, end = (int(h) % 24 for h in MAINTENANCE_HOURS.split("-"))
+    except ValueError:
+        return False
+    hour = time.gmtime().tm_hour
+    return start <= hour < end if start <= end else (hour >= start or hour < end)
+
+def vacuum_database():
+    # VACUUM не работает внутри транзакции — отдельное соединение в autocommit
     if USE_PG:
-        cur.execute("SELECT channel_dbid FROM channel_admins WHERE admin_user_id = %s", (uid,))
-        admin_rows = [r[0] for r in cur.fetchall()]
-        cur.execute("SELECT id FROM channels WHERE owner_id = %s", (uid,))
-        owner_rows = [r[0] for r in cur.fetchall()]
-    else:
-        cur.execute("SELECT channel_dbid FROM channel_admins WHERE admin_user_id = ?", (uid,))
-        admin_rows = [r[0] for r in cur.fetchall()]
-        cur.execute("SELECT id FROM channels WHERE owner_id = ?", (uid,))
-        owner_rows = [r[0] for r in cur.fetchall()]
-    watch_dbids = set(admin_rows + owner_rows)
-    if not watch_dbids:
-        bot.send_message(uid, "Вы не модератор и не владелец ни одного канала.")
+        conn = pg_connect()
+        try:
+            conn.autocommit = True
+            c = conn.cursor()
+            for table in ("submissions", "submission_actions", "submission_messages", "submission_assignments", "user_states", "cooldowns"):
+                c.execute(f"VACUUM (ANALYZE) {table}")
+        finally:
+            conn.close()
         return
-    # получить pending заявки для этих каналов
-    placeholders = ','.join('%s' for _ in watch_dbids) if USE_PG else ','.join('?' for _ in watch_dbids)
-    query = f"SELECT id, user_id, content_type, text_content, file_id, created_at, anonymous, target_channel_dbid FROM submissions WHERE status = 'pending' AND target_channel_dbid IN ({placeholders}) ORDER BY created_at DESC"
-    cur.execute(query, tuple(watch_dbids))
-    rows = cur.fetchall()
-    if not rows:
-        bot.send_message(uid, "Нет ожидающих заявок.")
+    conn = sqlite3.connect(DB_PATH, timeout=60, isolation_level=None)
+    try:
+        # полный VACUUM здесь не делаем: база без incremental vacuum переводится при старте процесса
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            conn.execute("PRAGMA incremental_vacuum")
+        conn.execute("ANALYZE")
+    finally:
+        conn.close()
+
+def run_maintenance():
+    if not claim_maintenance("sweep", MAINTENANCE_INTERVAL // 2):
         return
-    for r in rows[:20]:  # ограничим вывод
-        sid, user_id, ctype, txt, fid, created_at, anon, tdb = r
-        title = f"Заявка #{sid} — {'анонимно' if anon else 'неанонимно'} — канал {tdb}"
-        if ctype == 'text':
-            bot.send_message(uid, f"{title}\n\n{(txt or '')[:1000]}", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("✅ Принять", callback_data=f"accept:{sid}"), types.InlineKeyboardButton("❌ Отклонить", callback_data=f"reject:{sid}"), types.InlineKeyboardButton("✉️ Ответить автору", callback_data=f"reply:{sid}")))
-        else:
-            bot.send_message(uid, f"{title}\nТип: {ctype}\nID файла: {fid}", reply_markup=types.InlineKeyboardMarkup().add(types.InlineKeyboardButton("✅ Принять", callback_data=f"accept:{sid}"), types.InlineKeyboardButton("❌ Отклонить", callback_data=f"reject:{sid}"), types.InlineKeyboardButton("✉️ Ответить автору", callback_data=f"reply:{sid}")))
+    for task, fn in (("expire_pending", expire_pending_submissions), ("expire_states", expire_user_states), ("expire_cooldowns", expire_cooldowns)):
+        t0 = time.perf_counter()
+        rows = fn(MAINTENANCE_MAX_ROWS)
+        record_maintenance(task, rows, time.perf_counter() - t0)
+    if in_maintenance_window() and claim_maintenance("vacuum", 20 * 3600):
+        t0 = time.perf_counter()
+        vacuum_database()
+        record_maintenance("vacuum", 0, time.perf_counter() - t0)
 
-# ========== WEBHOOK: Flask-приложение для Telegram ==========
-app = Flask(__name__)
+# ========== ФОНОВЫЕ ЗАДАЧИ ==========
+def run_periodic(name, interval, fn):
+    # простой планировщик: отдельный daemon-поток на задачу
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                fn()
+            except CircuitOpenError as e:
+                logger.warning("Фоновая задача %s пропущена: %s", name, e)
+            except Exception:
+                logger.exception("Фоновая задача %s завершилась с ошибкой", name)
+    t = threading.Thread(target=loop, name=name, daemon=True)
+    t.start()
+    return t
 
-# health check
-@app.route("/", methods=["GET"])
-def index():
-    return "OK", 200
+def start_background_jobs():
+    if not BACKGROUND_JOBS:
+        return
+    run_periodic("reassign", ASSIGN_CHECK_INTERVAL, reassign_stale_submissions)
+    run_periodic("digests", DIGEST_CHECK_INTERVAL, send_digests)
+    if FLOOD_SHARED:
+        run_periodic("rate-buckets-cleanup", 600, cleanup_rate_buckets)
+    run_periodic("retention", RETENTION_INTERVAL, sweep_retention)
+    run_periodic("stats-check", STATS_CHECK_INTERVAL, check_channel_stats)
+    run_periodic("broadcasts", BROADCAST_POLL_INTERVAL, run_broadcasts)
+    run_periodic("maintenance", MAINTENANCE_INTERVAL, run_maintenance)
 
-WEBHOOK_PATH = f"/webhook/{TOKEN}"
+def start_fingerprint_index():
+    # индекс строится в фоне, чтобы не задерживать старт; до готовности работает только точный поиск по БД
+    def build():
+        try:
+            build_fingerprint_index()
+        except Exception:
+            logger.exception("Не удалось построить индекс отпечатков")
+            return
+        run_periodic("fingerprint-sync", CACHE_POLL_INTERVAL * 5, load_fingerprints)
+    threading.Thread(target=build, name="fingerprint-index", daemon=True).start()
 
-@app.route(WEBHOOK_PATH, methods=["POST"])
-def telegram_webhook():
-    if request.headers.get("content-type") == "application/json":
+def start_stats_backfill():
+    # свёртки для уже накопленных заявок — в фоне, один раз
+    if not BACKGROUND_JOBS:
+        return
+    def backfill():
         try:
-            json_string = request.get_data().decode("utf-8")
-            update = telebot.types.Update.de_json(json_string)
-            bot.process_new_updates([update])
-        except Exception as e:
-            logger.exception("Failed to process update: %s", e)
-            return "", 500
-        return "", 200
-    else:
-        return abort(403)
+            backfill_channel_stats()
+        except Exception:
+            logger.exception("Не удалось пересчитать статистику каналов")
+    threading.Thread(target=backfill, name="stats-backfill", daemon=True).start()
 
-def setup_webhook():
-    webhook_url = WEBHOOK_BASE.rstrip("/") + WEBHOOK_PATH
-    try:
-        logger.info("Removing old webhook (if any)...")
-        bot.remove_webhook()
-    except Exception:
-        pass
+def start_degraded_mode_jobs():
+    # проигрывание отложенного — в каждом процессе: spool-файл общий (его забирает один воркер), очередь своя
+    def recover():
+        replay_spooled_updates()
+        flush_deferred_calls()
+    run_periodic("degraded-recovery", SPOOL_REPLAY_INTERVAL, recover)
+
+# все обработчики зарегистрированы — раздаём реестр остальным ботам до того, как пойдут апдейты
+share_handlers()
+
+# Попытка установки webhook при импорте (gunicorn будет импортировать модуль)
+if RUN_MODE == "webhook":
     try:
-        logger.info("Setting webhook to: %s", webhook_url)
-        ok = bot.set_webhook(url=webhook_url)
-        if not ok:
-            logger.error("set_webhook returned False")
-        else:
-            logger.info("Webhook установлен успешно")
+        setup_webhook()
     except Exception as e:
-        logger.exception("Не удалось установить webhook: %s", e)
-        raise
+        logger.error("Ошибка при установке webhook: %s", e)
 
-# Попытка установки webhook при импорте (gunicorn будет импортировать модуль)
-try:
-    setup_webhook()
-except Exception as e:
-    logger.error("Ошибка при установке webhook: %s", e)
+start_invalidation_listener()
+start_replica_health_checks()
+audit_log.start()
+start_background_jobs()
+start_degraded_mode_jobs()
+start_fingerprint_index()
+start_stats_backfill()
 
 # ========== Запуск приложения (локально) ==========
 if __name__ == "__main__":
-    logger.info("Запуск Flask (local) на 0.0.0.0:%s", PORT)
-    app.run(host="0.0.0.0", port=PORT)
+    if RUN_MODE == "replay":
+        args = sys.argv[sys.argv.index("--replay") + 1:]
+        speed = 0.0
+        if "--speed" in args:
+            i = args.index("--speed")
+            speed = float(args[i + 1])
+            del args[i:i + 2]
+        print(json.dumps(replay_journal(args, speed), ensure_ascii=False, indent=2))
+    elif RUN_MODE == "polling":
+        run_polling()
+    else:
+        logger.info("Запуск Flask (local) на 0.0.0.0:%s", PORT)
+        app.run(host="0.0.0.0", port=PORT)
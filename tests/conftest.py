@@ -0,0 +1,138 @@
+# Общая обвязка тестов: main импортируется один раз на чистой SQLite-базе во временном каталоге,
+# Bot API подменён фейком, который записывает вызовы. Каналы и пользователи у каждого теста свои
+# (уникальные id), поэтому база между тестами не чистится.
+import itertools
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+import telebot
+from telebot import apihelper
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+WORKDIR = tempfile.mkdtemp(prefix="teleform-tests-")
+os.chdir(WORKDIR)
+for _name in ("DATABASE_URL", "DATABASE_REPLICA_URLS", "BOT_TOKENS", "UPDATE_JOURNAL_DIR", "PROFILE"):
+    os.environ.pop(_name, None)
+os.environ.update({
+    "BOT_TOKEN": "123456:TEST",
+    "BACKGROUND_JOBS": "0",
+    "CACHE_POLL_INTERVAL": "3600",
+    "FLOOD_CONTROL": "0",
+    # абсолютные пути: к концу сессии pytest возвращает исходный cwd
+    "SPOOL_PATH": os.path.join(WORKDIR, "teleform_spool.jsonl"),
+    "AUDIT_FALLBACK_PATH": os.path.join(WORKDIR, "teleform_audit.jsonl"),
+    "ARCHIVE_DB_PATH": os.path.join(WORKDIR, "teleform_archive.db"),
+})
+
+
+class FakeBotAPI:
+    def __init__(self):
+        self.calls = []
+        self.fail = {}
+        self._message_ids = itertools.count(1000)
+
+    def __call__(self, token, method_name, method="get", params=None, files=None):
+        params = dict(params or {})
+        self.calls.append((method_name, params))
+        handler = self.fail.get(method_name)
+        if handler is not None:
+            result = handler(params) if callable(handler) else handler
+            if isinstance(result, Exception):
+                raise result
+        if method_name == "getMe":
+            return {"id": 123456, "is_bot": True, "first_name": "B", "username": "testbot"}
+        if method_name in ("sendMessage", "sendPhoto", "sendVideo", "sendDocument", "forwardMessage",
+                           "editMessageText", "editMessageReplyMarkup"):
+            chat_id = str(params.get("chat_id", "0"))
+            return {"message_id": int(params.get("message_id") or next(self._message_ids)), "date": 0,
+                    "chat": {"id": int(chat_id) if chat_id.lstrip("-").isdigit() else 0, "type": "private"},
+                    "text": params.get("text", "")}
+        if method_name == "getChat":
+            chat_id = str(params.get("chat_id", "5"))
+            return {"id": int(chat_id) if chat_id.lstrip("-").isdigit() else 5, "type": "private", "first_name": "U"}
+        if method_name == "getUpdates":
+            return []
+        return True
+
+    def clear(self):
+        self.calls.clear()
+        self.fail.clear()
+
+    def methods(self):
+        return [c[0] for c in self.calls]
+
+    def sent_to(self, chat_id):
+        return [p.get("text") for m, p in self.calls if m == "sendMessage" and str(p.get("chat_id")) == str(chat_id)]
+
+
+FAKE_API = FakeBotAPI()
+apihelper._make_request = FAKE_API
+
+import main  # noqa: E402
+
+main.default_bot.threaded = False
+_ids = itertools.count(10_000)
+
+
+def new_id():
+    return next(_ids)
+
+
+@pytest.fixture(autouse=True, scope="session")
+def _close_audit_log():
+    # журнал действий дописывается до конца сессии: pytest потом возвращает cwd, а путь к базе относительный
+    yield
+    main.audit_log.close()
+
+
+@pytest.fixture
+def api():
+    FAKE_API.clear()
+    yield FAKE_API
+    FAKE_API.clear()
+
+
+@pytest.fixture
+def client():
+    return main.app.test_client()
+
+
+def post(client, update):
+    update.setdefault("update_id", new_id())
+    return client.post(main.WEBHOOK_PATH, data=json.dumps(update), content_type="application/json").status_code
+
+
+def msg(uid, text, chat_type="private"):
+    m = {"message_id": new_id(), "date": 0, "chat": {"id": uid, "type": chat_type},
+         "from": {"id": uid, "is_bot": False, "first_name": "u"}, "text": text}
+    if text.startswith("/"):
+        m["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": new_id(), "message": m}
+
+
+def cq(uid, data, text="Меню:", message_id=None):
+    return {"update_id": new_id(), "callback_query": {
+        "id": str(new_id()), "from": {"id": uid, "is_bot": False, "first_name": "u"}, "chat_instance": "1", "data": data,
+        "message": {"message_id": message_id or new_id(), "date": 0, "chat": {"id": uid, "type": "private"},
+                    "from": {"id": 123456, "is_bot": True, "first_name": "B"}, "text": text}}}
+
+
+def make_channel(mods=2):
+    # -> (dbid, owner_id, [moderator_id, ...])
+    owner = new_id()
+    dbid = main.add_channel(owner, f"@chan{owner}", "Chan")
+    moderators = [new_id() for _ in range(mods)]
+    for m in moderators:
+        main.add_channel_admin(dbid, m, owner)
+    return dbid, owner, moderators
+
+
+def submit(dbid, text="hello", uid=None):
+    uid = uid or new_id()
+    main.set_state(uid, f"awaiting_submission:1:{dbid}")
+    main.handle_submission(telebot.types.Message.de_json(msg(uid, text)["message"]), True, dbid)
+    return main.cur.execute("SELECT MAX(id) FROM submissions WHERE user_id = ?", (uid,)).fetchone()[0]
@@ -0,0 +1,60 @@
+import main
+from conftest import make_channel, new_id
+
+
+def test_owner_and_moderators_are_authorized_and_others_are_not():
+    dbid, owner, mods = make_channel(mods=2)
+    assert main.is_channel_owner(dbid, owner)
+    assert all(main.can_moderate(dbid, m) for m in mods)
+    assert main.can_moderate(dbid, owner)
+    assert not main.can_moderate(dbid, new_id())
+    assert dbid in main.moderated_channel_ids(mods[0])
+
+
+def test_admin_changes_update_the_cache():
+    dbid, owner, mods = make_channel(mods=1)
+    assert main.can_moderate(dbid, mods[0])
+    added = new_id()
+    main.add_channel_admin(dbid, added, owner)
+    assert main.can_moderate(dbid, added)
+    assert dbid in main.moderated_channel_ids(added)
+    main.remove_channel_admin(dbid, mods[0])
+    assert not main.can_moderate(dbid, mods[0])
+    assert dbid not in main.moderated_channel_ids(mods[0])
+
+
+def test_invalidation_during_load_does_not_install_stale_entry(monkeypatch):
+    dbid, owner, mods = make_channel(mods=1)
+    main._acl_on_invalidate(str(dbid))
+    real_cursor = main.db.cursor
+
+    class InvalidatingCursor:
+        # изменение приходит между SELECT и записью результата в кэш
+        def __init__(self):
+            self._c = real_cursor()
+
+        def __getattr__(self, name):
+            return getattr(self._c, name)
+
+        def fetchall(self):
+            rows = self._c.fetchall()
+            main._acl_on_invalidate(str(dbid))
+            return rows
+
+    monkeypatch.setattr(main.db, "cursor", InvalidatingCursor, raising=False)
+    assert main.channel_acl(dbid) is not None
+    assert dbid not in main._acl
+    monkeypatch.undo()
+    main.channel_acl(dbid)
+    assert dbid in main._acl
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    dbid, owner, mods = make_channel(mods=1)
+    main.channel_acl(dbid)
+    before = main.METRICS.get("acl_miss", 0)
+    main.channel_acl(dbid)
+    assert main.METRICS.get("acl_miss", 0) == before
+    monkeypatch.setattr(main, "ACL_CACHE_TTL", 0)
+    main.channel_acl(dbid)
+    assert main.METRICS.get("acl_miss", 0) == before + 1
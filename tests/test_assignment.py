@@ -0,0 +1,43 @@
+import sqlite3
+
+import main
+from conftest import make_channel, submit
+
+
+def _assignees(sub_ids):
+    rows = main.cur.execute(
+        f"SELECT submission_id, moderator_id FROM submission_assignments WHERE submission_id IN ({','.join('?' * len(sub_ids))})",
+        tuple(sub_ids)).fetchall()
+    return dict(rows)
+
+
+def test_round_robin_rotates_and_position_is_shared_through_the_db():
+    dbid, owner, mods = make_channel(mods=3)
+    main.set_channel_setting(dbid, "assign_mode", "round_robin")
+    first = [main._choose_moderator(dbid, "round_robin", mods) for _ in range(3)]
+    assert first == mods
+    # другой воркер взял позицию — этот процесс продолжает с следующей, а не со своей памяти
+    other = sqlite3.connect(main.DB_PATH)
+    other.execute("UPDATE assign_cursors SET next_idx = next_idx + 1 WHERE channel_dbid = ?", (dbid,))
+    other.commit()
+    other.close()
+    assert main._choose_moderator(dbid, "round_robin", mods) == mods[1]
+
+
+def test_least_loaded_balances_and_sees_decisions_made_elsewhere():
+    dbid, owner, mods = make_channel(mods=3)
+    main.set_channel_setting(dbid, "assign_mode", "least_loaded")
+    sub_ids = [submit(dbid, f"text {i}") for i in range(6)]
+    assigned = _assignees(sub_ids)
+    assert sorted(assigned.values()) == sorted(mods * 2)
+    # заявки первого модератора решены другим процессом прямо в БД
+    main.cur.execute("UPDATE submissions SET status = 'accepted' WHERE id IN (SELECT submission_id FROM submission_assignments WHERE moderator_id = ?)", (mods[0],))
+    main.db.commit()
+    assert main._choose_moderator(dbid, "least_loaded", mods) == mods[0]
+
+
+def test_broadcast_sends_to_every_moderator(api):
+    dbid, owner, mods = make_channel(mods=2)
+    submit(dbid)
+    for m in mods:
+        assert any("Контроль заявки" in (t or "") for t in api.sent_to(m))
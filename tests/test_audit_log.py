@@ -0,0 +1,103 @@
+import json
+import os
+import subprocess
+import time
+
+import pytest
+
+import main
+from conftest import new_id
+
+
+@pytest.fixture
+def log(tmp_path):
+    audit = main.AuditLog(str(tmp_path / "audit.jsonl"))
+    yield audit
+    audit.close()
+
+
+def _logged(sub_id):
+    return main.cur.execute("SELECT action FROM submission_actions WHERE submission_id = ? ORDER BY id", (sub_id,)).fetchall()
+
+
+def test_rows_are_buffered_until_flush_and_written_in_one_batch(log, monkeypatch):
+    sub_id = new_id()
+    log.log(sub_id, 1, "accepted")
+    log.log(sub_id, 1, "published")
+    assert _logged(sub_id) == []
+    writes = []
+    real_write = log._write
+    monkeypatch.setattr(log, "_write", lambda rows: (writes.append(len(rows)), real_write(rows)))
+    log.flush()
+    assert writes == [2]
+    assert _logged(sub_id) == [("accepted",), ("published",)]
+
+
+def test_overflow_spills_to_file_and_is_loaded_by_the_next_flush(log, monkeypatch):
+    monkeypatch.setattr(main, "AUDIT_BUFFER_SIZE", 3)
+    sub_id = new_id()
+    for action in ("a1", "a2", "a3", "a4", "a5"):
+        log.log(sub_id, 1, action)
+    with open(log.path) as f:
+        assert [json.loads(line)[2] for line in f] == ["a1", "a2"]
+    log.flush()
+    assert [r[0] for r in _logged(sub_id)] == ["a1", "a2", "a3", "a4", "a5"]
+    assert not os.path.exists(log.path)
+
+
+def test_failed_write_keeps_rows_and_reconnects(log):
+    sub_id = new_id()
+    log.log(sub_id, 1, "accepted")
+    log.flush()
+    # соединение писателя оборвалось между сбросами
+    log._conn.close()
+    log.log(sub_id, 1, "rejected")
+    log.flush()
+    assert _logged(sub_id) == [("accepted",)]
+    assert log.pending_days() == {main.now_ts() // 86400}
+    assert log._conn is None
+    log.flush()
+    assert _logged(sub_id) == [("accepted",), ("rejected",)]
+    assert log.pending_days() == set()
+
+
+def test_degraded_mode_spills_without_touching_the_database(log, monkeypatch):
+    monkeypatch.setattr(main, "degraded", lambda: True)
+    monkeypatch.setattr(log, "_write", lambda rows: pytest.fail("write while degraded"))
+    sub_id = new_id()
+    log.log(sub_id, 1, "accepted")
+    log.flush()
+    assert os.path.exists(log.path)
+    monkeypatch.undo()
+    log.flush()
+    assert _logged(sub_id) == [("accepted",)]
+
+
+def test_spilled_files_of_live_workers_are_left_alone(log):
+    live, orphan = new_id(), new_id()
+    dead = subprocess.Popen(["true"])
+    dead.wait()
+    for pid, sub_id in ((os.getppid(), live), (dead.pid, orphan)):
+        with open(f"{log.path}.replay.{pid}", "w") as f:
+            f.write(json.dumps([sub_id, 1, "accepted", "", main.now_ts()]) + "\n")
+    log.flush()
+    assert _logged(orphan) == [("accepted",)]
+    assert _logged(live) == []
+    assert os.path.exists(f"{log.path}.replay.{os.getppid()}")
+    os.remove(f"{log.path}.replay.{os.getppid()}")
+
+
+def test_writer_thread_flushes_full_batches_and_close_drains(log, monkeypatch):
+    monkeypatch.setattr(main, "AUDIT_FLUSH_ROWS", 2)
+    monkeypatch.setattr(main, "AUDIT_FLUSH_MS", 60000)
+    log.start()
+    sub_id = new_id()
+    log.log(sub_id, 1, "a1")
+    log.log(sub_id, 1, "a2")
+    deadline = time.monotonic() + 10
+    while len(_logged(sub_id)) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(_logged(sub_id)) == 2
+    log.log(sub_id, 1, "a3")
+    log.close()
+    assert [r[0] for r in _logged(sub_id)] == ["a1", "a2", "a3"]
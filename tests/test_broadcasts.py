@@ -0,0 +1,151 @@
+import json
+
+import pytest
+import telebot
+
+import main
+from conftest import cq, make_channel, msg, new_id, post, submit
+
+
+@pytest.fixture(autouse=True)
+def fast_sends(monkeypatch):
+    monkeypatch.setattr(main, "BROADCAST_RATE", 1e6)
+    monkeypatch.setattr(main, "BROADCAST_CHECKPOINT_EVERY", 2)
+    monkeypatch.setattr(main, "BROADCAST_BATCH", 3)
+
+
+@pytest.fixture
+def audience():
+    dbid, owner, mods = make_channel(mods=1)
+    users = sorted(new_id() for _ in range(7))
+    for i, u in enumerate(users):
+        submit(dbid, f"заявка {i}", u)
+    # второй раз тот же автор — одно сообщение
+    submit(dbid, "ещё одна", users[0])
+    return dbid, owner, users
+
+
+def _received(api, users, text="объявление"):
+    return {u: sum(1 for t in api.sent_to(u) if t and text in t) for u in users}
+
+
+def _start(dbid, owner, text="объявление"):
+    job_id = main.create_broadcast_job(dbid, owner, text)
+    assert main.transition_broadcast_job(job_id, "start")
+    return job_id
+
+
+def test_recipients_are_distinct_sorted_and_skip_banned(audience):
+    dbid, owner, users = audience
+    main.add_ban(dbid, users[3], owner)
+    expected = [u for u in users if u != users[3]]
+    assert main.count_broadcast_recipients(dbid) == len(expected)
+    assert main.broadcast_recipients(dbid, 0, 100) == expected
+    assert main.broadcast_recipients(dbid, users[4], 2) == expected[4:6]
+
+
+def test_only_one_unfinished_job_per_channel(audience):
+    dbid, owner, users = audience
+    job_id = main.create_broadcast_job(dbid, owner, "первая")
+    assert main.create_broadcast_job(dbid, owner, "вторая") is None
+    assert main.transition_broadcast_job(job_id, "cancel")
+    assert not main.transition_broadcast_job(job_id, "start")
+    assert main.create_broadcast_job(dbid, owner, "третья") is not None
+
+
+def test_job_reaches_everyone_once(api, audience):
+    dbid, owner, users = audience
+    job_id = _start(dbid, owner)
+    main.run_broadcasts()
+    assert set(_received(api, users).values()) == {1}
+    job = main.get_broadcast_job(job_id)
+    assert (job[4], job[6], job[7], job[8]) == ("done", len(users), 0, users[-1])
+
+
+def test_interrupted_job_resumes_from_the_checkpoint(api, audience):
+    dbid, owner, users = audience
+    job_id = _start(dbid, owner)
+    api.fail["sendMessage"] = lambda p: RuntimeError("network down") if int(p["chat_id"]) == users[4] else None
+    with pytest.raises(RuntimeError):
+        main.run_broadcasts()
+    job = main.get_broadcast_job(job_id)
+    assert (job[4], job[6], job[8]) == ("running", 4, users[3])
+    assert set(_received(api, users[:4]).values()) == {1}
+    api.clear()
+    main.run_broadcasts()
+    assert _received(api, users) == {u: int(i >= 4) for i, u in enumerate(users)}
+    assert main.get_broadcast_job(job_id)[4] == "done"
+
+
+def test_blocked_users_count_as_failed_and_429_is_waited_out(api, audience, monkeypatch):
+    dbid, owner, users = audience
+    sleeps = []
+    monkeypatch.setattr(main.time, "sleep", sleeps.append)
+    limited = {"left": 1}
+
+    def telegram(params):
+        chat_id = int(params["chat_id"])
+        if chat_id == users[1]:
+            return telebot.apihelper.ApiTelegramException("sendMessage", None, {"error_code": 403, "description": "Forbidden: bot was blocked by the user"})
+        if chat_id == users[2] and limited["left"]:
+            limited["left"] -= 1
+            return telebot.apihelper.ApiTelegramException("sendMessage", None, {"error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": 300}})
+        return None
+
+    api.fail["sendMessage"] = telegram
+    job_id = _start(dbid, owner)
+    main.run_broadcasts()
+    job = main.get_broadcast_job(job_id)
+    assert (job[4], job[6], job[7]) == ("done", len(users) - 1, 1)
+    assert 60 in sleeps
+
+
+def test_pause_stops_the_runner_and_resume_continues(api, audience):
+    dbid, owner, users = audience
+    job_id = _start(dbid, owner)
+
+    def pause_midway(params):
+        if int(params["chat_id"]) == users[2]:
+            main.transition_broadcast_job(job_id, "pause")
+        return None
+
+    api.fail["sendMessage"] = pause_midway
+    main.run_broadcasts()
+    job = main.get_broadcast_job(job_id)
+    assert (job[4], job[8]) == ("paused", users[3])
+    assert main.claim_broadcast_job() is None
+    api.fail.clear()
+    main.transition_broadcast_job(job_id, "resume")
+    main.run_broadcasts()
+    assert set(_received(api, users).values()) == {1}
+
+
+def test_lease_held_by_another_worker_blocks_the_claim(audience):
+    dbid, owner, users = audience
+    job_id = _start(dbid, owner)
+    main.cur.execute("UPDATE broadcast_jobs SET lease_owner = 'other', lease_until = ? WHERE id = ?", (main.now_ts() + 60, job_id))
+    main.db.commit()
+    assert main.claim_broadcast_job() is None
+    main.cur.execute("UPDATE broadcast_jobs SET lease_until = ? WHERE id = ?", (main.now_ts() - 1, job_id))
+    main.db.commit()
+    assert main.claim_broadcast_job()[0] == job_id
+    # потерявший аренду воркер не сдвигает позицию
+    main.cur.execute("UPDATE broadcast_jobs SET lease_owner = 'other' WHERE id = ?", (job_id,))
+    main.db.commit()
+    assert main.checkpoint_broadcast_job(job_id, users[-1], 5, 0) is None
+    assert main.get_broadcast_job(job_id)[8] == 0
+
+
+def test_owner_controls_the_job_from_chat(api, client, audience):
+    dbid, owner, users = audience
+    post(client, msg(owner, f"/broadcast {dbid} объявление"))
+    card = api.calls[-1][1]
+    buttons = [b["callback_data"] for b in json.loads(card["reply_markup"])["inline_keyboard"][0]]
+    start = next(b for b in buttons if b.startswith("bcast:start:"))
+    post(client, msg(owner, f"/broadcast {dbid} ещё одно"))
+    assert "уже есть незавершённая" in api.sent_to(owner)[-2]
+    stranger = new_id()
+    post(client, cq(stranger, start))
+    assert api.calls[-1][1].get("text") == "Нет доступа."
+    post(client, cq(owner, start))
+    assert main.active_broadcast_job(dbid)[4] == "running"
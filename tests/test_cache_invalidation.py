@@ -0,0 +1,62 @@
+import sys
+import types
+
+import pytest
+
+import main
+from conftest import make_channel
+
+
+def test_writes_bump_cache_versions_for_the_poller():
+    before = dict(main.cur.execute("SELECT topic, version FROM cache_versions").fetchall())
+    make_channel(mods=1)
+    after = dict(main.cur.execute("SELECT topic, version FROM cache_versions").fetchall())
+    assert after["channels"] > before["channels"]
+    assert after["channel_admins"] > before["channel_admins"]
+
+
+def test_invalidation_drops_cached_acl():
+    dbid, owner, mods = make_channel(mods=1)
+    assert main.can_moderate(dbid, mods[0])
+    assert dbid in main._acl
+    main.dispatch_invalidation("channel_admins", str(dbid))
+    assert dbid not in main._acl
+    main.channel_acl(dbid)
+    main._flush_all_caches()
+    assert dbid not in main._acl
+
+
+class _Stop(BaseException):
+    pass
+
+
+def test_pg_listener_flushes_caches_on_every_reconnect(monkeypatch):
+    connects, flushes = [], []
+
+    class FakeConn:
+        def set_isolation_level(self, level):
+            pass
+
+        def cursor(self):
+            return types.SimpleNamespace(execute=lambda sql: None)
+
+        def close(self):
+            pass
+
+    def fake_connect():
+        connects.append(1)
+        if len(connects) > 2:
+            raise _Stop()
+        return FakeConn()
+
+    def broken_select(*args):
+        raise OSError("connection lost")
+
+    monkeypatch.setattr(main, "pg_connect", fake_connect, raising=False)
+    monkeypatch.setattr(main, "psycopg2", types.SimpleNamespace(extensions=types.SimpleNamespace(ISOLATION_LEVEL_AUTOCOMMIT=0)), raising=False)
+    monkeypatch.setattr(main, "_flush_all_caches", lambda: flushes.append(1))
+    monkeypatch.setattr(main.time, "sleep", lambda s: None)
+    monkeypatch.setitem(sys.modules, "select", types.SimpleNamespace(select=broken_select))
+    with pytest.raises(_Stop):
+        main._pg_invalidation_listener()
+    assert len(flushes) == 2
@@ -0,0 +1,105 @@
+import json
+import os
+import subprocess
+import time
+
+import pytest
+
+import main
+from conftest import msg, new_id, post
+
+
+@pytest.fixture(autouse=True)
+def clean_spool():
+    yield
+    main.api_breaker.record_success()
+    main.db_breaker.record_success()
+    for path in [main.SPOOL_PATH] + [main.SPOOL_PATH + s for s in (".replay", f".replay.{os.getpid()}")]:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _spooled_lines():
+    if not os.path.exists(main.SPOOL_PATH):
+        return []
+    with open(main.SPOOL_PATH, encoding="utf-8") as f:
+        return [json.loads(l.partition("\t")[2])["message"]["from"]["id"] for l in f if l.strip()]
+
+
+def test_breaker_opens_rejects_and_recovers_through_a_probe(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    breaker = main.CircuitBreaker("test", failures=2, reset_seconds=30)
+    breaker.record_failure()
+    breaker.check()
+    breaker.record_failure()
+    assert breaker.is_open()
+    with pytest.raises(main.CircuitOpenError):
+        breaker.check()
+    now[0] += 31
+    # пробный вызов пропускается, остальные до его исхода — нет
+    assert breaker.allow()
+    assert breaker.is_open()
+    breaker.record_success()
+    assert not breaker.is_open()
+    breaker.check()
+
+
+def test_webhook_spools_while_degraded_and_replays_in_order(api, client):
+    users = [new_id() for _ in range(3)]
+    main.api_breaker.state, main.api_breaker.opened_at = "open", time.monotonic()
+    for u in users:
+        assert post(client, msg(u, "/start")) == 200
+    assert api.calls == []
+    assert _spooled_lines() == users
+    assert main.replay_spooled_updates() == 0
+    main.api_breaker.record_success()
+    assert main.replay_spooled_updates() == 3
+    assert all(api.sent_to(u) for u in users)
+    sent = [int(p["chat_id"]) for m, p in api.calls if m == "sendMessage"]
+    assert sorted(set(sent), key=sent.index) == users
+    assert not os.path.exists(main.SPOOL_PATH)
+
+
+def test_interrupted_replay_returns_the_rest_before_newer_updates(api):
+    first, failing, last, newer = (new_id() for _ in range(4))
+    for u in (first, failing, last):
+        main.spool_update(json.dumps(msg(u, "/start")))
+
+    def outage(params):
+        if int(params["chat_id"]) != failing:
+            return None
+        # пока шёл replay, webhook успел отложить ещё один апдейт
+        main.spool_update(json.dumps(msg(newer, "/start")))
+        return main.CircuitOpenError("api недоступен")
+
+    api.fail["sendMessage"] = outage
+    assert main.replay_spooled_updates() == 1
+    assert _spooled_lines() == [failing, last, newer]
+    api.fail.clear()
+    assert main.replay_spooled_updates() == 3
+    assert all(api.sent_to(u) for u in (failing, last, newer))
+
+
+def test_claim_skips_files_of_live_workers_and_takes_orphans(tmp_path):
+    path = str(tmp_path / "spool.jsonl")
+    dead = subprocess.Popen(["true"])
+    dead.wait()
+    live_file = f"{path}.replay.{os.getppid()}"
+    orphan_file = f"{path}.replay.{dead.pid}"
+    for p in (live_file, orphan_file):
+        with open(p, "w") as f:
+            f.write(p)
+    mine = main.claim_file(path)
+    assert mine == f"{path}.replay.{os.getpid()}"
+    assert open(mine).read() == orphan_file
+    assert os.path.exists(live_file)
+    # пока свой файл не догружен, он и возвращается; основной spool не трогается
+    with open(path, "w") as f:
+        f.write("new")
+    assert main.claim_file(path) == mine
+    os.remove(mine)
+    assert main.claim_file(path) == mine
+    assert open(mine).read() == "new"
+    os.remove(mine)
+    assert main.claim_file(path) is None
@@ -0,0 +1,68 @@
+import json
+
+import main
+from conftest import make_channel, submit
+
+
+def _make_due(dbid):
+    main.cur.execute("UPDATE moderator_digests SET last_sent_at = 0 WHERE channel_dbid = ?", (dbid,))
+    main.db.commit()
+
+
+def _digests_to(api, moderator_id):
+    return [t for t in api.sent_to(moderator_id) if t and t.startswith("📬")]
+
+
+def test_digest_subscriber_gets_one_summary_instead_of_each_submission(api):
+    dbid, owner, (mod,) = make_channel(mods=1)
+    main.set_digest(dbid, mod, 60)
+    ids = [submit(dbid, f"text {i}") for i in range(3)]
+    assert not any("Контроль заявки" in (t or "") for t in api.sent_to(mod))
+    _make_due(dbid)
+    main.send_digests()
+    (digest,) = _digests_to(api, mod)
+    assert "новых заявок — 3" in digest
+    assert all(f"#{i}" in digest for i in ids)
+    # повторно те же заявки не приходят
+    api.calls.clear()
+    _make_due(dbid)
+    main.send_digests()
+    assert _digests_to(api, mod) == []
+
+
+def test_lower_id_committed_later_is_not_skipped(api):
+    dbid, owner, (mod,) = make_channel(mods=1)
+    main.set_digest(dbid, mod, 60)
+    first = submit(dbid, "first")
+    second = submit(dbid, "second")
+    # имитация позднего commit: заявка first «появилась» уже после дайджеста, в котором был second
+    main.cur.execute("UPDATE moderator_digests SET sent_ids = ? WHERE channel_dbid = ?", (json.dumps([second]), dbid))
+    _make_due(dbid)
+    main.send_digests()
+    (digest,) = _digests_to(api, mod)
+    assert f"#{first}" in digest and f"#{second}" not in digest
+
+
+def test_position_advances_past_settled_submissions(api):
+    dbid, owner, (mod,) = make_channel(mods=1)
+    main.set_digest(dbid, mod, 60)
+    sub_id = submit(dbid)
+    _make_due(dbid)
+    main.send_digests()
+    main.cur.execute("UPDATE submissions SET created_at = created_at - ? WHERE id = ?", (main.DIGEST_SETTLE_SECONDS + 1, sub_id))
+    main.db.commit()
+    _make_due(dbid)
+    main.send_digests()
+    row = main.cur.execute("SELECT last_submission_id, sent_ids FROM moderator_digests WHERE channel_dbid = ?", (dbid,)).fetchone()
+    assert row == (sub_id, "[]")
+
+
+def test_failed_send_returns_the_window(api):
+    dbid, owner, (mod,) = make_channel(mods=1)
+    main.set_digest(dbid, mod, 60)
+    submit(dbid)
+    _make_due(dbid)
+    api.fail["sendMessage"] = lambda p: RuntimeError("down") if str(p.get("chat_id")) == str(mod) else None
+    assert main.send_digests() == 0
+    api.fail.clear()
+    assert main.send_digests() == 1
@@ -0,0 +1,85 @@
+import pytest
+
+import main
+from conftest import make_channel, new_id, submit
+
+POST = ("Сегодня вечером в центральном парке пройдёт бесплатный концерт местных музыкантов. Начало в семь часов "
+        "у летней сцены, вход свободный для всех желающих. Организаторы просят приходить заранее, брать с собой "
+        "пледы и хорошее настроение, а также не оставлять после себя мусор на газонах")
+EDITED = POST.replace("в семь", "в восемь")
+
+
+@pytest.fixture
+def index(monkeypatch):
+    monkeypatch.setattr(main.fingerprints, "ready", False)
+    main.build_fingerprint_index()
+    return main.fingerprints
+
+
+def test_normalization_ignores_case_punctuation_and_yo():
+    assert main.text_hash("Ёлка, ЁЛКА!") == main.text_hash("елка елка")
+    assert main.text_hash("!!!") is None
+
+
+def test_short_texts_have_no_simhash():
+    assert main.simhash("совсем короткий текст") is None
+    assert main.simhash(POST) is not None
+
+
+def test_small_edit_stays_within_simhash_distance():
+    a, b = main.simhash(POST), main.simhash(EDITED)
+    assert bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1") <= main.SIMHASH_MAX_DISTANCE
+
+
+def test_index_finds_exact_and_near_only_in_the_same_channel_and_window():
+    idx = main.FingerprintIndex()
+    shash = main.simhash(POST)
+    idx.add(1, 10, "file1", main.text_hash(POST), shash, 1000)
+    assert idx.find(10, "file1", None, None, 0) == (1, "exact")
+    assert idx.find(10, None, main.text_hash(POST.upper()), None, 0) == (1, "exact")
+    assert idx.find(10, None, None, main.simhash(EDITED), 0) == (1, "near")
+    assert idx.find(11, "file1", main.text_hash(POST), shash, 0) is None
+    assert idx.find(10, "file1", main.text_hash(POST), shash, 1001) is None
+    assert idx.prune(1001) > 0
+    assert idx.exact == {} and idx.bands == {}
+
+
+def test_repeated_post_is_rejected(api, index):
+    dbid, owner, mods = make_channel(mods=1)
+    first = submit(dbid, POST)
+    assert first is not None
+    uid = new_id()
+    assert submit(dbid, EDITED, uid) is None
+    assert any("уже предлагали" in (t or "") for t in api.sent_to(uid))
+    # в другой канал тот же пост проходит
+    other, _, _ = make_channel(mods=1)
+    assert submit(other, POST) is not None
+
+
+def test_dedup_modes(api, index):
+    dbid, owner, mods = make_channel(mods=1)
+    submit(dbid, POST)
+    main.set_channel_setting(dbid, "dedup", "exact")
+    assert submit(dbid, EDITED) is not None
+    assert submit(dbid, POST) is None
+    main.set_channel_setting(dbid, "dedup", "off")
+    assert submit(dbid, POST) is not None
+
+
+def test_exact_duplicates_are_caught_before_the_index_is_built(api, monkeypatch):
+    monkeypatch.setattr(main.fingerprints, "ready", False)
+    dbid, owner, mods = make_channel(mods=1)
+    submit(dbid, POST)
+    assert submit(dbid, POST.lower()) is None
+
+
+def test_index_picks_up_rows_written_by_other_workers(index):
+    dbid, owner, mods = make_channel(mods=1)
+    sub_id = submit(dbid, "x")
+    thash = main.text_hash("запись другого воркера")
+    main.cur.execute("UPDATE submission_fingerprints SET text_hash = ? WHERE submission_id = ?", (thash, sub_id))
+    main.db.commit()
+    assert main.fingerprints.find(dbid, None, thash, None, 0) is None
+    main.fingerprints.last_id = sub_id - 1
+    main.load_fingerprints()
+    assert main.fingerprints.find(dbid, None, thash, None, 0) == (sub_id, "exact")
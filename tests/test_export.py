@@ -0,0 +1,128 @@
+import csv
+import gzip
+import io
+import json
+import time
+
+import pytest
+
+import main
+from conftest import make_channel, msg, post, submit
+
+
+@pytest.fixture
+def channel(monkeypatch):
+    monkeypatch.setattr(main.time, "sleep", lambda s: None)
+    dbid, owner, (mod,) = make_channel(mods=1)
+    archived = submit(dbid, "старая заявка")
+    main.transition_submission_status(archived, "pending", "rejected", mod)
+    main.audit_log.flush()
+    main.archive_channel_submissions(dbid, main.now_ts() + 1, 100)
+    hot = [submit(dbid, f"заявка, \"с кавычками\" {i}") for i in range(3)]
+    main.transition_submission_status(hot[0], "pending", "accepted", mod)
+    main.audit_log.flush()
+    make_channel(mods=1)
+    return dbid, owner, [archived] + hot
+
+
+def _jsonl(data):
+    return [json.loads(line) for line in data.decode("utf-8").splitlines()]
+
+
+def test_export_covers_archive_and_hot_rows_of_one_channel(channel):
+    dbid, owner, ids = channel
+    rows = _jsonl(b"".join(main.export_stream(dbid, "submissions", "jsonl")))
+    assert [r["id"] for r in rows] == ids
+    assert {r["target_channel_dbid"] for r in rows} == {dbid}
+    actions = _jsonl(b"".join(main.export_stream(dbid, "actions", "jsonl")))
+    assert [(a["submission_id"], a["action"]) for a in actions] == [(ids[0], "rejected"), (ids[1], "accepted")]
+
+
+def test_csv_and_gzip_round_trip(channel):
+    dbid, owner, ids = channel
+    plain = b"".join(main.export_stream(dbid, "submissions", "csv"))
+    assert gzip.decompress(b"".join(main.export_stream(dbid, "submissions", "csv", compress=True))) == plain
+    rows = list(csv.DictReader(io.StringIO(plain.decode("utf-8"))))
+    assert [int(r["id"]) for r in rows] == ids
+    assert rows[1]["text_content"] == 'заявка, "с кавычками" 0'
+
+
+def test_rows_are_fetched_in_bounded_batches(channel, monkeypatch):
+    dbid, owner, ids = channel
+    sizes = []
+    real_connect = main.sqlite3.connect
+
+    class Conn:
+        def __init__(self, *args, **kwargs):
+            self._conn = real_connect(*args, **kwargs)
+
+        def __getattr__(self, name):
+            return getattr(self._conn, name)
+
+        def cursor(self):
+            c = self._conn.cursor()
+
+            class Cursor:
+                def __getattr__(self, name):
+                    return getattr(c, name)
+
+                def fetchmany(self, size):
+                    sizes.append(size)
+                    return c.fetchmany(size)
+            return Cursor()
+
+    monkeypatch.setattr(main.sqlite3, "connect", Conn)
+    monkeypatch.setattr(main, "EXPORT_FETCH_SIZE", 2)
+    rows = list(main.iter_export_rows(dbid, "submissions"))
+    assert [r[0] for r in rows] == ids
+    assert set(sizes) == {2}
+    # архив (1 строка) + горячая таблица (3 строки по 2)
+    assert len(sizes) == 2 + 3
+
+
+def test_file_parts_are_standalone(channel, monkeypatch):
+    dbid, owner, ids = channel
+    real_chunks = main.export_chunks
+    monkeypatch.setattr(main, "export_chunks", lambda *a: real_chunks(*a, rows_per_chunk=1))
+    parts = main.export_to_files(dbid, "submissions", "csv", compress=True, part_bytes=1)
+    try:
+        assert len(parts) == len(ids)
+        got = []
+        for f in parts:
+            rows = list(csv.reader(io.StringIO(gzip.decompress(f.read()).decode("utf-8"))))
+            assert rows[0][0] == "id"
+            got += [int(r[0]) for r in rows[1:]]
+        assert got == ids
+    finally:
+        for f in parts:
+            f.close()
+
+
+def test_empty_export_still_has_a_header():
+    (f,) = main.export_to_files(-1, "actions", "csv", compress=False)
+    assert f.read().decode("utf-8").startswith("id,")
+    f.close()
+
+
+def test_admin_endpoint_streams_the_export(channel, client, monkeypatch):
+    dbid, owner, ids = channel
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    assert client.get(f"/admin/export/{dbid}").status_code == 404
+    headers = {"X-Admin-Token": "secret"}
+    assert client.get(f"/admin/export/{dbid}?kind=users", headers=headers).status_code == 400
+    resp = client.get(f"/admin/export/{dbid}?gzip=1", headers=headers)
+    assert resp.status_code == 200 and resp.is_streamed
+    assert [r["id"] for r in _jsonl(gzip.decompress(resp.data))] == ids
+
+
+def test_export_command_is_owner_only(channel, api, client):
+    dbid, owner, ids = channel
+    (mod,) = main.channel_acl(dbid)[1]
+    post(client, msg(mod, f"/export {dbid}"))
+    assert "Только владелец" in api.sent_to(mod)[-1]
+    post(client, msg(owner, f"/export {dbid} csv gz"))
+    deadline = time.monotonic() + 10
+    while "sendDocument" not in api.methods() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    (doc,) = [p for m, p in api.calls if m == "sendDocument"]
+    assert str(doc["chat_id"]) == str(owner)
@@ -0,0 +1,87 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import main
+from conftest import cq, msg, new_id, post
+
+
+@pytest.fixture
+def flood(monkeypatch):
+    monkeypatch.setattr(main, "FLOOD_CONTROL", True)
+    monkeypatch.setattr(main, "FLOOD_USER_BURST", 3.0)
+    monkeypatch.setattr(main, "FLOOD_USER_RATE", 0.001)
+
+
+def test_user_bucket_drops_bursts_before_handlers(flood, api, client):
+    uid = new_id()
+    for i in range(6):
+        post(client, msg(uid, f"/start {i}"))
+    # прошли только первые FLOOD_USER_BURST апдейтов
+    assert len(api.sent_to(uid)) == 3
+
+
+def test_dropped_callback_query_is_answered(flood, api, client):
+    uid = new_id()
+    for _ in range(5):
+        post(client, cq(uid, "menu_help"))
+    answers = [p for m, p in api.calls if m == "answerCallbackQuery"]
+    assert len(answers) == 5
+    assert sum(1 for p in answers if "Слишком часто" in (p.get("text") or "")) == 2
+
+
+def test_shared_bucket_is_exact_across_threads(monkeypatch):
+    key = f"test:{new_id()}"
+    results = []
+
+    def worker():
+        for _ in range(10):
+            results.append(main._take_shared(key, 0.0001, 20, time.time()))
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sum(results) == 20
+
+
+def test_shared_bucket_query_runs_outside_the_flood_lock(monkeypatch):
+    seen = []
+
+    class Conn:
+        def __init__(self):
+            self._raw = sqlite3.connect(main.DB_PATH, check_same_thread=False, timeout=30, isolation_level=None)
+
+        def cursor(self):
+            raw = self._raw.cursor()
+
+            class Cursor:
+                def execute(self, *args):
+                    seen.append(main._flood_lock.locked())
+                    return raw.execute(*args)
+
+                def __getattr__(self, name):
+                    return getattr(raw, name)
+            return Cursor()
+
+        def close(self):
+            self._raw.close()
+
+    monkeypatch.setattr(main, "_flood_conns", [])
+    monkeypatch.setattr(main, "_flood_connect", Conn)
+    assert main._take_shared(f"test:{new_id()}", 1, 5, time.time())
+    assert seen and not any(seen)
+
+
+def test_broken_shared_connection_is_not_reused(monkeypatch):
+    monkeypatch.setattr(main, "_flood_conns", [])
+    main._take_shared(f"test:{new_id()}", 1, 5, time.time())
+    (conn,) = main._flood_conns
+    conn.close()
+    with pytest.raises(Exception):
+        main._take_shared(f"test:{new_id()}", 1, 5, time.time())
+    assert main._flood_conns == []
+    assert main._take_shared(f"test:{new_id()}", 1, 5, time.time())
@@ -0,0 +1,110 @@
+import json
+
+import pytest
+import requests
+import telebot
+
+import main
+
+URL = "https://api.telegram.org/bot1:a/"
+
+
+def _response(status, body, reason="OK"):
+    resp = requests.Response()
+    resp.status_code = status
+    resp._content = json.dumps(body).encode() if not isinstance(body, str) else body.encode()
+    resp.reason = reason
+    return resp
+
+
+def _too_many(retry_after):
+    return _response(429, {"ok": False, "error_code": 429, "description": "Too Many Requests",
+                           "parameters": {"retry_after": retry_after}}, "Too Many Requests")
+
+
+OK = {"ok": True, "result": True}
+
+
+class FakeClient:
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.calls = 0
+
+    def request(self, *args, **kwargs):
+        self.calls += 1
+        reply = self.replies.pop(0)
+        if isinstance(reply, BaseException):
+            raise reply
+        return reply
+
+
+@pytest.fixture
+def transport(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(main.time, "sleep", sleeps.append)
+
+    def install(*replies):
+        client = FakeClient(*replies)
+        monkeypatch.setattr(main, "_http_client", client)
+        return client
+    install.sleeps = sleeps
+    yield install
+    main.api_breaker.record_success()
+
+
+def test_default_client_is_one_pooled_session():
+    assert isinstance(main._http_client, requests.Session)
+    adapter = main._http_client.get_adapter(URL)
+    assert adapter._pool_maxsize == main.HTTP_POOL_SIZE
+
+
+def test_short_retry_after_is_waited_out(transport):
+    client = transport(_too_many(1), _response(200, OK))
+    resp = main.api_request_sender("post", URL + "sendMessage")
+    assert resp.status_code == 200
+    assert client.calls == 2
+    assert transport.sleeps == [1]
+
+
+def test_long_retry_after_is_returned_to_the_caller(transport):
+    client = transport(_too_many(main.HTTP_RETRY_AFTER_MAX + 20))
+    before = main.METRICS.get("api_retry_after_exceeded", 0)
+    resp = main.api_request_sender("post", URL + "sendMessage")
+    assert resp.status_code == 429
+    assert client.calls == 1
+    assert transport.sleeps == []
+    assert main.METRICS.get("api_retry_after_exceeded", 0) == before + 1
+
+
+def test_connection_errors_are_retried(transport):
+    client = transport(requests.ConnectionError("refused"), _response(200, OK))
+    assert main.api_request_sender("post", URL + "sendMessage").status_code == 200
+    assert client.calls == 2
+
+
+def test_read_timeout_on_send_is_not_retried(transport):
+    # сообщение могло уже уйти — повтор дал бы дубль
+    client = transport(requests.ReadTimeout("slow"), _response(200, OK))
+    with pytest.raises(requests.ReadTimeout):
+        main.api_request_sender("post", URL + "sendMessage")
+    assert client.calls == 1
+
+
+def test_read_timeout_on_idempotent_method_is_retried(transport):
+    client = transport(requests.ReadTimeout("slow"), _response(200, OK))
+    assert main.api_request_sender("post", URL + "answerCallbackQuery").status_code == 200
+    assert client.calls == 2
+
+
+def test_httpx_response_gets_reason_for_telebot(transport, monkeypatch):
+    class HttpxResponse:
+        status_code = 502
+        reason_phrase = "Bad Gateway"
+        text = "<html>bad gateway</html>"
+
+    monkeypatch.setattr(main, "HTTP2", True)
+    monkeypatch.setattr(main, "HTTP_MAX_RETRIES", 0)
+    transport(HttpxResponse())
+    resp = main.api_request_sender("post", URL + "sendMessage")
+    with pytest.raises(telebot.apihelper.ApiHTTPException, match="Bad Gateway"):
+        telebot.apihelper._check_result("sendMessage", resp)
@@ -0,0 +1,110 @@
+import pytest
+
+import main
+from conftest import make_channel, new_id, submit
+
+DAY = 86400
+
+
+@pytest.fixture(autouse=True)
+def fast_sends(monkeypatch):
+    monkeypatch.setattr(main, "BROADCAST_RATE", 1e6)
+
+
+def _age(sub_id, days):
+    main.cur.execute("UPDATE submissions SET created_at = ? WHERE id = ?", (main.now_ts() - days * DAY, sub_id))
+    main.db.commit()
+
+
+def _status(sub_id):
+    return main.cur.execute("SELECT status FROM submissions WHERE id = ?", (sub_id,)).fetchone()[0]
+
+
+def test_stale_pending_submissions_expire_and_authors_hear_once(api):
+    dbid, owner, (mod,) = make_channel(mods=1)
+    author = new_id()
+    stale = [submit(dbid, "первая", author)]
+    main.cur.execute("DELETE FROM cooldowns WHERE user_id = ?", (author,))
+    stale.append(submit(dbid, "вторая", author))
+    fresh = submit(dbid, "свежая")
+    decided = submit(dbid, "решённая")
+    main.transition_submission_status(decided, "pending", "rejected", mod)
+    for sub_id in stale + [decided]:
+        _age(sub_id, main.PENDING_EXPIRE_DAYS + 1)
+    api.clear()
+    main.expire_pending_submissions(1000)
+    assert [_status(s) for s in stale] == ["expired", "expired"]
+    assert (_status(fresh), _status(decided)) == ("pending", "rejected")
+    (notice,) = api.sent_to(author)
+    assert all(f"#{s}" in notice for s in stale)
+    # контрольные сообщения модератора закрыты итогом
+    edits = [p["text"] for m, p in api.calls if m == "editMessageText" and str(p["chat_id"]) == str(mod)]
+    assert len(edits) == 2 and all("Итог: истекла" in t for t in edits)
+    main.audit_log.flush()
+    assert main.cur.execute(f"SELECT COUNT(*) FROM submission_actions WHERE action = 'expired' AND submission_id IN ({stale[0]}, {stale[1]})").fetchone()[0] == 2
+
+
+def test_submission_decided_during_the_sweep_is_not_expired(monkeypatch):
+    dbid, owner, (mod,) = make_channel(mods=1)
+    raced, other = submit(dbid, "гонка"), submit(dbid, "другая")
+    for sub_id in (raced, other):
+        _age(sub_id, 5000)
+    real_cursor = main.db.cursor
+
+    class RacingCursor:
+        # модератор принимает заявку между выборкой и обновлением
+        def __init__(self):
+            self._c = real_cursor()
+
+        def __getattr__(self, name):
+            return getattr(self._c, name)
+
+        def fetchall(self):
+            rows = self._c.fetchall()
+            main.cur.execute("UPDATE submissions SET status = 'accepted' WHERE id = ?", (raced,))
+            return rows
+
+    monkeypatch.setattr(main.db, "cursor", RacingCursor, raising=False)
+    expired = main._expire_pending_batch(main.now_ts() - 4000 * DAY, 10)
+    monkeypatch.undo()
+    main.db.commit()
+    assert [r[0] for r in expired] == [other]
+    assert (_status(raced), _status(other)) == ("accepted", "expired")
+
+
+def test_expiry_respects_the_notification_budget(api, monkeypatch):
+    monkeypatch.setattr(main, "EXPIRE_NOTIFY_MAX", 2)
+    monkeypatch.setattr(main, "MAINTENANCE_BATCH", 1)
+    dbid, owner, (mod,) = make_channel(mods=1)
+    ids = [submit(dbid, f"старая {i}") for i in range(3)]
+    for i, sub_id in enumerate(ids):
+        _age(sub_id, 9000 - i)
+    assert main.expire_pending_submissions(1000) == 2
+    assert [_status(s) for s in ids] == ["expired", "expired", "pending"]
+
+
+def test_abandoned_states_and_cooldowns_are_purged_in_batches(monkeypatch):
+    monkeypatch.setattr(main, "MAINTENANCE_BATCH", 2)
+    users = [new_id() for _ in range(5)]
+    for u in users:
+        main.set_state(u, "awaiting_submission:1:1")
+    main.cur.execute(f"UPDATE user_states SET updated_at = 0 WHERE user_id IN ({','.join(map(str, users[:4]))})")
+    main.db.commit()
+    assert main.expire_user_states(3) == 3
+    assert main.expire_user_states(1000) >= 1
+    remaining = {r[0] for r in main.cur.execute(f"SELECT user_id FROM user_states WHERE user_id IN ({','.join(map(str, users))})")}
+    assert remaining == {users[4]}
+    main.set_cooldown(users[0], 1, 1)
+    main.set_cooldown(users[1], 1, main.now_ts())
+    main.expire_cooldowns(1000)
+    kept = {r[0] for r in main.cur.execute("SELECT user_id FROM cooldowns WHERE user_id IN (?, ?)", (users[0], users[1]))}
+    assert kept == {users[1]}
+
+
+def test_only_one_worker_runs_a_sweep_per_interval():
+    task = f"test{new_id()}"
+    assert main.claim_maintenance(task, 600)
+    assert not main.claim_maintenance(task, 600)
+    main.cur.execute("UPDATE maintenance_runs SET last_run_at = last_run_at - 601 WHERE task = ?", (task,))
+    main.db.commit()
+    assert main.claim_maintenance(task, 600)
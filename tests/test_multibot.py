@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+from telebot import apihelper
+
+import main
+from conftest import msg, new_id, post, submit
+
+OTHER_TOKEN = "777777:OTHER"
+
+
+@pytest.fixture
+def second_bot(monkeypatch):
+    # второй бот процесса — как из BOT_TOKENS, с копией реестра обработчиков основного
+    b = main.TeleformBot(OTHER_TOKEN, threaded=False, exception_handler=main.HandlerErrors())
+    monkeypatch.setitem(main.BOTS, b.bot_id, b)
+    monkeypatch.setitem(main.BOTS_BY_TOKEN, b.token, b)
+    main.share_handlers()
+    return b
+
+
+@pytest.fixture
+def sent(api, monkeypatch):
+    # (токен, метод, chat_id) каждого вызова Bot API
+    calls = []
+
+    def recording(token, method_name, method="get", params=None, files=None):
+        calls.append((token, method_name, str((params or {}).get("chat_id"))))
+        return api(token, method_name, method, params, files)
+
+    monkeypatch.setattr(apihelper, "_make_request", recording)
+    return calls
+
+
+def _post_to(client, token, update):
+    return client.post(f"/webhook/{token}", data=json.dumps(update), content_type="application/json").status_code
+
+
+def _tokens_to(sent, chat_id, method="sendMessage"):
+    return {t for t, m, c in sent if m == method and c == str(chat_id)}
+
+
+def test_each_bot_answers_on_its_own_webhook(client, second_bot, sent):
+    assert _post_to(client, "999:UNKNOWN", msg(new_id(), "/start")) == 404
+    uid = new_id()
+    assert _post_to(client, OTHER_TOKEN, msg(uid, "/start")) == 200
+    assert _tokens_to(sent, uid) == {OTHER_TOKEN}
+    other = new_id()
+    post(client, msg(other, "/start"))
+    assert _tokens_to(sent, other) == {main.TOKEN}
+
+
+def test_dialog_states_are_kept_per_bot(second_bot):
+    uid = new_id()
+    main.set_state(uid, "awaiting_submission:1:1")
+    with main.use_tenant(second_bot):
+        assert main.get_state(uid) is None
+        main.set_state(uid, "awaiting_submission:0:2")
+    assert main.get_state(uid) == "awaiting_submission:1:1"
+    with main.use_tenant(second_bot):
+        assert main.get_state(uid) == "awaiting_submission:0:2"
+
+
+def test_channels_belong_to_the_bot_they_were_added_through(second_bot):
+    owner = new_id()
+    with main.use_tenant(second_bot):
+        theirs = main.add_channel(owner, f"@other{owner}", "Other")
+    ours = main.add_channel(owner, f"@ours{owner}", "Ours")
+    assert (main.channel_bot(theirs), main.channel_bot(ours)) == (second_bot, main.default_bot)
+    with main.use_tenant(main.default_bot):
+        assert main.get_channel_by_dbid(theirs) is None
+        assert [r[0] for r in main.list_channels_by_owner(owner)] == [ours]
+    with main.use_tenant(second_bot):
+        assert [r[0] for r in main.list_channels_by_owner(owner)] == [theirs]
+    # вне апдейта (админка, фоновые задачи) канал виден по id
+    assert main.get_channel_by_dbid(theirs)[1] == owner
+
+
+def test_channel_of_a_bot_missing_from_the_process_falls_back_to_the_default(second_bot):
+    gone = main.TeleformBot("888888:GONE", threaded=False)
+    with main.use_tenant(gone):
+        dbid = main.add_channel(new_id(), f"@gone{new_id()}", "Gone")
+    assert main.channel_bot(dbid) is main.default_bot
+
+
+def test_background_jobs_write_through_the_channel_bot(second_bot, sent):
+    owner, author = new_id(), new_id()
+    with main.use_tenant(second_bot):
+        dbid = main.add_channel(owner, f"@other{owner}", "Other")
+        sub_id = submit(dbid, "старая заявка", author)
+    main.cur.execute("UPDATE submissions SET created_at = ? WHERE id = ?", (main.now_ts() - (main.PENDING_EXPIRE_DAYS + 1) * 86400, sub_id))
+    main.db.commit()
+    main.expire_pending_submissions(1000)
+    assert _tokens_to(sent, author) == {OTHER_TOKEN}
+
+
+def test_spooled_updates_are_replayed_by_the_bot_that_received_them(client, second_bot, sent):
+    uid = new_id()
+    main.api_breaker.state, main.api_breaker.opened_at = "open", time.monotonic()
+    try:
+        assert _post_to(client, OTHER_TOKEN, msg(uid, "/start")) == 200
+        with open(main.SPOOL_PATH, encoding="utf-8") as f:
+            assert f.read().startswith(f"{second_bot.bot_id}\t")
+        main.api_breaker.record_success()
+        assert main.replay_spooled_updates() == 1
+        assert _tokens_to(sent, uid) == {OTHER_TOKEN}
+    finally:
+        main.api_breaker.record_success()
+        if os.path.exists(main.SPOOL_PATH):
+            os.remove(main.SPOOL_PATH)
+
+
+def test_bound_callables_keep_the_bot_in_other_threads(second_bot):
+    seen = []
+    with main.use_tenant(second_bot):
+        job = main.bind_tenant(lambda: seen.append((main.current_bot_id(), main.bot.token)))
+    t = threading.Thread(target=job)
+    t.start()
+    t.join()
+    assert seen == [(second_bot.bot_id, OTHER_TOKEN)]
+    assert not main.tenant_active()
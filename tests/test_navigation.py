@@ -0,0 +1,33 @@
+import telebot
+
+from conftest import cq, post
+
+
+def test_menu_click_edits_the_message_in_place(api, client):
+    post(client, cq(501, "menu_channels", text="Главное меню"))
+    assert "editMessageText" in api.methods()
+    assert "sendMessage" not in api.methods()
+
+
+def test_repeated_click_is_edited_again_and_unchanged_is_not_resent(api, client):
+    def not_modified(params):
+        return telebot.apihelper.ApiTelegramException(
+            "editMessageText", None, {"error_code": 400, "description": "Bad Request: message is not modified"})
+
+    post(client, cq(502, "menu_channels", message_id=77))
+    api.calls.clear()
+    api.fail["editMessageText"] = not_modified
+    post(client, cq(502, "menu_channels", message_id=77))
+    # решение «не изменилось» принимает Telegram, а не память процесса; нового сообщения нет
+    assert api.methods().count("editMessageText") == 1
+    assert "sendMessage" not in api.methods()
+
+
+def test_non_text_message_falls_back_to_send(api, client):
+    update = cq(503, "menu_channels")
+    message = update["callback_query"]["message"]
+    del message["text"]
+    message["photo"] = [{"file_id": "f", "file_unique_id": "u", "width": 1, "height": 1}]
+    post(client, update)
+    assert "sendMessage" in api.methods()
+    assert "editMessageText" not in api.methods()
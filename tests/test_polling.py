@@ -0,0 +1,95 @@
+import queue
+import threading
+
+import pytest
+import telebot
+
+import main
+from conftest import msg, new_id
+
+
+class _Stop(BaseException):
+    pass
+
+
+def test_offset_advances_only_over_contiguous_completed_updates(monkeypatch):
+    monkeypatch.setattr(main, "POLL_OFFSET_SAVE_SECONDS", 3600)
+    progress = main.PollProgress(100, set(), name=f"t{new_id()}")
+    progress.complete(102)
+    progress.complete(101)
+    assert (progress.offset, progress.done) == (100, {101, 102})
+    progress.complete(100)
+    assert (progress.offset, progress.done) == (103, set())
+
+
+@pytest.fixture
+def poll_queues():
+    queues = [queue.Queue() for _ in range(3)]
+    for q in queues:
+        threading.Thread(target=main._poll_worker, args=(q,), daemon=True).start()
+    return queues
+
+
+def _run_poll_loop(monkeypatch, batches, progress, queues):
+    batches = list(batches)
+
+    def fake_get_updates(token, offset=None, **kwargs):
+        if not batches:
+            raise _Stop()
+        return batches.pop(0)
+
+    monkeypatch.setattr(telebot.apihelper, "get_updates", fake_get_updates)
+    with pytest.raises(_Stop):
+        main._poll_loop(main.default_bot, queues, progress)
+
+
+def test_offset_is_saved_once_per_batch(monkeypatch, api, poll_queues):
+    name = f"t{new_id()}"
+    saves = []
+    real_save = main.save_poll_offset
+    monkeypatch.setattr(main, "save_poll_offset", lambda *a: (saves.append(a), real_save(*a)))
+    monkeypatch.setattr(main, "POLL_OFFSET_SAVE_SECONDS", 3600)
+    users = [new_id() for _ in range(5)]
+    batch = [dict(msg(u, "/start"), update_id=500 + i) for i, u in enumerate(users)]
+    progress = main.PollProgress(None, set(), name)
+    _run_poll_loop(monkeypatch, [batch], progress, poll_queues)
+    assert len(saves) == 1
+    assert main.load_poll_offset(name) == (505, set())
+    assert all(api.sent_to(u) for u in users)
+
+
+def test_updates_completed_before_restart_are_not_processed_again(monkeypatch, api, poll_queues):
+    name = f"t{new_id()}"
+    done_user, new_user = new_id(), new_id()
+    main.save_poll_offset(700, {701}, name)
+    progress = main.PollProgress(*main.load_poll_offset(name), name)
+    batch = [dict(msg(done_user, "/start"), update_id=701), dict(msg(new_user, "/start"), update_id=700)]
+    _run_poll_loop(monkeypatch, [batch], progress, poll_queues)
+    assert api.sent_to(done_user) == []
+    assert api.sent_to(new_user)
+    assert main.load_poll_offset(name) == (702, set())
+
+
+def test_thread_cursor_keeps_results_per_thread():
+    barrier = threading.Barrier(2)
+    results = {}
+
+    def worker(n):
+        main.cur.execute("SELECT ?", (n,))
+        # второй поток выполняет свой запрос между нашими execute и fetch
+        barrier.wait()
+        barrier.wait()
+        results[n] = main.cur.fetchone()[0]
+
+    def other(n):
+        barrier.wait()
+        main.cur.execute("SELECT ?", (n,))
+        results[n] = main.cur.fetchone()[0]
+        barrier.wait()
+
+    threads = [threading.Thread(target=worker, args=(1,)), threading.Thread(target=other, args=(2,))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == {1: 1, 2: 2}
@@ -0,0 +1,101 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import main
+from conftest import msg, new_id, post
+
+
+@pytest.fixture
+def profile_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "PROFILE_MODE", "sample")
+    monkeypatch.setattr(main, "PROFILE_SAMPLE_N", 0)
+    return tmp_path
+
+
+def _slow_updates(profile_dir):
+    with open(profile_dir / "slow_updates.jsonl", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def _busy(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def test_slow_update_is_logged_with_its_handler_and_db_queries(client, profile_dir, monkeypatch):
+    monkeypatch.setattr(main, "PROFILE_SLOW_MS", 0)
+    uid = new_id()
+    post(client, msg(uid, "/start"))
+    (record,) = _slow_updates(profile_dir)
+    assert (record["update_type"], record["handler"], record["chat_id"]) == ("message:text", "cmd_start", uid)
+    assert record["db_queries"] > 0 and record["db_ms"] >= 0
+    assert main.METRICS["handler_cmd_start_count"] >= 1
+
+
+def test_fast_unsampled_update_leaves_no_files(client, profile_dir, monkeypatch):
+    monkeypatch.setattr(main, "PROFILE_SLOW_MS", 1e9)
+    count = main.METRICS.get("handler_cmd_start_count", 0)
+    post(client, msg(new_id(), "/start"))
+    assert os.listdir(profile_dir) == []
+    # длительность учитывается в метриках для каждого апдейта
+    assert main.METRICS["handler_cmd_start_count"] == count + 1
+
+
+def test_sampler_records_stacks_of_slow_handlers(profile_dir, monkeypatch):
+    monkeypatch.setattr(main, "PROFILE_SLOW_MS", 10)
+    main.profiled_task(_busy, "message")(0.1)
+    with open(profile_dir / "stacks.folded", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    assert lines
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert stack.startswith("message;unhandled;_busy (test_profiler.py:") and int(count) > 0
+    # после обработчика его поток больше не сэмплируется
+    assert threading.get_ident() not in main._sampler._active
+
+
+def test_failing_handler_is_still_recorded_and_the_error_propagates(profile_dir, monkeypatch):
+    monkeypatch.setattr(main, "PROFILE_SLOW_MS", 0)
+
+    def broken():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        main.profiled_task(broken, "callback_query")()
+    (record,) = _slow_updates(profile_dir)
+    assert (record["update_type"], record["handler"]) == ("callback_query", "unhandled")
+    assert main._profile_local.stats is None
+
+
+def test_cprofile_runs_one_update_at_a_time(profile_dir, monkeypatch):
+    monkeypatch.setattr(main, "PROFILE_MODE", "cprofile")
+    monkeypatch.setattr(main, "PROFILE_SAMPLE_N", 1)
+    main.profiled_task(_busy, "message")(0.01)
+    (dump,) = [f for f in os.listdir(profile_dir) if f.endswith(".prof")]
+    assert dump.endswith("-unhandled.prof")
+    # профайлер занят другим апдейтом — этот выполняется без него
+    with main._cprofile_lock:
+        main.profiled_task(_busy, "message")(0.01)
+    assert len([f for f in os.listdir(profile_dir) if f.endswith(".prof")]) == 1
+    assert not main._cprofile_lock.locked()
+
+
+def test_api_calls_are_counted_only_inside_a_profiled_handler(profile_dir):
+    sender = main.count_api_calls(lambda method, url, **kw: url)
+    # вне обработчика — просто проксирует
+    assert sender("post", "https://api.telegram.org/botX/getMe") == "https://api.telegram.org/botX/getMe"
+    seen = []
+
+    def handler():
+        sender("post", "https://api.telegram.org/botX/sendMessage")
+        sender("post", "https://api.telegram.org/botX/answerCallbackQuery")
+        seen.extend(main._profile_local.stats["api_calls"])
+
+    main.profiled_task(handler, "message")()
+    assert [m for m, ms in seen] == ["sendMessage", "answerCallbackQuery"]
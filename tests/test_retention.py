@@ -0,0 +1,91 @@
+import pytest
+
+import main
+from conftest import make_channel, msg, post, submit
+
+DAY = 86400
+
+
+@pytest.fixture(autouse=True)
+def no_pause(monkeypatch):
+    monkeypatch.setattr(main.time, "sleep", lambda s: None)
+
+
+def _decide(sub_id, moderator, status="rejected", age_days=400):
+    assert main.transition_submission_status(sub_id, "pending", status, moderator)
+    main.save_control_messages(sub_id, [(moderator, 1)])
+    main.audit_log.flush()
+    main.cur.execute("UPDATE submissions SET created_at = created_at - ? WHERE id = ?", (age_days * DAY, sub_id))
+    main.db.commit()
+
+
+def _where(sub_id):
+    hot = main.cur.execute("SELECT COUNT(*) FROM submissions WHERE id = ?", (sub_id,)).fetchone()[0]
+    archived = main.cur.execute("SELECT COUNT(*) FROM archive.submissions_archive WHERE id = ?", (sub_id,)).fetchone()[0]
+    return {(1, 0): "hot", (0, 1): "archive"}[(hot, archived)]
+
+
+def test_old_decided_submissions_move_with_their_history():
+    dbid, owner, (mod,) = make_channel(mods=1)
+    old = submit(dbid, "old")
+    _decide(old, mod)
+    recent = submit(dbid, "recent")
+    _decide(recent, mod, age_days=1)
+    pending = submit(dbid, "pending")
+    main.cur.execute("UPDATE submissions SET created_at = created_at - ? WHERE id = ?", (400 * DAY, pending))
+    main.db.commit()
+    assert main.archive_channel_submissions(dbid, main.now_ts() - 180 * DAY, 100) == 1
+    assert (_where(old), _where(recent), _where(pending)) == ("archive", "hot", "hot")
+    assert main.cur.execute("SELECT action FROM archive.submission_actions_archive WHERE submission_id = ?", (old,)).fetchall() == [("rejected",)]
+    for table in ("submission_actions", "submission_messages", "submission_assignments"):
+        assert main.cur.execute(f"SELECT COUNT(*) FROM {table} WHERE submission_id = ?", (old,)).fetchone()[0] == 0
+    # повторный проход ничего не трогает
+    assert main.archive_channel_submissions(dbid, main.now_ts() - 180 * DAY, 100) == 0
+
+
+def test_archiving_runs_in_batches_within_the_budget(monkeypatch):
+    monkeypatch.setattr(main, "RETENTION_BATCH", 2)
+    dbid, owner, (mod,) = make_channel(mods=1)
+    ids = [submit(dbid, f"s{i}") for i in range(5)]
+    for sub_id in ids:
+        _decide(sub_id, mod)
+    commits = []
+    real_commit = main.db.commit
+    monkeypatch.setattr(main.db, "commit", lambda: (commits.append(1), real_commit()), raising=False)
+    assert main.archive_channel_submissions(dbid, main.now_ts() - DAY, 3) == 3
+    assert len(commits) == 2
+    assert [_where(i) for i in ids] == ["archive"] * 3 + ["hot"] * 2
+
+
+def test_sweep_uses_per_channel_retention():
+    keep, owner, (mod,) = make_channel(mods=1)
+    short, owner2, (mod2,) = make_channel(mods=1)
+    main.set_channel_setting(keep, "retention_days", "0")
+    main.set_channel_setting(short, "retention_days", "30")
+    kept = submit(keep, "kept")
+    _decide(kept, mod)
+    aged = submit(short, "aged")
+    _decide(aged, mod2, age_days=40)
+    young = submit(short, "young")
+    _decide(young, mod2, age_days=20)
+    main.sweep_retention()
+    assert (_where(kept), _where(aged), _where(young)) == ("hot", "archive", "hot")
+
+
+def test_submissions_of_removed_channels_use_the_default(monkeypatch):
+    dbid, owner, (mod,) = make_channel(mods=1)
+    sub_id = submit(dbid, "orphan")
+    _decide(sub_id, mod, age_days=main.RETENTION_DAYS + 1)
+    main.remove_channel(dbid)
+    main.sweep_retention()
+    assert _where(sub_id) == "archive"
+
+
+def test_only_the_owner_changes_retention(api, client):
+    dbid, owner, (mod,) = make_channel(mods=1)
+    post(client, msg(mod, f"/retention {dbid} 7"))
+    assert "Только владелец" in api.sent_to(mod)[-1]
+    post(client, msg(owner, f"/retention {dbid} 7"))
+    assert main.channel_retention_days(dbid) == 7
+    post(client, msg(owner, f"/retention {dbid}"))
+    assert "через 7 дн." in api.sent_to(owner)[-1]
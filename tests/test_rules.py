@@ -0,0 +1,106 @@
+import random
+
+import pytest
+import telebot
+
+import main
+from conftest import make_channel, msg, new_id, submit
+
+
+def _message(text):
+    return telebot.types.Message.de_json(msg(1, text)["message"])
+
+
+def _evaluate(dbid, text):
+    return main.evaluate_rules(dbid, _message(text), text)
+
+
+def _cards_to(api, uid):
+    return [t for t in api.sent_to(uid) if t and "Контроль заявки" in t]
+
+
+def test_automaton_finds_every_occurrence_like_a_naive_scan():
+    rnd = random.Random(7)
+    for _ in range(200):
+        words = {"".join(rnd.choice("abc") for _ in range(rnd.randint(1, 4))) for _ in range(rnd.randint(1, 6))}
+        text = "".join(rnd.choice("abc") for _ in range(rnd.randint(0, 30)))
+        expected = sorted((i + len(w) - 1, w) for w in words for i in range(len(text)) if text.startswith(w, i))
+        assert sorted(main.KeywordAutomaton([(w, w) for w in words]).search(text)) == expected
+
+
+def test_keywords_match_whole_words_case_insensitively():
+    rules = main.CompiledRules([(1, "keyword", "кот, Ёж", "flag")])
+    assert rules.match("text", "Мой КОТ спит", 0, 0) == {1}
+    assert rules.match("text", "ежик и котлета", 0, 0) == set()
+    assert rules.match("text", "тут ёж!", 0, 0) == {1}
+
+
+def test_regexes_with_and_without_a_literal():
+    rules = main.CompiledRules([(1, "regex", r"casino\d+", "reject"), (2, "regex", r"\d{3}-\d{2}", "flag")])
+    assert rules.guarded and 1 in rules.guarded
+    assert rules.match("text", "visit CASINO777 now", 0, 0) == {1}
+    assert rules.match("text", "casino today", 0, 0) == set()
+    assert rules.match("text", "call 123-45", 0, 0) == {2}
+
+
+def test_limits_and_content_types():
+    rules = main.CompiledRules([(1, "max_links", "1", "flag"), (2, "max_mentions", "0", "flag"), (3, "content_types", "text, photo", "reject")])
+    assert rules.match("text", "", 2, 0) == {1}
+    assert rules.match("text", "", 1, 1) == {2}
+    assert rules.match("video", "", 0, 0) == {3}
+
+
+@pytest.mark.parametrize("kind, action, pattern", [
+    ("nope", "flag", "x"),
+    ("keyword", "delete", "x"),
+    ("keyword", "route:abc", "x"),
+    ("keyword", "flag", ""),
+    ("regex", "flag", "("),
+    ("regex", "flag", "(?P<g>x)"),
+    ("max_links", "flag", "many"),
+])
+def test_invalid_rules_are_refused(kind, action, pattern):
+    assert main.validate_rule(kind, action, pattern)
+
+
+def test_reject_wins_over_route_and_flag():
+    dbid, owner, (mod,) = make_channel(mods=1)
+    main.add_channel_rule(dbid, "keyword", "акция", "flag", owner)
+    main.add_channel_rule(dbid, "keyword", "скидка", f"route:{mod}", owner)
+    assert _evaluate(dbid, "акция")[0] == "flag"
+    action, reasons, route_to = _evaluate(dbid, "акция и скидка")
+    assert (action, route_to) == ("route", mod)
+    main.add_channel_rule(dbid, "keyword", "казино", "reject", owner)
+    verdict = _evaluate(dbid, "акция, скидка, казино")
+    assert verdict[0] == "reject" and len(verdict[1]) == 3
+
+
+def test_rule_changes_reset_the_compiled_cache():
+    dbid, owner, mods = make_channel(mods=1)
+    assert _evaluate(dbid, "спам") is None
+    rule_id = main.add_channel_rule(dbid, "keyword", "спам", "reject", owner)
+    assert _evaluate(dbid, "спам")[0] == "reject"
+    main.remove_channel_rule(dbid, rule_id)
+    assert _evaluate(dbid, "спам") is None
+    # правка из другого воркера приходит инвалидацией
+    main.cur.execute("INSERT INTO channel_rules (channel_dbid, kind, pattern, action, added_by, created_at) VALUES (?, 'keyword', 'спам', 'flag', ?, 0)", (dbid, owner))
+    main.db.commit()
+    assert _evaluate(dbid, "спам") is None
+    main.dispatch_invalidation("channel_rules", str(dbid))
+    assert _evaluate(dbid, "спам")[0] == "flag"
+
+
+def test_rules_steer_submissions(api):
+    dbid, owner, mods = make_channel(mods=2)
+    main.add_channel_rule(dbid, "keyword", "казино", "reject", owner)
+    main.add_channel_rule(dbid, "keyword", "реклама", f"route:{mods[1]}", owner)
+    main.add_channel_rule(dbid, "max_links", "0", "flag", owner)
+    uid = new_id()
+    assert submit(dbid, "лучшее казино", uid) is None
+    assert any("правилам канала" in (t or "") for t in api.sent_to(uid))
+    submit(dbid, "реклама магазина")
+    assert _cards_to(api, mods[0]) == [] and len(_cards_to(api, mods[1])) == 1
+    api.clear()
+    submit(dbid, "смотрите https://example.com")
+    cards = _cards_to(api, mods[0])
+    assert len(cards) == 1 and "Сработали правила: max_links: 0" in cards[0]
@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+import main
+from conftest import cq, make_channel, msg, new_id, post, submit
+
+
+def _ids(rows):
+    return {r[0] for r in rows}
+
+
+@pytest.fixture
+def channel():
+    dbid, owner, (mod,) = make_channel(mods=1)
+    ids = {
+        "concert": submit(dbid, "Бесплатные концерты в парке по субботам"),
+        "market": submit(dbid, "Ярмарка в парке, вход свободный"),
+        "cat": submit(dbid, "Пропал кот, рыжий, отзывается на Барсик"),
+    }
+    return dbid, owner, mod, ids
+
+
+@pytest.mark.parametrize("fts", [True, False])
+def test_all_words_must_match_and_long_words_match_by_prefix(channel, monkeypatch, fts):
+    monkeypatch.setattr(main, "SEARCH_FTS", main.SEARCH_FTS and fts)
+    dbid, owner, mod, ids = channel
+    assert _ids(main.search_submissions([dbid], "парке", 10)) == {ids["concert"], ids["market"]}
+    assert _ids(main.search_submissions([dbid], "концерт парке", 10)) == {ids["concert"]}
+    assert _ids(main.search_submissions([dbid], "концерт ярмарка", 10)) == set()
+
+
+def test_short_words_match_exactly_with_fts(channel):
+    if not main.SEARCH_FTS:
+        pytest.skip("SQLite без FTS5")
+    dbid, owner, mod, ids = channel
+    assert _ids(main.search_submissions([dbid], "кот", 10)) == {ids["cat"]}
+    assert _ids(main.search_submissions([dbid], "ко", 10)) == set()
+
+
+def test_results_are_limited_to_the_given_channels(channel):
+    dbid, owner, mod, ids = channel
+    other, _, _ = make_channel(mods=1)
+    theirs = submit(other, "Ярмарка в парке")
+    assert theirs not in _ids(main.search_submissions([dbid], "ярмарка", 10))
+    assert _ids(main.search_submissions([dbid, other], "ярмарка", 10)) == {ids["market"], theirs}
+    assert main.search_submissions([], "ярмарка", 10) == []
+
+
+def test_query_syntax_is_not_passed_through(channel):
+    dbid, owner, mod, ids = channel
+    assert _ids(main.search_submissions([dbid], '"кот" OR NOT* (ярмарка', 10)) == set()
+    assert main.search_submissions([dbid], '" * ()', 10) == []
+
+
+def test_index_follows_edits_and_deletes(channel):
+    dbid, owner, mod, ids = channel
+    main.cur.execute("UPDATE submissions SET text_content = 'Нашёлся пёс' WHERE id = ?", (ids["cat"],))
+    main.cur.execute("DELETE FROM submissions WHERE id = ?", (ids["market"],))
+    main.db.commit()
+    assert _ids(main.search_submissions([dbid], "кот", 10)) == set()
+    assert _ids(main.search_submissions([dbid], "нашёлся", 10)) == {ids["cat"]}
+    assert _ids(main.search_submissions([dbid], "ярмарка", 10)) == set()
+
+
+def test_search_command_pages_through_results(api, client, monkeypatch):
+    monkeypatch.setattr(main, "SEARCH_PAGE_SIZE", 2)
+    dbid, owner, (mod,) = make_channel(mods=1)
+    found = sorted(submit(dbid, f"объявление номер {i}") for i in range(3))
+    assert post(client, msg(new_id(), f"/search {dbid} объявление")) == 200
+    assert "не модератор" in api.calls[-1][1]["text"]
+    api.clear()
+    post(client, msg(mod, f"/search {dbid} объявление"))
+    page = api.calls[-1][1]
+    assert sum(f"#{i}" in page["text"] for i in found) == 2
+    (button,) = json.loads(page["reply_markup"])["inline_keyboard"][0]
+    assert button["callback_data"] == f"search:{dbid}:2"
+    post(client, cq(mod, button["callback_data"], text=page["text"]))
+    (edited,) = [p for m, p in api.calls if m == "editMessageText"]
+    assert sum(f"#{i}" in edited["text"] for i in found) == 1
@@ -0,0 +1,69 @@
+import threading
+
+import pytest
+
+import main
+from conftest import cq, make_channel, post, submit
+
+
+def test_concurrent_transitions_have_exactly_one_winner():
+    dbid, owner, mods = make_channel()
+    sub_id = submit(dbid)
+    results = []
+    barrier = threading.Barrier(4)
+
+    def decide(to_status):
+        barrier.wait()
+        results.append((to_status, main.transition_submission_status(sub_id, "pending", to_status)))
+
+    threads = [threading.Thread(target=decide, args=(s,)) for s in ("accepted", "rejected", "accepted", "rejected")]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    winners = [s for s, won in results if won]
+    assert len(winners) == 1
+    assert main.get_submission(sub_id)[5] == winners[0]
+
+
+def test_second_moderator_sees_already_processed_and_control_messages_sync(api, client):
+    dbid, owner, mods = make_channel()
+    sub_id = submit(dbid)
+    post(client, cq(mods[0], f"reject:{sub_id}"))
+    api.calls.clear()
+    post(client, cq(mods[1], f"accept:{sub_id}"))
+    assert main.get_submission(sub_id)[5] == "rejected"
+    assert any("уже обработана" in (t or "") for t in api.sent_to(mods[1]))
+    # кнопки у всех модераторов убраны одним проходом при первом решении
+    assert main.pop_control_messages(sub_id) == []
+
+
+def test_db_error_is_raised_and_keeps_other_uncommitted_writes(monkeypatch):
+    dbid, owner, mods = make_channel()
+    sub_id = submit(dbid)
+    other_id = submit(dbid, "other")
+    main.cur.execute("UPDATE submissions SET text_content = 'edited' WHERE id = ?", (other_id,))
+
+    def boom(*args):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(main, "record_status_change", boom)
+    with pytest.raises(RuntimeError):
+        main.transition_submission_status(sub_id, "pending", "accepted")
+    main.db.commit()
+    assert main.get_submission(sub_id)[5] == "pending"
+    assert main.cur.execute("SELECT text_content FROM submissions WHERE id = ?", (other_id,)).fetchone()[0] == "edited"
+
+
+def test_failed_publish_can_be_retried(api, client):
+    dbid, owner, mods = make_channel()
+    sub_id = submit(dbid)
+    api.fail["sendMessage"] = lambda p: (main.telebot.apihelper.ApiTelegramException(
+        "sendMessage", None, {"error_code": 403, "description": "Forbidden"}) if str(p.get("chat_id")).startswith("@") else None)
+    post(client, cq(mods[0], f"accept:{sub_id}"))
+    assert main.get_submission(sub_id)[5] == "accepted"
+    retry = [p for m, p in api.calls if m == "sendMessage" and "republish" in str(p.get("reply_markup"))]
+    assert retry
+    api.fail.clear()
+    post(client, cq(mods[0], f"republish:{sub_id}"))
+    assert main.get_submission(sub_id)[5] == "published"
@@ -0,0 +1,72 @@
+import random
+import threading
+import time
+
+import pytest
+import telebot
+
+import main
+from conftest import msg, new_id
+
+
+def _updates(data):
+    return [telebot.types.Update.de_json(d) for d in data]
+
+
+def test_batch_prefetches_states_and_writes_update_the_context(monkeypatch):
+    users = [new_id(), new_id()]
+    main.set_state(users[0], "some_state")
+    with main.use_tenant(main.default_bot):
+        ctx = main.prefetch_batch(_updates([msg(u, "hi") for u in users]))
+        with main.use_prefetch(ctx):
+            queries = []
+            monkeypatch.setattr(main.cur, "execute", lambda *a: queries.append(a))
+            assert main.get_state(users[0]) == "some_state"
+            assert main.get_state(users[1]) is None
+            assert queries == []
+            monkeypatch.undo()
+            main.set_state(users[1], "next")
+            assert main.get_state(users[1]) == "next"
+
+
+def test_single_update_skips_prefetch():
+    with main.use_tenant(main.default_bot):
+        ctx = main.prefetch_batch(_updates([msg(new_id(), "hi")]))
+    assert ctx.states == {}
+
+
+@pytest.fixture
+def ordered_handler(monkeypatch):
+    b = main.default_bot
+    seen = []
+
+    def handler(m):
+        time.sleep(random.random() * 0.01)
+        n = int(m.text[5:])
+        # состояние, записанное обработчиком предыдущего апдейта того же пользователя, уже видно
+        seen.append((m.from_user.id, n, main.get_state(m.from_user.id)))
+        main.set_state(m.from_user.id, str(n))
+
+    monkeypatch.setattr(b, "message_handlers", [b._build_handler_dict(handler, func=lambda m: (m.text or "").startswith("order"))] + b.message_handlers)
+    pool = telebot.util.ThreadPool(b, num_threads=8)
+    monkeypatch.setattr(b, "threaded", True)
+    monkeypatch.setattr(b, "worker_pool", pool)
+    yield seen
+    pool.close()
+
+
+def test_batch_keeps_per_user_order_on_the_thread_pool(ordered_handler):
+    users = [new_id() for _ in range(4)]
+    data = []
+    for n in range(1, 11):
+        for u in users:
+            data.append(msg(u, f"order{n}"))
+    main.process_update_batch(_updates(data), main.default_bot)
+    deadline = time.monotonic() + 10
+    while len(ordered_handler) < len(data) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(ordered_handler) == len(data)
+    for u in users:
+        mine = [(n, prev) for uid, n, prev in ordered_handler if uid == u]
+        assert [n for n, _ in mine] == list(range(1, 11))
+        assert [prev for _, prev in mine] == [None] + [str(n) for n in range(1, 10)]
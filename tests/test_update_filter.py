@@ -0,0 +1,54 @@
+import json
+
+import pytest
+import telebot
+
+import main
+from conftest import cq, msg, new_id, post
+
+
+@pytest.mark.parametrize("data, relevant", [
+    (msg(1, "hello"), True),
+    (msg(1, "/start"), True),
+    (cq(1, "menu_help"), True),
+    (msg(1, "/help", chat_type="group"), True),
+    (msg(1, "just chatting", chat_type="group"), False),
+    ({"update_id": 1, "edited_message": msg(1, "x")["message"]}, False),
+    ({"update_id": 1, "channel_post": msg(1, "x")["message"]}, False),
+    ({"update_id": 1, "my_chat_member": {}}, False),
+])
+def test_update_is_relevant(data, relevant):
+    assert main.update_is_relevant(data) is relevant
+
+
+def test_decode_update_accepts_bytes_and_str():
+    data = msg(1, "привет")
+    raw = json.dumps(data, ensure_ascii=False)
+    assert main.decode_update(raw.encode()) == data
+    assert main.decode_update(raw) == data
+
+
+def test_irrelevant_update_is_dropped_before_building_objects(monkeypatch):
+    built = []
+    monkeypatch.setattr(telebot.types.Update, "de_json", lambda d: built.append(d))
+    before = main.METRICS.get("updates_filtered", 0)
+    assert main.admit_update(msg(1, "chatter", chat_type="supergroup")) is None
+    assert built == []
+    assert main.METRICS.get("updates_filtered", 0) == before + 1
+
+
+def test_relevant_update_is_built():
+    update = main.admit_update(msg(7, "/start"))
+    assert isinstance(update, telebot.types.Update)
+    assert update.message.text == "/start"
+
+
+def test_webhook_acknowledges_filtered_updates_without_api_calls(api, client):
+    uid = new_id()
+    edited = {"update_id": new_id(), "edited_message": msg(uid, "/start")["message"]}
+    assert post(client, edited) == 200
+    assert post(client, msg(uid, "chatter", chat_type="group")) == 200
+    assert api.calls == []
+    assert post(client, msg(uid, "/start")) == 200
+    assert api.sent_to(uid)
+
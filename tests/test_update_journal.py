@@ -0,0 +1,113 @@
+import json
+import os
+import shutil
+import threading
+
+import pytest
+
+import main
+from conftest import msg, new_id, post
+
+
+@pytest.fixture
+def journal(tmp_path):
+    j = main.UpdateJournal(str(tmp_path / "journal"))
+    yield j
+    j.close()
+
+
+def _segments(j):
+    return sorted(os.path.join(j.directory, f) for f in os.listdir(j.directory))
+
+
+def _read(paths):
+    return [(ts, bot_id, data["update_id"]) for ts, bot_id, data in main.iter_journal(paths)]
+
+
+def test_updates_are_read_back_as_written(journal):
+    raw = json.dumps({"update_id": 1, "message": {"text": "две\nстроки"}}, indent=1)
+    journal.append(raw, 42, now=1000.0)
+    journal.append(b'{"update_id": 2}', 43, now=1000.5)
+    journal.close()
+    (segment,) = _segments(journal)
+    assert _read([segment]) == [(1000.0, 42, 1), (1000.5, 43, 2)]
+    ((_, _, data), _) = main.iter_journal([journal.directory])
+    assert data["message"]["text"] == "две\nстроки"
+
+
+def test_segments_rotate_by_size_and_time_and_old_ones_are_pruned(journal, monkeypatch):
+    monkeypatch.setattr(main, "UPDATE_JOURNAL_SEGMENT_BYTES", 100)
+    monkeypatch.setattr(main, "UPDATE_JOURNAL_SEGMENT_SECONDS", 60)
+    monkeypatch.setattr(main, "UPDATE_JOURNAL_KEEP", 2)
+    journal.append(json.dumps({"update_id": 1, "pad": "x" * 100}), 1, now=1000.0)
+    # сегмент переполнен — следующий апдейт идёт в новый
+    journal.append(json.dumps({"update_id": 2}), 1, now=1001.0)
+    assert len(_segments(journal)) == 2
+    journal.append(json.dumps({"update_id": 3}), 1, now=1001.5)
+    assert len(_segments(journal)) == 2
+    # прошла минута — ротация по времени, самый старый сегмент удалён
+    journal.append(json.dumps({"update_id": 4}), 1, now=1100.0)
+    journal.close()
+    assert [u for _, _, u in _read(_segments(journal))] == [2, 3, 4]
+
+
+def test_segment_of_a_crashed_process_is_readable_up_to_the_last_flush(journal, tmp_path):
+    journal.append(b'{"update_id": 1}', 1, now=1000.0)
+    journal.append(b'{"update_id": 2}', 1, now=1000.2)
+    journal.append(b'{"update_id": 3}', 1, now=1001.5)
+    # копия сегмента без завершающего gzip-трейлера — как после падения процесса
+    (segment,) = _segments(journal)
+    crashed = str(tmp_path / "crashed.jsonl.gz")
+    shutil.copy(segment, crashed)
+    assert [u for _, _, u in _read([crashed])] == [1, 2, 3]
+
+
+def test_segments_of_several_workers_are_merged_by_time(tmp_path):
+    first, second = main.UpdateJournal(str(tmp_path)), main.UpdateJournal(str(tmp_path))
+    second._seq = 100
+    for j, times in ((first, (1.0, 3.0, 5.0)), (second, (2.0, 4.0))):
+        for ts in times:
+            j.append(json.dumps({"update_id": int(ts)}), 1, now=1000 + ts)
+        j.close()
+    assert [u for _, _, u in _read([str(tmp_path)])] == [1, 2, 3, 4, 5]
+
+
+def test_webhook_journals_every_update_and_survives_journal_errors(client, journal, monkeypatch):
+    monkeypatch.setattr(main, "update_journal", journal)
+    uid = new_id()
+    post(client, msg(uid, "/start"))
+    journal.close()
+    ((_, bot_id, data),) = main.iter_journal([journal.directory])
+    assert (bot_id, data["message"]["from"]["id"]) == (main.DEFAULT_BOT_ID, uid)
+
+    def broken(raw, bot_id, now=None):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(journal, "append", broken)
+    errors = main.METRICS.get("journal_errors", 0)
+    assert post(client, msg(uid, "/start")) == 200
+    assert main.METRICS["journal_errors"] == errors + 1
+
+
+def test_replay_runs_the_journal_through_the_handlers(api, journal):
+    users = [new_id() for _ in range(3)]
+    for i, uid in enumerate(users):
+        journal.append(json.dumps(msg(uid, "/start")), main.DEFAULT_BOT_ID, now=1000.0 + i)
+    journal.close()
+    report = main.replay_journal([journal.directory])
+    assert (report["updates"], report["update_types"]) == (3, {"message": 3})
+    assert all(api.sent_to(uid) for uid in users)
+    assert report["latency_ms"]["max"] >= report["latency_ms"]["p50"]
+
+
+def test_replay_scales_the_original_pace_by_speed(api, journal, monkeypatch):
+    sleeps = []
+    real_sleep = main.time.sleep
+    # фоновые потоки (сэмплер профайлера и т.п.) спят как обычно
+    me = threading.get_ident()
+    monkeypatch.setattr(main.time, "sleep", lambda s: sleeps.append(s) if threading.get_ident() == me else real_sleep(s))
+    journal.append(json.dumps(msg(new_id(), "/start")), main.DEFAULT_BOT_ID, now=1000.0)
+    journal.append(json.dumps(msg(new_id(), "/start")), main.DEFAULT_BOT_ID, now=1030.0)
+    journal.close()
+    main.replay_journal([journal.directory], speed=2)
+    assert len(sleeps) == 1 and 14 < sleeps[0] <= 15